@@ -932,6 +932,22 @@ class ContainerBroker(DatabaseBroker):
                         protocol=PICKLE_PROTOCOL).encode('base64'))
                     fp.flush()
 
+    def put_objects(self, item_list):
+        """
+        Merges a batch of objects into the DB in a single transaction, along
+        with any still pending.
+
+        :param item_list: list of dictionaries of {'name', 'created_at',
+                          'size', 'content_type', 'etag', 'deleted'}
+        """
+        if self.db_file != ':memory:' and not os.path.exists(self.db_file):
+            raise DatabaseConnectionError(self.db_file, "DB doesn't exist")
+        if self.db_file == ':memory:' or \
+                not os.path.exists(self.pending_file):
+            self.merge_items(item_list)
+        else:
+            self._commit_puts(item_list)
+
     def is_deleted(self, timestamp=None):
         """
         Check if the DB is considered to be deleted.
@@ -121,6 +121,30 @@ class ReconMiddleware(object):
         return self._from_recon_cache(['async_pending'],
                                       self.object_recon_cache)
 
+    def get_device_load(self):
+        """
+        get the load of the object server's devices, summed over its live
+        workers
+        """
+        workers = self._from_recon_cache(['object_server_device_load'],
+                                         self.object_recon_cache)
+        workers = workers['object_server_device_load'] or {}
+        device_load = {}
+        for pid, worker in workers.iteritems():
+            try:
+                os.kill(int(pid), 0)
+            except OSError as err:
+                if err.errno == errno.ESRCH:
+                    continue
+            for device, stats in worker['devices'].iteritems():
+                load = device_load.setdefault(device, {
+                    'in_flight': 0, 'latency': 0.0, 'requests': 0,
+                    'rejected': 0})
+                for key in ('in_flight', 'requests', 'rejected'):
+                    load[key] += stats[key]
+                load['latency'] = max(load['latency'], stats['latency'])
+        return device_load
+
     def get_replication_info(self, recon_type):
         """get replication info"""
         if recon_type == 'account':
@@ -135,7 +159,9 @@ class ReconMiddleware(object):
                                           self.container_recon_cache)
         elif recon_type == 'object':
             return self._from_recon_cache(['object_replication_time',
-                                           'object_replication_last'],
+                                           'object_replication_last',
+                                           'object_replication_queue',
+                                           'object_replication_limits'],
                                           self.object_recon_cache)
         else:
             return None
@@ -312,6 +338,8 @@ class ReconMiddleware(object):
             content = self.get_quarantine_count()
         elif rcheck == "sockstat":
             content = self.get_socket_info()
+        elif rcheck == "deviceload":
+            content = self.get_device_load()
         elif rcheck == "version":
             content = self.get_version()
         else:
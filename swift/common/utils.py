@@ -74,6 +74,8 @@ SysLogHandler.priority_map['NOTICE'] = 'notice'
 
 # These are lazily pulled from libc elsewhere
 _sys_fallocate = None
+_sys_syncfs = None
+_sys_sendfile = None
 _posix_fadvise = None
 
 # If set to non-zero, fallocate routines will fail based on free space
@@ -391,6 +393,69 @@ def fsync(fd):
         os.fsync(fd)
 
 
+def fsync_dir(dirpath):
+    """
+    Sync the entries of a directory to disk, e.g. to make a rename into it
+    durable.
+
+    :param dirpath: path to the directory
+    """
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(fd):
+    """
+    Sync all modified data and metadata of the filesystem containing the
+    given file descriptor.
+
+    :param fd: file descriptor
+    :raises OSError: if syncfs(2) fails or is not available (ENOSYS)
+    """
+    global _sys_syncfs
+    if _sys_syncfs is None:
+        _sys_syncfs = load_libc_function('syncfs', log_error=False)
+    if _sys_syncfs is noop_libc_function:
+        raise OSError(errno.ENOSYS, 'syncfs is not available')
+    if _sys_syncfs(fd) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, 'Unable to syncfs(%s)' % fd)
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Copy up to count bytes from in_fd, starting at offset, to out_fd without
+    passing the data through user space.
+
+    :param out_fd: file descriptor to write to, usually a socket
+    :param in_fd: file descriptor to read from
+    :param offset: position in in_fd to start reading from
+    :param count: maximum number of bytes to copy
+    :returns: number of bytes copied; 0 means in_fd is at EOF
+    :raises OSError: if sendfile(2) fails (EAGAIN when a non-blocking out_fd
+                     is full) or is not available (ENOSYS)
+    """
+    global _sys_sendfile
+    if _sys_sendfile is None:
+        _sys_sendfile = load_libc_function('sendfile64', log_error=False)
+        if _sys_sendfile is not noop_libc_function:
+            _sys_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64),
+                                      ctypes.c_size_t]
+            _sys_sendfile.restype = ctypes.c_ssize_t
+    if _sys_sendfile is noop_libc_function:
+        raise OSError(errno.ENOSYS, 'sendfile is not available')
+    sent = _sys_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                         count)
+    if sent < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, 'Unable to sendfile(%s, %s)' % (out_fd, in_fd))
+    return sent
+
+
 def fdatasync(fd):
     """
     Sync modified file data to disk.
@@ -403,6 +468,17 @@ def fdatasync(fd):
         fsync(fd)
 
 
+def _fadvise(fd, offset, length, advice):
+    global _posix_fadvise
+    if _posix_fadvise is None:
+        _posix_fadvise = load_libc_function('posix_fadvise64')
+    ret = _posix_fadvise(fd, ctypes.c_uint64(offset),
+                         ctypes.c_uint64(length), advice)
+    if ret != 0:
+        logging.warn("posix_fadvise64(%s, %s, %s, %s) -> %s"
+                     % (fd, offset, length, advice, ret))
+
+
 def drop_buffer_cache(fd, offset, length):
     """
     Drop 'buffer' cache for the given range of the given file.
@@ -411,15 +487,21 @@ def drop_buffer_cache(fd, offset, length):
     :param offset: start offset
     :param length: length
     """
-    global _posix_fadvise
-    if _posix_fadvise is None:
-        _posix_fadvise = load_libc_function('posix_fadvise64')
     # 4 means "POSIX_FADV_DONTNEED"
-    ret = _posix_fadvise(fd, ctypes.c_uint64(offset),
-                         ctypes.c_uint64(length), 4)
-    if ret != 0:
-        logging.warn("posix_fadvise64(%s, %s, %s, 4) -> %s"
-                     % (fd, offset, length, ret))
+    _fadvise(fd, offset, length, 4)
+
+
+def advise_sequential(fd, offset=0, length=0):
+    """
+    Tell the kernel the given range of the given file is about to be read
+    sequentially, so it reads further ahead.
+
+    :param fd: file descriptor
+    :param offset: start offset
+    :param length: length; 0 for up to the end of the file
+    """
+    # 2 means "POSIX_FADV_SEQUENTIAL"
+    _fadvise(fd, offset, length, 2)
 
 
 def normalize_timestamp(timestamp):
@@ -1793,13 +1875,41 @@ def human_readable(value):
     return '%d%si' % (round(value), suffixes[index])
 
 
-def dump_recon_cache(cache_dict, cache_file, logger, lock_timeout=2):
+def put_recon_cache_entry(cache_entry, key, item):
+    """
+    Updates a recon cache entry item.
+
+    If item is a dict, it is merged into any dict already cached under key,
+    and any of its keys whose value is an empty dict is removed from it.
+    Other items replace what is cached under key.
+
+    :param cache_entry: dict of the recon cache
+    :param key: key of the item
+    :param item: new value of the item
+    """
+    if isinstance(item, dict):
+        current = cache_entry.get(key)
+        if not isinstance(current, dict):
+            current = cache_entry[key] = {}
+        for item_key, value in item.items():
+            if value == {}:
+                current.pop(item_key, None)
+            else:
+                current[item_key] = value
+    else:
+        cache_entry[key] = item
+
+
+def dump_recon_cache(cache_dict, cache_file, logger, lock_timeout=2,
+                     merge=False):
     """Update recon cache values
 
     :param cache_dict: Dictionary of cache key/value pairs to write out
     :param cache_file: cache file to update
     :param logger: the logger to use to log an encountered error
     :param lock_timeout: timeout (in seconds)
+    :param merge: merge dict values into those already cached, as
+                  put_recon_cache_entry does, rather than replace them
     """
     try:
         with lock_file(cache_file, lock_timeout, unlink=False) as cf:
@@ -1812,7 +1922,10 @@ def dump_recon_cache(cache_dict, cache_file, logger, lock_timeout=2):
                 #file doesn't have a valid entry, we'll recreate it
                 pass
             for cache_key, cache_value in cache_dict.items():
-                cache_entry[cache_key] = cache_value
+                if merge:
+                    put_recon_cache_entry(cache_entry, cache_key, cache_value)
+                else:
+                    cache_entry[cache_key] = cache_value
             try:
                 with NamedTemporaryFile(dir=os.path.dirname(cache_file),
                                         delete=False) as tf:
@@ -2189,6 +2302,171 @@ class ThreadPool(object):
             return self.run_in_thread(func, *args, **kwargs)
 
 
+class LRUCache(object):
+    """
+    Bounded mapping that forgets its least recently used keys once it holds
+    more than max_size of them.
+
+    Lookups and updates are O(1). There is no locking; this is meant for
+    per-worker caches used from greenthreads.
+
+    :param max_size: maximum number of keys to hold
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._links = {}
+        # Circular doubly linked list of [prev, next, key, value] links,
+        # least recently used first; the root link is a sentinel.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = link
+        self._root[0] = link
+
+    def get(self, key, default=None):
+        """
+        Returns the value for key, marking it most recently used, or default
+        if key is not cached.
+        """
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def set(self, key, value):
+        """
+        Sets the value for key, evicting the least recently used keys if the
+        cache is now over max_size.
+        """
+        link = self._links.get(key)
+        if link is None:
+            link = self._links[key] = [None, None, key, value]
+        else:
+            self._unlink(link)
+            link[3] = value
+        self._append(link)
+        while len(self._links) > self.max_size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+
+    def oldest(self):
+        """
+        Returns the least recently used (key, value), without marking it
+        used, or None if the cache is empty.
+        """
+        if not self._links:
+            return None
+        return tuple(self._root[1][2:])
+
+    def pop(self, key, default=None):
+        """
+        Removes key and returns its value, or default if key is not cached.
+        """
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        """Removes all keys."""
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+
+class FsyncBatcher(object):
+    """
+    Group commit for fsync(): callers syncing files on the same filesystem
+    within ``window`` seconds of each other share a single syncfs() call.
+
+    The first caller to arrive opens a batch and sleeps for the window, then
+    closes the batch and syncs the whole filesystem; everyone who joined the
+    batch meanwhile is released once that sync has completed, so no caller
+    returns before its own data is durable.
+
+    sync() blocks the calling OS thread, so it must only be called from
+    worker threads (e.g. via ThreadPool.force_run_in_thread), never from the
+    eventlet hub. Batches are therefore bounded by the number of threads
+    available to run sync() concurrently.
+
+    If window is 0, or syncfs() is not available on this platform, each
+    caller simply fsync()s its own file descriptor.
+
+    Batching only helps where an fsync takes longer than the window; where
+    fsyncs are fast every caller is merely delayed by the window, and fewer
+    writes complete per second than without batching.
+
+    :param window: seconds a batch stays open to collect other callers
+    """
+
+    def __init__(self, window=0):
+        self.window = window
+        self.batches = 0
+        self.synced = 0
+        self._cond = stdlib_threading.Condition()
+        self._open_batch = None
+
+    def sync(self, fd):
+        """
+        Make the data and metadata written to fd durable.
+
+        :param fd: file descriptor
+        :raises OSError: if the sync fails
+        """
+        if self.window <= 0:
+            fsync(fd)
+            return
+        with self._cond:
+            batch = self._open_batch
+            leader = batch is None
+            if leader:
+                batch = self._open_batch = {'done': False, 'error': None}
+        if leader:
+            time.sleep(self.window)
+            with self._cond:
+                self._open_batch = None
+            try:
+                syncfs(fd)
+            except OSError as err:
+                batch['error'] = err
+            with self._cond:
+                batch['done'] = True
+                self.batches += 1
+                self._cond.notify_all()
+        else:
+            with self._cond:
+                while not batch['done']:
+                    self._cond.wait()
+        err = batch['error']
+        if err is None:
+            with self._cond:
+                self.synced += 1
+        elif err.errno == errno.ENOSYS:
+            # No syncfs() here; stop batching and fall back to fsync().
+            self.window = 0
+            fsync(fd)
+        else:
+            raise err
+
+
 def ismount(path):
     """
     Test whether a path is a mount point.
@@ -27,15 +27,18 @@ from StringIO import StringIO
 import eventlet
 import eventlet.debug
 from eventlet import greenio, GreenPool, sleep, wsgi, listen
+from eventlet.hubs import trampoline
 from paste.deploy import loadwsgi
 from eventlet.green import socket, ssl
 from urllib import unquote
 
 from swift.common import utils
+from swift.common.ring import Ring
 from swift.common.swob import Request
 from swift.common.utils import capture_stdio, disable_fallocate, \
     drop_privileges, get_logger, NullLogger, config_true_value, \
-    validate_configuration, get_hub, config_auto_int_value
+    validate_configuration, get_hub, config_auto_int_value, sendfile, \
+    whataremyips
 
 try:
     import multiprocessing
@@ -180,6 +183,32 @@ def get_socket(conf, default_port=8080):
     return sock
 
 
+def get_device_ports(conf, ring_name):
+    """
+    Returns the ports the devices of this node listen on, according to a
+    ring. A server with replication_server set to true listens on the
+    devices' replication ports.
+
+    :param conf: Configuration dict to read swift_dir, bind_ip and
+                 replication_server from
+    :param ring_name: name of the ring, e.g. 'object'
+    :returns: sorted list of ports
+    """
+    devices = Ring(conf.get('swift_dir', '/etc/swift'),
+                   ring_name=ring_name).devs
+    bind_ip = conf.get('bind_ip', '0.0.0.0')
+    if bind_ip in ('0.0.0.0', '::'):
+        my_ips = whataremyips()
+    else:
+        my_ips = [bind_ip]
+    if config_true_value(conf.get('replication_server', 'false')):
+        ip_key, port_key = 'replication_ip', 'replication_port'
+    else:
+        ip_key, port_key = 'ip', 'port'
+    return sorted(set(dev[port_key] for dev in devices
+                      if dev and dev[ip_key] in my_ips))
+
+
 class RestrictedGreenPool(GreenPool):
     """
     Works the same as GreenPool, but if the size is specified as one, then the
@@ -196,6 +225,67 @@ class RestrictedGreenPool(GreenPool):
             self.waitall()
 
 
+class SwiftHttpProtocol(wsgi.HttpProtocol):
+    """
+    HttpProtocol that lets applications send file data straight to the
+    client socket.
+
+    For plain (non-SSL) connections the WSGI environment gets a
+    ``swift.sendfile`` callable; see :meth:`sendfile`.
+    """
+
+    def get_environ(self):
+        env = wsgi.HttpProtocol.get_environ(self)
+        if env.get('wsgi.url_scheme') != 'https':
+            env['swift.sendfile'] = self.sendfile
+        return env
+
+    def sendfile(self, fd, offset, length, run_in_thread=None):
+        """
+        Copy length bytes of fd, starting at offset, to the client socket
+        with sendfile(2), waiting on the hub whenever the socket is full.
+
+        The response headers must already have been written, which means
+        the caller's app_iter has to have yielded at least once and the
+        server must not be holding yielded data back (see the
+        eventlet.minimum_write_chunk_size environment key).
+
+        :param fd: file descriptor to send from
+        :param offset: position in fd to start at
+        :param length: number of bytes to send
+        :param run_in_thread: optional callable used to make the sendfile(2)
+                              calls, e.g. ThreadPool.run_in_thread, so disk
+                              reads do not block the hub
+        :returns: number of bytes sent, less than length if fd hit EOF, in
+                  which case the connection is closed after the response,
+                  as the client was promised length bytes
+        """
+        self.wfile.flush()
+        sock_fd = self.connection.fileno()
+        total = 0
+        while total < length:
+            try:
+                if run_in_thread:
+                    sent = run_in_thread(sendfile, sock_fd, fd,
+                                         offset + total, length - total)
+                else:
+                    sent = sendfile(sock_fd, fd, offset + total,
+                                    length - total)
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+                trampoline(sock_fd, write=True,
+                           timeout=getattr(wsgi, 'WRITE_TIMEOUT', None),
+                           timeout_exc=socket.timeout('timed out'))
+                continue
+            if not sent:
+                break
+            total += sent
+        if total < length:
+            self.close_connection = 1
+        return total
+
+
 def run_server(conf, logger, sock):
     # Ensure TZ environment variable exists to avoid stat('/etc/localtime') on
     # some platforms. This locks in reported times to the timezone in which
@@ -224,7 +314,8 @@ def run_server(conf, logger, sock):
     max_clients = int(conf.get('max_clients', '1024'))
     pool = RestrictedGreenPool(size=max_clients)
     try:
-        wsgi.server(sock, app, NullLogger(), custom_pool=pool)
+        wsgi.server(sock, app, NullLogger(), custom_pool=pool,
+                    protocol=SwiftHttpProtocol)
     except socket.error, err:
         if err[0] != errno.EINVAL:
             raise
@@ -247,8 +338,27 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
         print e
         return
 
-    # bind to address and port
-    sock = get_socket(conf, default_port=kwargs.get('default_port', 8080))
+    # bind to address and port: a single socket shared by all workers, or
+    # with servers_per_port, a socket per port of this node's devices in the
+    # ring, each with workers of its own
+    servers_per_port = int(conf.get('servers_per_port', 0))
+    if servers_per_port > 0:
+        try:
+            ports = get_device_ports(conf, app_section.split('-')[0])
+        except (IOError, OSError), e:
+            print _('Error loading ring for servers_per_port: %s') % e
+            return
+        if not ports:
+            print _('servers_per_port is set, but no devices in the ring '
+                    'are on this node')
+            return
+        socks = [(get_socket(dict(conf, bind_port=port)), servers_per_port)
+                 for port in ports]
+        worker_count = servers_per_port * len(socks)
+    else:
+        worker_count = config_auto_int_value(conf.get('workers'), CPU_COUNT)
+        sock = get_socket(conf, default_port=kwargs.get('default_port', 8080))
+        socks = [(sock, worker_count)]
     # remaining tasks should not require elevated privileges
     drop_privileges(conf.get('user', 'swift'))
 
@@ -262,8 +372,6 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
     # redirect errors to logger and close stdio
     capture_stdio(logger)
 
-    worker_count = config_auto_int_value(conf.get('workers'), CPU_COUNT)
-
     # Useful for profiling [no forks].
     if worker_count == 0:
         run_server(conf, logger, sock)
@@ -285,32 +393,38 @@ def run_wsgi(conf_path, app_section, *args, **kwargs):
     running = [True]
     signal.signal(signal.SIGTERM, kill_children)
     signal.signal(signal.SIGHUP, hup)
-    children = []
+    # pid -> the socket the child serves
+    children = {}
     while running[0]:
-        while len(children) < worker_count:
-            pid = os.fork()
-            if pid == 0:
-                signal.signal(signal.SIGHUP, signal.SIG_DFL)
-                signal.signal(signal.SIGTERM, signal.SIG_DFL)
-                run_server(conf, logger, sock)
-                logger.notice('Child %d exiting normally' % os.getpid())
-                return
-            else:
-                logger.notice('Started child %s' % pid)
-                children.append(pid)
+        for sock, sock_workers in socks:
+            while children.values().count(sock) < sock_workers:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    for other_sock, _junk in socks:
+                        if other_sock is not sock:
+                            other_sock.close()
+                    run_server(conf, logger, sock)
+                    logger.notice('Child %d exiting normally' % os.getpid())
+                    return
+                else:
+                    logger.notice('Started child %s' % pid)
+                    children[pid] = sock
         try:
             pid, status = os.wait()
             if os.WIFEXITED(status) or os.WIFSIGNALED(status):
                 logger.error('Removing dead child %s' % pid)
-                children.remove(pid)
+                children.pop(pid, None)
         except OSError, err:
             if err.errno not in (errno.EINTR, errno.ECHILD):
                 raise
         except KeyboardInterrupt:
             logger.notice('User quit')
             break
-    greenio.shutdown_safe(sock)
-    sock.close()
+    for sock, _junk in socks:
+        greenio.shutdown_safe(sock)
+        sock.close()
     logger.notice('Exited')
 
 
@@ -32,7 +32,8 @@ from swift.common.utils import get_logger, hash_path, public, \
     normalize_timestamp, storage_directory, validate_sync_to, \
     config_true_value, json, timing_stats, replication, parse_content_type
 from swift.common.constraints import CONTAINER_LISTING_LIMIT, \
-    check_mount, check_float, check_utf8
+    MAX_HEADER_SIZE, MAX_OBJECT_NAME_LENGTH, check_mount, check_float, \
+    check_utf8
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
 from swift.common.db_replicator import ReplicatorRpc
@@ -40,9 +41,14 @@ from swift.common.http import HTTP_NOT_FOUND, is_success
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPConflict, \
     HTTPCreated, HTTPInternalServerError, HTTPNoContent, HTTPNotFound, \
     HTTPPreconditionFailed, HTTPMethodNotAllowed, Request, Response, \
-    HTTPInsufficientStorage, HTTPException, HeaderKeyDict
+    HTTPInsufficientStorage, HTTPException, HeaderKeyDict, \
+    HTTPRequestEntityTooLarge, HTTPLengthRequired
 
 DATADIR = 'containers'
+# Most bytes an object row of a MERGE request can take: JSON escaping may
+# spend six characters on a byte of the name or content type, and the other
+# fields are short.
+MAX_MERGE_ROW_SIZE = 6 * (MAX_OBJECT_NAME_LENGTH + MAX_HEADER_SIZE) + 256
 
 
 class ContainerController(object):
@@ -75,6 +81,7 @@ class ContainerController(object):
             self.save_headers.append('x-versions-location')
         swift.common.db.DB_PREALLOCATION = \
             config_true_value(conf.get('db_preallocation', 'f'))
+        self.max_merge_rows = int(conf.get('max_merge_rows', 10000))
 
     def _get_container_broker(self, drive, part, account, container, **kwargs):
         """
@@ -282,6 +289,83 @@ class ContainerController(object):
             else:
                 return HTTPAccepted(request=req)
 
+    def _merge_item(self, row):
+        """
+        Turns an object row of a MERGE request into an item for the broker.
+
+        :param row: dictionary of 'name' and 'created_at', and either
+                    'deleted' set or 'size', 'content_type' and 'etag'
+        :returns: dictionary of {'name', 'created_at', 'size',
+                  'content_type', 'etag', 'deleted'}
+        :raises ValueError: if the row is malformed
+        """
+        try:
+            name = row['name']
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if not name or not check_utf8(name) or \
+                    not check_float(row['created_at']):
+                raise ValueError('Invalid object row')
+            item = {'name': name,
+                    'created_at': normalize_timestamp(row['created_at'])}
+            if row.get('deleted'):
+                item.update(size=0, content_type='application/deleted',
+                            etag='noetag', deleted=1)
+            else:
+                content_type = row['content_type']
+                if isinstance(content_type, unicode):
+                    content_type = content_type.encode('utf-8')
+                item.update(size=int(row['size']),
+                            content_type=content_type,
+                            etag=str(row['etag']), deleted=0)
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Invalid object row')
+        return item
+
+    @public
+    @timing_stats()
+    def MERGE(self, req):
+        """
+        Handle HTTP MERGE request: a JSON list of object rows, each as would
+        be sent by an object PUT or DELETE, merged into the container in a
+        single transaction. Bodies too large to hold max_merge_rows rows
+        are refused before they are read.
+        """
+        drive, part, account, container = split_and_validate_path(req, 4)
+        if 'x-timestamp' not in req.headers or \
+                not check_float(req.headers['x-timestamp']):
+            return HTTPBadRequest(body='Missing timestamp', request=req,
+                                  content_type='text/plain')
+        if self.mount_check and not check_mount(self.root, drive):
+            return HTTPInsufficientStorage(drive=drive, request=req)
+        try:
+            if req.content_length is None:
+                return HTTPLengthRequired(request=req)
+            if req.content_length > self.max_merge_rows * MAX_MERGE_ROW_SIZE:
+                return HTTPRequestEntityTooLarge(request=req)
+            rows = json.load(req.environ['wsgi.input'])
+            if not isinstance(rows, list):
+                raise ValueError('Expected a list of object rows')
+            if len(rows) > self.max_merge_rows:
+                return HTTPRequestEntityTooLarge(request=req)
+            item_list = [self._merge_item(row) for row in rows]
+        except ValueError, err:
+            return HTTPBadRequest(body=str(err), request=req,
+                                  content_type='text/plain')
+        broker = self._get_container_broker(drive, part, account, container)
+        if account.startswith(self.auto_create_account_prefix) and \
+                not os.path.exists(broker.db_file):
+            try:
+                broker.initialize(
+                    normalize_timestamp(req.headers['x-timestamp']))
+            except swift.common.db.DatabaseAlreadyExists:
+                pass
+        if not os.path.exists(broker.db_file):
+            return HTTPNotFound()
+        if item_list:
+            broker.put_objects(item_list)
+        return HTTPNoContent(request=req)
+
     @public
     @timing_stats(sample_rate=0.1)
     def HEAD(self, req):
@@ -14,29 +14,67 @@
 # limitations under the License.
 
 import os
+import select
 import time
+import cPickle as pickle
 from gettext import gettext as _
+from random import shuffle
 
 from eventlet import Timeout
 
 from swift.obj import diskfile
 from swift.obj import server as object_server
-from swift.common.utils import get_logger, audit_location_generator, \
-    ratelimit_sleep, config_true_value, dump_recon_cache, list_from_csv, json
+from swift.common.utils import get_logger, ratelimit_sleep, \
+    config_true_value, dump_recon_cache, list_from_csv, json, listdir, \
+    write_pickle, advise_sequential
 from swift.common.exceptions import AuditException, DiskFileError, \
     DiskFileNotExist
 from swift.common.daemon import Daemon
 
 SLEEP_BETWEEN_AUDITS = 30
+# Where each device's audit pass stands, per auditor type
+CURSOR_FILE = 'object_auditor_%s.cursor'
+
+
+def sum_stats(stats):
+    """
+    Returns the sums of the periodic stats of auditor workers: the counts
+    and bytes are added up, with the earliest start time, the longest
+    auditing time and the latest end of the workers' passes.
+
+    :param stats: list of the stats dictionaries of the workers
+    """
+    etas = [worker['eta'] for worker in stats if worker['eta'] is not None]
+    totals = {'start_time': min(worker['start_time'] for worker in stats),
+              'audit_time': max(worker['audit_time'] for worker in stats),
+              'eta': max(etas) if etas else None}
+    for key in ('errors', 'passes', 'quarantined', 'bytes_processed',
+                'bytes_remaining'):
+        totals[key] = sum(worker[key] for worker in stats)
+    return totals
 
 
 class AuditorWorker(object):
-    """Walk through file system to audit object"""
+    """
+    Walk through file system to audit object
 
-    def __init__(self, conf, logger, zero_byte_only_at_fps=0):
+    :param conf: auditor configuration
+    :param logger: logger
+    :param zero_byte_only_at_fps: if set, only zero byte files are audited,
+                                  at up to this many files per second
+    :param device_dirs: optional list of the devices to audit; all of them
+                        by default
+    :param reporter: optional callable given the periodic stats instead of
+                     saving them to the recon cache
+    """
+
+    def __init__(self, conf, logger, zero_byte_only_at_fps=0,
+                 device_dirs=None, reporter=None):
         self.conf = conf
         self.logger = logger
         self.devices = conf.get('devices', '/srv/node')
+        self.device_dirs = device_dirs
+        self.reporter = reporter
         self.mount_check = config_true_value(conf.get('mount_check', 'true'))
         self.max_files_per_second = float(conf.get('files_per_second', 20))
         self.max_bytes_per_second = float(conf.get('bytes_per_second',
@@ -47,11 +85,20 @@ class AuditorWorker(object):
             self.max_files_per_second = float(self.zero_byte_only_at_fps)
             self.auditor_type = 'ZBF'
         self.log_time = int(conf.get('log_time', 3600))
+        self.checkpoint_time = int(conf.get('checkpoint_time', 60))
+        # larger reads only pay off with devices audited in parallel
+        self.disk_chunk_size = int(conf.get(
+            'disk_chunk_size',
+            1048576 if int(conf.get('concurrency', 1)) > 1 else 65536))
         self.files_running_time = 0
         self.bytes_running_time = 0
         self.bytes_processed = 0
         self.total_bytes_processed = 0
         self.total_files_processed = 0
+        # sizes of the objects audited, whether read or not
+        self.total_bytes_covered = 0
+        # device -> progress of its pass; see load_progress()
+        self.progress = {}
         self.passes = 0
         self.quarantines = 0
         self.errors = 0
@@ -69,21 +116,31 @@ class AuditorWorker(object):
         begin = reported = time.time()
         self.total_bytes_processed = 0
         self.total_files_processed = 0
+        self.total_bytes_covered = 0
         total_quarantines = 0
         total_errors = 0
         time_auditing = 0
-        all_locs = audit_location_generator(self.devices,
-                                            object_server.DATADIR, '.data',
-                                            mount_check=self.mount_check,
-                                            logger=self.logger)
-        for path, device, partition in all_locs:
+        self.progress = {}
+        for device in self.device_dirs or listdir(self.devices):
+            if self.mount_check and not \
+                    os.path.ismount(os.path.join(self.devices, device)):
+                self.logger.debug(
+                    _('Skipping %s as it is not mounted'), device)
+                continue
+            self.progress[device] = self.load_progress(device)
+        checkpointed = time.time()
+        for path, device, partition, position in self.location_generator():
             loop_time = time.time()
             self.object_audit(path, device, partition)
+            self.progress[device]['cursor'] = position
             self.logger.timing_since('timing', loop_time)
             self.files_running_time = ratelimit_sleep(
                 self.files_running_time, self.max_files_per_second)
             self.total_files_processed += 1
             now = time.time()
+            if now - checkpointed >= self.checkpoint_time:
+                self.checkpoint()
+                checkpointed = now
             if now - reported >= self.log_time:
                 self.logger.info(_(
                     'Object audit (%(type)s). '
@@ -100,15 +157,25 @@ class AuditorWorker(object):
                         'brate': self.bytes_processed / (now - reported),
                         'total': (now - begin), 'audit': time_auditing,
                         'audit_rate': time_auditing / (now - begin)})
-                dump_recon_cache({'object_auditor_stats_%s' %
-                                  self.auditor_type: {
-                                      'errors': self.errors,
-                                      'passes': self.passes,
-                                      'quarantined': self.quarantines,
-                                      'bytes_processed': self.bytes_processed,
-                                      'start_time': reported,
-                                      'audit_time': time_auditing}},
-                                 self.rcache, self.logger)
+                bytes_remaining = self.bytes_remaining()
+                eta = None
+                if self.total_bytes_covered:
+                    eta = bytes_remaining * (now - begin) / \
+                        self.total_bytes_covered
+                stats = {'errors': self.errors,
+                         'passes': self.passes,
+                         'quarantined': self.quarantines,
+                         'bytes_processed': self.bytes_processed,
+                         'start_time': reported,
+                         'audit_time': time_auditing,
+                         'bytes_remaining': bytes_remaining,
+                         'eta': eta}
+                if self.reporter:
+                    self.reporter(stats)
+                else:
+                    dump_recon_cache({'object_auditor_stats_%s' %
+                                      self.auditor_type: stats},
+                                     self.rcache, self.logger)
                 reported = now
                 total_quarantines += self.quarantines
                 total_errors += self.errors
@@ -134,6 +201,85 @@ class AuditorWorker(object):
             self.logger.info(
                 _('Object audit stats: %s') % json.dumps(self.stats_buckets))
 
+    def location_generator(self):
+        """
+        Yields (path, device, partition, position) for the objects of the
+        devices in self.progress, each device from where its pass stands.
+        A device whose pass is over is checkpointed to start the next one
+        from the beginning and dropped from self.progress.
+        """
+        devices = list(self.progress)
+        shuffle(devices)
+        for device in devices:
+            cursor = self.progress[device]['cursor']
+            if cursor:
+                self.logger.info(
+                    _('Resuming object audit (%(type)s) of %(device)s at '
+                      '%(position)s'),
+                    {'type': self.auditor_type, 'device': device,
+                     'position': '/'.join(cursor)})
+            for location in diskfile.device_location_generator(
+                    self.devices, device, object_server.DATADIR, cursor):
+                yield location
+            self.progress[device] = self.new_progress()
+            self.checkpoint(device)
+            del self.progress[device]
+
+    def new_progress(self):
+        """
+        Returns the progress of a device's pass about to begin: a
+        dictionary of its "cursor", the (partition, suffix, hash) of the
+        last object audited or None, the "bytes" of the objects audited and
+        when it was "started".
+        """
+        return {'cursor': None, 'bytes': 0, 'started': time.time()}
+
+    def load_progress(self, device):
+        """
+        Returns the progress of a device's pass as last checkpointed, or of
+        a new pass if there is none.
+        """
+        try:
+            with open(os.path.join(self.devices, device,
+                                   CURSOR_FILE % self.auditor_type),
+                      'rb') as fp:
+                progress = pickle.load(fp)
+            if progress['cursor'] is None or len(progress['cursor']) == 3:
+                return progress
+        except Exception:
+            pass
+        return self.new_progress()
+
+    def checkpoint(self, device=None):
+        """
+        Saves the progress of a device's pass, or of all the devices in
+        self.progress, so a later run resumes from there.
+        """
+        devices = [device] if device else self.progress.keys()
+        for device in devices:
+            try:
+                write_pickle(self.progress[device], os.path.join(
+                    self.devices, device, CURSOR_FILE % self.auditor_type))
+            except (Exception, Timeout):
+                self.logger.exception(
+                    _('ERROR Saving object audit progress of %s'), device)
+
+    def bytes_remaining(self):
+        """
+        Returns an estimate of the bytes left to audit in the passes of the
+        devices in self.progress: the space used on each device less the
+        sizes of the objects audited so far.
+        """
+        remaining = 0
+        for device, progress in self.progress.iteritems():
+            try:
+                stats = os.statvfs(os.path.join(self.devices, device))
+            except OSError:
+                continue
+            used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+            remaining += max(0, used - progress['bytes'])
+        return remaining
+
     def record_stats(self, obj_size):
         """
         Based on config's object_size_stats will keep track of how many objects
@@ -161,13 +307,14 @@ class AuditorWorker(object):
         """
         try:
             try:
-                name = diskfile.read_metadata(path)['name']
+                name = diskfile.read_location_metadata(path)['name']
             except (Exception, Timeout) as exc:
                 raise AuditException('Error when reading metadata: %s' % exc)
             _junk, account, container, obj = name.split('/', 3)
             df = diskfile.DiskFile(self.devices, device, partition,
                                    account, container, obj, self.logger,
-                                   keep_data_fp=True)
+                                   keep_data_fp=True, packed_volumes=True,
+                                   disk_chunk_size=self.disk_chunk_size)
             try:
                 try:
                     obj_size = df.get_data_file_size()
@@ -177,9 +324,18 @@ class AuditorWorker(object):
                     raise AuditException(str(e))
                 if self.stats_sizes:
                     self.record_stats(obj_size)
+                if device in self.progress:
+                    self.progress[device]['bytes'] += obj_size
+                self.total_bytes_covered += obj_size
                 if self.zero_byte_only_at_fps and obj_size:
                     self.passes += 1
                     return
+                if df.volume_entry:
+                    # only the record's own range of the shared volume
+                    advise_sequential(df.fp.fileno(), df.fp.offset,
+                                      df.fp.length)
+                elif df.fp:
+                    advise_sequential(df.fp.fileno())
                 for chunk in df:
                     self.bytes_running_time = ratelimit_sleep(
                         self.bytes_running_time, self.max_bytes_per_second,
@@ -220,6 +376,7 @@ class ObjectAuditor(Daemon):
         self.logger = get_logger(conf, log_route='object-auditor')
         self.conf_zero_byte_fps = int(
             conf.get('zero_byte_files_per_second', 50))
+        self.concurrency = int(conf.get('concurrency', 1))
 
     def _sleep(self):
         time.sleep(SLEEP_BETWEEN_AUDITS)
@@ -247,6 +404,81 @@ class ObjectAuditor(Daemon):
         """Run the object audit once."""
         mode = kwargs.get('mode', 'once')
         zero_byte_only_at_fps = kwargs.get('zero_byte_fps', 0)
+        if self.concurrency > 1:
+            self.audit_in_parallel(mode, zero_byte_only_at_fps)
+            return
         worker = AuditorWorker(self.conf, self.logger,
                                zero_byte_only_at_fps=zero_byte_only_at_fps)
         worker.audit_all_objects(mode=mode)
+
+    def audit_in_parallel(self, mode, zero_byte_only_at_fps=0):
+        """
+        Audits the devices in up to concurrency groups, each in a worker
+        process of its own with its own rate limits. The workers send their
+        periodic stats to this process, which saves their sums to the recon
+        cache.
+        """
+        devices = listdir(self.conf.get('devices', '/srv/node'))
+        readers = {}
+        for start in xrange(min(self.concurrency, len(devices))):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                self._run_worker(mode, zero_byte_only_at_fps,
+                                 devices[start::self.concurrency], write_fd)
+            os.close(write_fd)
+            readers[read_fd] = pid
+        self.collect_stats(readers,
+                           'ZBF' if zero_byte_only_at_fps else 'ALL')
+
+    def _run_worker(self, mode, zero_byte_only_at_fps, device_dirs,
+                    write_fd):
+        """Audits some devices in a forked worker process, then exits."""
+        status = 0
+        try:
+            worker = AuditorWorker(
+                self.conf, self.logger,
+                zero_byte_only_at_fps=zero_byte_only_at_fps,
+                device_dirs=device_dirs,
+                reporter=lambda stats: os.write(
+                    write_fd, json.dumps(stats) + '\n'))
+            worker.audit_all_objects(mode=mode)
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR auditing'))
+            status = 1
+        finally:
+            os._exit(status)
+
+    def collect_stats(self, readers, auditor_type):
+        """
+        Reads the stats the workers send until they are all done, saving
+        the sums of each worker's latest stats to the recon cache.
+
+        :param readers: dictionary of the read end of each worker's pipe to
+                        its process id
+        :param auditor_type: ALL or ZBF
+        """
+        rcache = os.path.join(
+            self.conf.get('recon_cache_path', '/var/cache/swift'),
+            'object.recon')
+        partial = dict((read_fd, '') for read_fd in readers)
+        latest = {}
+        while partial:
+            for read_fd in select.select(list(partial), [], [])[0]:
+                data = os.read(read_fd, 65536)
+                if not data:
+                    os.close(read_fd)
+                    del partial[read_fd]
+                    continue
+                lines = (partial[read_fd] + data).split('\n')
+                partial[read_fd] = lines.pop()
+                for line in lines:
+                    latest[read_fd] = json.loads(line)
+                if lines:
+                    dump_recon_cache(
+                        {'object_auditor_stats_%s' % auditor_type:
+                         sum_stats(latest.values())},
+                        rcache, self.logger)
+        for pid in readers.itervalues():
+            os.waitpid(pid, 0)
@@ -19,41 +19,131 @@ from __future__ import with_statement
 import cPickle as pickle
 import errno
 import os
+import struct
+import sys
 import time
 import uuid
 import hashlib
 import logging
+import threading
 import traceback
 from gettext import gettext as _
 from os.path import basename, dirname, exists, getmtime, getsize, join
 from tempfile import mkstemp
 from contextlib import contextmanager
+from collections import defaultdict
+from Queue import Queue
 
 from xattr import getxattr, setxattr
-from eventlet import Timeout
+from eventlet import spawn, Timeout
 
 from swift.common.constraints import check_mount
 from swift.common.utils import mkdirs, normalize_timestamp, \
     storage_directory, hash_path, renamer, fallocate, fsync, \
-    fdatasync, drop_buffer_cache, ThreadPool, lock_path, write_pickle
+    fdatasync, drop_buffer_cache, ThreadPool, lock_path, write_pickle, \
+    LRUCache, FsyncBatcher, config_true_value
 from swift.common.exceptions import DiskFileError, DiskFileNotExist, \
     DiskFileCollision, DiskFileNoSpace, DiskFileDeviceUnavailable, \
-    PathNotDir
+    PathNotDir, LockTimeout
 from swift.common.swob import multi_range_iterator
+from swift.obj.hashtree import partition_hash, HASH_TREE_FILE, \
+    UNKNOWN_HASH
+from swift.obj.journal import AsyncPendingJournal, DEFAULT_SEGMENT_SIZE
+from swift.obj.volume import find_volume, get_volume
 
 
 PICKLE_PROTOCOL = 2
 ONE_WEEK = 604800
+DATADIR = 'objects'
+ASYNCDIR = 'async_pending'
 HASH_FILE = 'hashes.pkl'
+HASH_INVALIDATIONS_FILE = 'hashes.invalid'
+# Times get_hashes() goes over a partition whose hashes keep being changed
+# underneath it before it gives up and answers with what it has.
+GET_HASHES_ATTEMPTS = 5
 METADATA_KEY = 'user.swift.metadata'
+# Compact metadata is a flat str -> str encoding stored, where the filesystem
+# allows it, in a single xattr: magic, version, total length, item count, a
+# table of (key length, value length) pairs and then the keys and values.
+# Pickles never start with a NUL byte, so the two formats cannot be confused.
+COMPACT_METADATA_MAGIC = '\x00SM'
+COMPACT_METADATA_VERSION = 1
+_COMPACT_HEADER = struct.Struct('!3sBIH')
 # These are system-set metadata keys that cannot be changed with a POST.
 # They should be lowercase.
 DATAFILE_SYSTEM_META = set('content-length content-type deleted etag'.split())
 
+# Threads hashing suffixes for get_hashes(), by device and concurrency. The
+# threads of a pool are shared by all its callers, so they also bound how
+# many suffixes (and so listdirs) are hashed at once on the device.
+_suffix_hash_pools = {}
+_suffix_hash_pools_lock = threading.Lock()
+
+
+def _pack_metadata(metadata):
+    """
+    Encode a metadata dictionary in the compact format.
+
+    :param metadata: dictionary of metadata
+    :returns: encoded string, or None if the metadata holds anything but
+              plain str keys and values (it must then be pickled)
+    """
+    lengths = []
+    data = []
+    for key, value in metadata.iteritems():
+        if type(key) is not str or type(value) is not str or \
+                len(key) > 0xffff:
+            return None
+        lengths.append(len(key))
+        lengths.append(len(value))
+        data.append(key)
+        data.append(value)
+    table = struct.pack('!' + 'HI' * len(metadata), *lengths)
+    body = table + ''.join(data)
+    return _COMPACT_HEADER.pack(
+        COMPACT_METADATA_MAGIC, COMPACT_METADATA_VERSION,
+        _COMPACT_HEADER.size + len(body), len(metadata)) + body
+
+
+def _unpack_metadata(metastr):
+    """
+    Decode a metadata string in the compact format.
+
+    :param metastr: encoded metadata
+    :returns: dictionary of metadata
+    :raises ValueError: on an unknown version, or if the lengths recorded
+                        in the string do not add up to its length
+    """
+    if len(metastr) < _COMPACT_HEADER.size:
+        raise ValueError('Metadata too short: %d' % len(metastr))
+    _junk, version, length, count = _COMPACT_HEADER.unpack_from(metastr)
+    if version != COMPACT_METADATA_VERSION:
+        raise ValueError('Unknown metadata version %d' % version)
+    if len(metastr) != length:
+        raise ValueError('Metadata length %d does not match %d' %
+                         (len(metastr), length))
+    offset = _COMPACT_HEADER.size + 6 * count
+    if offset > length:
+        raise ValueError('Metadata of length %d cannot hold %d items' %
+                         (length, count))
+    lengths = struct.unpack_from('!' + 'HI' * count, metastr,
+                                 _COMPACT_HEADER.size)
+    if offset + sum(lengths) != length:
+        raise ValueError('Metadata items do not add up to length %d' %
+                         length)
+    metadata = {}
+    for i in xrange(0, 2 * count, 2):
+        key_end = offset + lengths[i]
+        offset = key_end + lengths[i + 1]
+        metadata[metastr[key_end - lengths[i]:key_end]] = \
+            metastr[key_end:offset]
+    return metadata
+
 
 def read_metadata(fd):
     """
-    Helper function to read the pickled metadata from an object file.
+    Helper function to read the metadata from an object file, in either the
+    compact or the legacy pickled format.
 
     :param fd: file descriptor to load the metadata from
 
@@ -65,19 +155,43 @@ def read_metadata(fd):
         while True:
             metadata += getxattr(fd, '%s%s' % (METADATA_KEY, (key or '')))
             key += 1
+            # Compact metadata knows its own length, so there is no need to
+            # probe for a chunk that does not exist once it is complete.
+            if metadata.startswith(COMPACT_METADATA_MAGIC) and \
+                    len(metadata) >= _COMPACT_HEADER.size and \
+                    len(metadata) >= \
+                    _COMPACT_HEADER.unpack_from(metadata)[2]:
+                break
     except IOError:
         pass
+    if metadata.startswith(COMPACT_METADATA_MAGIC):
+        return _unpack_metadata(metadata)
     return pickle.loads(metadata)
 
 
-def write_metadata(fd, metadata):
+def write_metadata(fd, metadata, compact=False):
     """
-    Helper function to write pickled metadata for an object file.
+    Helper function to write metadata for an object file.
+
+    By default the metadata is pickled and split into 254 byte xattrs. With
+    compact, it is written in the compact format to a single xattr, falling
+    back to chunking if the filesystem will not hold a value that large, and
+    to pickling if the metadata is not plain strings.
 
     :param fd: file descriptor to write the metadata
     :param metadata: metadata to write
+    :param compact: use the compact metadata format
     """
-    metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
+    metastr = compact and _pack_metadata(metadata)
+    if metastr:
+        try:
+            setxattr(fd, METADATA_KEY, metastr)
+            return
+        except IOError as err:
+            if err.errno not in (errno.E2BIG, errno.ENOSPC, errno.ERANGE):
+                raise
+    else:
+        metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
     key = 0
     while metastr:
         setxattr(fd, '%s%s' % (METADATA_KEY, key or ''), metastr[:254])
@@ -110,26 +224,27 @@ def quarantine_renamer(device_path, corrupted_file_path):
     return to_dir
 
 
-def hash_cleanup_listdir(hsh_path, reclaim_age=ONE_WEEK):
+def get_obsolete_files(files, reclaim_age=ONE_WEEK):
     """
-    List contents of a hash directory and clean up any old files.
+    Work out which of a hash directory's files are obsolete: anything older
+    than the newest .data or .ts file, older .meta files, and a tombstone
+    older than reclaim_age if it is the only file.
 
-    :param hsh_path: object hash path
+    :param files: list of file names, which is reverse sorted in place
     :param reclaim_age: age in seconds at which to remove tombstones
-    :returns: list of files remaining in the directory, reverse sorted
+    :returns: list of obsolete file names
     """
-    files = os.listdir(hsh_path)
+    obsolete = []
     if len(files) == 1:
         if files[0].endswith('.ts'):
             # remove tombstones older than reclaim_age
             ts = files[0].rsplit('.', 1)[0]
             if (time.time() - float(ts)) > reclaim_age:
-                os.unlink(join(hsh_path, files[0]))
-                files.remove(files[0])
+                obsolete.append(files[0])
     elif files:
         files.sort(reverse=True)
         meta = data = tomb = None
-        for filename in list(files):
+        for filename in files:
             if not meta and filename.endswith('.meta'):
                 meta = filename
             if not data and filename.endswith('.data'):
@@ -140,8 +255,42 @@ def hash_cleanup_listdir(hsh_path, reclaim_age=ONE_WEEK):
                 filename < data or       # any file older than data
                 (filename.endswith('.meta') and
                  filename < meta)):      # old meta
-                os.unlink(join(hsh_path, filename))
-                files.remove(filename)
+                obsolete.append(filename)
+    return obsolete
+
+
+def live_files(files, reclaim_age=ONE_WEEK):
+    """
+    Returns the files of an object left once the obsolete ones are removed,
+    including a tombstone older than reclaim_age that is only alone once
+    the files it replaced are gone. Records packed in a volume are not
+    removed as files are, so they take part in hashes as files would after
+    the next reclaim.
+
+    :param files: iterable of file names
+    :param reclaim_age: age in seconds at which to remove tombstones
+    :returns: list of the live file names, reverse sorted
+    """
+    files = list(files)
+    for _junk in xrange(2):
+        for filename in get_obsolete_files(files, reclaim_age):
+            files.remove(filename)
+    files.sort(reverse=True)
+    return files
+
+
+def hash_cleanup_listdir(hsh_path, reclaim_age=ONE_WEEK):
+    """
+    List contents of a hash directory and clean up any old files.
+
+    :param hsh_path: object hash path
+    :param reclaim_age: age in seconds at which to remove tombstones
+    :returns: list of files remaining in the directory, reverse sorted
+    """
+    files = os.listdir(hsh_path)
+    for filename in get_obsolete_files(files, reclaim_age):
+        os.unlink(join(hsh_path, filename))
+        files.remove(filename)
     return files
 
 
@@ -149,23 +298,37 @@ def hash_suffix(path, reclaim_age):
     """
     Performs reclamation and returns an md5 of all (remaining) files.
 
+    Objects packed in the partition's volume are hashed by the names their
+    records would have as files once reclaimed, see live_files(). A suffix
+    only in the volume, with no live records left, does not exist.
+
     :param reclaim_age: age in seconds at which to remove tombstones
     :raises PathNotDir: if given path is not a valid directory
     :raises OSError: for non-ENOTDIR errors
     """
     md5 = hashlib.md5()
+    volume = find_volume(dirname(path))
+    packed = volume.suffix_hashes(basename(path)) if volume else set()
+    only_packed = False
     try:
         path_contents = sorted(os.listdir(path))
     except OSError, err:
-        if err.errno in (errno.ENOTDIR, errno.ENOENT):
+        if err.errno not in (errno.ENOTDIR, errno.ENOENT):
+            raise
+        if not packed or err.errno == errno.ENOTDIR:
             raise PathNotDir()
-        raise
+        path_contents = []
+        only_packed = True
+    if packed:
+        path_contents = sorted(packed.union(path_contents))
     for hsh in path_contents:
         hsh_path = join(path, hsh)
         try:
             files = hash_cleanup_listdir(hsh_path, reclaim_age)
         except OSError, err:
-            if err.errno == errno.ENOTDIR:
+            if err.errno == errno.ENOENT and hsh in packed:
+                files = []
+            elif err.errno == errno.ENOTDIR:
                 partition_path = dirname(path)
                 objects_path = dirname(partition_path)
                 device_path = dirname(objects_path)
@@ -174,11 +337,21 @@ def hash_suffix(path, reclaim_age):
                     _('Quarantined %s to %s because it is not a directory') %
                     (hsh_path, quar_path))
                 continue
-            raise
-        if not files:
-            os.rmdir(hsh_path)
+            else:
+                raise
+        else:
+            if not files:
+                os.rmdir(hsh_path)
+        if hsh in packed:
+            files = live_files(set(files).union(
+                entry.filename for entry in volume.lookup(hsh).itervalues()),
+                reclaim_age)
         for filename in files:
             md5.update(filename)
+        if files:
+            only_packed = False
+    if only_packed:
+        raise PathNotDir()
     try:
         os.rmdir(path)
     except OSError:
@@ -186,31 +359,171 @@ def hash_suffix(path, reclaim_age):
     return md5.hexdigest()
 
 
+class SuffixHashPool(object):
+    """
+    A fixed set of daemon threads hashing suffixes, started once and reused
+    by every call, so get_hashes() does not start threads of its own.
+
+    :param nthreads: number of threads, and so of suffixes hashed at once
+    """
+
+    def __init__(self, nthreads):
+        self.nthreads = nthreads
+        self._tasks = Queue()
+        for _junk in xrange(nthreads):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            suffix_dir, reclaim_age, results = self._tasks.get()
+            try:
+                results.put((suffix_dir, True,
+                             hash_suffix(suffix_dir, reclaim_age)))
+            except PathNotDir:
+                results.put((suffix_dir, True, None))
+            except OSError:
+                logging.exception(_('Error hashing suffix'))
+                results.put((suffix_dir, False, None))
+            except BaseException as err:
+                results.put((suffix_dir, False, err))
+
+    def hash_suffixes(self, partition_dir, suffixes, reclaim_age):
+        """
+        Hashes a partition's suffixes on the pool's threads, waiting for
+        them all.
+
+        :returns: dictionary of suffix to hash, with None for suffixes that
+                  no longer exist; suffixes that failed to hash are left out
+        """
+        results = Queue()
+        for suffix in suffixes:
+            self._tasks.put((join(partition_dir, suffix), reclaim_age,
+                             results))
+        hashes = {}
+        errors = []
+        for _junk in suffixes:
+            suffix_dir, hashed, value = results.get()
+            if hashed:
+                hashes[basename(suffix_dir)] = value
+            elif value is not None:
+                errors.append(value)
+        if errors:
+            raise errors[0]
+        return hashes
+
+
+def get_suffix_hash_pool(device_path, concurrency):
+    """
+    Returns the threads hashing suffixes on a device, starting them on first
+    use.
+
+    :param device_path: path to the device
+    :param concurrency: number of threads in the pool
+    """
+    with _suffix_hash_pools_lock:
+        key = (device_path, concurrency)
+        if key not in _suffix_hash_pools:
+            _suffix_hash_pools[key] = SuffixHashPool(concurrency)
+        return _suffix_hash_pools[key]
+
+
+def hash_suffixes_concurrently(partition_dir, suffixes, reclaim_age,
+                               concurrency):
+    """
+    Hashes a partition's suffixes on the pooled threads of its device. No
+    more than concurrency suffixes are hashed at once on the partition's
+    device by callers with the same concurrency, no matter how many there
+    are.
+
+    :param partition_dir: absolute path of the partition
+    :param suffixes: list of suffixes to hash
+    :param reclaim_age: age in seconds at which to remove tombstones
+    :param concurrency: maximum number of suffixes hashed at once per device
+
+    :returns: dictionary of suffix to hash, with None for suffixes that no
+              longer exist; suffixes that failed to hash are left out
+    """
+    return get_suffix_hash_pool(
+        dirname(dirname(partition_dir)), concurrency).hash_suffixes(
+            partition_dir, suffixes, reclaim_age)
+
+
 def invalidate_hash(suffix_dir):
     """
     Invalidates the hash for a suffix_dir in the partition's hashes file.
 
+    Rather than rewriting the hashes file, the suffix is appended to the
+    partition's invalidations journal, which get_hashes() folds into the
+    hashes file the next time it is read.
+
     :param suffix_dir: absolute path to suffix dir whose hash needs
                        invalidating
     """
 
     suffix = basename(suffix_dir)
     partition_dir = dirname(suffix_dir)
+    invalidations_file = join(partition_dir, HASH_INVALIDATIONS_FILE)
+    with lock_path(partition_dir):
+        with open(invalidations_file, 'ab') as fp:
+            fp.write(suffix + '\n')
+
+
+def _read_invalidations(partition_dir):
+    """
+    Returns the suffixes listed in a partition's invalidations journal.
+
+    :param partition_dir: absolute path of the partition
+    """
+    try:
+        with open(join(partition_dir, HASH_INVALIDATIONS_FILE), 'rb') as fp:
+            suffixes = set(line.strip() for line in fp)
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return set()
+    suffixes.discard('')
+    return suffixes
+
+
+def consolidate_hashes(partition_dir):
+    """
+    Fold the suffixes listed in a partition's invalidations journal into
+    its hashes file, then empty the journal.
+
+    :param partition_dir: absolute path of partition to consolidate
+    """
     hashes_file = join(partition_dir, HASH_FILE)
+    invalidations_file = join(partition_dir, HASH_INVALIDATIONS_FILE)
+    try:
+        if not os.stat(invalidations_file).st_size:
+            return
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return
     with lock_path(partition_dir):
         try:
             with open(hashes_file, 'rb') as fp:
                 hashes = pickle.load(fp)
-            if suffix in hashes and not hashes[suffix]:
-                return
         except Exception:
-            return
-        hashes[suffix] = None
-        write_pickle(hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+            # No usable hashes file; get_hashes() will list the whole
+            # partition anyway, so the journal has nothing to add.
+            hashes = None
+        suffixes = _read_invalidations(partition_dir)
+        if hashes is not None and [suffix for suffix in suffixes
+                                   if suffix not in hashes or hashes[suffix]]:
+            hashes.update((suffix, None) for suffix in suffixes)
+            write_pickle(hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
+        # Every invalidation is now reflected in the hashes file (or there
+        # is no hashes file), so the journal can be emptied.
+        with open(invalidations_file, 'wb'):
+            pass
 
 
 def get_hashes(partition_dir, recalculate=None, do_listdir=False,
-               reclaim_age=ONE_WEEK):
+               reclaim_age=ONE_WEEK, concurrency=1):
     """
     Get a list of hashes for the suffix dir.  do_listdir causes it to mistrust
     the hash cache for suffix existence at the (unexpectedly high) cost of a
@@ -220,55 +533,811 @@ def get_hashes(partition_dir, recalculate=None, do_listdir=False,
     :param recalculate: list of suffixes which should be recalculated when got
     :param do_listdir: force existence check for all hashes in the partition
     :param reclaim_age: age at which to remove tombstones
+    :param concurrency: if greater than 1, invalid suffixes are hashed on up
+                        to this many threads per device
 
     :returns: tuple of (number of suffix dirs hashed, dictionary of hashes)
     """
 
     hashed = 0
     hashes_file = join(partition_dir, HASH_FILE)
-    modified = False
-    force_rewrite = False
-    hashes = {}
-    mtime = -1
 
     if recalculate is None:
         recalculate = []
 
-    try:
-        with open(hashes_file, 'rb') as fp:
-            hashes = pickle.load(fp)
-        mtime = getmtime(hashes_file)
-    except Exception:
-        do_listdir = True
-        force_rewrite = True
-    if do_listdir:
-        for suff in os.listdir(partition_dir):
-            if len(suff) == 3:
+    for _junk in xrange(GET_HASHES_ATTEMPTS):
+        modified = False
+        force_rewrite = False
+        hashes = {}
+        mtime = -1
+        # suffixes hashed on this attempt
+        computed = set()
+
+        consolidate_hashes(partition_dir)
+        try:
+            with open(hashes_file, 'rb') as fp:
+                hashes = pickle.load(fp)
+            mtime = getmtime(hashes_file)
+        except Exception:
+            do_listdir = True
+            force_rewrite = True
+        if do_listdir:
+            for suff in os.listdir(partition_dir):
+                if len(suff) == 3:
+                    hashes.setdefault(suff, None)
+            volume = find_volume(partition_dir)
+            for suff in volume.suffixes() if volume else ():
                 hashes.setdefault(suff, None)
-        modified = True
-    hashes.update((hash_, None) for hash_ in recalculate)
-    for suffix, hash_ in hashes.items():
-        if not hash_:
-            suffix_dir = join(partition_dir, suffix)
-            try:
-                hashes[suffix] = hash_suffix(suffix_dir, reclaim_age)
-                hashed += 1
-            except PathNotDir:
-                del hashes[suffix]
-            except OSError:
-                logging.exception(_('Error hashing suffix'))
             modified = True
-    if modified:
+        hashes.update((hash_, None) for hash_ in recalculate)
+        if concurrency > 1:
+            invalid = [suffix for suffix, hash_ in hashes.iteritems()
+                       if not hash_]
+            if invalid:
+                modified = True
+                for suffix, hash_ in hash_suffixes_concurrently(
+                        partition_dir, invalid, reclaim_age,
+                        concurrency).iteritems():
+                    if hash_ is None:
+                        del hashes[suffix]
+                    else:
+                        hashes[suffix] = hash_
+                        computed.add(suffix)
+        else:
+            for suffix, hash_ in hashes.items():
+                if not hash_:
+                    suffix_dir = join(partition_dir, suffix)
+                    try:
+                        hashes[suffix] = hash_suffix(suffix_dir, reclaim_age)
+                        computed.add(suffix)
+                    except PathNotDir:
+                        del hashes[suffix]
+                    except OSError:
+                        logging.exception(_('Error hashing suffix'))
+                    modified = True
+        hashed += len(computed)
+        if computed:
+            compact_volume(partition_dir, reclaim_age)
+        if not modified:
+            return hashed, hashes
         with lock_path(partition_dir):
             if force_rewrite or not exists(hashes_file) or \
                     getmtime(hashes_file) == mtime:
+                # invalidate_hash() only appends to the journal, so suffixes
+                # changed while they were being hashed are found there. They
+                # are saved as invalid, and hashed again if what was just
+                # computed for them is stale.
+                invalidated = _read_invalidations(partition_dir)
+                hashes.update((suffix, None) for suffix in invalidated)
                 write_pickle(
                     hashes, hashes_file, partition_dir, PICKLE_PROTOCOL)
-                return hashed, hashes
-        return get_hashes(partition_dir, recalculate, do_listdir,
+                if invalidated:
+                    with open(join(partition_dir, HASH_INVALIDATIONS_FILE),
+                              'wb'):
+                        pass
+                if not computed.intersection(invalidated):
+                    return hashed, hashes
+                # What was asked for has been saved.
+                recalculate = []
+                do_listdir = False
+    return hashed, hashes
+
+
+def compact_volume(partition_dir, reclaim_age=ONE_WEEK):
+    """
+    Compacts a partition's volume, if it has one, once enough of it is
+    taken up by records made obsolete by newer records or files, and by
+    tombstones older than reclaim_age.
+
+    :param partition_dir: path to the partition directory
+    :param reclaim_age: age in seconds at which to remove tombstones
+    :returns: number of bytes reclaimed
+    """
+    volume = find_volume(partition_dir)
+    if volume is None:
+        return 0
+
+    def live(hsh, entries):
+        kept = live_files(_object_files(partition_dir, hsh, volume),
                           reclaim_age)
+        return [entry for entry in entries.itervalues()
+                if entry.filename in kept]
+
+    return volume.compact(live)
+
+
+def unpack_suffixes(partition_dir, suffixes):
+    """
+    Writes the live records of objects packed in a partition's volume out as
+    files in their hash directories, so that the suffixes can be rsynced.
+    Files already present are left alone.
+
+    :param partition_dir: path to the partition directory
+    :param suffixes: suffixes to unpack
+    :returns: list of paths of the files written
+    """
+    volume = get_volume(partition_dir)
+    tmpdir = join(dirname(dirname(partition_dir)), 'tmp')
+    written = []
+    for suffix in suffixes:
+        for hsh in volume.suffix_hashes(suffix):
+            entries = volume.lookup(hsh)
+            filenames = [entry.filename for entry in entries.itervalues()]
+            obsolete = get_obsolete_files(filenames)
+            for entry in entries.itervalues():
+                hsh_path = join(partition_dir, suffix, hsh)
+                target_path = join(hsh_path, entry.filename)
+                if entry.filename in obsolete or exists(target_path):
+                    continue
+                metadata, fp = volume.open(entry)
+                mkdirs(tmpdir)
+                fd, tmppath = mkstemp(dir=tmpdir)
+                try:
+                    try:
+                        for chunk in iter(lambda: fp.read(65536), ''):
+                            while chunk:
+                                chunk = chunk[os.write(fd, chunk):]
+                    finally:
+                        fp.close()
+                    write_metadata(fd, metadata)
+                    fsync(fd)
+                    renamer(tmppath, target_path)
+                finally:
+                    os.close(fd)
+                    if exists(tmppath):
+                        os.unlink(tmppath)
+                written.append(target_path)
+    return written
+
+
+def remove_unpacked(paths):
+    """
+    Removes files written by unpack_suffixes(), and any hash and suffix
+    directories left empty. The objects are still in the volume.
+
+    :param paths: list of paths returned by unpack_suffixes()
+    """
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        for empty_dir in (dirname(path), dirname(dirname(path))):
+            try:
+                os.rmdir(empty_dir)
+            except OSError:
+                break
+
+
+def _object_files(partition_dir, hsh, volume):
+    """Returns the names of an object's files, whether packed or not."""
+    try:
+        files = os.listdir(join(partition_dir, hsh[-3:], hsh))
+    except OSError as err:
+        if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        files = []
+    files = set(files)
+    files.update(entry.filename for entry in volume.lookup(hsh).itervalues())
+    return [filename for filename in files
+            if filename.endswith(('.data', '.meta', '.ts'))]
+
+
+def list_object_files(partition_dir, suffixes, reclaim_age=ONE_WEEK):
+    """
+    Returns the live files of the objects in some suffixes of a partition,
+    whether packed in the partition's volume or not.
+
+    :param partition_dir: path to the partition directory
+    :param suffixes: suffixes to list
+    :param reclaim_age: age in seconds at which tombstones are not listed
+    :returns: dictionary of object hash to sorted list of file names
+    """
+    volume = get_volume(partition_dir)
+    objects = {}
+    for suffix in suffixes:
+        try:
+            hashes = set(os.listdir(join(partition_dir, suffix)))
+        except OSError as err:
+            if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            hashes = set()
+        hashes.update(volume.suffix_hashes(suffix))
+        for hsh in hashes:
+            if len(hsh) != 32:
+                continue
+            files = sorted(live_files(
+                _object_files(partition_dir, hsh, volume), reclaim_age))
+            if files:
+                objects[hsh] = files
+    return objects
+
+
+def missing_object_files(partition_dir, offered, reclaim_age=ONE_WEEK):
+    """
+    Works out which of the object files another node has this one needs:
+    those it does not have, and that are not made obsolete by those it has.
+
+    :param partition_dir: path to the partition directory
+    :param offered: dictionary of object hash to list of file names, as
+                    returned by list_object_files() on the other node
+    :param reclaim_age: age in seconds at which tombstones are not wanted
+    :returns: dictionary of object hash to sorted list of file names
+    """
+    volume = get_volume(partition_dir)
+    wanted = {}
+    for hsh, filenames in offered.iteritems():
+        local = _object_files(partition_dir, hsh, volume)
+        obsolete = get_obsolete_files(
+            list(set(local).union(filenames)), reclaim_age)
+        want = sorted(set(filenames).difference(local, obsolete))
+        if want:
+            wanted[hsh] = want
+    return wanted
+
+
+def open_object_file(partition_dir, hsh, filename):
+    """
+    Opens one of an object's files, or the record standing for it in the
+    partition's volume.
+
+    :param partition_dir: path to the partition directory
+    :param hsh: object hash
+    :param filename: name of the file
+    :returns: tuple of the file's metadata, a file-like object of its data
+              and the length of the data
+    :raises DiskFileNotExist: if there is no such file or record
+    """
+    try:
+        fp = open(join(partition_dir, hsh[-3:], hsh, filename), 'rb')
+    except IOError as err:
+        if err.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
     else:
-        return hashed, hashes
+        try:
+            return read_metadata(fp), fp, os.fstat(fp.fileno()).st_size
+        except Exception:
+            fp.close()
+            raise
+    volume = get_volume(partition_dir)
+    for entry in volume.lookup(hsh).itervalues():
+        if entry.filename == filename:
+            metadata, fp = volume.open(entry)
+            return metadata, fp, entry.data_length
+    raise DiskFileNotExist('%s/%s does not exist' % (hsh, filename))
+
+
+def _create_tmp_file(tmpdir):
+    mkdirs(tmpdir)
+    return mkstemp(dir=tmpdir)
+
+
+def _write_all(fd, chunk):
+    while chunk:
+        chunk = chunk[os.write(fd, chunk):]
+
+
+def _commit_tmp_file(fd, tmppath, target_path, metadata, compact_metadata):
+    write_metadata(fd, metadata, compact=compact_metadata)
+    fsync(fd)
+    renamer(tmppath, target_path)
+
+
+def _discard_tmp_file(fd, tmppath):
+    os.close(fd)
+    if exists(tmppath):
+        os.unlink(tmppath)
+
+
+def _invalidate_suffixes(paths):
+    for suffix_dir in set(dirname(dirname(path)) for path in paths):
+        invalidate_hash(suffix_dir)
+
+
+def write_object_files(partition_dir, files, compact_metadata=False,
+                       chunk_size=65536, threadpool=None):
+    """
+    Writes object files received from another node to their hash
+    directories, removing any they make obsolete, and invalidates the
+    hashes of their suffixes.
+
+    :param partition_dir: path to the partition directory
+    :param files: iterable of (hash, file name, metadata, length, read)
+                  tuples, where read(size) returns the file's data; each
+                  file's data is read in full before the next is taken
+    :param compact_metadata: whether to write metadata in the compact format
+    :param chunk_size: size of the reads of file data
+    :param threadpool: optional thread pool in which to do the disk work;
+                       the files are still read in the calling thread
+    :returns: list of the paths of the files written
+    """
+    threadpool = threadpool or ThreadPool(nthreads=0)
+    tmpdir = join(dirname(dirname(partition_dir)), 'tmp')
+    written = []
+    try:
+        for hsh, filename, metadata, length, read in files:
+            hsh_path = join(partition_dir, hsh[-3:], hsh)
+            target_path = join(hsh_path, filename)
+            fd, tmppath = threadpool.force_run_in_thread(
+                _create_tmp_file, tmpdir)
+            try:
+                remaining = length
+                while remaining > 0:
+                    chunk = read(min(remaining, chunk_size))
+                    if not chunk:
+                        raise DiskFileError(
+                            'Truncated data of %s/%s' % (hsh, filename))
+                    remaining -= len(chunk)
+                    threadpool.run_in_thread(_write_all, fd, chunk)
+                threadpool.force_run_in_thread(
+                    _commit_tmp_file, fd, tmppath, target_path, metadata,
+                    compact_metadata)
+                written.append(target_path)
+            finally:
+                threadpool.force_run_in_thread(_discard_tmp_file, fd, tmppath)
+            threadpool.force_run_in_thread(hash_cleanup_listdir, hsh_path)
+    finally:
+        if written:
+            threadpool.force_run_in_thread(_invalidate_suffixes, written)
+    return written
+
+
+def volume_location_generator(devices, datadir, mount_check=True,
+                              logger=None):
+    """
+    Like audit_location_generator(), but yields (path, device, partition)
+    for the .data records of objects packed in volumes. The paths are the
+    ones the records would have as files, and can be passed to
+    read_location_metadata().
+
+    :param devices: parent directory of the devices
+    :param datadir: object data directory under each device
+    :param mount_check: whether to skip devices that are not mounted
+    :param logger: a logger object
+    """
+    device_dir = os.listdir(devices)
+    for device in device_dir:
+        if mount_check and not check_mount(devices, device):
+            if logger:
+                logger.debug(_('Skipping %s as it is not mounted'), device)
+            continue
+        datadir_path = join(devices, device, datadir)
+        try:
+            partitions = os.listdir(datadir_path)
+        except OSError:
+            continue
+        for partition in partitions:
+            partition_dir = join(datadir_path, partition)
+            volume = find_volume(partition_dir)
+            if volume is None:
+                continue
+            for suffix in volume.suffixes():
+                for hsh in sorted(volume.suffix_hashes(suffix)):
+                    entry = volume.lookup(hsh).get('.data')
+                    if entry:
+                        yield (join(partition_dir, suffix, hsh,
+                                    entry.filename), device, partition)
+
+
+def device_location_generator(devices, device, datadir, cursor=None):
+    """
+    Yields (path, device, partition, position) for the .data files and the
+    .data records packed in volumes of the objects on one device, in order
+    of partition, suffix and object hash, so a walk can be resumed from
+    where an earlier one stopped. The paths are as for
+    volume_location_generator(). An object may have several locations, so
+    the position is the cursor to resume from once a location is done
+    with: that of the object itself for its last location, and that of
+    the object before it, or the cursor given, for the others.
+
+    :param devices: parent directory of the devices
+    :param device: the device to walk
+    :param datadir: object data directory under the device
+    :param cursor: optional (partition, suffix, hash) position; only
+                   objects after it are yielded
+    """
+    datadir_path = join(devices, device, datadir)
+    try:
+        partitions = [partition for partition in os.listdir(datadir_path)
+                      if partition.isdigit()]
+    except OSError:
+        return
+    # the last object all of whose locations have been yielded
+    done = cursor
+    for partition in sorted(partitions, key=int):
+        # -1: before the cursor, 0: at its partition or suffix, 1: past it
+        at_partition = 1
+        if cursor:
+            at_partition = cmp(int(partition), int(cursor[0]))
+            if at_partition < 0:
+                continue
+        partition_dir = join(datadir_path, partition)
+        if not os.path.isdir(partition_dir):
+            continue
+        volume = find_volume(partition_dir)
+        suffixes = set(volume.suffixes() if volume else ())
+        suffixes.update(suffix for suffix in os.listdir(partition_dir)
+                        if len(suffix) == 3)
+        for suffix in sorted(suffixes):
+            at_suffix = at_partition
+            if at_partition == 0:
+                at_suffix = cmp(suffix, cursor[1])
+                if at_suffix < 0:
+                    continue
+            suffix_dir = join(partition_dir, suffix)
+            hashes = volume.suffix_hashes(suffix) if volume else set()
+            try:
+                hashes.update(os.listdir(suffix_dir))
+            except OSError:
+                pass
+            for hsh in sorted(hashes):
+                if at_suffix == 0 and hsh <= cursor[2]:
+                    continue
+                hash_dir = join(suffix_dir, hsh)
+                try:
+                    files = os.listdir(hash_dir)
+                except OSError:
+                    files = []
+                paths = [join(hash_dir, filename)
+                         for filename in sorted(files, reverse=True)
+                         if filename.endswith('.data')]
+                entry = volume and volume.lookup(hsh).get('.data')
+                if entry:
+                    paths.append(join(hash_dir, entry.filename))
+                for index, path in enumerate(paths):
+                    if index == len(paths) - 1:
+                        done = (partition, suffix, hsh)
+                    yield path, device, partition, done
+
+
+def read_location_metadata(path):
+    """
+    Returns the metadata of an object file or, if there is no such file, of
+    the record standing for it in its partition's volume.
+
+    :param path: path to an object's .data, .meta or .ts file
+    """
+    if exists(path):
+        return read_metadata(path)
+    hsh_path = dirname(path)
+    volume = get_volume(dirname(dirname(hsh_path)))
+    for entry in volume.lookup(basename(hsh_path)).itervalues():
+        if entry.filename == basename(path):
+            return volume.read_metadata(entry)
+    raise DiskFileNotExist('%s does not exist' % path)
+
+
+class DeviceHashTree(object):
+    """
+    Hash tree of the objects of a device; see swift.obj.hashtree.
+
+    :param device_path: path to the device
+    :param reclaim_age: age at which to remove tombstones when rehashing
+    :param concurrency: threads on which to rehash invalid suffixes, as for
+                        get_hashes()
+    """
+
+    def __init__(self, device_path, reclaim_age=ONE_WEEK, concurrency=1):
+        self.device_path = device_path
+        self.objects_dir = join(device_path, DATADIR)
+        self.tree_file = join(device_path, HASH_TREE_FILE)
+        self.reclaim_age = reclaim_age
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        # partition -> (state of its hashes files, partition hash)
+        self._partitions = None
+
+    def _load(self):
+        try:
+            with open(self.tree_file, 'rb') as fp:
+                self._partitions = pickle.load(fp)
+        except Exception:
+            self._partitions = {}
+
+    @staticmethod
+    def _state(partition_dir):
+        """
+        Returns the state of a partition's hashes files a partition hash may
+        be reused for, or None if its hashes file is missing or suffixes
+        have been invalidated since it was written.
+        """
+        try:
+            if os.stat(join(partition_dir,
+                            HASH_INVALIDATIONS_FILE)).st_size:
+                return None
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        try:
+            stat = os.stat(join(partition_dir, HASH_FILE))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return stat.st_ino, stat.st_mtime
+
+    def _hash_partition(self, partition_dir):
+        """
+        Returns the state of a partition's hashes files and its hash,
+        rehashing any invalid suffixes first.
+        """
+        for attempt in xrange(2):
+            state = self._state(partition_dir)
+            if state is not None:
+                try:
+                    with open(join(partition_dir, HASH_FILE), 'rb') as fp:
+                        hashes = pickle.load(fp)
+                except Exception:
+                    hashes = None
+                if hashes is not None and all(hashes.itervalues()) and \
+                        self._state(partition_dir) == state:
+                    return state, partition_hash(hashes)
+            hashes = get_hashes(partition_dir, reclaim_age=self.reclaim_age,
+                                concurrency=self.concurrency)[1]
+        # Changed again while being read; not to be reused.
+        return None, partition_hash(hashes)
+
+    def get(self, partitions, deadline=None):
+        """
+        Returns the hashes of some partitions, rehashing those whose hashes
+        changed since they were last asked for.
+
+        :param partitions: list of partitions
+        :param deadline: optional time after which partitions are no longer
+                         rehashed
+        :returns: dictionary of partition to partition hash, which is None
+                  for partitions with no objects and UNKNOWN_HASH for those
+                  left to rehash after the deadline
+        """
+        with self._lock:
+            if self._partitions is None:
+                self._load()
+            hashes = {}
+            changed = False
+            for partition in partitions:
+                partition_dir = join(self.objects_dir, partition)
+                if not os.path.isdir(partition_dir):
+                    hashes[partition] = None
+                    if self._partitions.pop(partition, None):
+                        changed = True
+                    continue
+                cached = self._partitions.get(partition)
+                if cached and cached[0] is not None and \
+                        cached[0] == self._state(partition_dir):
+                    hashes[partition] = cached[1]
+                    continue
+                if deadline is not None and time.time() >= deadline:
+                    hashes[partition] = UNKNOWN_HASH
+                    continue
+                self._partitions[partition] = self._hash_partition(
+                    partition_dir)
+                hashes[partition] = self._partitions[partition][1]
+                changed = True
+            if changed:
+                write_pickle(self._partitions, self.tree_file,
+                             pickle_protocol=PICKLE_PROTOCOL)
+            return hashes
+
+
+class HashDirListingCache(object):
+    """
+    Bounded LRU cache of object hash directory listings, used by DiskFile to
+    avoid a listdir and sort per request for popular objects.
+
+    Each entry remembers the directory's inode and mtime, and is only used
+    while a stat of the directory still matches, so changes made by other
+    processes (replicators, other workers) are noticed. Callers that change
+    a hash directory should still invalidate it.
+
+    :param max_size: maximum number of directories to remember
+    :param logger: optional logger; lookups are counted as
+                   hash_dir_cache.hits and hash_dir_cache.misses
+    """
+
+    def __init__(self, max_size, logger=None):
+        self.logger = logger
+        self._listings = LRUCache(max_size)
+
+    def listdir(self, path):
+        """
+        Returns the contents of a hash directory, reverse sorted.
+
+        :param path: hash directory path
+        :raises OSError: as os.stat or os.listdir would, e.g. ENOENT
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._listings.pop(path)
+            raise
+        # Stat before listing, so a change made in between only makes the
+        # entry look stale next time.
+        version = (st.st_ino, st.st_mtime)
+        entry = self._listings.get(path)
+        if entry and entry[0] == version:
+            if self.logger:
+                self.logger.increment('hash_dir_cache.hits')
+            return entry[1]
+        if self.logger:
+            self.logger.increment('hash_dir_cache.misses')
+        files = tuple(sorted(os.listdir(path), reverse=True))
+        self._listings.set(path, (version, files))
+        return files
+
+    def invalidate(self, path):
+        """
+        Forgets the listing of a hash directory.
+
+        :param path: hash directory path
+        """
+        self._listings.pop(path)
+
+
+class MetadataCache(object):
+    """
+    Bounded LRU cache of the metadata of data files, used by DiskFile so
+    that HEADs and GETs answered from the metadata alone (such as 304s) need
+    not open the data file and decode its metadata.
+
+    An entry is keyed by the data file's path and remembers its inode, mtime
+    and ctime (metadata is set with xattrs, which changes the ctime) and the
+    name of the .meta file merged into it. It is only used while all of
+    these still match.
+
+    :param max_size: maximum number of data files to remember
+    :param logger: optional logger; lookups are counted as
+                   metadata_cache.hits and metadata_cache.misses
+    """
+
+    def __init__(self, max_size, logger=None):
+        self.logger = logger
+        self._metadata = LRUCache(max_size)
+
+    def get(self, data_file, meta_file):
+        """
+        Looks up the metadata of a data file.
+
+        :param data_file: data file path
+        :param meta_file: path of the .meta file to merge in, or None
+        :returns: a tuple of the data file's current version, to hand to
+                  set() on a miss, and a copy of its metadata or None
+        :raises OSError: as os.stat would, e.g. ENOENT
+        """
+        try:
+            st = os.stat(data_file)
+        except OSError:
+            self._metadata.pop(data_file)
+            raise
+        version = (st.st_ino, st.st_mtime, st.st_ctime, meta_file)
+        entry = self._metadata.get(data_file)
+        if entry and entry[0] == version:
+            if self.logger:
+                self.logger.increment('metadata_cache.hits')
+            return version, dict(entry[1])
+        if self.logger:
+            self.logger.increment('metadata_cache.misses')
+        return version, None
+
+    def set(self, data_file, version, metadata):
+        """
+        Remembers the metadata of a data file.
+
+        :param data_file: data file path
+        :param version: the version get() returned for the data file,
+                        which must have been looked up before the metadata
+                        was read
+        :param metadata: the data file's metadata
+        """
+        self._metadata.set(data_file, (version, dict(metadata)))
+
+    def invalidate(self, data_file):
+        """
+        Forgets the metadata of a data file.
+
+        :param data_file: data file path
+        """
+        self._metadata.pop(data_file)
+
+
+class PageCacheTracker(object):
+    """
+    Decides which objects read by GETs may stay in the page cache, so that
+    popular objects of any size are served from memory while one-off reads
+    do not push them out.
+
+    How often each object is read is estimated with a count-min sketch of
+    4 rows of ``sketch_size`` counters, all halved every 10 * sketch_size
+    reads so that popularity fades. The objects whose pages are kept are
+    remembered least recently read first, with their sizes adding up to no
+    more than ``budget`` bytes. An object is admitted once it has been read
+    ``min_hits`` times, evicting the least recently read objects to make
+    room, unless one of those is read at least as often as it is
+    (TinyLFU admission). Everything else has its pages dropped after the
+    read.
+
+    :param budget: bytes of objects whose pages may be kept
+    :param min_hits: reads of an object before its pages are kept
+    :param sketch_size: counters per row of the sketch; rounded up to a
+                        power of two
+    :param logger: optional logger; decisions are counted as
+                   page_cache.hits (the object is still kept),
+                   page_cache.misses and page_cache.evictions
+    """
+
+    def __init__(self, budget, min_hits=2, sketch_size=65536, logger=None):
+        self.budget = budget
+        self.min_hits = min_hits
+        self.logger = logger
+        self._mask = 1
+        while self._mask < sketch_size:
+            self._mask <<= 1
+        self._rows = [bytearray(self._mask) for _junk in xrange(4)]
+        self._mask -= 1
+        self._reads = 0
+        self._sample_size = 10 * (self._mask + 1)
+        # key -> size, least recently read first
+        self._kept = LRUCache(sys.maxint)
+        self.kept_bytes = 0
+
+    def _indexes(self, key):
+        digest = hashlib.md5(key).digest()
+        return [(row, index & self._mask) for row, index in
+                zip(self._rows, struct.unpack('!4I', digest))]
+
+    def estimate(self, key):
+        """
+        Returns an estimate of how often an object has been read lately.
+
+        :param key: the object's key
+        """
+        return min(row[index] for row, index in self._indexes(key))
+
+    def _record(self, key):
+        indexes = self._indexes(key)
+        count = min(row[index] for row, index in indexes)
+        if count < 255:
+            # Conservative update: only the smallest counters are raised.
+            for row, index in indexes:
+                if row[index] == count:
+                    row[index] = count + 1
+        self._reads += 1
+        if self._reads >= self._sample_size:
+            for row in self._rows:
+                for index in xrange(len(row)):
+                    row[index] >>= 1
+            self._reads //= 2
+        return count + 1 if count < 255 else count
+
+    def _count(self, metric):
+        if self.logger:
+            self.logger.increment('page_cache.' + metric)
+
+    def keep(self, key, size):
+        """
+        Records a read of an object, and returns whether its pages should
+        be kept in the page cache.
+
+        :param key: the object's key, e.g. its data file's path
+        :param size: the object's size in bytes
+        """
+        frequency = self._record(key)
+        if self._kept.get(key) is not None:
+            self._count('hits')
+            return True
+        self._count('misses')
+        if size > self.budget or frequency < self.min_hits:
+            return False
+        while self.kept_bytes + size > self.budget:
+            victim, victim_size = self._kept.oldest()
+            if self.estimate(victim) >= frequency:
+                return False
+            self._kept.pop(victim)
+            self.kept_bytes -= victim_size
+            self._count('evictions')
+        self._kept.set(key, size)
+        self.kept_bytes += size
+        return True
 
 
 class DiskWriter(object):
@@ -284,6 +1353,7 @@ class DiskWriter(object):
         self.upload_size = 0
         self.last_sync = 0
         self.threadpool = threadpool
+        self._writing = None
 
     def write(self, chunk):
         """
@@ -307,14 +1377,53 @@ class DiskWriter(object):
             drop_buffer_cache(self.fd, self.last_sync, diff)
             self.last_sync = self.upload_size
 
+    def _write_chunks(self, chunks, etag):
+        for chunk in chunks:
+            if etag is not None:
+                etag.update(chunk)
+            while chunk:
+                written = os.write(self.fd, chunk)
+                self.upload_size += written
+                chunk = chunk[written:]
+            diff = self.upload_size - self.last_sync
+            if diff >= self.disk_file.bytes_per_sync:
+                fdatasync(self.fd)
+                drop_buffer_cache(self.fd, self.last_sync, diff)
+                self.last_sync = self.upload_size
+
+    def write_batch(self, chunks, etag=None):
+        """
+        Hash and write a batch of chunks in a thread without waiting for it,
+        so that the next batch can be received meanwhile. Only one batch is
+        written at a time; the one before is waited for first.
+
+        :param chunks: list of chunks of data to write as string objects
+        :param etag: optional hash object to update with the chunks
+        """
+        self.wait()
+        self._writing = spawn(self.threadpool.force_run_in_thread,
+                              self._write_chunks, chunks, etag)
+
+    def wait(self):
+        """
+        Wait for the batch being written, if any, re-raising its error.
+        """
+        writing, self._writing = self._writing, None
+        if writing is not None:
+            writing.wait()
+
     def _finalize_put(self, metadata, target_path):
         # Write the metadata before calling fsync() so that both data and
         # metadata are flushed to disk.
-        write_metadata(self.fd, metadata)
+        write_metadata(self.fd, metadata,
+                       compact=self.disk_file.compact_metadata)
         # We call fsync() before calling drop_cache() to lower the amount
         # of redundant work the drop cache code will perform on the pages
         # (now that after fsync the pages will be all clean).
-        fsync(self.fd)
+        if self.disk_file.fsync_batcher:
+            self.disk_file.fsync_batcher.sync(self.fd)
+        else:
+            fsync(self.fd)
         # From the Department of the Redundancy Department, make sure
         # we call drop_cache() after fsync() to avoid redundant work
         # (pages all clean).
@@ -325,6 +1434,45 @@ class DiskWriter(object):
         renamer(self.tmppath, target_path)
         hash_cleanup_listdir(self.disk_file.datadir)
 
+    def _should_pack(self, extension):
+        """
+        Small .data files go to the partition's volume. Tombstones and .meta
+        files do too, unless the object has a hash directory already.
+        """
+        disk_file = self.disk_file
+        if not (disk_file.volume and disk_file.pack_max_size):
+            return False
+        if extension == '.data':
+            return self.upload_size <= disk_file.pack_max_size
+        return not exists(disk_file.datadir)
+
+    def _finalize_pack(self, metadata, timestamp, extension):
+        datadir = self.disk_file.datadir
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        for chunk in iter(lambda: os.read(self.fd, 65536), ''):
+            chunks.append(chunk)
+        invalidate_hash(dirname(datadir))
+        self.disk_file.volume.append(basename(datadir), timestamp, extension,
+                                     metadata, ''.join(chunks))
+        # Remove any files the new record makes obsolete.
+        try:
+            files = os.listdir(datadir)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+        packed_name = timestamp + extension
+        for filename in get_obsolete_files(files + [packed_name]):
+            if filename != packed_name:
+                os.unlink(join(datadir, filename))
+                files.remove(filename)
+        if not files:
+            try:
+                os.rmdir(datadir)
+            except OSError:
+                pass
+
     def put(self, metadata, extension='.data'):
         """
         Finalize writing the file on disk, and renames it from the temp file
@@ -336,12 +1484,21 @@ class DiskWriter(object):
         """
         if not self.tmppath:
             raise ValueError("tmppath is unusable.")
+        self.wait()
         timestamp = normalize_timestamp(metadata['X-Timestamp'])
         metadata['name'] = self.disk_file.name
         target_path = join(self.disk_file.datadir, timestamp + extension)
 
-        self.threadpool.force_run_in_thread(
-            self._finalize_put, metadata, target_path)
+        if self._should_pack(extension):
+            self.threadpool.force_run_in_thread(
+                self._finalize_pack, metadata, timestamp, extension)
+        else:
+            self.threadpool.force_run_in_thread(
+                self._finalize_put, metadata, target_path)
+        if self.disk_file.listing_cache:
+            self.disk_file.listing_cache.invalidate(self.disk_file.datadir)
+        if self.disk_file.metadata_cache and self.disk_file.data_file:
+            self.disk_file.metadata_cache.invalidate(self.disk_file.data_file)
         self.disk_file.metadata = metadata
 
 
@@ -360,6 +1517,20 @@ class DiskFile(object):
     :param bytes_per_sync: number of bytes between fdatasync calls
     :param iter_hook: called when __iter__ returns a chunk
     :param threadpool: thread pool in which to do blocking operations
+    :param fsync_batcher: optional FsyncBatcher shared by the device's PUTs
+                          so that their final fsyncs are group committed
+    :param compact_metadata: write new metadata in the compact format
+    :param sendfile: optional callable, as given by the WSGI server in
+                     swift.sendfile, used to send the data to the client
+    :param listing_cache: optional HashDirListingCache used to list the
+                          object's hash directory
+    :param packed_volumes: if True, also look for the object in its
+                           partition's packing volume
+    :param pack_max_size: with packed_volumes, .data files of up to this many
+                          bytes are appended to the volume; 0 packs nothing
+    :param metadata_cache: optional MetadataCache of the metadata of data
+                           files; on a hit the data file is not opened until
+                           the data is read
 
     :raises DiskFileCollision: on md5 collision
     """
@@ -367,7 +1538,10 @@ class DiskFile(object):
     def __init__(self, path, device, partition, account, container, obj,
                  logger, keep_data_fp=False, disk_chunk_size=65536,
                  bytes_per_sync=(512 * 1024 * 1024), iter_hook=None,
-                 threadpool=None, obj_dir='objects', mount_check=False):
+                 threadpool=None, obj_dir='objects', mount_check=False,
+                 fsync_batcher=None, compact_metadata=False, sendfile=None,
+                 listing_cache=None, packed_volumes=False, pack_max_size=0,
+                 metadata_cache=None):
         if mount_check and not check_mount(path, device):
             raise DiskFileDeviceUnavailable()
         self.disk_chunk_size = disk_chunk_size
@@ -390,6 +1564,22 @@ class DiskFile(object):
         self.keep_cache = False
         self.suppress_file_closing = False
         self.threadpool = threadpool or ThreadPool(nthreads=0)
+        self.fsync_batcher = fsync_batcher
+        self.compact_metadata = compact_metadata
+        self.sendfile = sendfile
+        self.listing_cache = listing_cache
+        self.volume = None
+        if packed_volumes:
+            self.volume = get_volume(dirname(dirname(self.datadir)))
+        self.pack_max_size = pack_max_size
+        # Records standing in for files, by file name, and the one holding
+        # the data, if the data file is packed.
+        self.volume_entries = {}
+        self.volume_entry = None
+        self.metadata_cache = metadata_cache
+        # Set when the metadata came from the cache and the data file is
+        # still to be opened for reading; see open_data_file().
+        self.open_deferred = False
 
         data_file, meta_file, ts_file = self._get_ondisk_file()
         if not data_file:
@@ -397,7 +1587,9 @@ class DiskFile(object):
                 self._construct_from_ts_file(ts_file)
         else:
             fp = self._construct_from_data_file(data_file, meta_file)
-            if keep_data_fp:
+            if fp is None:
+                self.open_deferred = keep_data_fp
+            elif keep_data_fp:
                 self.fp = fp
             else:
                 fp.close()
@@ -424,32 +1616,44 @@ class DiskFile(object):
                      object exists, and optionally has fast-POST metadata
         """
         data_file = meta_file = ts_file = None
+        files = ()
         try:
-            files = sorted(os.listdir(self.datadir), reverse=True)
+            if self.listing_cache:
+                files = self.listing_cache.listdir(self.datadir)
+            else:
+                files = sorted(os.listdir(self.datadir), reverse=True)
         except OSError as err:
             if err.errno != errno.ENOENT:
                 raise
-            # The data directory does not exist, so the object cannot exist.
-        else:
-            for afile in files:
-                assert ts_file is None, "On-disk file search loop" \
-                    " continuing after tombstone, %s, encountered" % ts_file
-                assert data_file is None, "On-disk file search loop" \
-                    " continuing after data file, %s, encountered" % data_file
-                if afile.endswith('.ts'):
-                    meta_file = None
-                    ts_file = join(self.datadir, afile)
-                    break
-                if afile.endswith('.meta') and not meta_file:
-                    meta_file = join(self.datadir, afile)
-                    # NOTE: this does not exit this loop, since a fast-POST
-                    # operation just updates metadata, writing one or more
-                    # .meta files, the data file will have an older timestamp,
-                    # so we keep looking.
-                    continue
-                if afile.endswith('.data'):
-                    data_file = join(self.datadir, afile)
-                    break
+            # The data directory does not exist, so the object cannot exist
+            # unless it is packed.
+        if self.volume:
+            for entry in self.volume.lookup(
+                    basename(self.datadir)).itervalues():
+                if entry.filename not in files:
+                    self.volume_entries[entry.filename] = entry
+            if self.volume_entries:
+                files = sorted(set(files).union(self.volume_entries),
+                               reverse=True)
+        for afile in files:
+            assert ts_file is None, "On-disk file search loop" \
+                " continuing after tombstone, %s, encountered" % ts_file
+            assert data_file is None, "On-disk file search loop" \
+                " continuing after data file, %s, encountered" % data_file
+            if afile.endswith('.ts'):
+                meta_file = None
+                ts_file = join(self.datadir, afile)
+                break
+            if afile.endswith('.meta') and not meta_file:
+                meta_file = join(self.datadir, afile)
+                # NOTE: this does not exit this loop, since a fast-POST
+                # operation just updates metadata, writing one or more
+                # .meta files, the data file will have an older timestamp,
+                # so we keep looking.
+                continue
+            if afile.endswith('.data'):
+                data_file = join(self.datadir, afile)
+                break
         assert ((data_file is None and meta_file is None and ts_file is None)
                 or (ts_file is not None and data_file is None
                     and meta_file is None)
@@ -463,10 +1667,17 @@ class DiskFile(object):
         A tombstone means the object is considered deleted. We just need to
         pull the metadata from the tombstone file which has the timestamp.
         """
-        with open(ts_file) as fp:
-            self.metadata = read_metadata(fp)
+        self.metadata = self._read_file_metadata(ts_file)
         self.metadata['deleted'] = True
 
+    def _read_file_metadata(self, path):
+        """Read the metadata of an on-disk file, or of its packed record."""
+        entry = self.volume_entries.get(basename(path))
+        if entry:
+            return self.volume.read_metadata(entry)
+        with open(path) as fp:
+            return read_metadata(fp)
+
     def _verify_name(self):
         """
         Verify the metadata's name value matches what we think the object is
@@ -489,13 +1700,28 @@ class DiskFile(object):
         Open the data file to fetch its metadata, and fetch the metadata from
         the fast-POST .meta file as well if it exists, merging them properly.
 
-        :returns: the opened data file pointer
+        :returns: the opened data file pointer, or None if the metadata was
+                  cached and the data file has not been opened
         """
-        fp = open(data_file, 'rb')
-        datafile_metadata = read_metadata(fp)
+        self.volume_entry = self.volume_entries.get(basename(data_file))
+        version = None
+        if self.volume_entry:
+            datafile_metadata, fp = self.volume.open(self.volume_entry)
+            # The data is part of the volume's file.
+            self.sendfile = None
+        else:
+            if self.metadata_cache:
+                version, metadata = self.metadata_cache.get(data_file,
+                                                            meta_file)
+                if metadata is not None:
+                    self.metadata = metadata
+                    self._verify_name()
+                    self.data_file = data_file
+                    return None
+            fp = open(data_file, 'rb')
+            datafile_metadata = read_metadata(fp)
         if meta_file:
-            with open(meta_file) as mfp:
-                self.metadata = read_metadata(mfp)
+            self.metadata = self._read_file_metadata(meta_file)
             sys_metadata = dict(
                 [(key, val) for key, val in datafile_metadata.iteritems()
                  if key.lower() in DATAFILE_SYSTEM_META])
@@ -504,15 +1730,42 @@ class DiskFile(object):
             self.metadata = datafile_metadata
         self._verify_name()
         self.data_file = data_file
+        if version:
+            self.metadata_cache.set(data_file, version, self.metadata)
         return fp
 
+    def open_data_file(self):
+        """
+        Opens the data file, if that was put off by a cache hit. Callers
+        about to send the data should call this before committing to a
+        response, as the file may have gone since its metadata was cached.
+
+        :raises DiskFileNotExist: if the data file no longer exists
+        """
+        if self.open_deferred:
+            self.open_deferred = False
+            try:
+                self.fp = open(self.data_file, 'rb')
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                self.metadata_cache.invalidate(self.data_file)
+                raise DiskFileNotExist('Data File does not exist.')
+
     def __iter__(self):
         """Returns an iterator over the data file."""
         try:
+            self.open_data_file()
             dropped_cache = 0
             read = 0
             self.started_at_0 = False
             self.read_to_eof = False
+            if self.sendfile:
+                offset = self.fp.tell()
+                for chunk in self._sendfile_iter(
+                        offset, self._sendfile_size() - offset):
+                    yield chunk
+                return
             if self.fp.tell() == 0:
                 self.started_at_0 = True
                 self.iter_etag = hashlib.md5()
@@ -541,6 +1794,7 @@ class DiskFile(object):
 
     def app_iter_range(self, start, stop):
         """Returns an iterator over the data file for range (start, stop)"""
+        self.open_data_file()
         if start or start == 0:
             self.fp.seek(start)
         if stop is not None:
@@ -548,6 +1802,13 @@ class DiskFile(object):
         else:
             length = None
         try:
+            if self.sendfile:
+                offset = self.fp.tell()
+                if length is None:
+                    length = self._sendfile_size() - offset
+                for chunk in self._sendfile_iter(offset, length):
+                    yield chunk
+                return
             for chunk in self:
                 if length is not None:
                     length -= len(chunk)
@@ -567,6 +1828,9 @@ class DiskFile(object):
         else:
             try:
                 self.suppress_file_closing = True
+                # The MIME boundaries are yielded between the ranges, so
+                # every range has to go through the iterator as well.
+                self.sendfile = None
                 for chunk in multi_range_iterator(
                         ranges, content_type, boundary, size,
                         self.app_iter_range):
@@ -575,6 +1839,38 @@ class DiskFile(object):
                 self.suppress_file_closing = False
                 self.close()
 
+    def _sendfile_size(self):
+        """
+        Returns the size the data file should have, which is what the client
+        was told to expect.
+        """
+        if 'Content-Length' in self.metadata:
+            return int(self.metadata['Content-Length'])
+        return os.fstat(self.fp.fileno()).st_size
+
+    def _sendfile_iter(self, offset, length):
+        """
+        Returns an iterator that sends length bytes of the data file, from
+        offset, straight to the client with the sendfile callable given to
+        the DiskFile. The data never passes through the object server, so
+        its MD5 is not checked here; that is left to the auditor. A data file
+        found shorter than expected is quarantined.
+
+        :raises DiskFileError: if the data file could not be sent in full
+        """
+        # The empty chunk gets the response headers written out before the
+        # body is sent underneath the WSGI server.
+        yield ''
+        fd = self.fp.fileno()
+        sent = self.sendfile(fd, offset, length, self.threadpool.run_in_thread)
+        self._drop_cache(fd, offset, sent)
+        if sent != length:
+            # The response headers promised length bytes, so the response
+            # can only be cut short; raising gets the connection dropped.
+            self.quarantine()
+            raise DiskFileError(
+                'Sent %s of %s bytes of %s' % (sent, length, self.data_file))
+
     def _handle_close_quarantine(self):
         """Check if file needs to be quarantined"""
         try:
@@ -597,6 +1893,7 @@ class DiskFile(object):
         :param verify_file: Defaults to True. If false, will not check
                             file to see if it needs quarantining.
         """
+        self.open_deferred = False
         if self.fp:
             try:
                 if verify_file:
@@ -642,14 +1939,22 @@ class DiskFile(object):
         if not exists(self.tmpdir):
             mkdirs(self.tmpdir)
         fd, tmppath = mkstemp(dir=self.tmpdir)
+        writer = None
         try:
             if size is not None and size > 0:
                 try:
                     fallocate(fd, size)
                 except OSError:
                     raise DiskFileNoSpace()
-            yield DiskWriter(self, fd, tmppath, self.threadpool)
+            writer = DiskWriter(self, fd, tmppath, self.threadpool)
+            yield writer
         finally:
+            if writer:
+                # Don't close the file under a batch still being written.
+                try:
+                    writer.wait()
+                except (Exception, Timeout):
+                    pass
             try:
                 os.close(fd)
             except OSError:
@@ -681,7 +1986,7 @@ class DiskFile(object):
 
     def _drop_cache(self, fd, offset, length):
         """Method for no-oping buffer cache drop method."""
-        if not self.keep_cache:
+        if not (self.keep_cache or self.volume_entry):
             drop_buffer_cache(fd, offset, length)
 
     def quarantine(self):
@@ -693,11 +1998,42 @@ class DiskFile(object):
                   directory otherwise None
         """
         if not (self.is_deleted() or self.quarantined_dir):
-            self.quarantined_dir = self.threadpool.run_in_thread(
-                quarantine_renamer, self.device_path, self.data_file)
+            if self.metadata_cache:
+                self.metadata_cache.invalidate(self.data_file)
+            if self.volume_entry:
+                self.quarantined_dir = self.threadpool.run_in_thread(
+                    self._quarantine_packed)
+            else:
+                self.quarantined_dir = self.threadpool.run_in_thread(
+                    quarantine_renamer, self.device_path, self.data_file)
             self.logger.increment('quarantines')
             return self.quarantined_dir
 
+    def _quarantine_packed(self):
+        """
+        Copy a packed object's data record out to the quarantine area, then
+        have the volume forget the object.
+
+        :returns: path (str) of the directory the record was copied to
+        """
+        to_dir = join(self.device_path, 'quarantined', 'objects',
+                      basename(self.datadir))
+        if exists(to_dir):
+            to_dir = "%s-%s" % (to_dir, uuid.uuid4().hex)
+        mkdirs(to_dir)
+        metadata, fp = self.volume.open(self.volume_entry)
+        try:
+            with open(join(to_dir, basename(self.data_file)), 'wb') as qfp:
+                for chunk in iter(lambda: fp.read(65536), ''):
+                    qfp.write(chunk)
+                qfp.flush()
+                write_metadata(qfp.fileno(), metadata)
+        finally:
+            fp.close()
+        invalidate_hash(dirname(self.datadir))
+        self.volume.quarantine(basename(self.datadir))
+        return to_dir
+
     def get_data_file_size(self):
         """
         Returns the os.path.getsize for the file.  Raises an exception if this
@@ -711,8 +2047,11 @@ class DiskFile(object):
         try:
             file_size = 0
             if self.data_file:
-                file_size = self.threadpool.run_in_thread(
-                    getsize, self.data_file)
+                if self.volume_entry:
+                    file_size = self.volume_entry.data_length
+                else:
+                    file_size = self.threadpool.run_in_thread(
+                        getsize, self.data_file)
                 if 'Content-Length' in self.metadata:
                     metadata_size = int(self.metadata['Content-Length'])
                     if file_size != metadata_size:
@@ -724,3 +2063,184 @@ class DiskFile(object):
             if err.errno != errno.ENOENT:
                 raise
         raise DiskFileNotExist('Data File does not exist.')
+
+
+class DiskFileManager(object):
+    """
+    Management class for the object server's DiskFiles, holding what is
+    shared between them and the operations that are not about one object.
+
+    The object server loads its manager from the diskfile_manager option,
+    so other storage backends can be plugged in by providing a class with
+    the same interface:
+
+    * ``__init__(conf, logger)``, given the object server's configuration
+    * ``get_diskfile(device, partition, account, container, obj, **kwargs)``
+      returning an object with DiskFile's interface. The keyword arguments
+      are those of DiskFile; backends ignore any they have no use for.
+    * ``get_hashes(device, partition, suffixes)`` for REPLICATE
+    * ``get_missing_files(device, partition, offered)`` and
+      ``put_object_files(device, partition, files)`` for REPLICATE requests
+      of the HTTP object sync (see swift.obj.sync)
+    * ``get_partition_hashes(device, partitions, deadline=None)`` for
+      REPLICATE requests comparing hash trees (see swift.obj.hashtree)
+    * ``pickle_async_update(device, account, container, obj, data,
+      timestamp)`` to save a container update for the object updater
+
+    This is the manager of objects stored as files on local devices.
+
+    :param conf: object server configuration
+    :param logger: logger for the DiskFiles
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.devices = conf.get('devices', '/srv/node/')
+        self.mount_check = config_true_value(conf.get('mount_check', 'true'))
+        self.disk_chunk_size = int(conf.get('disk_chunk_size', 65536))
+        self.bytes_per_sync = int(conf.get('mb_per_sync', 512)) * 1024 * 1024
+        self.threads_per_disk = int(conf.get('threads_per_disk', '0'))
+        self.threadpools = defaultdict(
+            lambda: ThreadPool(nthreads=self.threads_per_disk))
+        self.fsync_batch_window = float(conf.get('fsync_batch_window', 0))
+        self.fsync_batchers = defaultdict(
+            lambda: FsyncBatcher(window=self.fsync_batch_window))
+        self.compact_metadata = config_true_value(
+            conf.get('compact_metadata', 'false'))
+        self.suffix_hash_concurrency = int(
+            conf.get('suffix_hash_concurrency', 1))
+        self.reclaim_age = int(conf.get('reclaim_age', ONE_WEEK))
+        self.pack_max_size = int(conf.get('pack_max_size', 0))
+        hash_dir_cache_size = int(conf.get('hash_dir_cache_size', 0))
+        self.hash_dir_cache = None
+        if hash_dir_cache_size > 0:
+            self.hash_dir_cache = HashDirListingCache(hash_dir_cache_size,
+                                                      logger=logger)
+        self.async_pending_journal = config_true_value(
+            conf.get('async_pending_journal', 'false'))
+        self.journal_segment_size = int(
+            conf.get('journal_segment_size', DEFAULT_SEGMENT_SIZE))
+        self.async_journals = {}
+        self.hash_trees = {}
+        metadata_cache_size = int(conf.get('metadata_cache_size', 0))
+        self.metadata_cache = None
+        if metadata_cache_size > 0:
+            self.metadata_cache = MetadataCache(metadata_cache_size,
+                                                logger=logger)
+
+    def get_diskfile(self, device, partition, account, container, obj,
+                     **kwargs):
+        """
+        Returns a DiskFile for an object.
+
+        :raises DiskFileDeviceUnavailable: if the device is not mounted
+        """
+        kwargs.setdefault('mount_check', self.mount_check)
+        kwargs.setdefault('bytes_per_sync', self.bytes_per_sync)
+        kwargs.setdefault('disk_chunk_size', self.disk_chunk_size)
+        kwargs.setdefault('threadpool', self.threadpools[device])
+        if self.fsync_batch_window > 0:
+            kwargs.setdefault('fsync_batcher', self.fsync_batchers[device])
+        kwargs.setdefault('obj_dir', DATADIR)
+        kwargs.setdefault('compact_metadata', self.compact_metadata)
+        kwargs.setdefault('listing_cache', self.hash_dir_cache)
+        kwargs.setdefault('metadata_cache', self.metadata_cache)
+        if self.pack_max_size > 0:
+            kwargs.setdefault('packed_volumes', True)
+            kwargs.setdefault('pack_max_size', self.pack_max_size)
+        return DiskFile(self.devices, device, partition, account,
+                        container, obj, self.logger, **kwargs)
+
+    def get_hashes(self, device, partition, suffixes):
+        """
+        Returns the suffix hashes of a partition, recalculating the given
+        suffixes, as get_hashes() does.
+
+        :raises DiskFileDeviceUnavailable: if the device is not mounted
+        """
+        if self.mount_check and not check_mount(self.devices, device):
+            raise DiskFileDeviceUnavailable()
+        path = join(self.devices, device, DATADIR, partition)
+        if not exists(path):
+            mkdirs(path)
+        return self.threadpools[device].force_run_in_thread(
+            get_hashes, path, recalculate=suffixes,
+            concurrency=self.suffix_hash_concurrency)
+
+    def _partition_path(self, device, partition):
+        if self.mount_check and not check_mount(self.devices, device):
+            raise DiskFileDeviceUnavailable()
+        return join(self.devices, device, DATADIR, partition)
+
+    def get_missing_files(self, device, partition, offered):
+        """
+        Returns which of the object files offered by another node are
+        needed here, as missing_object_files() does.
+
+        :raises DiskFileDeviceUnavailable: if the device is not mounted
+        """
+        return self.threadpools[device].force_run_in_thread(
+            missing_object_files, self._partition_path(device, partition),
+            offered)
+
+    def put_object_files(self, device, partition, files):
+        """
+        Writes object files received from another node, as
+        write_object_files() does.
+
+        :returns: number of files written
+        :raises DiskFileDeviceUnavailable: if the device is not mounted
+        """
+        written = write_object_files(
+            self._partition_path(device, partition), files,
+            compact_metadata=self.compact_metadata,
+            chunk_size=self.disk_chunk_size,
+            threadpool=self.threadpools[device])
+        if self.hash_dir_cache:
+            for path in written:
+                self.hash_dir_cache.invalidate(dirname(path))
+        return len(written)
+
+    def get_partition_hashes(self, device, partitions, deadline=None):
+        """
+        Returns the hashes of some partitions of a device from its hash
+        tree; see DeviceHashTree.get().
+
+        :raises DiskFileDeviceUnavailable: if the device is not mounted
+        """
+        if self.mount_check and not check_mount(self.devices, device):
+            raise DiskFileDeviceUnavailable()
+        tree = self.hash_trees.get(device)
+        if tree is None:
+            tree = self.hash_trees[device] = DeviceHashTree(
+                join(self.devices, device), reclaim_age=self.reclaim_age,
+                concurrency=self.suffix_hash_concurrency)
+        return self.threadpools[device].force_run_in_thread(
+            tree.get, partitions, deadline)
+
+    def pickle_async_update(self, device, account, container, obj, data,
+                            timestamp):
+        """
+        Saves a container update in the device's async_pending directory,
+        or appends it to the device's async pending journal if that is
+        enabled.
+        """
+        if self.async_pending_journal:
+            journal = self.async_journals.get(device)
+            if journal is None:
+                journal = self.async_journals[device] = AsyncPendingJournal(
+                    join(self.devices, device),
+                    segment_size=self.journal_segment_size)
+            try:
+                self.threadpools[device].run_in_thread(journal.append, data)
+                return
+            except LockTimeout:
+                # async_pending is still read, so fall back to it rather
+                # than lose the update.
+                self.logger.increment('async_journal.lock_timeouts')
+        ohash = hash_path(account, container, obj)
+        self.threadpools[device].run_in_thread(
+            write_pickle, data,
+            join(self.devices, device, ASYNCDIR, ohash[-3:],
+                 ohash + '-' + normalize_timestamp(timestamp)),
+            join(self.devices, device, 'tmp'))
@@ -0,0 +1,66 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Multi-partition REPLICATE requests, for the suffix hashes of many partitions
+in one round trip rather than a request per partition.
+
+The object replicator makes a REPLICATE request to a peer's object server,
+to a partition of ``*`` and with an X-Replication-Batch header of
+``hashes``. The body is a JSON object of partitions to the lists of their
+suffixes to recalculate, which are empty when only the hashes are wanted.
+The response is a JSON object of the same partitions to their suffix
+hashes, as a single partition's REPLICATE request returns them. A node that
+has spent its replicate_batch_time on a request answers for the partitions
+done so far only; the replicator asks for the others in another request.
+
+The replicator fetches the hashes of a batch of a device's partitions from
+each peer before replicating them, and has the peers recalculate the
+suffixes it synced once the batch is done, over connections kept alive for
+the whole replication pass.
+"""
+
+import re
+
+from swift.common.utils import json
+
+
+BATCH_HEADER = 'X-Replication-Batch'
+_SUFFIX = re.compile(r'^[0-9a-f]{3}$')
+
+
+def parse_request(body):
+    """
+    Parses the body of a batch request.
+
+    :param body: the request body
+    :returns: dictionary of partition to list of suffixes to recalculate
+    :raises ValueError: if the body is not well formed
+    """
+    request = json.loads(body)
+    if not isinstance(request, dict):
+        raise ValueError('Invalid batch request')
+    partitions = {}
+    for partition, suffixes in request.iteritems():
+        if not partition.isdigit():
+            raise ValueError('Invalid partition %r' % (partition,))
+        if not isinstance(suffixes, list):
+            raise ValueError('Invalid suffixes of %r' % (partition,))
+        for suffix in suffixes:
+            if not isinstance(suffix, basestring) or \
+                    not _SUFFIX.match(suffix):
+                raise ValueError('Invalid suffix %r' % (suffix,))
+        partitions[str(partition)] = [str(suffix) for suffix in suffixes]
+    return partitions
@@ -0,0 +1,117 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Hash tree of a device's objects, for comparing many partitions with a peer
+in a few requests rather than a REPLICATE request per partition.
+
+The leaves of the tree are the suffix hashes in each partition's hashes
+file (see swift.obj.diskfile.get_hashes()). A partition's hash is the MD5 of
+its suffix hashes, and the partitions two devices have in common are hashed
+in buckets of consecutive partitions. The object replicator makes two
+REPLICATE requests to a peer's object server, to a partition of ``*`` and
+marked with an X-Replication-Tree header:
+
+``buckets``
+    The body is a JSON object with the ``partitions`` to compare, in order,
+    and the ``bucket_size``. The response is a JSON list of the hashes of
+    the buckets.
+
+``partitions``
+    The body is a JSON object with the ``partitions`` of the buckets that
+    differ. The response is a JSON object of those partitions to their
+    hashes.
+
+Only the partitions that still differ need their suffix hashes compared.
+
+A node answers once it has spent replicate_batch_time rehashing partitions;
+the partitions it did not get to are given the hash UNKNOWN_HASH, which never
+matches, so they are taken to differ.
+
+The partition hashes are kept in memory and, for restarts, in the device's
+object_hashes.tree file, along with the state of the hashes files they were
+computed from; a partition is only read or rehashed again once its hashes
+file changes or suffixes are invalidated.
+"""
+
+from hashlib import md5
+
+from swift.common.utils import json
+
+
+TREE_HEADER = 'X-Replication-Tree'
+HASH_TREE_FILE = 'object_hashes.tree'
+UNKNOWN_HASH = 'unknown'
+
+
+def partition_hash(hashes):
+    """
+    Returns the hash of a partition.
+
+    :param hashes: dictionary of suffix to suffix hash of the partition, as
+                   returned by get_hashes()
+    :returns: MD5 hex digest, or None if the partition has no objects
+    """
+    if not hashes:
+        return None
+    digest = md5()
+    for suffix in sorted(hashes):
+        digest.update('%s:%s\n' % (suffix, hashes[suffix]))
+    return digest.hexdigest()
+
+
+def bucket_hashes(partition_hashes, partitions, bucket_size):
+    """
+    Returns the hashes of the buckets of consecutive partitions.
+
+    :param partition_hashes: dictionary of partition to partition hash
+    :param partitions: list of the partitions, in order
+    :param bucket_size: number of partitions in a bucket
+    :returns: list of MD5 hex digests, one per bucket
+    """
+    buckets = []
+    for start in xrange(0, len(partitions), bucket_size):
+        digest = md5()
+        for partition in partitions[start:start + bucket_size]:
+            digest.update('%s:%s\n' % (
+                partition, partition_hashes.get(partition) or ''))
+        buckets.append(digest.hexdigest())
+    return buckets
+
+
+def parse_request(body):
+    """
+    Parses the body of a tree request.
+
+    :param body: the request body
+    :returns: tuple of the list of partitions and the bucket size, which is
+              None if not given
+    :raises ValueError: if the body is not well formed
+    """
+    request = json.loads(body)
+    if not isinstance(request, dict) or \
+            not isinstance(request.get('partitions'), list):
+        raise ValueError('Invalid tree request')
+    partitions = []
+    for partition in request['partitions']:
+        if not isinstance(partition, basestring) or \
+                not partition.isdigit():
+            raise ValueError('Invalid partition %r' % (partition,))
+        partitions.append(str(partition))
+    bucket_size = request.get('bucket_size')
+    if bucket_size is not None:
+        if not isinstance(bucket_size, int) or bucket_size < 1:
+            raise ValueError('Invalid bucket size %r' % (bucket_size,))
+    return partitions, bucket_size
@@ -0,0 +1,168 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Append-only journal of async pending container updates.
+
+Rather than a pickle file per update in async_pending, the object server may
+append updates to a journal per device::
+
+    <device>/async_journal/0000000000000001.journal
+    <device>/async_journal/0000000000000002.journal
+    ...
+
+Each update is a record of its length, its CRC32 and its pickle, written with
+a single append and fsynced. Updates always go to the newest segment, which
+is rotated once it reaches the configured size. Every process starts a new
+segment the first time it appends, so a record torn by a crash can only be
+the last of its segment.
+
+The object updater rotates the journal before it reads it, so no more
+updates are appended to the segments it consumes, then reads each of those
+sequentially, re-appending any updates that could not be sent yet to the
+newest segment before removing the consumed one.
+"""
+
+from __future__ import with_statement
+import cPickle as pickle
+import errno
+import os
+import struct
+import zlib
+from os.path import join
+
+from swift.common.utils import fsync, lock_path
+
+
+PICKLE_PROTOCOL = 2
+JOURNAL_DIR = 'async_journal'
+SEGMENT_SUFFIX = '.journal'
+DEFAULT_SEGMENT_SIZE = 4194304
+# Record header: length and CRC32 of the pickled update that follows.
+_RECORD_HEADER = struct.Struct('!II')
+
+
+def _segment_name(seq):
+    return '%016d%s' % (seq, SEGMENT_SUFFIX)
+
+
+def read_segment(path):
+    """
+    Reads the updates of a journal segment.
+
+    :param path: path to the segment
+    :returns: a tuple of the list of updates and the number of bytes of the
+              segment they were read from; anything past that is a torn or
+              corrupt record
+    """
+    with open(path, 'rb') as fp:
+        buf = fp.read()
+    updates = []
+    pos = 0
+    while pos + _RECORD_HEADER.size <= len(buf):
+        length, crc = _RECORD_HEADER.unpack_from(buf, pos)
+        start = pos + _RECORD_HEADER.size
+        record = buf[start:start + length]
+        if len(record) != length or \
+                zlib.crc32(record) & 0xffffffff != crc:
+            break
+        try:
+            updates.append(pickle.loads(record))
+        except Exception:
+            break
+        pos = start + length
+    return updates, pos
+
+
+class AsyncPendingJournal(object):
+    """
+    The async pending journal of one device.
+
+    :param device_path: path to the device
+    :param segment_size: size in bytes past which a new segment is started
+    """
+
+    def __init__(self, device_path, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.journal_dir = join(device_path, JOURNAL_DIR)
+        self.segment_size = segment_size
+        self._started = False
+
+    def segments(self):
+        """Returns the paths of the journal's segments, oldest first."""
+        try:
+            names = os.listdir(self.journal_dir)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        return [join(self.journal_dir, name) for name in sorted(names)
+                if name.endswith(SEGMENT_SUFFIX)]
+
+    def _new_segment(self, segments):
+        if segments:
+            seq = int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)])
+        else:
+            seq = 0
+        path = join(self.journal_dir, _segment_name(seq + 1))
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT))
+        return path
+
+    def append(self, update):
+        """
+        Appends an update to the journal.
+
+        :param update: the update, as would be pickled to async_pending
+        :raises LockTimeout: if the journal stays locked too long
+        """
+        record = pickle.dumps(update, PICKLE_PROTOCOL)
+        record = _RECORD_HEADER.pack(
+            len(record), zlib.crc32(record) & 0xffffffff) + record
+        with lock_path(self.journal_dir):
+            segments = self.segments()
+            path = segments[-1] if segments else None
+            if path is None or (not self._started and os.path.getsize(path)) \
+                    or os.path.getsize(path) >= self.segment_size:
+                path = self._new_segment(segments)
+            self._started = True
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            try:
+                offset = os.fstat(fd).st_size
+                if os.write(fd, record) != len(record):
+                    os.ftruncate(fd, offset)
+                    raise IOError(errno.EIO, 'Short write to %s' % path)
+            except Exception:
+                os.close(fd)
+                raise
+        # Other processes may append while this one waits for the disk.
+        try:
+            fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rotate(self):
+        """
+        Starts a new segment, so nothing more is appended to the existing
+        ones.
+
+        :returns: the paths of the segments that can now be consumed, oldest
+                  first
+        """
+        with lock_path(self.journal_dir):
+            segments = self.segments()
+            if segments and not os.path.getsize(segments[-1]):
+                return segments[:-1]
+            if segments:
+                self._new_segment(segments)
+            return segments
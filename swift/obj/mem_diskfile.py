@@ -0,0 +1,308 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-Memory Disk File Interface for Swift Object Server
+
+Objects are kept in a dictionary of the object server process, so nothing
+survives a restart and nothing is shared between workers. This is meant for
+measuring the request handling overhead of the proxy and object servers
+without any disk I/O; to use it, set in the object server's configuration::
+
+    diskfile_manager = swift.obj.mem_diskfile.DiskFileManager
+"""
+
+from __future__ import with_statement
+import time
+from contextlib import contextmanager
+
+from swift.common.exceptions import DiskFileNotExist
+from swift.common.swob import multi_range_iterator
+from swift.common.utils import normalize_timestamp
+from swift.obj.diskfile import DATAFILE_SYSTEM_META
+
+
+class InMemoryFileSystem(object):
+    """
+    A dictionary of object names to the object's data and metadata, standing
+    in for the devices of a node.
+    """
+
+    def __init__(self):
+        self._filesystem = {}
+
+    def get_object(self, name):
+        """
+        Returns the data and metadata of an object, or (None, None).
+        """
+        return self._filesystem.get(name, (None, None))
+
+    def put_object(self, name, data, metadata):
+        """
+        Stores an object; a data of None marks it deleted.
+        """
+        self._filesystem[name] = (data, metadata)
+
+
+class DiskWriter(object):
+    """
+    Collects the data of a PUT. Serves as the context manager object for
+    DiskFile's create() method.
+    """
+
+    def __init__(self, disk_file):
+        self.disk_file = disk_file
+        self.chunks = []
+        self.upload_size = 0
+
+    def write(self, chunk):
+        """
+        Write a chunk of data.
+
+        :param chunk: the chunk of data to write as a string object
+        """
+        self.chunks.append(chunk)
+        self.upload_size += len(chunk)
+
+    def write_batch(self, chunks, etag=None):
+        """
+        Write a batch of chunks of data.
+
+        :param chunks: list of chunks of data to write as string objects
+        :param etag: optional hash object to update with the chunks
+        """
+        for chunk in chunks:
+            if etag is not None:
+                etag.update(chunk)
+            self.write(chunk)
+
+    def wait(self):
+        """Nothing is written in the background; for compatibility."""
+        pass
+
+    def put(self, metadata, extension='.data'):
+        """
+        Stores the object's data and metadata, replacing any earlier ones.
+
+        :param metadata: dictionary of metadata to be written
+        :param extension: .data, .meta or .ts, as for an on-disk DiskFile
+        """
+        disk_file = self.disk_file
+        metadata['name'] = disk_file.name
+        data, old_metadata = disk_file.filesystem.get_object(disk_file.name)
+        if extension == '.meta':
+            if data is None:
+                # As for files, a .meta without a .data has no effect.
+                return
+            metadata.update(
+                (key, val) for key, val in old_metadata.iteritems()
+                if key.lower() in DATAFILE_SYSTEM_META)
+        elif extension == '.ts':
+            data = None
+        else:
+            data = ''.join(self.chunks)
+        disk_file.filesystem.put_object(disk_file.name, data, metadata)
+        disk_file.metadata = metadata
+
+
+class DiskFile(object):
+    """
+    Manage an object kept in an InMemoryFileSystem. This has the interface
+    of swift.obj.diskfile.DiskFile; the keyword arguments of that class that
+    mean nothing without a filesystem are accepted and ignored.
+
+    :param filesystem: the InMemoryFileSystem holding the object
+    :param account: account name for the object
+    :param container: container name for the object
+    :param obj: object name for the object
+    :param logger: logger
+    :param disk_chunk_size: size of the chunks the data is returned in
+    :param iter_hook: called when __iter__ returns a chunk
+    """
+
+    def __init__(self, filesystem, account, container, obj, logger,
+                 disk_chunk_size=65536, iter_hook=None, **kwargs):
+        self.filesystem = filesystem
+        self.name = '/' + '/'.join((account, container, obj))
+        self.logger = logger
+        self.disk_chunk_size = disk_chunk_size
+        self.iter_hook = iter_hook
+        self.keep_cache = False
+        self.quarantined_dir = None
+        self.data, metadata = filesystem.get_object(self.name)
+        self.metadata = dict(metadata or {})
+        if metadata and self.data is None:
+            self.metadata['deleted'] = True
+
+    def __iter__(self):
+        """Returns an iterator over the data."""
+        for offset in xrange(0, len(self.data or ''), self.disk_chunk_size):
+            yield self.data[offset:offset + self.disk_chunk_size]
+            if self.iter_hook:
+                self.iter_hook()
+
+    def app_iter_range(self, start, stop):
+        """Returns an iterator over the data for range (start, stop)"""
+        data = self.data[start or 0:stop]
+        for offset in xrange(0, len(data), self.disk_chunk_size):
+            yield data[offset:offset + self.disk_chunk_size]
+            if self.iter_hook:
+                self.iter_hook()
+
+    def app_iter_ranges(self, ranges, content_type, boundary, size):
+        """Returns an iterator over the data for a set of ranges"""
+        if not ranges:
+            yield ''
+        else:
+            for chunk in multi_range_iterator(
+                    ranges, content_type, boundary, size,
+                    self.app_iter_range):
+                yield chunk
+
+    def open_data_file(self):
+        """The data is already in memory; for compatibility with DiskFile."""
+        pass
+
+    def close(self, verify_file=True):
+        """Nothing to close; for compatibility with DiskFile."""
+        pass
+
+    def is_deleted(self):
+        """
+        Check if the object is deleted.
+
+        :returns: True if the object doesn't exist or has been deleted.
+        """
+        return self.data is None
+
+    def is_expired(self):
+        """
+        Check if the object is expired.
+
+        :returns: True if the object has an X-Delete-At in the past
+        """
+        return ('X-Delete-At' in self.metadata and
+                int(self.metadata['X-Delete-At']) <= time.time())
+
+    @contextmanager
+    def create(self, size=None):
+        """
+        Context manager to create an object.
+
+        :param size: ignored
+        """
+        yield DiskWriter(self)
+
+    def put_metadata(self, metadata, tombstone=False):
+        """
+        Short hand for updating the metadata of an object, or deleting it.
+
+        :param metadata: dictionary of metadata to be written
+        :param tombstone: whether or not we are deleting the object
+        """
+        extension = '.ts' if tombstone else '.meta'
+        with self.create() as writer:
+            writer.put(metadata, extension=extension)
+
+    def delete(self, timestamp):
+        """
+        Marks the object deleted.
+
+        :param timestamp: time stamp to mark the object deleted at
+        """
+        self.put_metadata({'X-Timestamp': timestamp}, tombstone=True)
+
+    def quarantine(self):
+        """
+        Objects in memory cannot be corrupted, so there is nothing to
+        quarantine.
+        """
+        return None
+
+    def get_data_file_size(self):
+        """
+        Returns the size of the object's data.
+
+        :raises DiskFileNotExist: if the object does not exist
+        """
+        if self.data is None:
+            raise DiskFileNotExist('Data File does not exist.')
+        return len(self.data)
+
+
+class DiskFileManager(object):
+    """
+    Manager of objects kept in memory, with the interface of
+    swift.obj.diskfile.DiskFileManager.
+
+    :param conf: object server configuration
+    :param logger: logger for the DiskFiles
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.filesystem = InMemoryFileSystem()
+        # (device, account, container, obj, timestamp) -> update
+        self.async_updates = {}
+
+    def get_diskfile(self, device, partition, account, container, obj,
+                     **kwargs):
+        """Returns a DiskFile for an object."""
+        return DiskFile(self.filesystem, account, container, obj,
+                        self.logger, **kwargs)
+
+    def get_hashes(self, device, partition, suffixes):
+        """
+        Objects in memory are never replicated, so there are no suffix
+        hashes to report.
+        """
+        return 0, {}
+
+    def get_missing_files(self, device, partition, offered):
+        """
+        Objects in memory are never replicated, so nothing is asked for.
+        """
+        return {}
+
+    def put_object_files(self, device, partition, files):
+        """
+        Objects in memory are never replicated, so received files are
+        discarded.
+        """
+        count = 0
+        for hsh, filename, metadata, length, read in files:
+            while length > 0:
+                chunk = read(min(length, 65536))
+                if not chunk:
+                    break
+                length -= len(chunk)
+            count += 1
+        return count
+
+    def get_partition_hashes(self, device, partitions, deadline=None):
+        """
+        Objects in memory are never replicated, so every partition is
+        empty.
+        """
+        return dict((partition, None) for partition in partitions)
+
+    def pickle_async_update(self, device, account, container, obj, data,
+                            timestamp):
+        """
+        Keeps a container update that could not be made. Nothing sends
+        these later; they are only kept so they can be looked at.
+        """
+        self.async_updates[(device, account, container, obj,
+                            normalize_timestamp(timestamp))] = data
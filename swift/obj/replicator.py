@@ -20,26 +20,117 @@ import shutil
 import time
 import itertools
 import cPickle as pickle
+from collections import defaultdict, deque
 from gettext import gettext as _
+from urllib import quote
 
 import eventlet
 from eventlet import GreenPool, tpool, Timeout, sleep, hubs
 from eventlet.green import subprocess
+from eventlet.queue import LightQueue
 from eventlet.support.greenlets import GreenletExit
 
 from swift.common.ring import Ring
 from swift.common.utils import whataremyips, unlink_older_than, \
     compute_eta, get_logger, dump_recon_cache, \
     rsync_ip, mkdirs, config_true_value, list_from_csv, get_hub, \
-    tpool_reraise
-from swift.common.bufferedhttp import http_connect
+    tpool_reraise, json, ratelimit_sleep, readconf
+from swift.common.bufferedhttp import http_connect, BufferedHTTPConnection
 from swift.common.daemon import Daemon
-from swift.common.http import HTTP_OK, HTTP_INSUFFICIENT_STORAGE
-from swift.obj.diskfile import get_hashes
+from swift.common.http import HTTP_OK, HTTP_INSUFFICIENT_STORAGE, \
+    is_success
+from swift.obj import hashbatch, hashtree, sync
+from swift.obj.diskfile import get_hashes, unpack_suffixes, \
+    remove_unpacked, list_object_files, DeviceHashTree
+from swift.obj.volume import get_volume
 
 
 hubs.use_hub(get_hub())
 
+# Replication job priorities, most urgent first: partitions to hand off,
+# partitions some of whose other nodes are known to be out of date, and the
+# routine checks of the rest.
+HANDOFF, OUT_OF_DATE, ROUTINE = 0, 1, 2
+PRIORITY_NAMES = ('handoff', 'out_of_date', 'routine')
+
+
+class ReplicationQueue(object):
+    """
+    Replication jobs queued per device and by priority. Jobs are taken most
+    urgent first, from each device holding jobs of that priority in turn,
+    so no device's backlog holds up another's.
+    """
+
+    def __init__(self):
+        # device -> one deque of jobs per priority
+        self.queues = {}
+        self.devices = deque()
+
+    def __len__(self):
+        return sum(len(jobs) for queues in self.queues.itervalues()
+                   for jobs in queues)
+
+    def push(self, job, priority):
+        """
+        Queues a job.
+
+        :param job: the job
+        :param priority: one of HANDOFF, OUT_OF_DATE or ROUTINE
+        """
+        queues = self.queues.get(job['device'])
+        if queues is None:
+            queues = self.queues[job['device']] = tuple(
+                deque() for name in PRIORITY_NAMES)
+            self.devices.append(job['device'])
+        queues[priority].append(job)
+
+    def pop(self, available=None):
+        """
+        Returns the next job to run.
+
+        :param available: optional callable telling whether a job of a
+                          device may start now
+        :returns: the job, or None if there are none that may start
+        """
+        jobs = self.pop_batch(1, available)
+        if not jobs:
+            return None
+        return jobs[0]
+
+    def pop_batch(self, size, available=None):
+        """
+        Returns the next jobs to run, of the same device and priority.
+
+        :param size: the most jobs to return
+        :param available: optional callable telling whether a job of a
+                          device may start now
+        :returns: list of jobs, empty if there are none that may start
+        """
+        best = None
+        for device in self.devices:
+            if available and not available(device):
+                continue
+            for priority, jobs in enumerate(self.queues[device]):
+                if jobs and (best is None or priority < best[1]):
+                    best = device, priority
+                    break
+        if best is None:
+            return []
+        device, priority = best
+        self.devices.remove(device)
+        self.devices.append(device)
+        jobs = self.queues[device][priority]
+        return [jobs.popleft() for _junk in xrange(min(size, len(jobs)))]
+
+    def depths(self):
+        """
+        Returns the number of jobs queued for each device by priority.
+        """
+        return dict(
+            (device, dict((name, len(jobs)) for name, jobs in
+                          zip(PRIORITY_NAMES, self.queues[device])))
+            for device in self.devices)
+
 
 class ObjectReplicator(Daemon):
     """
@@ -74,6 +165,10 @@ class ObjectReplicator(Daemon):
         self.rsync_io_timeout = conf.get('rsync_io_timeout', '30')
         self.rsync_bwlimit = conf.get('rsync_bwlimit', '0')
         self.http_timeout = int(conf.get('http_timeout', 60))
+        self.sync_method = conf.get('sync_method', 'rsync').lower()
+        if self.sync_method not in ('rsync', 'http'):
+            raise ValueError(_('Invalid sync_method: %s') % self.sync_method)
+        self.sync_chunk_size = int(conf.get('sync_chunk_size', 65536))
         self.lockup_timeout = int(conf.get('lockup_timeout', 1800))
         self.recon_cache_path = conf.get('recon_cache_path',
                                          '/var/cache/swift')
@@ -83,6 +178,266 @@ class ObjectReplicator(Daemon):
             'user-agent': 'obj-replicator %s' % os.getpid()}
         self.rsync_error_log_line_length = \
             int(conf.get('rsync_error_log_line_length', 0))
+        self.suffix_hash_concurrency = int(
+            conf.get('suffix_hash_concurrency', 1))
+        self.suffix_hash_time = 0
+        self.hash_tree = config_true_value(conf.get('hash_tree', 'false'))
+        self.hash_tree_bucket_size = int(
+            conf.get('hash_tree_bucket_size', 256))
+        self.hash_trees = {}
+        self.replicate_batch_size = int(
+            conf.get('replicate_batch_size', 32))
+        # (ip, port) -> idle connections kept alive for batch requests
+        self.peer_conns = defaultdict(list)
+        self.queue = ReplicationQueue()
+        # (device, partition) of jobs that failed to sync with some node
+        self.out_of_date = set()
+        self.reload_interval = int(conf.get('reload_interval', 60))
+        self.next_reload = time.time() + self.reload_interval
+        self.conf_mtime = None
+        if conf.get('__file__'):
+            self.conf_mtime = os.path.getmtime(conf['__file__'])
+        self.load_limits(conf)
+        self.device_jobs = defaultdict(int)
+        # device -> running times of ratelimit_sleep() for bytes and ops
+        self.device_budgets = defaultdict(lambda: [0, 0])
+        self.finished_jobs = LightQueue()
+
+    def load_limits(self, conf):
+        """
+        Sets the per-device limits, which may be changed while running by
+        editing the configuration file; see reload_limits().
+        """
+        self.device_concurrency = int(conf.get('device_concurrency', 0))
+        self.device_bytes_per_sec = int(conf.get('device_bytes_per_sec', 0))
+        self.device_iops = int(conf.get('device_iops', 0))
+
+    def report_limits(self):
+        """Saves the per-device limits in force to the recon cache."""
+        dump_recon_cache({'object_replication_limits': {
+            'device_concurrency': self.device_concurrency,
+            'device_bytes_per_sec': self.device_bytes_per_sec,
+            'device_iops': self.device_iops,
+            'loaded': time.time()}}, self.rcache, self.logger)
+
+    def reload_limits(self):
+        """
+        Reloads the per-device limits if the configuration file changed,
+        checking at most every reload_interval seconds.
+        """
+        if not self.conf_mtime or time.time() < self.next_reload:
+            return
+        self.next_reload = time.time() + self.reload_interval
+        try:
+            mtime = os.path.getmtime(self.conf['__file__'])
+            if mtime == self.conf_mtime:
+                return
+            conf = readconf(self.conf['__file__'], 'object-replicator')
+            self.load_limits(conf)
+        except (Exception, SystemExit):
+            # readconf() exits if the file cannot be parsed.
+            self.logger.exception(_('Error reloading the device limits'))
+            return
+        self.conf_mtime = mtime
+        self.logger.info(
+            _('Device limits reloaded: concurrency %(concurrency)d, '
+              '%(bytes)d bytes/s, %(iops)d IOPS'),
+            {'concurrency': self.device_concurrency,
+             'bytes': self.device_bytes_per_sec, 'iops': self.device_iops})
+        self.report_limits()
+
+    def charge(self, device, nbytes=0, ops=0):
+        """
+        Waits until the device's budgets allow for some replication work.
+
+        :param device: the device worked on
+        :param nbytes: number of bytes read or sent
+        :param ops: number of I/O operations
+        """
+        budget = self.device_budgets[device]
+        budget[0] = ratelimit_sleep(budget[0], self.device_bytes_per_sec,
+                                    incr_by=nbytes)
+        budget[1] = ratelimit_sleep(budget[1], self.device_iops,
+                                    incr_by=ops)
+
+    def device_available(self, device):
+        """Whether another job of the device may start."""
+        return not self.device_concurrency or \
+            self.device_jobs[device] < self.device_concurrency
+
+    def run_jobs(self, jobs):
+        """
+        Runs a batch of jobs of a device one after the other, counting them
+        as one against the device's concurrency. For more than one job, the
+        suffix hashes of their partitions are fetched from each node first,
+        and the nodes synced with rehash the suffixes once all are done.
+        """
+        try:
+            if len(jobs) > 1:
+                self.fetch_remote_hashes(jobs)
+            for job in jobs:
+                if job['delete']:
+                    self.update_deleted(job)
+                else:
+                    self.update(job)
+            if len(jobs) > 1:
+                self.rehash_remotes(jobs)
+        finally:
+            self.device_jobs[jobs[0]['device']] -= 1
+            self.finished_jobs.put(jobs[0]['device'])
+
+    def _batch_request(self, node, partitions):
+        """
+        Makes a multi-partition REPLICATE request, on a connection to the
+        node kept alive from earlier ones if there is one; see
+        swift.obj.hashbatch.
+
+        :param node: the "dev" entry for the remote node
+        :param partitions: dictionary of partition to list of suffixes to
+                           recalculate
+        :returns: dictionary of partition to suffix hashes
+        """
+        body = json.dumps(partitions)
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(body))
+        headers[hashbatch.BATCH_HEADER] = 'hashes'
+        idle = self.peer_conns[(node['replication_ip'],
+                                node['replication_port'])]
+        while True:
+            reused = bool(idle)
+            if reused:
+                conn = idle.pop()
+            else:
+                conn = BufferedHTTPConnection(node['replication_ip'],
+                                              node['replication_port'])
+            try:
+                conn.putrequest('REPLICATE',
+                                quote('/%s/*' % node['device']))
+                for header, value in headers.iteritems():
+                    conn.putheader(header, value)
+                # The body goes out with the headers, so a kept alive
+                # connection does not wait on a delayed ACK between them.
+                conn.endheaders(body)
+                resp = conn.getresponse()
+                result = resp.read()
+            except Exception:
+                conn.close()
+                if reused:
+                    # The node may have closed the idle connection.
+                    continue
+                raise
+            except Timeout:
+                conn.close()
+                raise
+            break
+        if resp.will_close:
+            conn.close()
+        else:
+            idle.append(conn)
+        if resp.status != HTTP_OK:
+            raise Exception(_('Invalid response %(resp)s from %(ip)s') %
+                            {'resp': resp.status,
+                             'ip': node['replication_ip']})
+        return json.loads(result)
+
+    def _iter_batch_requests(self, node, partitions):
+        """
+        Makes multi-partition REPLICATE requests until the node has answered
+        for all the partitions. A node answers for as many as it can within
+        its replicate_batch_time, so each request has to fit in http_timeout
+        on its own.
+
+        :param node: the "dev" entry for the remote node
+        :param partitions: dictionary of partition to list of suffixes to
+                           recalculate
+        :returns: iterator of dictionaries of partition to suffix hashes,
+                  one per request
+        """
+        remaining = dict(partitions)
+        while remaining:
+            with Timeout(self.http_timeout):
+                answered = self._batch_request(node, dict(remaining))
+            answered = dict((partition, hashes)
+                            for partition, hashes in answered.iteritems()
+                            if remaining.pop(partition, None) is not None)
+            if not answered:
+                raise Exception(_('No partitions answered by %s') %
+                                node['replication_ip'])
+            yield answered
+
+    def close_peer_connections(self):
+        """Closes the connections kept alive for batch requests."""
+        for idle in self.peer_conns.itervalues():
+            for conn in idle:
+                conn.close()
+        self.peer_conns.clear()
+
+    def _fetch_node_hashes(self, node, jobs):
+        """Fetches the suffix hashes of the jobs' partitions from a node."""
+        partition_jobs = dict((job['partition'], job) for job in jobs)
+        try:
+            for hashes in self._iter_batch_requests(node, dict(
+                    (partition, []) for partition in partition_jobs)):
+                for partition, suffix_hashes in hashes.iteritems():
+                    if isinstance(suffix_hashes, dict):
+                        partition_jobs[partition]['remote_hashes'][
+                            node['id']] = suffix_hashes
+        except (Exception, Timeout):
+            # The jobs not answered for make their own requests to the node
+            # instead.
+            self.logger.exception(
+                _("Error fetching hashes from node: %s") % node)
+
+    def fetch_remote_hashes(self, jobs):
+        """
+        Fetches the suffix hashes of a batch of jobs' partitions from their
+        other primary nodes, in one request per node. The hashes are kept
+        in each job's "remote_hashes" for update(), and the remote rehashes
+        the jobs need are collected in their "rehash" lists to be requested
+        by rehash_remotes().
+        """
+        peers = defaultdict(list)
+        nodes = {}
+        for job in jobs:
+            job['rehash'] = []
+            if job['delete']:
+                continue
+            job['remote_hashes'] = {}
+            for node in job['nodes']:
+                if node['id'] in job.get('synced', ()):
+                    continue
+                peers[node['id']].append(job)
+                nodes[node['id']] = node
+        pool = GreenPool(size=max(1, len(peers)))
+        for node_id, peer_jobs in peers.iteritems():
+            pool.spawn_n(self._fetch_node_hashes, nodes[node_id], peer_jobs)
+        pool.waitall()
+
+    def _rehash_node(self, node, partitions):
+        """Has a node recalculate the suffixes of some partitions."""
+        try:
+            for _junk in self._iter_batch_requests(node, partitions):
+                pass
+        except (Exception, Timeout):
+            self.logger.exception(
+                _("Error rehashing suffixes of node: %s") % node)
+
+    def rehash_remotes(self, jobs):
+        """
+        Has the nodes synced with by a batch of jobs recalculate the synced
+        suffixes, in one request per node.
+        """
+        rehashes = defaultdict(dict)
+        nodes = {}
+        for job in jobs:
+            for node, suffixes in job.pop('rehash', ()):
+                rehashes[node['id']][job['partition']] = suffixes
+                nodes[node['id']] = node
+            job.pop('remote_hashes', None)
+        pool = GreenPool(size=max(1, len(rehashes)))
+        for node_id, partitions in rehashes.iteritems():
+            pool.spawn_n(self._rehash_node, nodes[node_id], partitions)
+        pool.waitall()
 
     def _rsync(self, args):
         """
@@ -142,6 +497,30 @@ class ObjectReplicator(Daemon):
         """
         if not os.path.exists(job['path']):
             return False
+        # Packed objects only take part in the rsync as files, which are
+        # removed again afterwards.
+        unpacked = tpool_reraise(unpack_suffixes, job['path'], suffixes)
+        try:
+            return self._rsync_suffixes(node, job, suffixes)
+        finally:
+            if unpacked:
+                tpool_reraise(remove_unpacked, unpacked)
+
+    def _rsync_bwlimit(self):
+        """
+        Returns rsync's --bwlimit, within the device's bytes budget shared
+        by as many rsyncs as may run for it at once.
+        """
+        bwlimit = int(self.rsync_bwlimit)
+        if self.device_bytes_per_sec:
+            share = max(1, self.device_bytes_per_sec / 1024 /
+                        (self.device_concurrency or self.concurrency))
+            if not bwlimit or share < bwlimit:
+                bwlimit = share
+        return bwlimit
+
+    def _rsync_suffixes(self, node, job, suffixes):
+        """Runs the rsync for rsync(), once packed objects are unpacked."""
         args = [
             'rsync',
             '--recursive',
@@ -152,7 +531,7 @@ class ObjectReplicator(Daemon):
             '--ignore-existing',
             '--timeout=%s' % self.rsync_io_timeout,
             '--contimeout=%s' % self.rsync_io_timeout,
-            '--bwlimit=%s' % self.rsync_bwlimit,
+            '--bwlimit=%s' % self._rsync_bwlimit(),
         ]
         node_ip = rsync_ip(node['replication_ip'])
         if self.vm_test_mode:
@@ -171,6 +550,217 @@ class ObjectReplicator(Daemon):
                     'objects', job['partition']))
         return self._rsync(args) == 0
 
+    def http_sync(self, node, job, suffixes):
+        """
+        Synchronize local suffix directories from a partition with a remote
+        node over HTTP; see swift.obj.sync. The remote node invalidates the
+        hashes of the suffixes itself.
+
+        :param node: the "dev" entry for the remote node to sync with
+        :param job: information about the partition being synced
+        :param suffixes: a list of suffixes which need to be pushed
+
+        :returns: boolean indicating success or failure
+        """
+        if not os.path.exists(job['path']):
+            return False
+        offered = tpool_reraise(list_object_files, job['path'], suffixes,
+                                self.reclaim_age)
+        if not offered:
+            return True
+        begin = time.time()
+        body = json.dumps(offered)
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(body))
+        headers[sync.SYNC_HEADER] = 'missing'
+        conn = None
+        try:
+            with Timeout(self.http_timeout):
+                conn = http_connect(
+                    node['replication_ip'], node['replication_port'],
+                    node['device'], job['partition'], 'REPLICATE', '',
+                    headers=headers)
+                conn.send(body)
+                resp = conn.getresponse()
+                wanted = resp.read()
+                if resp.status != HTTP_OK:
+                    self.logger.error(
+                        _("Invalid response %(resp)s from %(ip)s"),
+                        {'resp': resp.status, 'ip': node['replication_ip']})
+                    return False
+                wanted = json.loads(wanted)
+                if not wanted:
+                    return True
+            # The files go over the same connection. Like rsync, sending them
+            # may take up to rsync_timeout, as long as no chunk takes longer
+            # than rsync_io_timeout.
+            with Timeout(max(self.rsync_timeout, self.http_timeout)):
+                conn.putrequest('REPLICATE', quote(
+                    '/%s/%s' % (node['device'], job['partition'])))
+                conn.putheader('User-Agent', self.headers['user-agent'])
+                conn.putheader(sync.SYNC_HEADER, 'put')
+                conn.putheader('Transfer-Encoding', 'chunked')
+                conn.endheaders()
+                sent = sync.send_files(
+                    conn, job['path'], wanted, self.sync_chunk_size,
+                    lambda nbytes, ops: self.charge(job['device'], nbytes,
+                                                    ops),
+                    io_timeout=float(self.rsync_io_timeout))
+                with Timeout(self.http_timeout):
+                    resp = conn.getresponse()
+                    resp.read()
+                if not is_success(resp.status):
+                    self.logger.error(
+                        _("Invalid response %(resp)s from %(ip)s"),
+                        {'resp': resp.status, 'ip': node['replication_ip']})
+                    return False
+        finally:
+            if conn:
+                conn.close()
+        self.logger.update_stats('sync.files', sent)
+        self.logger.debug(
+            _("Successful sync of %(sent)d files of %(src)s at %(ip)s "
+              "(%(time).03f)"),
+            {'sent': sent, 'src': job['path'], 'ip': node['replication_ip'],
+             'time': time.time() - begin})
+        return True
+
+    def sync(self, node, job, suffixes):
+        """
+        Synchronize local suffix directories from a partition with a remote
+        node, with rsync or over HTTP as configured by sync_method.
+
+        :returns: boolean indicating success or failure
+        """
+        if self.sync_method == 'http':
+            return self.http_sync(node, job, suffixes)
+        return self.rsync(node, job, suffixes)
+
+    def _rehash_remote(self, node, job, suffixes):
+        """
+        Has the remote node recalculate the hashes of suffixes after an
+        rsync. Syncs over HTTP need not do this. For jobs run in a batch,
+        this is left to rehash_remotes().
+        """
+        if self.sync_method == 'http':
+            return
+        if 'rehash' in job:
+            job['rehash'].append((node, suffixes))
+            return
+        with Timeout(self.http_timeout):
+            conn = http_connect(
+                node['replication_ip'], node['replication_port'],
+                node['device'], job['partition'], 'REPLICATE',
+                '/' + '-'.join(suffixes), headers=self.headers)
+            conn.getresponse().read()
+
+    def _tree_request(self, node, tree_step, body):
+        """Makes a REPLICATE request comparing hash trees."""
+        body = json.dumps(body)
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(body))
+        headers[hashtree.TREE_HEADER] = tree_step
+        conn = http_connect(
+            node['replication_ip'], node['replication_port'],
+            node['device'], '*', 'REPLICATE', '', headers=headers)
+        try:
+            conn.send(body)
+            resp = conn.getresponse()
+            result = resp.read()
+        finally:
+            conn.close()
+        if resp.status != HTTP_OK:
+            raise Exception(_('Invalid response %(resp)s from %(ip)s') %
+                            {'resp': resp.status,
+                             'ip': node['replication_ip']})
+        return json.loads(result)
+
+    def compare_hash_trees(self, device, node, jobs):
+        """
+        Compares the partitions of some jobs with a node that holds them
+        too, in two requests whatever their number; see swift.obj.hashtree.
+        The node is added to the "synced" set of the jobs whose partitions
+        it has the same hashes for.
+
+        :param device: the local device of the jobs
+        :param node: the "dev" entry for the remote node
+        :param jobs: the jobs of the partitions to compare
+        """
+        partitions = sorted((job['partition'] for job in jobs), key=int)
+        bucket_size = self.hash_tree_bucket_size
+        try:
+            tree = self.hash_trees.get(device)
+            if tree is None:
+                tree = self.hash_trees[device] = DeviceHashTree(
+                    join(self.devices_dir, device),
+                    reclaim_age=self.reclaim_age,
+                    concurrency=self.suffix_hash_concurrency)
+            local = tpool_reraise(tree.get, partitions)
+            with Timeout(self.http_timeout):
+                remote_buckets = self._tree_request(
+                    node, 'buckets',
+                    {'partitions': partitions, 'bucket_size': bucket_size})
+                differing = []
+                for index, bucket in enumerate(hashtree.bucket_hashes(
+                        local, partitions, bucket_size)):
+                    if index >= len(remote_buckets) or \
+                            bucket != remote_buckets[index]:
+                        differing.extend(partitions[
+                            index * bucket_size:(index + 1) * bucket_size])
+                remote = {}
+                if differing:
+                    remote = self._tree_request(
+                        node, 'partitions', {'partitions': differing})
+        except (Exception, Timeout):
+            self.logger.exception(
+                _("Error comparing hash trees with node: %s") % node)
+            return
+        differing = set(partition for partition in differing
+                        if remote.get(partition, '') != local[partition])
+        for job in jobs:
+            if job['partition'] in differing:
+                job['differing'].add(node['id'])
+            else:
+                job['synced'].add(node['id'])
+        self.logger.update_stats('hash_tree.synced',
+                                 len(jobs) - len(differing))
+        self.logger.update_stats('hash_tree.differing', len(differing))
+
+    def compare_partitions(self, jobs):
+        """
+        Compares the partitions of the jobs with their other primary nodes
+        by hash trees, a pair of local device and node at a time.
+        """
+        peers = defaultdict(list)
+        nodes = {}
+        for job in jobs:
+            if job['delete']:
+                continue
+            job['synced'] = set()
+            job['differing'] = set()
+            for node in job['nodes']:
+                peers[(job['device'], node['id'])].append(job)
+                nodes[node['id']] = node
+        pool = GreenPool(size=self.concurrency)
+        for (device, node_id), peer_jobs in peers.iteritems():
+            pool.spawn_n(self.compare_hash_trees, device, nodes[node_id],
+                         peer_jobs)
+        pool.waitall()
+
+    def job_priority(self, job):
+        """
+        Returns the priority of a job: HANDOFF for partitions that do not
+        belong on this node, OUT_OF_DATE for those a node was found to
+        differ from by hash tree or that failed to sync with some node last
+        time, and ROUTINE for the rest.
+        """
+        if job['delete']:
+            return HANDOFF
+        if job.get('differing') or \
+                (job['device'], job['partition']) in self.out_of_date:
+            return OUT_OF_DATE
+        return ROUTINE
+
     def check_ring(self):
         """
         Check to see if the ring has been updated
@@ -192,8 +782,10 @@ class ObjectReplicator(Daemon):
         """
 
         def tpool_get_suffixes(path):
-            return [suff for suff in os.listdir(path)
-                    if len(suff) == 3 and isdir(join(path, suff))]
+            suffixes = set(get_volume(path).suffixes())
+            suffixes.update(suff for suff in os.listdir(path)
+                            if len(suff) == 3 and isdir(join(path, suff)))
+            return list(suffixes)
         self.replication_count += 1
         self.logger.increment('partition.delete.count.%s' % (job['device'],))
         begin = time.time()
@@ -202,15 +794,9 @@ class ObjectReplicator(Daemon):
             suffixes = tpool.execute(tpool_get_suffixes, job['path'])
             if suffixes:
                 for node in job['nodes']:
-                    success = self.rsync(node, job, suffixes)
+                    success = self.sync(node, job, suffixes)
                     if success:
-                        with Timeout(self.http_timeout):
-                            conn = http_connect(
-                                node['replication_ip'],
-                                node['replication_port'],
-                                node['device'], job['partition'], 'REPLICATE',
-                                '/' + '-'.join(suffixes), headers=self.headers)
-                            conn.getresponse().read()
+                        self._rehash_remote(node, job, suffixes)
                     responses.append(success)
             if not suffixes or (len(responses) ==
                                 len(job['nodes']) and all(responses)):
@@ -231,13 +817,22 @@ class ObjectReplicator(Daemon):
         self.replication_count += 1
         self.logger.increment('partition.update.count.%s' % (job['device'],))
         begin = time.time()
+        failed = False
         try:
+            hash_begin = time.time()
+            # The hash trees only know of the suffixes in hashes files, so
+            # nodes found in sync are still compared with when suffixes have
+            # been listed.
+            do_listdir = (self.replication_count % 10) == 0
             hashed, local_hash = tpool_reraise(
                 get_hashes, job['path'],
-                do_listdir=(self.replication_count % 10) == 0,
-                reclaim_age=self.reclaim_age)
+                do_listdir=do_listdir,
+                reclaim_age=self.reclaim_age,
+                concurrency=self.suffix_hash_concurrency)
+            self.suffix_hash_time += time.time() - hash_begin
             self.suffix_hash += hashed
             self.logger.update_stats('suffix.hashes', hashed)
+            self.charge(job['device'], ops=hashed)
             attempts_left = len(job['nodes'])
             nodes = itertools.chain(
                 job['nodes'],
@@ -246,25 +841,38 @@ class ObjectReplicator(Daemon):
                 # If this throws StopIterator it will be caught way below
                 node = next(nodes)
                 attempts_left -= 1
+                if node['id'] in job.get('synced', ()) and not do_listdir:
+                    continue
+                remote_hash = job.get('remote_hashes', {}).pop(
+                    node['id'], None)
                 try:
-                    with Timeout(self.http_timeout):
-                        resp = http_connect(
-                            node['replication_ip'], node['replication_port'],
-                            node['device'], job['partition'], 'REPLICATE',
-                            '', headers=self.headers).getresponse()
-                        if resp.status == HTTP_INSUFFICIENT_STORAGE:
-                            self.logger.error(_('%(ip)s/%(device)s responded'
-                                                ' as unmounted'), node)
-                            attempts_left += 1
-                            continue
-                        if resp.status != HTTP_OK:
-                            self.logger.error(_("Invalid response %(resp)s "
-                                                "from %(ip)s"),
-                                              {'resp': resp.status,
-                                               'ip': node['replication_ip']})
-                            continue
-                        remote_hash = pickle.loads(resp.read())
-                        del resp
+                    if remote_hash is None:
+                        replicate_begin = time.time()
+                        with Timeout(self.http_timeout):
+                            resp = http_connect(
+                                node['replication_ip'],
+                                node['replication_port'],
+                                node['device'], job['partition'],
+                                'REPLICATE', '',
+                                headers=self.headers).getresponse()
+                            if resp.status == HTTP_INSUFFICIENT_STORAGE:
+                                self.logger.error(
+                                    _('%(ip)s/%(device)s responded as '
+                                      'unmounted'), node)
+                                attempts_left += 1
+                                continue
+                            if resp.status != HTTP_OK:
+                                self.logger.error(
+                                    _("Invalid response %(resp)s from "
+                                      "%(ip)s"),
+                                    {'resp': resp.status,
+                                     'ip': node['replication_ip']})
+                                failed = True
+                                continue
+                            remote_hash = pickle.loads(resp.read())
+                            del resp
+                        self.logger.timing_since(
+                            'partition.replicate.timing', replicate_begin)
                     suffixes = [suffix for suffix in local_hash if
                                 local_hash[suffix] !=
                                 remote_hash.get(suffix, -1)]
@@ -273,29 +881,32 @@ class ObjectReplicator(Daemon):
                     hashed, recalc_hash = tpool_reraise(
                         get_hashes,
                         job['path'], recalculate=suffixes,
-                        reclaim_age=self.reclaim_age)
+                        reclaim_age=self.reclaim_age,
+                        concurrency=self.suffix_hash_concurrency)
                     self.logger.update_stats('suffix.hashes', hashed)
+                    self.charge(job['device'], ops=hashed)
                     local_hash = recalc_hash
                     suffixes = [suffix for suffix in local_hash if
                                 local_hash[suffix] !=
                                 remote_hash.get(suffix, -1)]
-                    self.rsync(node, job, suffixes)
-                    with Timeout(self.http_timeout):
-                        conn = http_connect(
-                            node['replication_ip'], node['replication_port'],
-                            node['device'], job['partition'], 'REPLICATE',
-                            '/' + '-'.join(suffixes),
-                            headers=self.headers)
-                        conn.getresponse().read()
+                    if not self.sync(node, job, suffixes):
+                        failed = True
+                    self._rehash_remote(node, job, suffixes)
                     self.suffix_sync += len(suffixes)
                     self.logger.update_stats('suffix.syncs', len(suffixes))
                 except (Exception, Timeout):
+                    failed = True
                     self.logger.exception(_("Error syncing with node: %s") %
                                           node)
             self.suffix_count += len(local_hash)
         except (Exception, Timeout):
+            failed = True
             self.logger.exception(_("Error syncing partition"))
         finally:
+            if failed:
+                self.out_of_date.add((job['device'], job['partition']))
+            else:
+                self.out_of_date.discard((job['device'], job['partition']))
             self.partition_times.append(time.time() - begin)
             self.logger.timing_since('partition.update.timing', begin)
 
@@ -323,6 +934,13 @@ class ObjectReplicator(Daemon):
                     {'checked': self.suffix_count,
                      'hashed': (self.suffix_hash * 100.0) / self.suffix_count,
                      'synced': (self.suffix_sync * 100.0) / self.suffix_count})
+                if self.suffix_hash_time:
+                    self.logger.info(
+                        _("%(hashed)d suffixes hashed in %(time).2fs "
+                          "(%(rate).2f/sec)"),
+                        {'hashed': self.suffix_hash,
+                         'time': self.suffix_hash_time,
+                         'rate': self.suffix_hash / self.suffix_hash_time})
                 self.partition_times.sort()
                 self.logger.info(
                     _("Partition times: max %(max).4fs, "
@@ -352,6 +970,15 @@ class ObjectReplicator(Daemon):
         while True:
             eventlet.sleep(self.stats_interval)
             self.stats_line()
+            self.report_queue()
+
+    def report_queue(self):
+        """
+        Saves the number of jobs queued for each device by priority to the
+        recon cache.
+        """
+        dump_recon_cache({'object_replication_queue': self.queue.depths()},
+                         self.rcache, self.logger)
 
     def detect_lockups(self):
         """
@@ -421,6 +1048,7 @@ class ObjectReplicator(Daemon):
         self.suffix_count = 0
         self.suffix_sync = 0
         self.suffix_hash = 0
+        self.suffix_hash_time = 0
         self.replication_count = 0
         self.last_replication_count = -1
         self.partition_times = []
@@ -430,31 +1058,47 @@ class ObjectReplicator(Daemon):
         if override_partitions is None:
             override_partitions = []
 
+        self.reload_limits()
+        self.report_limits()
         stats = eventlet.spawn(self.heartbeat)
         lockup_detector = eventlet.spawn(self.detect_lockups)
         eventlet.sleep()  # Give spawns a cycle
 
         try:
             self.run_pool = GreenPool(size=self.concurrency)
-            jobs = self.collect_jobs()
-            for job in jobs:
+            jobs = []
+            for job in self.collect_jobs():
                 if override_devices and job['device'] not in override_devices:
                     continue
                 if override_partitions and \
                         job['partition'] not in override_partitions:
                     continue
-                dev_path = join(self.devices_dir, job['device'])
+                jobs.append(job)
+            if self.hash_tree:
+                self.compare_partitions(jobs)
+            self.queue = ReplicationQueue()
+            for job in jobs:
+                self.queue.push(job, self.job_priority(job))
+            self.report_queue()
+            while self.queue:
+                self.reload_limits()
+                batch_jobs = self.queue.pop_batch(
+                    max(1, self.replicate_batch_size), self.device_available)
+                if not batch_jobs:
+                    # Every device with jobs left is running all it may.
+                    self.finished_jobs.get()
+                    continue
+                device = batch_jobs[0]['device']
+                dev_path = join(self.devices_dir, device)
                 if self.mount_check and not os.path.ismount(dev_path):
-                    self.logger.warn(_('%s is not mounted'), job['device'])
+                    self.logger.warn(_('%s is not mounted'), device)
                     continue
                 if not self.check_ring():
                     self.logger.info(_("Ring change detected. Aborting "
                                        "current replication pass."))
                     return
-                if job['delete']:
-                    self.run_pool.spawn(self.update_deleted, job)
-                else:
-                    self.run_pool.spawn(self.update, job)
+                self.device_jobs[device] += 1
+                self.run_pool.spawn(self.run_jobs, batch_jobs)
             with Timeout(self.lockup_timeout):
                 self.run_pool.waitall()
         except (Exception, Timeout):
@@ -464,6 +1108,9 @@ class ObjectReplicator(Daemon):
             stats.kill()
             lockup_detector.kill()
             self.stats_line()
+            self.close_peer_connections()
+            self.queue = ReplicationQueue()
+            self.report_queue()
 
     def run_once(self, *args, **kwargs):
         start = time.time()
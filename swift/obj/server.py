@@ -17,42 +17,275 @@
 
 from __future__ import with_statement
 import cPickle as pickle
+import errno
 import os
 import time
 import traceback
-from collections import defaultdict
 from datetime import datetime
 from gettext import gettext as _
 from hashlib import md5
 
-from eventlet import sleep, Timeout
+from eventlet import GreenPool, sleep, spawn, Timeout
+from eventlet.event import Event
 
-from swift.common.utils import mkdirs, normalize_timestamp, public, \
-    hash_path, get_logger, write_pickle, config_true_value, timing_stats, \
-    ThreadPool, replication
+from swift.common.utils import public, get_logger, config_true_value, \
+    timing_stats, replication, json, dump_recon_cache
 from swift.common.bufferedhttp import http_connect
-from swift.common.constraints import check_object_creation, check_mount, \
-    check_float, check_utf8
+from swift.common.constraints import check_object_creation, check_float, \
+    check_utf8
 from swift.common.exceptions import ConnectionTimeout, DiskFileError, \
     DiskFileNotExist, DiskFileCollision, DiskFileNoSpace, \
     DiskFileDeviceUnavailable
-from swift.common.http import is_success
+from swift.common.http import is_success, HTTP_INTERNAL_SERVER_ERROR, \
+    HTTP_METHOD_NOT_ALLOWED, HTTP_SERVICE_UNAVAILABLE, \
+    HTTP_INSUFFICIENT_STORAGE
 from swift.common.request_helpers import split_and_validate_path
 from swift.common.swob import HTTPAccepted, HTTPBadRequest, HTTPCreated, \
     HTTPInternalServerError, HTTPNoContent, HTTPNotFound, HTTPNotModified, \
     HTTPPreconditionFailed, HTTPRequestTimeout, HTTPUnprocessableEntity, \
     HTTPClientDisconnect, HTTPMethodNotAllowed, Request, Response, UTC, \
     HTTPInsufficientStorage, HTTPForbidden, HTTPException, HeaderKeyDict, \
-    HTTPConflict
-from swift.obj.diskfile import DATAFILE_SYSTEM_META, DiskFile, \
-    get_hashes
+    HTTPConflict, HTTPServiceUnavailable
+from swift.obj import diskfile, hashbatch, hashtree, sync
+from swift.obj.diskfile import DATAFILE_SYSTEM_META
 
 
-DATADIR = 'objects'
-ASYNCDIR = 'async_pending'
+DATADIR = diskfile.DATADIR
+ASYNCDIR = diskfile.ASYNCDIR
 MAX_OBJECT_NAME_LENGTH = 1024
 
 
+def merge_row(op, obj, headers):
+    """
+    Returns the object row of a container MERGE request standing for an
+    object update.
+
+    :param op: operation performed (ex: 'PUT', or 'DELETE')
+    :param obj: object name
+    :param headers: headers of the update, as would be sent in the container
+                    request
+    """
+    headers = HeaderKeyDict(headers)
+    row = {'name': obj, 'created_at': headers['x-timestamp']}
+    if op == 'DELETE':
+        row['deleted'] = 1
+    else:
+        row.update(size=headers['x-size'],
+                   content_type=headers['x-content-type'],
+                   etag=headers['x-etag'])
+    return row
+
+
+class ContainerUpdateBatcher(object):
+    """
+    Write-behind buffer of container updates: updates to the same container
+    replica made within ``window`` seconds of each other are sent in a single
+    MERGE request.
+
+    The first update to arrive opens a batch and waits for the window, or
+    until the batch is full, then sends the batch; everyone who joined it
+    meanwhile is released with the status of that request, so each can still
+    save its update as an async pending if the batch failed. The transaction
+    ids of the merged updates are logged with the request.
+
+    :param window: seconds a batch stays open to collect other updates
+    :param max_batch_size: most updates in a batch
+    :param conn_timeout: connection timeout to the container server
+    :param node_timeout: request timeout to the container server
+    :param logger: logger
+    """
+
+    def __init__(self, window, max_batch_size, conn_timeout, node_timeout,
+                 logger):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.conn_timeout = conn_timeout
+        self.node_timeout = node_timeout
+        self.logger = logger
+        self._open_batches = {}
+
+    def update(self, host, partition, contdevice, account, container, obj,
+               op, headers_out):
+        """
+        Adds an update to the open batch of its container replica, opening
+        one if there is none, and waits for the batch to be sent.
+
+        :returns: the status of the MERGE request, or None if the update
+                  was not sent because it was alone in its batch or the
+                  container server does not support MERGE
+        """
+        key = (host, partition, contdevice, account, container)
+        batch = self._open_batches.get(key)
+        leader = batch is None
+        if leader:
+            batch = self._open_batches[key] = {
+                'rows': [], 'trans_ids': [], 'full': Event(), 'done': Event()}
+        batch['rows'].append(merge_row(op, obj, headers_out))
+        batch['trans_ids'].append(headers_out.get('x-trans-id', '-'))
+        if len(batch['rows']) >= self.max_batch_size and \
+                self._open_batches.get(key) is batch:
+            del self._open_batches[key]
+            batch['full'].send()
+        if not leader:
+            return batch['done'].wait()
+        with Timeout(self.window, False):
+            batch['full'].wait()
+        if self._open_batches.get(key) is batch:
+            del self._open_batches[key]
+        status = None
+        if len(batch['rows']) > 1:
+            status = self._send(host, partition, contdevice, account,
+                                container, batch['rows'], batch['trans_ids'],
+                                headers_out)
+            if status == HTTP_METHOD_NOT_ALLOWED:
+                status = None
+        batch['done'].send(status)
+        return status
+
+    def _send(self, host, partition, contdevice, account, container, rows,
+              trans_ids, headers):
+        body = json.dumps(rows)
+        headers_out = {
+            'x-timestamp': max(row['created_at'] for row in rows),
+            'x-trans-id': headers.get('x-trans-id', '-'),
+            'content-type': 'application/json',
+            'content-length': str(len(body)),
+            'user-agent': 'obj-server %s' % os.getpid()}
+        self.logger.increment('container_update_batches')
+        self.logger.update_stats('container_updates_batched', len(rows))
+        self.logger.debug(
+            _('Merging container updates of transactions %(trans_ids)s '
+              'into %(trans_id)s'),
+            {'trans_ids': ', '.join(trans_ids),
+             'trans_id': headers_out['x-trans-id']})
+        try:
+            with ConnectionTimeout(self.conn_timeout):
+                ip, port = host.rsplit(':', 1)
+                conn = http_connect(ip, port, contdevice, partition, 'MERGE',
+                                    '/%s/%s' % (account, container),
+                                    headers_out)
+            with Timeout(self.node_timeout):
+                conn.send(body)
+                response = conn.getresponse()
+                response.read()
+                return response.status
+        except (Exception, Timeout):
+            self.logger.exception(_(
+                'ERROR container update batch failed with %(host)s/%(dev)s '
+                'for transactions %(trans_ids)s'),
+                {'host': host, 'dev': contdevice,
+                 'trans_ids': ', '.join(trans_ids)})
+        return HTTP_INTERNAL_SERVER_ERROR
+
+
+class DeviceLoad(object):
+    """
+    Tracks the requests in progress on each device and how long requests
+    take, so that requests for a struggling device are turned away at once
+    rather than tying up the worker until they time out, and the proxy can
+    move on to another node.
+
+    :param max_concurrency: requests that may be in progress on a device;
+                            more are refused with 503. 0 for no limit.
+    :param max_latency: seconds requests to a device may take on average;
+                        while that is exceeded, requests are refused with
+                        507 unless none is in progress on the device. 0 for
+                        no limit.
+    :param decay: weight of each request in the average
+    """
+
+    def __init__(self, max_concurrency=0, max_latency=0, decay=0.2):
+        self.max_concurrency = max_concurrency
+        self.max_latency = max_latency
+        self.decay = decay
+        self.devices = {}
+
+    def stats(self, device):
+        """
+        Returns the stats of a device: in_flight requests, the average
+        latency in seconds, and counts of requests and rejected requests.
+        """
+        stats = self.devices.get(device)
+        if stats is None:
+            stats = self.devices[device] = {
+                'in_flight': 0, 'latency': 0.0, 'requests': 0, 'rejected': 0}
+        return stats
+
+    def admit(self, device):
+        """
+        Starts a request on a device, unless the device is overloaded.
+
+        :returns: None if the request may go ahead, in which case done()
+                  must be called when it finishes; otherwise the status to
+                  refuse it with
+        """
+        stats = self.stats(device)
+        if self.max_concurrency and \
+                stats['in_flight'] >= self.max_concurrency:
+            status = HTTP_SERVICE_UNAVAILABLE
+        elif self.max_latency and stats['in_flight'] and \
+                stats['latency'] > self.max_latency:
+            # Requests alone on the device are let through, so the average
+            # follows the device back down once it recovers.
+            status = HTTP_INSUFFICIENT_STORAGE
+        else:
+            stats['in_flight'] += 1
+            return None
+        stats['rejected'] += 1
+        return status
+
+    def done(self, device, elapsed):
+        """
+        Finishes a request admitted on a device.
+
+        :param device: the device
+        :param elapsed: seconds the request took
+        """
+        stats = self.stats(device)
+        stats['in_flight'] -= 1
+        stats['requests'] += 1
+        if stats['requests'] == 1:
+            stats['latency'] = elapsed
+        else:
+            stats['latency'] += self.decay * (elapsed - stats['latency'])
+
+
+class DeviceLoadIter(object):
+    """
+    Wraps the body of a response admitted by DeviceLoad, so that the request
+    only counts as finished once its body has been read from the device and
+    sent, or abandoned.
+
+    :param app_iter: the response body
+    :param finish: called without arguments once the body is done with
+    """
+
+    def __init__(self, app_iter, finish):
+        self.app_iter = app_iter
+        self._iter = iter(app_iter)
+        self._finish = finish
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iter.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        finish, self._finish = self._finish, None
+        if finish is None:
+            return
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            finish()
+
+
 class ObjectController(object):
     """Implements the WSGI application for the Swift Object Server."""
 
@@ -64,26 +297,54 @@ class ObjectController(object):
         /etc/swift/object-server.conf-sample.
         """
         self.logger = get_logger(conf, log_route='object-server')
-        self.devices = conf.get('devices', '/srv/node/')
-        self.mount_check = config_true_value(conf.get('mount_check', 'true'))
         self.node_timeout = int(conf.get('node_timeout', 3))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
-        self.disk_chunk_size = int(conf.get('disk_chunk_size', 65536))
+        self.container_update_wait = float(
+            conf.get('container_update_wait', self.node_timeout))
+        self.container_update_batcher = None
+        batch_window = float(conf.get('update_batch_window', 0))
+        if batch_window > 0:
+            self.container_update_batcher = ContainerUpdateBatcher(
+                batch_window,
+                int(conf.get('update_batch_size', 1000)),
+                self.conn_timeout, self.node_timeout, self.logger)
         self.network_chunk_size = int(conf.get('network_chunk_size', 65536))
+        self.put_batch_size = int(conf.get('put_batch_size', 0))
         self.keep_cache_size = int(conf.get('keep_cache_size', 5242880))
         self.keep_cache_private = \
             config_true_value(conf.get('keep_cache_private', 'false'))
+        self.page_cache = None
+        page_cache_budget = int(conf.get('page_cache_budget', 0))
+        if page_cache_budget > 0:
+            self.page_cache = diskfile.PageCacheTracker(
+                page_cache_budget,
+                int(conf.get('page_cache_min_hits', 2)),
+                int(conf.get('page_cache_sketch_size', 65536)),
+                self.logger)
+        self.device_load = DeviceLoad(
+            int(conf.get('device_max_concurrency', 0)),
+            float(conf.get('device_max_latency', 0)))
+        self.device_load_interval = float(
+            conf.get('device_load_interval', 30))
+        self._device_load_reporter = None
+        self.rcache = os.path.join(
+            conf.get('recon_cache_path', '/var/cache/swift'), 'object.recon')
         self.log_requests = config_true_value(conf.get('log_requests', 'true'))
         self.max_upload_time = int(conf.get('max_upload_time', 86400))
         self.slow = int(conf.get('slow', 0))
-        self.bytes_per_sync = int(conf.get('mb_per_sync', 512)) * 1024 * 1024
+        self.replicate_batch_time = float(
+            conf.get('replicate_batch_time', 10))
         replication_server = conf.get('replication_server', None)
         if replication_server is not None:
             replication_server = config_true_value(replication_server)
         self.replication_server = replication_server
-        self.threads_per_disk = int(conf.get('threads_per_disk', '0'))
-        self.threadpools = defaultdict(
-            lambda: ThreadPool(nthreads=self.threads_per_disk))
+        self.use_sendfile = config_true_value(
+            conf.get('use_sendfile', 'false'))
+        manager = conf.get('diskfile_manager',
+                           'swift.obj.diskfile.DiskFileManager')
+        mod, cls = manager.rsplit('.', 1)
+        self._diskfile_mgr = getattr(__import__(mod, fromlist=[cls]), cls)(
+            conf, self.logger)
         default_allowed_headers = '''
             content-disposition,
             content-encoding,
@@ -108,13 +369,8 @@ class ObjectController(object):
 
     def _diskfile(self, device, partition, account, container, obj, **kwargs):
         """Utility method for instantiating a DiskFile."""
-        kwargs.setdefault('mount_check', self.mount_check)
-        kwargs.setdefault('bytes_per_sync', self.bytes_per_sync)
-        kwargs.setdefault('disk_chunk_size', self.disk_chunk_size)
-        kwargs.setdefault('threadpool', self.threadpools[device])
-        kwargs.setdefault('obj_dir', DATADIR)
-        return DiskFile(self.devices, device, partition, account,
-                        container, obj, self.logger, **kwargs)
+        return self._diskfile_mgr.get_diskfile(
+            device, partition, account, container, obj, **kwargs)
 
     def async_update(self, op, account, container, obj, host, partition,
                      contdevice, headers_out, objdevice):
@@ -135,38 +391,40 @@ class ObjectController(object):
         headers_out['user-agent'] = 'obj-server %s' % os.getpid()
         full_path = '/%s/%s/%s' % (account, container, obj)
         if all([host, partition, contdevice]):
-            try:
-                with ConnectionTimeout(self.conn_timeout):
-                    ip, port = host.rsplit(':', 1)
-                    conn = http_connect(ip, port, contdevice, partition, op,
-                                        full_path, headers_out)
-                with Timeout(self.node_timeout):
-                    response = conn.getresponse()
-                    response.read()
-                    if is_success(response.status):
-                        return
-                    else:
-                        self.logger.error(_(
-                            'ERROR Container update failed '
-                            '(saving for async update later): %(status)d '
-                            'response from %(ip)s:%(port)s/%(dev)s'),
-                            {'status': response.status, 'ip': ip, 'port': port,
-                             'dev': contdevice})
-            except (Exception, Timeout):
-                self.logger.exception(_(
-                    'ERROR container update failed with '
-                    '%(ip)s:%(port)s/%(dev)s (saving for async update later)'),
-                    {'ip': ip, 'port': port, 'dev': contdevice})
-        async_dir = os.path.join(self.devices, objdevice, ASYNCDIR)
-        ohash = hash_path(account, container, obj)
+            status = None
+            if self.container_update_batcher:
+                status = self.container_update_batcher.update(
+                    host, partition, contdevice, account, container, obj,
+                    op, headers_out)
+            if status is None:
+                try:
+                    with ConnectionTimeout(self.conn_timeout):
+                        ip, port = host.rsplit(':', 1)
+                        conn = http_connect(ip, port, contdevice, partition,
+                                            op, full_path, headers_out)
+                    with Timeout(self.node_timeout):
+                        response = conn.getresponse()
+                        response.read()
+                        status = response.status
+                except (Exception, Timeout):
+                    self.logger.exception(_(
+                        'ERROR container update failed with '
+                        '%(host)s/%(dev)s (saving for async update later)'),
+                        {'host': host, 'dev': contdevice})
+            if status is not None:
+                if is_success(status):
+                    return
+                self.logger.error(_(
+                    'ERROR Container update failed '
+                    '(saving for async update later): %(status)d '
+                    'response from %(host)s/%(dev)s'),
+                    {'status': status, 'host': host, 'dev': contdevice})
         self.logger.increment('async_pendings')
-        self.threadpools[objdevice].run_in_thread(
-            write_pickle,
+        self._diskfile_mgr.pickle_async_update(
+            objdevice, account, container, obj,
             {'op': op, 'account': account, 'container': container,
              'obj': obj, 'headers': headers_out},
-            os.path.join(async_dir, ohash[-3:], ohash + '-' +
-                         normalize_timestamp(headers_out['x-timestamp'])),
-            os.path.join(self.devices, objdevice, 'tmp'))
+            headers_out['x-timestamp'])
 
     def container_update(self, op, account, container, obj, request,
                          headers_out, objdevice):
@@ -206,10 +464,30 @@ class ObjectController(object):
 
         headers_out['x-trans-id'] = headers_in.get('x-trans-id', '-')
         headers_out['referer'] = request.as_referer()
+        if not updates:
+            return
+        pool = GreenPool(len(updates))
         for conthost, contdevice in updates:
-            self.async_update(op, account, container, obj, conthost,
-                              contpartition, contdevice, headers_out,
-                              objdevice)
+            pool.spawn_n(self.async_update, op, account, container, obj,
+                         conthost, contpartition, contdevice, headers_out,
+                         objdevice)
+        # Wait for the container servers, so that a listing made right after
+        # the response shows the object; a shorter container_update_wait
+        # stops one slow container server holding up the response, leaving
+        # updates still running to go on in the background, and be saved as
+        # async pendings if they fail.
+        try:
+            with Timeout(self.container_update_wait) as timer:
+                pool.waitall()
+        except Timeout as t:
+            if t is not timer:
+                raise
+            self.logger.increment('container_update_timeouts')
+            self.logger.debug(
+                _('Container update of %(path)s still running after '
+                  '%(wait).4fs, finishing it in the background'),
+                {'path': '/%s/%s/%s' % (account, container, obj),
+                 'wait': self.container_update_wait})
 
     def delete_at_update(self, op, delete_at, account, container, obj,
                          request, objdevice):
@@ -364,15 +642,30 @@ class ObjectController(object):
         try:
             with disk_file.create(size=fsize) as writer:
                 reader = request.environ['wsgi.input'].read
+                batch = []
+                batch_size = 0
                 for chunk in iter(lambda: reader(self.network_chunk_size), ''):
                     start_time = time.time()
                     if start_time > upload_expiration:
                         self.logger.increment('PUT.timeouts')
                         return HTTPRequestTimeout(request=request)
-                    etag.update(chunk)
-                    writer.write(chunk)
+                    if self.put_batch_size > 0:
+                        # Hash and write whole batches in a thread, while
+                        # the next batch is received.
+                        batch.append(chunk)
+                        batch_size += len(chunk)
+                        if batch_size >= self.put_batch_size:
+                            writer.write_batch(batch, etag)
+                            batch = []
+                            batch_size = 0
+                    else:
+                        etag.update(chunk)
+                        writer.write(chunk)
                     sleep()
                     elapsed_time += time.time() - start_time
+                if batch:
+                    writer.write_batch(batch, etag)
+                writer.wait()
                 upload_size = writer.upload_size
                 if upload_size:
                     self.logger.transfer_rate(
@@ -428,9 +721,16 @@ class ObjectController(object):
         """Handle HTTP GET requests for the Swift Object Server."""
         device, partition, account, container, obj = \
             split_and_validate_path(request, 5, 5, True)
+        sendfile = None
+        if self.use_sendfile and 'swift.sendfile' in request.environ:
+            sendfile = request.environ['swift.sendfile']
+            # The body is sent underneath the WSGI server, so it has to pass
+            # on every chunk we yield (the headers) straight away.
+            request.environ['eventlet.minimum_write_chunk_size'] = 0
         try:
             disk_file = self._diskfile(device, partition, account, container,
-                                       obj, keep_data_fp=True, iter_hook=sleep)
+                                       obj, keep_data_fp=True, iter_hook=sleep,
+                                       sendfile=sendfile)
         except DiskFileDeviceUnavailable:
             return HTTPInsufficientStorage(drive=device, request=request)
         if disk_file.is_deleted() or disk_file.is_expired():
@@ -475,6 +775,11 @@ class ObjectController(object):
                 if_modified_since:
             disk_file.close()
             return HTTPNotModified(request=request)
+        try:
+            # Only now is the body certain to be sent.
+            disk_file.open_data_file()
+        except DiskFileNotExist:
+            return HTTPNotFound(request=request)
         response = Response(app_iter=disk_file,
                             request=request, conditional_response=True)
         response.headers['Content-Type'] = disk_file.metadata.get(
@@ -486,11 +791,16 @@ class ObjectController(object):
         response.etag = disk_file.metadata['ETag']
         response.last_modified = float(disk_file.metadata['X-Timestamp'])
         response.content_length = file_size
-        if response.content_length < self.keep_cache_size and \
-                (self.keep_cache_private or
-                 ('X-Auth-Token' not in request.headers and
-                  'X-Storage-Token' not in request.headers)):
-            disk_file.keep_cache = True
+        if self.keep_cache_private or \
+                ('X-Auth-Token' not in request.headers and
+                 'X-Storage-Token' not in request.headers):
+            if self.page_cache is not None:
+                disk_file.keep_cache = self.page_cache.keep(
+                    '%s%s/%s' % (device, disk_file.name,
+                                 disk_file.metadata['X-Timestamp']),
+                    file_size)
+            elif response.content_length < self.keep_cache_size:
+                disk_file.keep_cache = True
         if 'Content-Encoding' in disk_file.metadata:
             response.content_encoding = disk_file.metadata['Content-Encoding']
         response.headers['X-Timestamp'] = disk_file.metadata['X-Timestamp']
@@ -584,21 +894,145 @@ class ObjectController(object):
         device, partition, suffix = split_and_validate_path(
             request, 2, 3, True)
 
-        if self.mount_check and not check_mount(self.devices, device):
-            return HTTPInsufficientStorage(drive=device, request=request)
-        path = os.path.join(self.devices, device, DATADIR, partition)
-        if not os.path.exists(path):
-            mkdirs(path)
+        tree_step = request.headers.get(hashtree.TREE_HEADER)
+        if tree_step:
+            return self._replicate_tree(request, device, tree_step)
+        batch_step = request.headers.get(hashbatch.BATCH_HEADER)
+        if batch_step:
+            return self._replicate_batch(request, device, batch_step)
+        sync_step = request.headers.get(sync.SYNC_HEADER)
+        if sync_step:
+            return self._replicate_sync(request, device, partition,
+                                        sync_step)
         suffixes = suffix.split('-') if suffix else []
-        _junk, hashes = self.threadpools[device].force_run_in_thread(
-            get_hashes, path, recalculate=suffixes)
+        try:
+            hashed, hashes = self._diskfile_mgr.get_hashes(
+                device, partition, suffixes)
+        except DiskFileDeviceUnavailable:
+            return HTTPInsufficientStorage(drive=device, request=request)
+        self.logger.update_stats('REPLICATE.suffix.hashes', hashed)
         return Response(body=pickle.dumps(hashes))
 
+    def _replicate_tree(self, request, device, tree_step):
+        """
+        Handles the REPLICATE requests comparing hash trees; see
+        swift.obj.hashtree. Once replicate_batch_time has passed, partitions
+        still to be rehashed are answered for as unknown.
+        """
+        deadline = time.time() + self.replicate_batch_time
+        try:
+            partitions, bucket_size = hashtree.parse_request(request.body)
+            if tree_step not in ('buckets', 'partitions') or \
+                    (tree_step == 'buckets' and not bucket_size):
+                return HTTPBadRequest(
+                    body='Invalid tree step: %s' % tree_step,
+                    request=request, content_type='text/plain')
+            hashes = self._diskfile_mgr.get_partition_hashes(
+                device, partitions, deadline)
+        except DiskFileDeviceUnavailable:
+            return HTTPInsufficientStorage(drive=device, request=request)
+        except ValueError as err:
+            return HTTPBadRequest(body=str(err), request=request,
+                                  content_type='text/plain')
+        if tree_step == 'buckets':
+            hashes = hashtree.bucket_hashes(hashes, partitions, bucket_size)
+        return Response(body=json.dumps(hashes),
+                        content_type='application/json')
+
+    def _replicate_batch(self, request, device, batch_step):
+        """
+        Handles the REPLICATE requests for the suffix hashes of many
+        partitions; see swift.obj.hashbatch. Once replicate_batch_time has
+        passed, the partitions hashed so far are answered for and the others
+        left for another request.
+        """
+        if batch_step != 'hashes':
+            return HTTPBadRequest(
+                body='Invalid batch step: %s' % batch_step,
+                request=request, content_type='text/plain')
+        hashes = {}
+        hashed = 0
+        deadline = time.time() + self.replicate_batch_time
+        try:
+            for partition, suffixes in hashbatch.parse_request(
+                    request.body).iteritems():
+                if hashes and time.time() >= deadline:
+                    break
+                count, hashes[partition] = self._diskfile_mgr.get_hashes(
+                    device, partition, suffixes)
+                hashed += count
+        except DiskFileDeviceUnavailable:
+            return HTTPInsufficientStorage(drive=device, request=request)
+        except ValueError as err:
+            return HTTPBadRequest(body=str(err), request=request,
+                                  content_type='text/plain')
+        self.logger.update_stats('REPLICATE.suffix.hashes', hashed)
+        return Response(body=json.dumps(hashes),
+                        content_type='application/json')
+
+    def _replicate_sync(self, request, device, partition, sync_step):
+        """
+        Handles the REPLICATE requests of the HTTP object sync; see
+        swift.obj.sync.
+        """
+        try:
+            if sync_step == 'missing':
+                wanted = self._diskfile_mgr.get_missing_files(
+                    device, partition, sync.parse_offer(request.body))
+                return Response(body=json.dumps(wanted),
+                                content_type='application/json')
+            if sync_step == 'put':
+                received = self._diskfile_mgr.put_object_files(
+                    device, partition,
+                    sync.iter_files(request.environ['wsgi.input']))
+                self.logger.update_stats('REPLICATE.sync.files', received)
+                return HTTPNoContent(request=request)
+        except DiskFileDeviceUnavailable:
+            return HTTPInsufficientStorage(drive=device, request=request)
+        except (ValueError, DiskFileError) as err:
+            return HTTPBadRequest(body=str(err), request=request,
+                                  content_type='text/plain')
+        return HTTPBadRequest(body='Unknown sync step: %s' % sync_step,
+                              request=request, content_type='text/plain')
+
+    def _report_device_load(self):
+        """
+        Saves the load of the devices as seen by this worker to the recon
+        cache, alongside that of the other workers, and drops the load saved
+        by workers that have since exited.
+        """
+        workers = {str(os.getpid()): {'time': time.time(),
+                                      'devices': self.device_load.devices}}
+        try:
+            with open(self.rcache) as fp:
+                cached = json.load(fp).get('object_server_device_load')
+        except (IOError, ValueError):
+            cached = None
+        for pid in cached or ():
+            try:
+                os.kill(int(pid), 0)
+            except OSError as err:
+                if err.errno == errno.ESRCH:
+                    workers[pid] = {}
+        dump_recon_cache({'object_server_device_load': workers},
+                         self.rcache, self.logger, merge=True)
+
+    def _report_device_load_forever(self):
+        """Reports the load of the devices every device_load_interval."""
+        while True:
+            sleep(self.device_load_interval)
+            try:
+                self._report_device_load()
+            except (Exception, Timeout):
+                self.logger.exception(_('ERROR reporting device load'))
+
     def __call__(self, env, start_response):
         """WSGI Application entry point for the Swift Object Server."""
         start_time = time.time()
         req = Request(env)
         self.logger.txn_id = req.headers.get('x-trans-id', None)
+        # device the request was admitted on, until its response is sent
+        admitted = None
 
         if not check_utf8(req.path_info):
             res = HTTPPreconditionFailed(body='Invalid UTF8 or contains NULL')
@@ -615,7 +1049,33 @@ class ObjectController(object):
                 except AttributeError:
                     res = HTTPMethodNotAllowed()
                 else:
-                    res = method(req)
+                    device = None
+                    # Device load is only tracked while there are limits
+                    # to enforce.
+                    if not replication_method and \
+                            (self.device_load.max_concurrency or
+                             self.device_load.max_latency):
+                        try:
+                            device = req.split_path(1, 5, True)[0]
+                        except ValueError:
+                            pass
+                    refused = device and self.device_load.admit(device)
+                    if refused == HTTP_SERVICE_UNAVAILABLE:
+                        self.logger.increment('device_load_rejections')
+                        res = HTTPServiceUnavailable(request=req)
+                    elif refused == HTTP_INSUFFICIENT_STORAGE:
+                        self.logger.increment('device_load_rejections')
+                        res = HTTPInsufficientStorage(drive=device,
+                                                      request=req)
+                    else:
+                        try:
+                            res = method(req)
+                        except BaseException:
+                            if device:
+                                self.device_load.done(
+                                    device, time.time() - start_time)
+                            raise
+                        admitted = device
             except DiskFileCollision:
                 res = HTTPForbidden(request=req)
             except HTTPException as error_response:
@@ -640,11 +1100,21 @@ class ObjectController(object):
                 self.logger.debug(log_line)
             else:
                 self.logger.info(log_line)
+        if self._device_load_reporter is None and \
+                (self.device_load.max_concurrency or
+                 self.device_load.max_latency):
+            self._device_load_reporter = spawn(
+                self._report_device_load_forever)
         if req.method in ('PUT', 'DELETE'):
             slow = self.slow - trans_time
             if slow > 0:
                 sleep(slow)
-        return res(env, start_response)
+        app_iter = res(env, start_response)
+        if admitted:
+            # GET bodies are read from the device as they are sent.
+            return DeviceLoadIter(app_iter, lambda: self.device_load.done(
+                admitted, time.time() - start_time))
+        return app_iter
 
 
 def app_factory(global_conf, **local_conf):
@@ -0,0 +1,186 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Object sync over HTTP, as an alternative to rsync for the object replicator.
+
+Once the replicator knows which suffixes of a partition differ on a remote
+node, it makes two REPLICATE requests to the node's object server over the
+same connection, each marked with an X-Replication-Sync header:
+
+``missing``
+    The body is a JSON object of every object hash in the suffixes to the
+    names of its live files (as in a hash directory, e.g.
+    ``1376929423.12345.data``). The response is a JSON object of the hashes
+    to the names of the files the remote node lacks and that are not made
+    obsolete by what it has.
+
+``put``
+    The body is the files asked for, each as a line of JSON with its
+    ``name`` (``<suffix>/<hash>/<file name>``), metadata and data
+    ``length``, followed by the data. Metadata of byte strings, however
+    they are encoded, is sent as ``packed_metadata``: base64 of the compact
+    metadata format of swift.obj.diskfile. Other metadata is sent as a JSON
+    ``metadata`` object. It is sent with chunked transfer
+    encoding, so files are read as they are sent. The receiver writes them
+    to their hash directories and invalidates the suffixes' hashes, so no
+    further request is needed to have them rehashed.
+
+Objects packed in a partition's volume take part under the names their
+records would have as files, and are received as files.
+"""
+
+from __future__ import with_statement
+import re
+from base64 import b64decode, b64encode
+
+from swift.common.exceptions import ChunkWriteTimeout, DiskFileNotExist
+from swift.common.utils import json
+from swift.obj.diskfile import open_object_file, _pack_metadata, \
+    _unpack_metadata
+
+
+SYNC_HEADER = 'X-Replication-Sync'
+_NAME = re.compile(
+    r'^([0-9a-f]{3})/([0-9a-f]{29}\1)/(\d+\.\d+\.(?:data|meta|ts))$')
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _parse_name(name):
+    if not isinstance(name, basestring):
+        raise ValueError('Invalid object file name %r' % (name,))
+    match = _NAME.match(_utf8(name))
+    if not match:
+        raise ValueError('Invalid object file name %r' % name)
+    return match.group(2), match.group(3)
+
+
+def parse_offer(body):
+    """
+    Parses the body of a missing request.
+
+    :param body: the request body
+    :returns: dictionary of object hash to list of file names
+    :raises ValueError: if the body is not well formed
+    """
+    offer = json.loads(body)
+    if not isinstance(offer, dict):
+        raise ValueError('Invalid offer')
+    offered = {}
+    for hsh, filenames in offer.iteritems():
+        if not isinstance(filenames, list):
+            raise ValueError('Invalid files of %r' % hsh)
+        for filename in filenames:
+            _parse_name('%s/%s/%s' % (hsh[-3:], hsh, filename))
+        offered[_utf8(hsh)] = [_utf8(filename) for filename in filenames]
+    return offered
+
+
+def file_header(hsh, filename, metadata, length):
+    """Returns the line preceding a file's data in a put request."""
+    header = {'name': '%s/%s/%s' % (hsh[-3:], hsh, filename),
+              'length': length}
+    packed = _pack_metadata(metadata)
+    if packed is None:
+        header['metadata'] = metadata
+    else:
+        header['packed_metadata'] = b64encode(packed)
+    return json.dumps(header) + '\n'
+
+
+def _header_metadata(header):
+    if 'packed_metadata' in header:
+        return _unpack_metadata(b64decode(header['packed_metadata']))
+    return dict((_utf8(key), _utf8(value))
+                for key, value in header['metadata'].iteritems())
+
+
+def iter_files(wsgi_input):
+    """
+    Parses the body of a put request.
+
+    :param wsgi_input: file-like object of the request body
+    :returns: iterator of (hash, file name, metadata, length, read) tuples,
+              as expected by swift.obj.diskfile.write_object_files()
+    :raises ValueError: if the body is not well formed
+    """
+    while True:
+        line = wsgi_input.readline()
+        if not line:
+            break
+        header = json.loads(line)
+        try:
+            hsh, filename = _parse_name(header['name'])
+            metadata = _header_metadata(header)
+            length = int(header['length'])
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('Invalid file header %r' % line)
+        yield hsh, filename, metadata, length, wsgi_input.read
+
+
+def send_files(conn, partition_dir, wanted, chunk_size=65536, charge=None,
+               io_timeout=None):
+    """
+    Sends the files asked for by a missing request as the body of a put
+    request. The request line and headers must already have been sent, for
+    chunked transfer encoding.
+
+    :param conn: connection to send on
+    :param partition_dir: path to the partition directory
+    :param wanted: dictionary of object hash to list of file names
+    :param chunk_size: size of the reads of file data
+    :param charge: optional callable, given the number of bytes and of I/O
+                   operations before each read from disk
+    :param io_timeout: seconds each chunk may take to send, or None
+    :returns: number of files sent; files gone since they were offered are
+              skipped
+    :raises ChunkWriteTimeout: if a chunk takes longer than io_timeout
+    """
+    sent = 0
+    for hsh in sorted(wanted):
+        for filename in wanted[hsh]:
+            if charge:
+                charge(0, 1)
+            try:
+                metadata, fp, length = open_object_file(
+                    partition_dir, hsh, filename)
+            except DiskFileNotExist:
+                continue
+            try:
+                header = file_header(hsh, filename, metadata, length)
+                with ChunkWriteTimeout(io_timeout):
+                    conn.send('%x\r\n%s\r\n' % (len(header), header))
+                remaining = length
+                while remaining > 0:
+                    if charge:
+                        charge(min(remaining, chunk_size), 1)
+                    chunk = fp.read(min(remaining, chunk_size))
+                    if not chunk:
+                        raise DiskFileNotExist(
+                            'Truncated data of %s/%s' % (hsh, filename))
+                    remaining -= len(chunk)
+                    with ChunkWriteTimeout(io_timeout):
+                        conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+            finally:
+                fp.close()
+            sent += 1
+    with ChunkWriteTimeout(io_timeout):
+        conn.send('0\r\n\r\n')
+    return sent
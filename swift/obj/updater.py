@@ -21,17 +21,19 @@ import time
 from gettext import gettext as _
 from random import random
 
-from eventlet import patcher, Timeout
+from eventlet import GreenPool, patcher, sleep, Timeout
 
 from swift.common.bufferedhttp import http_connect
 from swift.common.exceptions import ConnectionTimeout
 from swift.common.ring import Ring
 from swift.common.utils import get_logger, renamer, write_pickle, \
-    dump_recon_cache, config_true_value
+    dump_recon_cache, config_true_value, json, hash_path, \
+    normalize_timestamp
 from swift.common.daemon import Daemon
-from swift.obj.server import ASYNCDIR
+from swift.obj.server import ASYNCDIR, merge_row
+from swift.obj.journal import AsyncPendingJournal, read_segment
 from swift.common.http import is_success, HTTP_NOT_FOUND, \
-    HTTP_INTERNAL_SERVER_ERROR
+    HTTP_INTERNAL_SERVER_ERROR, HTTP_METHOD_NOT_ALLOWED
 
 
 class ObjectUpdater(Daemon):
@@ -47,6 +49,9 @@ class ObjectUpdater(Daemon):
         self.container_ring = None
         self.concurrency = int(conf.get('concurrency', 1))
         self.slowdown = float(conf.get('slowdown', 0.01))
+        self.update_concurrency = int(conf.get('update_concurrency', 1))
+        self.update_window = int(conf.get('update_window', 1000))
+        self._next_update = 0
         self.node_timeout = int(conf.get('node_timeout', 10))
         self.conn_timeout = float(conf.get('conn_timeout', 0.5))
         self.successes = 0
@@ -89,6 +94,7 @@ class ObjectUpdater(Daemon):
                     self.failures = 0
                     forkbegin = time.time()
                     self.object_sweep(os.path.join(self.devices, device))
+                    self.journal_sweep(os.path.join(self.devices, device))
                     elapsed = time.time() - forkbegin
                     self.logger.info(
                         _('Object update sweep of %(device)s'
@@ -121,6 +127,7 @@ class ObjectUpdater(Daemon):
                     _('Skipping %s as it is not mounted'), device)
                 continue
             self.object_sweep(os.path.join(self.devices, device))
+            self.journal_sweep(os.path.join(self.devices, device))
         elapsed = time.time() - begin
         self.logger.info(
             _('Object update single threaded sweep completed: '
@@ -130,6 +137,56 @@ class ObjectUpdater(Daemon):
         dump_recon_cache({'object_updater_sweep': elapsed},
                          self.rcache, self.logger)
 
+    def _rate_limit(self):
+        """
+        Waits for the next slot to send a request in, so that requests leave
+        a device no more often than once every slowdown seconds however many
+        are sent at once.
+        """
+        now = time.time()
+        slot = max(self._next_update, now)
+        self._next_update = slot + self.slowdown
+        if slot > now:
+            sleep(slot - now)
+
+    def _process_group(self, group, process):
+        """
+        Sends the updates of one container.
+
+        :param group: list of (update, location) tuples
+        :param process: called with the group to send it
+        :returns: False if process raised, True otherwise
+        """
+        self._rate_limit()
+        try:
+            process(group)
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR processing async pendings of %s'),
+                ', '.join(sorted(set(location for _u, location in group))))
+            return False
+        return True
+
+    def _send_window(self, pool, updates, process):
+        """
+        Groups a window of updates by container and sends each group in the
+        device's pool, waiting for all of them to be sent. The updates of
+        one container are sent together, so as not to contend on the
+        container's database.
+
+        :param pool: the device's GreenPool
+        :param updates: list of (update, location) tuples
+        :param process: called with each group to send it
+        :returns: True if every group was processed without error
+        """
+        groups = {}
+        for update, location in updates:
+            groups.setdefault((update['account'], update['container']),
+                              []).append((update, location))
+        threads = [pool.spawn(self._process_group, group, process)
+                   for group in groups.itervalues()]
+        return all([thread.wait() for thread in threads])
+
     def object_sweep(self, device):
         """
         If there are async pendings on the device, walk each one and update.
@@ -140,10 +197,18 @@ class ObjectUpdater(Daemon):
         async_pending = os.path.join(device, ASYNCDIR)
         if not os.path.isdir(async_pending):
             return
+        pool = GreenPool(self.update_concurrency)
+
+        def process(group):
+            self.process_object_updates(group, device)
+
+        window = []
+        prefix_paths = []
         for prefix in os.listdir(async_pending):
             prefix_path = os.path.join(async_pending, prefix)
             if not os.path.isdir(prefix_path):
                 continue
+            prefix_paths.append(prefix_path)
             last_obj_hash = None
             for update in sorted(os.listdir(prefix_path), reverse=True):
                 update_path = os.path.join(prefix_path, update)
@@ -160,25 +225,118 @@ class ObjectUpdater(Daemon):
                 if obj_hash == last_obj_hash:
                     self.logger.increment("unlinks")
                     os.unlink(update_path)
-                else:
-                    self.process_object_update(update_path, device)
-                    last_obj_hash = obj_hash
-                time.sleep(self.slowdown)
+                    continue
+                last_obj_hash = obj_hash
+                update = self.load_object_update(update_path, device)
+                if update is None:
+                    continue
+                window.append((update, update_path))
+                if len(window) >= self.update_window:
+                    self._send_window(pool, window, process)
+                    window = []
+        self._send_window(pool, window, process)
+        for prefix_path in prefix_paths:
             try:
                 os.rmdir(prefix_path)
             except OSError:
                 pass
         self.logger.timing_since('timing', start_time)
 
-    def process_object_update(self, update_path, device):
+    def journal_sweep(self, device):
         """
-        Process the object information to be updated and update.
+        If the device has an async pending journal, send the updates in it.
+        Each segment is read in turn; only the newest update of each object
+        in the segment is sent, and those that fail are appended to the
+        journal again, or saved to async_pending if that fails. The segment
+        is only removed once every update in it was sent or saved again.
+
+        :param device: path to device
+        """
+        start_time = time.time()
+        journal = AsyncPendingJournal(device)
+        if not os.path.isdir(journal.journal_dir):
+            return
+        pool = GreenPool(self.update_concurrency)
+
+        def process(group):
+            results = self.send_object_updates(group)
+            for (update, segment), (success, new_successes) in \
+                    zip(group, results):
+                if not success:
+                    self.requeue_object_update(journal, update, device)
+
+        for segment in journal.rotate():
+            updates, length = read_segment(segment)
+            newest = {}
+            for update in updates:
+                key = (update['account'], update['container'], update['obj'])
+                current = newest.get(key)
+                if current:
+                    self.logger.increment('unlinks')
+                    if float(current['headers']['x-timestamp']) >= \
+                            float(update['headers']['x-timestamp']):
+                        continue
+                newest[key] = update
+            newest = [(update, segment) for update in newest.itervalues()]
+            processed = True
+            for i in xrange(0, len(newest), self.update_window):
+                if not self._send_window(
+                        pool, newest[i:i + self.update_window], process):
+                    processed = False
+            if not processed:
+                # Some updates were neither sent nor saved again; the
+                # segment is read again on the next sweep.
+                self.logger.increment('journal_segments_kept')
+                continue
+            if length < os.path.getsize(segment):
+                self.logger.error(
+                    _('ERROR Corrupt async pending journal segment, '
+                      'quarantining %s'), segment)
+                self.logger.increment('quarantines')
+                renamer(segment, os.path.join(
+                    device, 'quarantined', 'objects',
+                    os.path.basename(segment)))
+            else:
+                os.unlink(segment)
+        self.logger.timing_since('journal_timing', start_time)
+
+    def requeue_object_update(self, journal, update, device):
+        """
+        Appends an update that could not be sent to the journal again, or
+        saves it to async_pending if the journal cannot be appended to.
+
+        :param journal: the device's AsyncPendingJournal
+        :param update: the update
+        :param device: path to device
+        :raises: whatever saving to async_pending raised, if the update
+                 could be saved nowhere
+        """
+        try:
+            journal.append(update)
+            return
+        except (Exception, Timeout):
+            self.logger.exception(
+                _('ERROR appending to async pending journal of %s, saving '
+                  'to async_pending instead'), device)
+        ohash = hash_path(update['account'], update['container'],
+                          update['obj'])
+        write_pickle(
+            update,
+            os.path.join(device, ASYNCDIR, ohash[-3:], ohash + '-' +
+                         normalize_timestamp(
+                             update['headers']['x-timestamp'])),
+            os.path.join(device, 'tmp'))
+
+    def load_object_update(self, update_path, device):
+        """
+        Loads a pickled object update, quarantining it if it is corrupt.
 
         :param update_path: path to pickled object update file
         :param device: path to device
+        :returns: the update, or None if it was quarantined
         """
         try:
-            update = pickle.load(open(update_path, 'rb'))
+            return pickle.load(open(update_path, 'rb'))
         except Exception:
             self.logger.exception(
                 _('ERROR Pickle problem, quarantining %s'), update_path)
@@ -186,38 +344,114 @@ class ObjectUpdater(Daemon):
             renamer(update_path, os.path.join(
                     device, 'quarantined', 'objects',
                     os.path.basename(update_path)))
-            return
-        successes = update.get('successes', [])
-        part, nodes = self.get_container_ring().get_nodes(
-            update['account'], update['container'])
-        obj = '/%s/%s/%s' % \
-              (update['account'], update['container'], update['obj'])
-        success = True
-        new_successes = False
+
+    def process_object_update(self, update_path, device, update=None):
+        """
+        Process the object information to be updated and update.
+
+        :param update_path: path to pickled object update file
+        :param device: path to device
+        :param update: the update, if already loaded from update_path
+        """
+        if update is None:
+            update = self.load_object_update(update_path, device)
+            if update is None:
+                return
+        self.process_object_updates([(update, update_path)], device)
+
+    def process_object_updates(self, updates, device):
+        """
+        Update the container of a group of pickled object updates, removing
+        the updates that are complete.
+
+        :param updates: list of (update, update_path) tuples, all for the
+                        same container
+        :param device: path to device
+        """
+        results = self.send_object_updates(updates)
+        for (update, update_path), (success, new_successes) in \
+                zip(updates, results):
+            if success:
+                self.logger.increment("unlinks")
+                os.unlink(update_path)
+            elif new_successes:
+                write_pickle(update, update_path,
+                             os.path.join(device, 'tmp'))
+
+    def send_object_update(self, update, update_path):
+        """
+        Send an async update to the container replicas that have not had it
+        yet, recording those that now have in update['successes'].
+
+        :param update: the update, as unpickled
+        :param update_path: where the update is kept, for logging
+        :returns: a tuple of whether the update is complete and whether any
+                  replica newly succeeded
+        """
+        return self.send_object_updates([(update, update_path)])[0]
+
+    def send_object_updates(self, updates):
+        """
+        Send async updates of one container to the container replicas that
+        have not had them yet, recording those that now have in each
+        update's 'successes'. A replica missing more than one of the updates
+        is sent all of them in a single MERGE request, or one after another
+        if it does not support MERGE.
+
+        :param updates: list of (update, location) tuples, all for the same
+                        container; the location is used for logging
+        :returns: a list of tuples of whether the update is complete and
+                  whether any replica newly succeeded, one per update
+        """
+        account = updates[0][0]['account']
+        container = updates[0][0]['container']
+        part, nodes = self.get_container_ring().get_nodes(account, container)
+        successes = [update.get('successes', []) for update, _l in updates]
+        failed = [False] * len(updates)
+        new_successes = [False] * len(updates)
         for node in nodes:
-            if node['id'] not in successes:
-                status = self.object_update(node, part, update['op'], obj,
-                                            update['headers'])
+            missing = [i for i in xrange(len(updates))
+                       if node['id'] not in successes[i]]
+            statuses = None
+            if len(missing) > 1:
+                status = self.object_merge(
+                    node, part, account, container,
+                    [updates[i][0] for i in missing])
+                if status != HTTP_METHOD_NOT_ALLOWED:
+                    statuses = [status] * len(missing)
+            if statuses is None:
+                statuses = []
+                for n, i in enumerate(missing):
+                    if n:
+                        self._rate_limit()
+                    update = updates[i][0]
+                    statuses.append(self.object_update(
+                        node, part, update['op'], '/%s/%s/%s' % (
+                            account, container, update['obj']),
+                        update['headers']))
+            for i, status in zip(missing, statuses):
                 if not is_success(status) and status != HTTP_NOT_FOUND:
-                    success = False
+                    failed[i] = True
                 else:
-                    successes.append(node['id'])
-                    new_successes = True
-        if success:
-            self.successes += 1
-            self.logger.increment('successes')
-            self.logger.debug(_('Update sent for %(obj)s %(path)s'),
-                              {'obj': obj, 'path': update_path})
-            self.logger.increment("unlinks")
-            os.unlink(update_path)
-        else:
-            self.failures += 1
-            self.logger.increment('failures')
-            self.logger.debug(_('Update failed for %(obj)s %(path)s'),
-                              {'obj': obj, 'path': update_path})
-            if new_successes:
-                update['successes'] = successes
-                write_pickle(update, update_path, os.path.join(device, 'tmp'))
+                    successes[i].append(node['id'])
+                    new_successes[i] = True
+        results = []
+        for i, (update, location) in enumerate(updates):
+            obj = '/%s/%s/%s' % (account, container, update['obj'])
+            if not failed[i]:
+                self.successes += 1
+                self.logger.increment('successes')
+                self.logger.debug(_('Update sent for %(obj)s %(path)s'),
+                                  {'obj': obj, 'path': location})
+            else:
+                self.failures += 1
+                self.logger.increment('failures')
+                self.logger.debug(_('Update failed for %(obj)s %(path)s'),
+                                  {'obj': obj, 'path': location})
+                if new_successes[i]:
+                    update['successes'] = successes[i]
+            results.append((not failed[i], new_successes[i]))
+        return results
 
     def object_update(self, node, part, op, obj, headers):
         """
@@ -243,3 +477,38 @@ class ObjectUpdater(Daemon):
             self.logger.exception(_('ERROR with remote server '
                                     '%(ip)s:%(port)s/%(device)s'), node)
         return HTTP_INTERNAL_SERVER_ERROR
+
+    def object_merge(self, node, part, account, container, updates):
+        """
+        Perform several object updates to the container in one MERGE
+        request.
+
+        :param node: node dictionary from the container ring
+        :param part: partition that holds the container
+        :param account: account name of the container
+        :param container: container name
+        :param updates: the updates, as unpickled
+        """
+        rows = [merge_row(update['op'], update['obj'], update['headers'])
+                for update in updates]
+        body = json.dumps(rows)
+        headers_out = {
+            'x-timestamp': max(row['created_at'] for row in rows),
+            'content-type': 'application/json',
+            'content-length': str(len(body)),
+            'user-agent': 'obj-updater %s' % os.getpid()}
+        try:
+            with ConnectionTimeout(self.conn_timeout):
+                conn = http_connect(node['ip'], node['port'], node['device'],
+                                    part, 'MERGE',
+                                    '/%s/%s' % (account, container),
+                                    headers_out)
+            with Timeout(self.node_timeout):
+                conn.send(body)
+                resp = conn.getresponse()
+                resp.read()
+                return resp.status
+        except (Exception, Timeout):
+            self.logger.exception(_('ERROR with remote server '
+                                    '%(ip)s:%(port)s/%(device)s'), node)
+        return HTTP_INTERNAL_SERVER_ERROR
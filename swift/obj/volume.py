@@ -0,0 +1,547 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Small-object packing volumes.
+
+Instead of a hash directory holding one file per object, small objects may
+be appended to a volume shared by the whole partition::
+
+    objects/<partition>/volume/volume.<generation>.dat
+    objects/<partition>/volume/volume.<generation>.idx
+    objects/<partition>/volume/volume.gen
+
+The .dat file holds records of pickled metadata followed by the object's
+data. The .idx file is an append-only list of fixed size entries, one per
+record, naming the object hash, the timestamp and extension the record
+would have had as a file (.data, .meta or .ts), and where the record is in
+the .dat file. A record is always fsynced before its index entry is
+written, and readers ignore a torn entry at the end of the index, so an
+entry never points at missing data.
+
+Each process keeps the index of the volumes it uses in memory, reading only
+the entries appended since it last looked.
+
+Records that are no longer needed stay in the volume until it is compacted:
+the records still needed are copied to the data and index files of the next
+generation, and volume.gen, naming the current generation (0 when it does
+not exist), is then replaced in a single rename. Only once that rename is
+durable are the files of the old generation removed, so a crash at any
+point leaves one whole generation current. A reader holding entries of the
+old generation finds its files gone and looks the record up again.
+"""
+
+from __future__ import with_statement
+import cPickle as pickle
+import errno
+import os
+from tempfile import mkstemp
+import struct
+import threading
+import uuid
+from collections import namedtuple
+from os.path import join
+
+from swift.common.utils import fsync, fsync_dir, lock_path, mkdirs, \
+    LRUCache
+
+
+PICKLE_PROTOCOL = 2
+VOLUME_DIR = 'volume'
+VOLUME_DATA_FILE = 'volume.%d.dat'
+VOLUME_INDEX_FILE = 'volume.%d.idx'
+VOLUME_GENERATION_FILE = 'volume.gen'
+# Index entry: object hash (binary md5), normalized timestamp, kind, offset
+# of the record in volume.dat, length of its metadata and length of its data.
+_INDEX_ENTRY = struct.Struct('!16s16sBQIQ')
+# Kinds 0-2 are the extensions a record stands for. A quarantine entry
+# removes everything known about the object up to that point. The first
+# entry of an index is a header holding a random volume id in place of the
+# hash, so a volume recreated in the same place is not mistaken for the one
+# already loaded, and the inode of its data file in place of the offset.
+EXTENSIONS = ('.data', '.meta', '.ts')
+HEADER = 254
+QUARANTINED = 255
+
+# Volumes whose indexes this process has loaded, by partition directory.
+_volumes = LRUCache(256)
+_volumes_lock = threading.Lock()
+
+
+class VolumeEntry(namedtuple('VolumeEntry', 'timestamp extension offset '
+                                            'metadata_length data_length '
+                                            'hsh generation data_inode')):
+    """
+    A record in a volume, as found in the index of one of its generations.
+    data_inode is the inode of the data file the index was written for, or 0
+    if unknown.
+    """
+
+    @property
+    def filename(self):
+        """The name the record would have as a file in a hash directory."""
+        return self.timestamp + self.extension
+
+
+class VolumeSlice(object):
+    """
+    Read only file-like object for one object's data in a volume.
+
+    :param fp: file object of the volume's data file
+    :param offset: offset of the data in the volume
+    :param length: length of the data
+    """
+
+    def __init__(self, fp, offset, length):
+        self._fp = fp
+        self.offset = offset
+        self.length = length
+        self._pos = 0
+
+    def read(self, size=-1):
+        remaining = self.length - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self._fp.seek(self.offset + self._pos)
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self._pos = max(pos, 0)
+
+    def tell(self):
+        return self._pos
+
+    def fileno(self):
+        return self._fp.fileno()
+
+    def close(self):
+        self._fp.close()
+
+
+class PartitionVolume(object):
+    """
+    The packing volume of one partition.
+
+    :param partition_dir: path to the partition directory
+    """
+
+    def __init__(self, partition_dir):
+        self.partition_dir = partition_dir
+        self.volume_dir = join(partition_dir, VOLUME_DIR)
+        self.generation_path = join(self.volume_dir, VOLUME_GENERATION_FILE)
+        self._lock = threading.Lock()
+        # ((inode, mtime) of volume.gen, generation it names)
+        self._generation_cache = (None, 0)
+        self._reset(None)
+
+    @property
+    def data_path(self):
+        """Path to the data file of the current generation."""
+        return self._data_path(self._read_generation())
+
+    @property
+    def index_path(self):
+        """Path to the index file of the current generation."""
+        return self._index_path(self._read_generation())
+
+    def _data_path(self, generation):
+        return join(self.volume_dir, VOLUME_DATA_FILE % generation)
+
+    def _index_path(self, generation):
+        return join(self.volume_dir, VOLUME_INDEX_FILE % generation)
+
+    def _read_generation(self):
+        """Returns the current generation of the volume."""
+        try:
+            st = os.stat(self.generation_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return 0
+        key, generation = self._generation_cache
+        if key != (st.st_ino, st.st_mtime):
+            with open(self.generation_path, 'rb') as fp:
+                generation = int(fp.read())
+            self._generation_cache = ((st.st_ino, st.st_mtime), generation)
+        return generation
+
+    def _reset(self, index_key):
+        # hash -> {extension: newest VolumeEntry}
+        self._entries = {}
+        # suffix -> set of hashes
+        self._suffixes = {}
+        self._volume_id = None
+        self._data_inode = 0
+        # (generation, inode) of the loaded index
+        self._index_key = index_key
+        self._index_size = 0
+        self._index_mtime = None
+
+    def _apply(self, hsh, timestamp, kind, offset, metadata_length,
+               data_length):
+        if kind == HEADER:
+            self._volume_id = hsh
+            self._data_inode = offset
+            return
+        if kind == QUARANTINED:
+            self._entries.pop(hsh, None)
+            hashes = self._suffixes.get(hsh[-3:])
+            if hashes:
+                hashes.discard(hsh)
+            return
+        entry = VolumeEntry(timestamp, EXTENSIONS[kind], offset,
+                            metadata_length, data_length, hsh,
+                            self._index_key[0], self._data_inode)
+        entries = self._entries.setdefault(hsh, {})
+        current = entries.get(entry.extension)
+        if current is None or entry.timestamp >= current.timestamp:
+            entries[entry.extension] = entry
+        self._suffixes.setdefault(hsh[-3:], set()).add(hsh)
+
+    def refresh(self):
+        """Loads any index entries appended since the last refresh."""
+        with self._lock:
+            for _junk in xrange(3):
+                generation = self._read_generation()
+                try:
+                    fp = open(self._index_path(generation), 'rb')
+                    break
+                except IOError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                # A compaction may have just removed the generation read.
+                if self._read_generation() == generation:
+                    if self._index_key is not None:
+                        self._reset(None)
+                    return
+            else:
+                raise IOError(errno.EAGAIN, 'Volume %s keeps changing' %
+                              self.volume_dir)
+            with fp:
+                st = os.fstat(fp.fileno())
+                whole = st.st_size - st.st_size % _INDEX_ENTRY.size
+                if (generation, st.st_ino) != self._index_key or \
+                        whole < self._index_size or \
+                        (whole == self._index_size and
+                         st.st_mtime != self._index_mtime):
+                    self._reset((generation, st.st_ino))
+                if whole == self._index_size:
+                    return
+                if self._index_size and \
+                        fp.read(16).encode('hex') != self._volume_id:
+                    self._reset((generation, st.st_ino))
+                fp.seek(self._index_size)
+                buf = fp.read(whole - self._index_size)
+            buf = buf[:len(buf) - len(buf) % _INDEX_ENTRY.size]
+            for pos in xrange(0, len(buf), _INDEX_ENTRY.size):
+                hsh, timestamp, kind, offset, metadata_length, data_length = \
+                    _INDEX_ENTRY.unpack_from(buf, pos)
+                self._apply(hsh.encode('hex'), timestamp, kind, offset,
+                            metadata_length, data_length)
+            self._index_size += len(buf)
+            self._index_mtime = st.st_mtime
+
+    def lookup(self, hsh):
+        """
+        Returns the newest records of an object.
+
+        :param hsh: object hash
+        :returns: dictionary of extension to VolumeEntry
+        """
+        self.refresh()
+        return dict(self._entries.get(hsh) or {})
+
+    def suffixes(self):
+        """Returns the suffixes with objects in the volume."""
+        self.refresh()
+        return [suffix for suffix, hashes in self._suffixes.iteritems()
+                if hashes]
+
+    def suffix_hashes(self, suffix):
+        """Returns the set of object hashes in a suffix."""
+        self.refresh()
+        return set(self._suffixes.get(suffix) or ())
+
+    def _append_index_entry(self, generation, packed):
+        fd = os.open(self._index_path(generation), os.O_WRONLY | os.O_CREAT)
+        try:
+            size = os.fstat(fd).st_size
+            if size < _INDEX_ENTRY.size:
+                try:
+                    data_inode = os.stat(
+                        self._data_path(generation)).st_ino
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    data_inode = 0
+                packed = _INDEX_ENTRY.pack(
+                    uuid.uuid4().bytes, '0' * 16, HEADER, data_inode, 0,
+                    0) + packed
+            # Overwrite a torn entry left behind by a crash.
+            os.lseek(fd, size - size % _INDEX_ENTRY.size, os.SEEK_SET)
+            while packed:
+                packed = packed[os.write(fd, packed):]
+            fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, hsh, timestamp, extension, metadata, data=''):
+        """
+        Appends a record to the volume.
+
+        :param hsh: object hash
+        :param timestamp: normalized timestamp of the record
+        :param extension: extension the record stands for (.data, .meta or
+                          .ts)
+        :param metadata: dictionary of metadata
+        :param data: object data
+        """
+        metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
+        mkdirs(self.volume_dir)
+        with lock_path(self.volume_dir):
+            generation = self._read_generation()
+            fd = os.open(self._data_path(generation),
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            try:
+                offset = os.fstat(fd).st_size
+                record = metastr + data
+                while record:
+                    record = record[os.write(fd, record):]
+                fsync(fd)
+            finally:
+                os.close(fd)
+            self._append_index_entry(generation, _INDEX_ENTRY.pack(
+                hsh.decode('hex'), timestamp, EXTENSIONS.index(extension),
+                offset, len(metastr), len(data)))
+
+    def quarantine(self, hsh):
+        """
+        Forgets all records of an object written so far, e.g. because its
+        data is corrupt.
+
+        :param hsh: object hash
+        """
+        with lock_path(self.volume_dir):
+            self._append_index_entry(
+                self._read_generation(), _INDEX_ENTRY.pack(
+                    hsh.decode('hex'), '0' * 16, QUARANTINED, 0, 0, 0))
+
+    def _open_data(self, entry):
+        """
+        Opens the data file holding a record. If the volume was compacted
+        since the record was looked up, it is looked up again.
+
+        :returns: tuple of the data file and the record's current entry
+        :raises IOError: if the record is gone
+        """
+        for _junk in xrange(3):
+            try:
+                fp = open(self._data_path(entry.generation), 'rb')
+            except IOError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            else:
+                if not entry.data_inode or \
+                        os.fstat(fp.fileno()).st_ino == entry.data_inode:
+                    return fp, entry
+                fp.close()
+            current = self.lookup(entry.hsh).get(entry.extension)
+            if current is None or current.timestamp != entry.timestamp:
+                break
+            entry = current
+        raise IOError(errno.ENOENT, 'Record %s/%s is gone from %s' % (
+            entry.hsh, entry.filename, self.volume_dir))
+
+    def read_metadata(self, entry):
+        """Returns the metadata of a record."""
+        fp, entry = self._open_data(entry)
+        with fp:
+            fp.seek(entry.offset)
+            return pickle.loads(fp.read(entry.metadata_length))
+
+    def open(self, entry):
+        """
+        Opens a record.
+
+        :returns: tuple of the record's metadata and a VolumeSlice of its
+                  data
+        """
+        fp, entry = self._open_data(entry)
+        try:
+            fp.seek(entry.offset)
+            metadata = pickle.loads(fp.read(entry.metadata_length))
+        except Exception:
+            fp.close()
+            raise
+        return metadata, VolumeSlice(
+            fp, entry.offset + entry.metadata_length, entry.data_length)
+
+    def _switch_generation(self, generation):
+        """
+        Durably makes generation the current one, in a single rename of
+        volume.gen.
+        """
+        fd, tmp_path = mkstemp(dir=self.volume_dir, prefix='.tmp')
+        try:
+            os.write(fd, str(generation))
+            fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            os.rename(tmp_path, self.generation_path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+        fsync_dir(self.volume_dir)
+
+    def _remove_other_generations(self, generation):
+        """
+        Removes the files of generations other than the given one, and
+        temporary files, left behind by a compaction that did not finish.
+        """
+        keep = (VOLUME_DATA_FILE % generation, VOLUME_INDEX_FILE % generation,
+                VOLUME_GENERATION_FILE)
+        for name in os.listdir(self.volume_dir):
+            if name not in keep and (name.startswith('.tmp') or (
+                    name.startswith('volume.') and
+                    name.endswith(('.dat', '.idx')))):
+                try:
+                    os.unlink(join(self.volume_dir, name))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+
+    def compact(self, live, min_dead_ratio=0.5):
+        """
+        Rewrites the volume with only the records still needed, once enough
+        of it is taken up by records that are not. The records are copied to
+        a new generation, which is switched to once it is durable; the old
+        generation is removed after that.
+
+        :param live: callable given an object hash and the dictionary of
+                     extension to VolumeEntry of its newest records,
+                     returning the entries to keep
+        :param min_dead_ratio: fraction of the data file that has to be
+                               reclaimable for the volume to be rewritten
+        :returns: number of bytes reclaimed
+        """
+        with lock_path(self.volume_dir):
+            self.refresh()
+            generation = self._read_generation()
+            self._remove_other_generations(generation)
+            data_path = self._data_path(generation)
+            try:
+                size = os.stat(data_path).st_size
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                return 0
+            with self._lock:
+                objects = [(hsh, dict(entries))
+                           for hsh, entries in self._entries.iteritems()]
+            keep = []
+            for hsh, entries in sorted(objects):
+                keep.extend(sorted(live(hsh, entries),
+                                   key=lambda entry: entry.offset))
+            kept = sum(entry.metadata_length + entry.data_length
+                       for entry in keep)
+            if not size or size - kept < size * min_dead_ratio:
+                return 0
+            new_generation = generation + 1
+            offset = 0
+            if keep:
+                new_data_path = self._data_path(new_generation)
+                new_index_path = self._index_path(new_generation)
+                data_fd = os.open(new_data_path,
+                                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                index_fd = os.open(new_index_path,
+                                   os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+                try:
+                    index = [_INDEX_ENTRY.pack(
+                        uuid.uuid4().bytes, '0' * 16, HEADER,
+                        os.fstat(data_fd).st_ino, 0, 0)]
+                    with open(data_path, 'rb') as fp:
+                        for entry in keep:
+                            length = entry.metadata_length + \
+                                entry.data_length
+                            fp.seek(entry.offset)
+                            record = fp.read(length)
+                            if len(record) != length:
+                                raise IOError(
+                                    errno.EIO, 'Truncated record %s/%s' %
+                                    (entry.hsh, entry.filename))
+                            while record:
+                                record = record[os.write(data_fd, record):]
+                            index.append(_INDEX_ENTRY.pack(
+                                entry.hsh.decode('hex'), entry.timestamp,
+                                EXTENSIONS.index(entry.extension), offset,
+                                entry.metadata_length, entry.data_length))
+                            offset += length
+                    fsync(data_fd)
+                    index = ''.join(index)
+                    while index:
+                        index = index[os.write(index_fd, index):]
+                    fsync(index_fd)
+                except BaseException:
+                    for path in (new_data_path, new_index_path):
+                        os.unlink(path)
+                    raise
+                finally:
+                    os.close(data_fd)
+                    os.close(index_fd)
+            # Nothing is read from the new generation's files until it is
+            # current, and the old one is only removed once it is not.
+            self._switch_generation(new_generation)
+            for path in (self._index_path(generation), data_path):
+                try:
+                    os.unlink(path)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+            self.refresh()
+            return size - offset
+
+
+def get_volume(partition_dir):
+    """
+    Returns the PartitionVolume of a partition, sharing loaded indexes
+    across callers in the process.
+
+    :param partition_dir: path to the partition directory
+    """
+    with _volumes_lock:
+        volume = _volumes.get(partition_dir)
+        if volume is None:
+            volume = PartitionVolume(partition_dir)
+            _volumes.set(partition_dir, volume)
+        return volume
+
+
+def find_volume(partition_dir):
+    """
+    Like get_volume(), but returns None, without loading anything, if the
+    partition has no volume.
+
+    :param partition_dir: path to the partition directory
+    """
+    with _volumes_lock:
+        volume = _volumes.get(partition_dir)
+    if volume is None and os.path.isdir(join(partition_dir, VOLUME_DIR)):
+        volume = get_volume(partition_dir)
+    return volume
@@ -17,6 +17,7 @@ import unittest
 from unittest import TestCase
 from contextlib import contextmanager
 from posix import stat_result, statvfs_result
+import errno
 import os
 import mock
 
@@ -384,6 +385,29 @@ class TestReconSuccess(TestCase):
         rv = self.app.get_async_info()
         self.assertEquals(rv, {'async_pending': 5})
 
+    def test_get_device_load(self):
+        stats = {'in_flight': 1, 'latency': 0.5, 'requests': 10,
+                 'rejected': 2}
+        self.fakecache.fakeout = {'object_server_device_load': {
+            '1': {'time': 1, 'devices': {'sda1': stats}},
+            '2': {'time': 1, 'devices': {'sda1': dict(stats, latency=0.25),
+                                         'sdb1': stats}},
+            '3': {'time': 1, 'devices': {'sda1': stats}}}}
+
+        def fake_kill(pid, sig):
+            self.assertEquals(sig, 0)
+            if pid == 3:
+                raise OSError(errno.ESRCH, os.strerror(errno.ESRCH))
+
+        with mock.patch('os.kill', fake_kill):
+            rv = self.app.get_device_load()
+        self.assertEquals(rv, {
+            'sda1': {'in_flight': 2, 'latency': 0.5, 'requests': 20,
+                     'rejected': 4},
+            'sdb1': stats})
+        self.fakecache.fakeout = {'object_server_device_load': None}
+        self.assertEquals(self.app.get_device_load(), {})
+
     def test_get_replication_info_account(self):
         from_cache_response = {
             "replication_stats": {
@@ -446,17 +470,26 @@ class TestReconSuccess(TestCase):
             "replication_last": 1357969645.25})
 
     def test_get_replication_object(self):
+        queue = {'sda1': {'handoff': 1, 'out_of_date': 0, 'routine': 20}}
+        limits = {'device_concurrency': 2, 'device_bytes_per_sec': 0,
+                  'device_iops': 100, 'loaded': 1357962809.15}
         from_cache_response = {"object_replication_time": 200.0,
-                               "object_replication_last": 1357962809.15}
+                               "object_replication_last": 1357962809.15,
+                               "object_replication_queue": queue,
+                               "object_replication_limits": limits}
         self.fakecache.fakeout_calls = []
         self.fakecache.fakeout = from_cache_response
         rv = self.app.get_replication_info('object')
         self.assertEquals(self.fakecache.fakeout_calls,
                           [((['object_replication_time',
-                              'object_replication_last'],
+                              'object_replication_last',
+                              'object_replication_queue',
+                              'object_replication_limits'],
                               '/var/cache/swift/object.recon'), {})])
         self.assertEquals(rv, {'object_replication_time': 200.0,
-                               'object_replication_last': 1357962809.15})
+                               'object_replication_last': 1357962809.15,
+                               'object_replication_queue': queue,
+                               'object_replication_limits': limits})
 
     def test_get_updater_info_container(self):
         from_cache_response = {"container_updater_sweep": 18.476239919662476}
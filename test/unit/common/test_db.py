@@ -958,6 +958,41 @@ class TestContainerBroker(unittest.TestCase):
             self.assertEquals(conn.execute(
                 "SELECT deleted FROM object").fetchone()[0], 0)
 
+    def test_put_objects(self):
+        # Test swift.common.db.ContainerBroker.put_objects
+        testdir = os.path.join(os.path.dirname(__file__), 'put_objects')
+        rmtree(testdir, ignore_errors=1)
+        os.mkdir(testdir)
+        try:
+            broker = ContainerBroker(os.path.join(testdir, 'c.db'),
+                                     account='a', container='c')
+            self.assertRaises(DatabaseConnectionError, broker.put_objects, [])
+            broker.initialize(normalize_timestamp('1'))
+            broker.put_object('o1', normalize_timestamp('2'), 1, 'text/plain',
+                              'etag1')
+            self.assert_(os.path.getsize(broker.pending_file))
+            broker.put_objects([
+                {'name': 'o1', 'created_at': normalize_timestamp('3'),
+                 'size': 3, 'content_type': 'text/plain', 'etag': 'etag3',
+                 'deleted': 0},
+                {'name': 'o2', 'created_at': normalize_timestamp('2'),
+                 'size': 2, 'content_type': 'text/plain', 'etag': 'etag2',
+                 'deleted': 0},
+                {'name': 'o3', 'created_at': normalize_timestamp('2'),
+                 'size': 0, 'content_type': 'application/deleted',
+                 'etag': 'noetag', 'deleted': 1}])
+            # the pending put was merged along with the batch
+            self.assertEquals(os.path.getsize(broker.pending_file), 0)
+            with broker.get() as conn:
+                self.assertEquals([tuple(row) for row in conn.execute(
+                    "SELECT name, size, deleted FROM object ORDER BY name")],
+                    [('o1', 3, 0), ('o2', 2, 0), ('o3', 0, 1)])
+            info = broker.get_info()
+            self.assertEquals(info['object_count'], 2)
+            self.assertEquals(info['bytes_used'], 5)
+        finally:
+            rmtree(testdir, ignore_errors=1)
+
     def test_get_info(self):
         # Test swift.common.db.ContainerBroker.get_info
         broker = ContainerBroker(':memory:', account='test1',
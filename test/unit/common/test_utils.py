@@ -16,7 +16,7 @@
 """Tests for swift.common.utils"""
 
 from __future__ import with_statement
-from test.unit import temptree
+from test.unit import temptree, FakeLogger
 
 import ctypes
 import errno
@@ -1354,6 +1354,20 @@ log_name = %(yarr)s'''
         finally:
             utils._sys_fallocate = orig__sys_fallocate
 
+    def test_posix_fadvise_calls(self):
+        calls = []
+
+        def fake_fadvise(fd, offset, length, advice):
+            calls.append((fd, offset.value, length.value, advice))
+            return 0
+
+        with patch.object(utils, '_posix_fadvise', fake_fadvise):
+            utils.drop_buffer_cache(1234, 10, 100)
+            utils.advise_sequential(1234)
+            utils.advise_sequential(1234, 10, 100)
+        self.assertEquals(calls, [(1234, 10, 100, 4), (1234, 0, 0, 2),
+                                  (1234, 10, 100, 2)])
+
     def test_generate_trans_id(self):
         fake_time = 1366428370.5163341
         with patch.object(utils.time, 'time', return_value=fake_time):
@@ -1403,6 +1417,27 @@ log_name = %(yarr)s'''
                 utils.tpool_reraise,
                 MagicMock(side_effect=BaseException('test3')))
 
+    def test_dump_recon_cache(self):
+        testdir = mkdtemp()
+        try:
+            cache_file = os.path.join(testdir, 'object.recon')
+            logger = FakeLogger()
+            utils.dump_recon_cache({'a': 1, 'b': {'x': 1, 'y': 2}},
+                                   cache_file, logger)
+            utils.dump_recon_cache({'a': 2, 'b': {'x': 3, 'y': {}, 'z': 4}},
+                                   cache_file, logger, merge=True)
+            with open(cache_file) as fp:
+                self.assertEquals(utils.json.load(fp),
+                                  {'a': 2, 'b': {'x': 3, 'z': 4}})
+            # without merge, values are replaced whole
+            utils.dump_recon_cache({'b': {'w': {}}}, cache_file, logger)
+            with open(cache_file) as fp:
+                self.assertEquals(utils.json.load(fp),
+                                  {'a': 2, 'b': {'w': {}}})
+            self.assertEquals(logger.log_dict['exception'], [])
+        finally:
+            rmtree(testdir)
+
     def test_lock_file(self):
         flags = os.O_CREAT | os.O_RDWR
         with NamedTemporaryFile(delete=False) as nt:
@@ -2314,6 +2349,39 @@ class TestStatsdLoggingDelegation(unittest.TestCase):
                 utils.fsync(12345)
                 self.assertEquals(called, [12345])
 
+    def test_sendfile(self):
+        rsock, wsock = socket.socketpair()
+        with TemporaryFile() as fp:
+            fp.write('0123456789')
+            fp.flush()
+            sent = utils.sendfile(wsock.fileno(), fp.fileno(), 2, 5)
+            self.assertEquals(sent, 5)
+            self.assertEquals(rsock.recv(10), '23456')
+            # offset is not moved
+            self.assertEquals(fp.tell(), 10)
+            self.assertEquals(
+                utils.sendfile(wsock.fileno(), fp.fileno(), 10, 5), 0)
+        rsock.close()
+        wsock.close()
+
+    def test_sendfile_errors(self):
+        with TemporaryFile() as fp:
+            try:
+                utils.sendfile(-1, fp.fileno(), 0, 5)
+            except OSError as err:
+                self.assertEquals(err.errno, errno.EBADF)
+            else:
+                self.fail('OSError not raised')
+        with nested(patch('swift.common.utils.load_libc_function',
+                          return_value=utils.noop_libc_function),
+                    patch('swift.common.utils._sys_sendfile', None)):
+            try:
+                utils.sendfile(1, 2, 0, 5)
+            except OSError as err:
+                self.assertEquals(err.errno, errno.ENOSYS)
+            else:
+                self.fail('OSError not raised')
+
 
 class TestThreadpool(unittest.TestCase):
 
@@ -2401,5 +2469,130 @@ class TestThreadpool(unittest.TestCase):
         self.assertTrue(caught)
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = utils.LRUCache(2)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), 2)
+        cache.set('a', 3)
+        self.assertEquals(cache.get('a'), 3)
+        self.assertEquals(len(cache), 2)
+        self.assert_('a' in cache)
+        self.assert_('c' not in cache)
+
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assert_('b' not in cache)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        cache.set('c', 4)
+        cache.set('d', 5)
+        self.assert_('a' not in cache)
+        self.assertEquals(len(cache), 2)
+
+    def test_pop_and_clear(self):
+        cache = utils.LRUCache(3)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.pop('a'), 1)
+        self.assertEquals(cache.pop('a', 'default'), 'default')
+        self.assertEquals(len(cache), 1)
+        cache.set('c', 3)
+        cache.set('d', 4)
+        cache.set('e', 5)
+        self.assertEquals(len(cache), 3)
+        self.assert_('b' not in cache)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        cache.set('f', 6)
+        self.assertEquals(cache.get('f'), 6)
+
+    def test_oldest(self):
+        cache = utils.LRUCache(3)
+        self.assertEquals(cache.oldest(), None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.oldest(), ('a', 1))
+        self.assertEquals(cache.oldest(), ('a', 1))
+        cache.get('a')
+        self.assertEquals(cache.oldest(), ('b', 2))
+
+    def test_zero_size(self):
+        cache = utils.LRUCache(0)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+
+class TestFsyncBatcher(unittest.TestCase):
+
+    def test_no_window_fsyncs(self):
+        called = []
+        batcher = utils.FsyncBatcher(window=0)
+        with nested(patch('swift.common.utils.fsync', called.append),
+                    patch('swift.common.utils.syncfs')) as (_junk, syncfs):
+            batcher.sync(12345)
+        self.assertEquals(called, [12345])
+        self.assertFalse(syncfs.called)
+
+    def test_concurrent_syncs_share_one_syncfs(self):
+        synced = []
+        fsynced = []
+        batcher = utils.FsyncBatcher(window=0.1)
+        errors = []
+
+        def sync(fd):
+            try:
+                batcher.sync(fd)
+            except Exception as err:
+                errors.append(err)
+
+        with nested(patch('swift.common.utils.syncfs', synced.append),
+                    patch('swift.common.utils.fsync', fsynced.append)):
+            threads = [threading.Thread(target=sync, args=(fd,))
+                       for fd in (10, 11, 12)]
+            for thr in threads:
+                thr.start()
+            for thr in threads:
+                thr.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(synced), 1)
+        self.assertEquals(fsynced, [])
+        self.assertEquals(batcher.batches, 1)
+        self.assertEquals(batcher.synced, 3)
+
+    def test_syncfs_error_raised(self):
+        batcher = utils.FsyncBatcher(window=0.001)
+
+        def syncfs(fd):
+            raise OSError(errno.EIO, 'Unable to syncfs(%s)' % fd)
+
+        with patch('swift.common.utils.syncfs', syncfs):
+            self.assertRaises(OSError, batcher.sync, 12345)
+        self.assertEquals(batcher.synced, 0)
+
+    def test_no_syncfs_falls_back_to_fsync(self):
+        called = []
+        batcher = utils.FsyncBatcher(window=0.001)
+        with nested(patch('swift.common.utils.load_libc_function',
+                          return_value=utils.noop_libc_function),
+                    patch('swift.common.utils._sys_syncfs', None),
+                    patch('swift.common.utils.fsync', called.append)):
+            batcher.sync(12345)
+            self.assertEquals(called, [12345])
+            self.assertEquals(batcher.window, 0)
+            batcher.sync(12346)
+            self.assertEquals(called, [12345, 12346])
+
+
 if __name__ == '__main__':
     unittest.main()
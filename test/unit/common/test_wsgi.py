@@ -26,11 +26,13 @@ import pickle
 from textwrap import dedent
 from gzip import GzipFile
 from StringIO import StringIO
+from tempfile import TemporaryFile
 from collections import defaultdict
-from contextlib import closing
+from contextlib import closing, nested
 from urllib import quote
 
-from eventlet import listen
+import eventlet
+from eventlet import listen, greenio
 
 import swift
 from swift.common.swob import Request
@@ -38,7 +40,7 @@ from swift.common import wsgi, utils, ring
 
 from test.unit import temptree
 
-from mock import patch
+from mock import patch, MagicMock
 
 
 def _fake_rings(tmpdir):
@@ -302,6 +304,104 @@ class TestWSGI(unittest.TestCase):
             wsgi.sleep = old_sleep
             wsgi.time = old_time
 
+    def test_get_device_ports(self):
+        with temptree([]) as t:
+            _fake_rings(t)
+            with patch('swift.common.wsgi.whataremyips',
+                       return_value=['10.0.0.1', '127.0.0.1']):
+                self.assertEquals(
+                    wsgi.get_device_ports({'swift_dir': t}, 'object'),
+                    [6010, 6020])
+                self.assertEquals(
+                    wsgi.get_device_ports({'swift_dir': t}, 'container'),
+                    [6011, 6021])
+            self.assertEquals(
+                wsgi.get_device_ports({'swift_dir': t,
+                                       'bind_ip': '127.0.0.1'}, 'object'),
+                [6010, 6020])
+            self.assertEquals(
+                wsgi.get_device_ports({'swift_dir': t,
+                                       'bind_ip': '10.0.0.1'}, 'object'),
+                [])
+
+    def test_get_device_ports_replication_server(self):
+        with temptree([]) as t:
+            with closing(GzipFile(os.path.join(t, 'object.ring.gz'),
+                                  'wb')) as f:
+                pickle.dump(ring.RingData(
+                    [[0, 1, 0, 1], [1, 0, 1, 0]],
+                    [{'id': 0, 'zone': 0, 'device': 'sda1',
+                      'ip': '127.0.0.1', 'port': 6010,
+                      'replication_ip': '127.0.0.2',
+                      'replication_port': 6050},
+                     {'id': 1, 'zone': 1, 'device': 'sdb1',
+                      'ip': '127.0.0.1', 'port': 6020,
+                      'replication_ip': '127.0.0.2',
+                      'replication_port': 6060}], 30), f)
+            for replication_server, bind_ip, ports in (
+                    (None, '127.0.0.1', [6010, 6020]),
+                    ('false', '127.0.0.1', [6010, 6020]),
+                    ('true', '127.0.0.2', [6050, 6060]),
+                    ('true', '127.0.0.1', [])):
+                conf = {'swift_dir': t, 'bind_ip': bind_ip}
+                if replication_server is not None:
+                    conf['replication_server'] = replication_server
+                self.assertEquals(wsgi.get_device_ports(conf, 'object'),
+                                  ports, conf)
+
+    def test_run_wsgi_servers_per_port(self):
+        conf = {'servers_per_port': '2', 'bind_ip': '127.0.0.1',
+                'workers': '8'}
+        socks = {}
+        served = []
+
+        class MockSock(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        def fake_get_socket(conf, default_port=8080):
+            socks[conf['bind_port']] = MockSock()
+            return socks[conf['bind_port']]
+
+        def fake_run_server(conf, logger, sock):
+            served.append(sock)
+
+        with nested(
+                patch('swift.common.wsgi._initrp',
+                      return_value=(conf, MagicMock(), 'object-server')),
+                patch('swift.common.wsgi.get_device_ports',
+                      return_value=[6010, 6020]),
+                patch('swift.common.wsgi.get_socket', fake_get_socket),
+                patch('swift.common.wsgi.drop_privileges'),
+                patch('swift.common.wsgi.loadapp'),
+                patch('swift.common.wsgi.capture_stdio'),
+                patch('swift.common.wsgi.greenio'),
+                patch('swift.common.wsgi.run_server', fake_run_server),
+                patch('os.fork'),
+                patch('os.wait', side_effect=KeyboardInterrupt),
+                patch('signal.signal')) as mocks:
+            get_device_ports, fork = mocks[1], mocks[8]
+            # the parent starts servers_per_port workers per port
+            fork.side_effect = [101, 102, 103, 104]
+            wsgi.run_wsgi('/etc/swift/object-server.conf', 'object-server')
+            self.assertEquals(get_device_ports.call_args[0][1], 'object')
+            self.assertEquals(fork.call_count, 4)
+            self.assertEquals(served, [])
+            self.assert_(socks[6010].closed and socks[6020].closed)
+            # each worker only keeps the socket of its port
+            fork.side_effect = [101, 102, 0]
+            wsgi.run_wsgi('/etc/swift/object-server.conf', 'object-server')
+            self.assertEquals(served, [socks[6020]])
+            self.assert_(socks[6010].closed)
+            self.assertFalse(socks[6020].closed)
+            # no devices on this node
+            get_device_ports.return_value = []
+            fork.reset_mock()
+            wsgi.run_wsgi('/etc/swift/object-server.conf', 'object-server')
+            self.assertFalse(fork.called)
+
     def test_run_server(self):
         config = """
         [DEFAULT]
@@ -349,6 +449,7 @@ class TestWSGI(unittest.TestCase):
         self.assert_(isinstance(server_logger, wsgi.NullLogger))
         self.assert_('custom_pool' in kwargs)
         self.assertEquals(1000, kwargs['custom_pool'].size)
+        self.assertEquals(wsgi.SwiftHttpProtocol, kwargs['protocol'])
 
     def test_run_server_conf_dir(self):
         config_dir = {
@@ -539,6 +640,76 @@ class TestWSGI(unittest.TestCase):
         self.assertEquals(r.environ['PATH_INFO'], '/override')
 
 
+class TestSwiftHttpProtocol(unittest.TestCase):
+
+    def _protocol(self, sock):
+
+        class Protocol(wsgi.SwiftHttpProtocol):
+            def __init__(self, sock):
+                self.connection = sock
+                self.wfile = sock.makefile('wb')
+
+        return Protocol(sock)
+
+    def test_sendfile(self):
+        rsock, wsock = socket.socketpair()
+        rsock = greenio.GreenSocket(rsock)
+        wsock = greenio.GreenSocket(wsock)
+        proto = self._protocol(wsock)
+        # more than the socket buffers hold, so sendfile has to wait
+        data = ''.join(chr(i % 256) for i in xrange(256)) * 32768
+        with TemporaryFile() as fp:
+            fp.write('x' * 10 + data)
+            fp.flush()
+            # buffered headers are flushed before the body
+            proto.wfile.write('headers')
+
+            def read_all():
+                got = []
+                while sum(map(len, got)) < len(data) + 7:
+                    got.append(rsock.recv(65536))
+                return ''.join(got)
+
+            reader = eventlet.spawn(read_all)
+            self.assertEquals(proto.sendfile(fp.fileno(), 10, len(data)),
+                              len(data))
+            self.assertEquals(reader.wait(), 'headers' + data)
+            self.assertFalse(getattr(proto, 'close_connection', 0))
+            # short file
+            self.assertEquals(proto.sendfile(fp.fileno(), len(data), 20), 10)
+            self.assertEquals(rsock.recv(20), data[-10:])
+            # the client can not be sent what it was promised
+            self.assertEquals(proto.close_connection, 1)
+
+    def test_sendfile_run_in_thread(self):
+        rsock, wsock = socket.socketpair()
+        proto = self._protocol(greenio.GreenSocket(wsock))
+        called = []
+
+        def run_in_thread(func, *args):
+            called.append(args[1:])
+            return func(*args)
+
+        with TemporaryFile() as fp:
+            fp.write('0123456789')
+            fp.flush()
+            self.assertEquals(
+                proto.sendfile(fp.fileno(), 1, 3, run_in_thread), 3)
+            self.assertEquals(called, [(fp.fileno(), 1, 3)])
+        self.assertEquals(rsock.recv(10), '123')
+
+    def test_get_environ(self):
+        proto = self._protocol(socket.socket())
+        with patch.object(wsgi.wsgi.HttpProtocol, 'get_environ',
+                          return_value={'wsgi.url_scheme': 'http'}):
+            env = proto.get_environ()
+        self.assertEquals(env['swift.sendfile'], proto.sendfile)
+        with patch.object(wsgi.wsgi.HttpProtocol, 'get_environ',
+                          return_value={'wsgi.url_scheme': 'https'}):
+            env = proto.get_environ()
+        self.assert_('swift.sendfile' not in env)
+
+
 class TestWSGIContext(unittest.TestCase):
 
     def test_app_call(self):
@@ -657,6 +657,94 @@ class TestContainerController(unittest.TestCase):
         resp = req.get_response(self.controller)
         self.assertEquals(resp.status_int, 404)
 
+    def test_MERGE(self):
+        req = Request.blank(
+            '/sda1/p/a/c',
+            environ={'REQUEST_METHOD': 'PUT'}, headers={'X-Timestamp': '1'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        req = Request.blank(
+            '/sda1/p/a/c/o2',
+            environ={'REQUEST_METHOD': 'PUT', 'HTTP_X_TIMESTAMP': '2',
+                     'HTTP_X_SIZE': 1, 'HTTP_X_CONTENT_TYPE': 'text/plain',
+                     'HTTP_X_ETAG': 'x'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 201)
+        rows = [{'name': u'o1\u2603', 'created_at': '2', 'size': 3,
+                 'content_type': 'text/plain', 'etag': 'y'},
+                {'name': 'o2', 'created_at': '3', 'deleted': 1},
+                {'name': 'o3', 'created_at': '1', 'deleted': 0, 'size': 5,
+                 'content_type': 'image/jpeg', 'etag': 'z'}]
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '3'}, body=simplejson.dumps(rows))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 204)
+        req = Request.blank('/sda1/p/a/c?format=json',
+                            environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(
+            [(o['name'], o['bytes'], o['content_type'])
+             for o in simplejson.loads(resp.body)],
+            [(u'o1\u2603', 3, 'text/plain'), (u'o3', 5, 'image/jpeg')])
+
+        # malformed rows are refused
+        for body in ('garbage', '{}', '[{"name": "o"}]',
+                     '[{"name": "o", "created_at": "x", "deleted": 1}]',
+                     '[{"name": "o", "created_at": "1", "size": "x", '
+                     '"content_type": "text/plain", "etag": "x"}]'):
+            req = Request.blank(
+                '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+                headers={'X-Timestamp': '4'}, body=body)
+            resp = req.get_response(self.controller)
+            self.assertEquals(resp.status_int, 400)
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'}, body='[]')
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 400)
+        self.controller.max_merge_rows = 2
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4'}, body=simplejson.dumps(rows))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 413)
+        # too large a body is refused unread
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4', 'Content-Length': str(
+                2 * container_server.MAX_MERGE_ROW_SIZE + 1)})
+        req.environ['wsgi.input'] = mock.Mock()
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 413)
+        self.assertEquals(req.environ['wsgi.input'].method_calls, [])
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4', 'Content-Length': 'x'}, body='[]')
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 400)
+        req = Request.blank(
+            '/sda1/p/a/c', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4'}, body='[]')
+        del req.headers['Content-Length']
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 411)
+
+        # containers are only created for the auto-create accounts
+        req = Request.blank(
+            '/sda1/p/a/c2', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4'}, body='[]')
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 404)
+        req = Request.blank(
+            '/sda1/p/.a/c2', environ={'REQUEST_METHOD': 'MERGE'},
+            headers={'X-Timestamp': '4'}, body=simplejson.dumps(rows[:1]))
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.status_int, 204)
+        req = Request.blank('/sda1/p/.a/c2',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.controller)
+        self.assertEquals(resp.headers['x-container-object-count'], '1')
+
     def test_DELETE_account_update(self):
         bindsock = listen(('127.0.0.1', 0))
 
@@ -18,6 +18,7 @@ import unittest
 import mock
 import os
 import time
+import cPickle as pickle
 from shutil import rmtree
 from hashlib import md5
 from tempfile import mkdtemp
@@ -26,7 +27,7 @@ from swift.obj import auditor
 from swift.obj.diskfile import DiskFile, write_metadata, invalidate_hash
 from swift.obj.server import DATADIR
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp, \
-    storage_directory
+    storage_directory, json
 
 
 class TestAuditor(unittest.TestCase):
@@ -184,6 +185,32 @@ class TestAuditor(unittest.TestCase):
         self.assertEquals(self.auditor.stats_buckets[1024], 1)
         self.assertEquals(self.auditor.stats_buckets[10240], 0)
 
+    def test_object_run_once_packed(self):
+        self.auditor = auditor.AuditorWorker(self.conf, self.logger)
+        disk_file = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                             self.logger, packed_volumes=True,
+                             pack_max_size=1024)
+        timestamp = str(normalize_timestamp(time.time()))
+        with disk_file.create() as writer:
+            writer.write('0' * 1024)
+            writer.put({'ETag': md5('1' * 1024).hexdigest(),
+                        'X-Timestamp': timestamp,
+                        'Content-Length': '1024'})
+        self.assertFalse(os.path.exists(disk_file.datadir))
+        pre_quarantines = self.auditor.quarantines
+        with mock.patch('swift.obj.auditor.advise_sequential') as advise:
+            self.auditor.audit_all_objects()
+        # only the object's data is advised, not the whole volume
+        self.assertEquals(advise.call_count, 1)
+        fd, offset, length = advise.call_args[0]
+        self.assert_(offset > 0)
+        self.assertEquals(length, 1024)
+        self.assertEquals(self.auditor.quarantines, pre_quarantines + 1)
+        self.assertEquals(self.auditor.stats_buckets[1024], 1)
+        disk_file = DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                             self.logger, packed_volumes=True)
+        self.assert_(disk_file.is_deleted())
+
     def test_object_run_once_no_sda(self):
         self.auditor = auditor.AuditorWorker(self.conf, self.logger)
         timestamp = str(normalize_timestamp(time.time()))
@@ -349,6 +376,179 @@ class TestAuditor(unittest.TestCase):
         finally:
             auditor.diskfile.DiskFile = was_df
 
+    def _put_objects(self, count):
+        paths = []
+        timestamp = normalize_timestamp(time.time())
+        for part in xrange(count):
+            disk_file = DiskFile(self.devices, 'sda', str(part), 'a', 'c',
+                                 'o%d' % part, self.logger)
+            with disk_file.create() as writer:
+                writer.write('0' * 1024)
+                writer.put({'ETag': md5('0' * 1024).hexdigest(),
+                            'X-Timestamp': timestamp,
+                            'Content-Length': '1024'})
+            paths.append(os.path.join(disk_file.datadir,
+                                      timestamp + '.data'))
+        return paths
+
+    def test_audit_resumes_from_checkpoint(self):
+        paths = self._put_objects(3)
+        self.conf['checkpoint_time'] = '0'
+        audited = []
+        crash = [True]
+
+        class Crash(Exception):
+            pass
+
+        def fake_object_audit(path, device, partition):
+            if crash[0] and len(audited) == 2:
+                raise Crash()
+            audited.append(path)
+
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        worker.object_audit = fake_object_audit
+        self.assertRaises(Crash, worker.audit_all_objects)
+        self.assertEquals(audited, paths[:2])
+        cursor_file = os.path.join(self.devices, 'sda',
+                                   'object_auditor_ALL.cursor')
+        with open(cursor_file, 'rb') as fp:
+            self.assertEquals(pickle.load(fp)['cursor'][0], '1')
+        # the next run picks up after the last object checkpointed
+        del audited[:]
+        crash[0] = False
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        worker.object_audit = fake_object_audit
+        worker.audit_all_objects()
+        self.assertEquals(audited, paths[2:])
+        with open(cursor_file, 'rb') as fp:
+            self.assertEquals(pickle.load(fp)['cursor'], None)
+        self.assertEquals(worker.progress, {})
+        # and the one after that starts over
+        del audited[:]
+        worker.audit_all_objects()
+        self.assertEquals(audited, paths)
+        # the zero byte auditor keeps its own cursor
+        worker = auditor.AuditorWorker(self.conf, self.logger,
+                                       zero_byte_only_at_fps=50)
+        self.assertEquals(worker.load_progress('sda')['cursor'], None)
+        with open(cursor_file, 'wb') as fp:
+            fp.write('garbage')
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        self.assertEquals(worker.load_progress('sda')['cursor'], None)
+
+    def test_audit_resumes_within_object(self):
+        paths = self._put_objects(2)
+        # an older .data file not yet cleaned up is a second location of
+        # the same object
+        older = os.path.join(os.path.dirname(paths[1]),
+                             normalize_timestamp(1) + '.data')
+        with open(older, 'wb'):
+            pass
+        self.conf['checkpoint_time'] = '0'
+        audited = []
+        crash = [True]
+
+        class Crash(Exception):
+            pass
+
+        def fake_object_audit(path, device, partition):
+            if crash[0] and path == older:
+                raise Crash()
+            audited.append(path)
+
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        worker.object_audit = fake_object_audit
+        self.assertRaises(Crash, worker.audit_all_objects)
+        self.assertEquals(audited, paths)
+        # the object is not done with until its last location is
+        del audited[:]
+        crash[0] = False
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        worker.object_audit = fake_object_audit
+        worker.audit_all_objects()
+        self.assertEquals(audited, [paths[1], older])
+
+    def test_audit_eta(self):
+        rmtree(os.path.join(self.devices, 'sdb'))
+        self._put_objects(2)
+        self.conf['recon_cache_path'] = self.testdir
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        worker.log_time = 0
+        statvfs = mock.MagicMock(f_blocks=10, f_bfree=4, f_frsize=1024)
+        with mock.patch('swift.obj.auditor.os.statvfs',
+                        return_value=statvfs):
+            worker.audit_all_objects()
+        with open(os.path.join(self.testdir, 'object.recon')) as fp:
+            stats = json.load(fp)['object_auditor_stats_ALL']
+        # 6 KiB used less the 2 KiB audited by the last report
+        self.assertEquals(stats['bytes_remaining'], 4096)
+        self.assertTrue(stats['eta'] >= 0)
+        self.assertEquals(worker.total_bytes_covered, 2048)
+
+    def test_object_audit_advises_sequential_reads(self):
+        self._put_objects(1)
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        with mock.patch('swift.obj.auditor.advise_sequential') as advise:
+            worker.audit_all_objects()
+        self.assertEquals(advise.call_count, 1)
+        self.assertTrue(isinstance(advise.call_args[0][0], int))
+        self.assertEquals(worker.passes, 1)
+        # the zero byte fast track never reads data
+        worker = auditor.AuditorWorker(self.conf, self.logger,
+                                       zero_byte_only_at_fps=50)
+        with mock.patch('swift.obj.auditor.advise_sequential') as advise:
+            worker.audit_all_objects()
+        self.assertFalse(advise.called)
+
+    def test_disk_chunk_size(self):
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        self.assertEquals(worker.disk_chunk_size, 65536)
+        self.conf['concurrency'] = '2'
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        self.assertEquals(worker.disk_chunk_size, 1048576)
+        self.conf['disk_chunk_size'] = '4096'
+        worker = auditor.AuditorWorker(self.conf, self.logger)
+        self.assertEquals(worker.disk_chunk_size, 4096)
+
+    def test_sum_stats(self):
+        stats = [{'errors': 1, 'passes': 10, 'quarantined': 0,
+                  'bytes_processed': 100, 'start_time': 5, 'audit_time': 2,
+                  'bytes_remaining': 1000, 'eta': 20},
+                 {'errors': 0, 'passes': 5, 'quarantined': 2,
+                  'bytes_processed': 50, 'start_time': 3, 'audit_time': 4,
+                  'bytes_remaining': 0, 'eta': None}]
+        self.assertEquals(auditor.sum_stats(stats),
+                          {'errors': 1, 'passes': 15, 'quarantined': 2,
+                           'bytes_processed': 150, 'start_time': 3,
+                           'audit_time': 4, 'bytes_remaining': 1000,
+                           'eta': 20})
+        stats[0]['eta'] = None
+        self.assertEquals(auditor.sum_stats(stats)['eta'], None)
+
+    def test_audit_in_parallel(self):
+        os.mkdir(self.objects_2)
+        timestamp = normalize_timestamp(time.time())
+        for device in ('sda', 'sdb'):
+            disk_file = DiskFile(self.devices, device, '0', 'a', 'c', 'o',
+                                 self.logger)
+            with disk_file.create() as writer:
+                writer.write('0' * 1024)
+                writer.put({'ETag': md5('1' * 1024).hexdigest(),
+                            'X-Timestamp': timestamp,
+                            'Content-Length': '1024'})
+        self.conf.update(concurrency='2', log_time='0',
+                         recon_cache_path=self.testdir)
+        my_auditor = auditor.ObjectAuditor(self.conf)
+        my_auditor.run_once()
+        # each device was audited by a worker of its own
+        for device in ('sda', 'sdb'):
+            self.assertTrue(os.path.isdir(os.path.join(
+                self.devices, device, 'quarantined', 'objects')))
+        with open(os.path.join(self.testdir, 'object.recon')) as fp:
+            stats = json.load(fp)['object_auditor_stats_ALL']
+        self.assertEquals(stats['quarantined'], 2)
+        self.assertEquals(stats['passes'], 2)
+
     def test_run_forever(self):
 
         class StopForever(Exception):
@@ -21,12 +21,14 @@ from __future__ import with_statement
 import cPickle as pickle
 import os
 import errno
+import struct
 import mock
 import unittest
 import email
 import tempfile
+import threading
 from shutil import rmtree
-from time import time
+from time import time, sleep
 from tempfile import mkdtemp
 from hashlib import md5
 from contextlib import closing
@@ -35,11 +37,13 @@ from gzip import GzipFile
 from eventlet import tpool
 from test.unit import FakeLogger, mock as unit_mock
 from test.unit import _setxattr as setxattr
-from swift.obj import diskfile
+from swift.obj import diskfile, volume
 from swift.common import utils
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp
 from swift.common import ring
-from swift.common.exceptions import DiskFileNotExist, DiskFileDeviceUnavailable
+from swift.common.exceptions import DiskFileNotExist, \
+    DiskFileDeviceUnavailable, LockTimeout
+from swift.obj.journal import AsyncPendingJournal, read_segment
 
 
 def _create_test_ring(path):
@@ -187,6 +191,416 @@ class TestDiskFileModuleMethods(unittest.TestCase):
         # only the meta and data should be left
         self.assertEquals(len(os.listdir(whole_hsh_path)), 2)
 
+    def test_get_obsolete_files(self):
+        files = ['1.data', '3.meta', '2.meta', '0.ts']
+        self.assertEquals(sorted(diskfile.get_obsolete_files(files)),
+                          ['0.ts', '2.meta'])
+        self.assertEquals(files, ['3.meta', '2.meta', '1.data', '0.ts'])
+        self.assertEquals(diskfile.get_obsolete_files(['2.ts', '1.data']),
+                          ['1.data'])
+        self.assertEquals(diskfile.get_obsolete_files(['1.data']), [])
+        old_ts = normalize_timestamp(time() - 1000) + '.ts'
+        self.assertEquals(diskfile.get_obsolete_files([old_ts], 100),
+                          [old_ts])
+        self.assertEquals(diskfile.get_obsolete_files([old_ts], 10000), [])
+
+    def _pack(self, part, obj, timestamp, extension='.data', data=''):
+        df = diskfile.DiskFile(self.devices, 'sda', part, 'a', 'c', obj,
+                               FakeLogger(), packed_volumes=True,
+                               pack_max_size=1024)
+        if extension == '.data':
+            with df.create() as writer:
+                writer.write(data)
+                writer.put({'X-Timestamp': timestamp,
+                            'ETag': md5(data).hexdigest(),
+                            'Content-Length': str(len(data))})
+        else:
+            df.put_metadata({'X-Timestamp': timestamp},
+                            tombstone=(extension == '.ts'))
+        return df
+
+    def _put_file(self, part, obj, timestamp, extension='.data', data=''):
+        df = diskfile.DiskFile(self.devices, 'sda', part, 'a', 'c', obj,
+                               FakeLogger())
+        if extension == '.data':
+            with df.create() as writer:
+                writer.write(data)
+                writer.put({'X-Timestamp': timestamp,
+                            'ETag': md5(data).hexdigest(),
+                            'Content-Length': str(len(data))})
+        else:
+            df.put_metadata({'X-Timestamp': timestamp},
+                            tombstone=(extension == '.ts'))
+        return df
+
+    def test_packed_suffix_hashes_match_files(self):
+        ts = [normalize_timestamp(time() - t) for t in (30, 20, 10)]
+        for obj, updates in (('o1', [(ts[0], '.data')]),
+                             ('o2', [(ts[0], '.data'), (ts[1], '.meta')]),
+                             ('o3', [(ts[0], '.data'), (ts[2], '.ts')]),
+                             ('o4', [(ts[0], '.data'), (ts[1], '.data')])):
+            for timestamp, extension in updates:
+                packed = self._pack('0', obj, timestamp, extension, 'x')
+                self._put_file('1', obj, timestamp, extension, 'x')
+        # part 0 has no object files at all
+        self.assertEquals([name for name in os.listdir(self.parts['0'])
+                           if len(name) == 3], [])
+        self.assert_(os.path.isdir(os.path.join(self.parts['0'], 'volume')))
+        packed_hashes = diskfile.get_hashes(self.parts['0'])[1]
+        file_hashes = diskfile.get_hashes(self.parts['1'])[1]
+        self.assertEquals(packed_hashes, file_hashes)
+        self.assertEquals(
+            diskfile.get_hashes(self.parts['0'], do_listdir=True)[1],
+            file_hashes)
+        suffix = os.path.basename(os.path.dirname(packed.datadir))
+        self.assertEquals(
+            diskfile.hash_suffix(os.path.join(self.parts['0'], suffix),
+                                 diskfile.ONE_WEEK),
+            diskfile.hash_suffix(os.path.join(self.parts['1'], suffix),
+                                 diskfile.ONE_WEEK))
+
+    def test_packed_suffix_hash_mixed_layouts(self):
+        t1, t2 = normalize_timestamp(1), normalize_timestamp(2)
+        # packed .data over a file .data, and the other way around
+        self._put_file('0', 'o1', t1, data='old')
+        self._pack('0', 'o1', t2, data='new')
+        self._pack('0', 'o2', t1, data='old')
+        self._put_file('0', 'o2', t2, data='new')
+        self._put_file('1', 'o1', t2, data='new')
+        self._put_file('1', 'o2', t2, data='new')
+        self.assertEquals(diskfile.get_hashes(self.parts['0'])[1],
+                          diskfile.get_hashes(self.parts['1'])[1])
+
+    def test_packed_tombstones_are_reclaimed(self):
+        t1 = normalize_timestamp(time() - 30 * 86400)
+        t2 = normalize_timestamp(time() - 29 * 86400)
+        for extension in ('.data', '.ts'):
+            df = self._pack('0', 'o', (t1, t2)[extension == '.ts'],
+                            extension, 'x')
+            self._put_file('1', 'o', (t1, t2)[extension == '.ts'],
+                           extension, 'x')
+        self._pack('0', 'o2', t2, data='live')
+        suffix = os.path.basename(os.path.dirname(df.datadir))
+        # the tombstone is reclaimed from files, and the suffix is gone
+        self.assertEquals(
+            diskfile.hash_suffix(os.path.join(self.parts['1'], suffix),
+                                 86400),
+            md5().hexdigest())
+        self.assertRaises(diskfile.PathNotDir, diskfile.hash_suffix,
+                          os.path.join(self.parts['1'], suffix), 86400)
+        # the records stay in the volume, but are hashed as reclaimed too
+        for _junk in xrange(2):
+            self.assertRaises(diskfile.PathNotDir, diskfile.hash_suffix,
+                              os.path.join(self.parts['0'], suffix), 86400)
+        # hashing the partition compacts away the dead records
+        vol = volume.get_volume(self.parts['0'])
+        size = os.path.getsize(vol.data_path)
+        hashes = diskfile.get_hashes(self.parts['0'], reclaim_age=86400)[1]
+        self.assertFalse(suffix in hashes)
+        self.assert_(os.path.getsize(vol.data_path) < size)
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o2',
+                               FakeLogger(), packed_volumes=True,
+                               keep_data_fp=True)
+        self.assertEquals(''.join(df), 'live')
+        self.assertEquals(
+            diskfile.compact_volume(self.parts['0'], reclaim_age=86400), 0)
+
+    def test_get_hashes_without_volume(self):
+        self._put_file('0', 'o', normalize_timestamp(1), data='x')
+        with mock.patch('swift.obj.diskfile.get_volume') as get_volume:
+            hashes = diskfile.get_hashes(self.parts['0'], do_listdir=True)[1]
+        self.assertEquals(len(hashes), 1)
+        self.assertFalse(get_volume.called)
+        self.assertEquals(diskfile.compact_volume(self.parts['0']), 0)
+
+    def test_unpack_suffixes(self):
+        t1, t2 = normalize_timestamp(1), normalize_timestamp(2)
+        df = self._pack('0', 'o', t1, data='data')
+        self._pack('0', 'o', t2, '.meta')
+        suffix = os.path.basename(os.path.dirname(df.datadir))
+        written = diskfile.unpack_suffixes(self.parts['0'], [suffix])
+        self.assertEquals(sorted(written),
+                          [os.path.join(df.datadir, t1 + '.data'),
+                           os.path.join(df.datadir, t2 + '.meta')])
+        with open(os.path.join(df.datadir, t1 + '.data')) as fp:
+            self.assertEquals(fp.read(), 'data')
+            self.assertEquals(diskfile.read_metadata(fp)['name'], '/a/c/o')
+        # files already there are left alone
+        self.assertEquals(
+            diskfile.unpack_suffixes(self.parts['0'], [suffix]), [])
+        diskfile.remove_unpacked(written)
+        self.assertFalse(os.path.exists(os.path.dirname(df.datadir)))
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                               FakeLogger(), packed_volumes=True)
+        self.assertEquals(df.metadata['X-Timestamp'], t2)
+
+    def test_volume_location_generator(self):
+        t1 = normalize_timestamp(1)
+        df = self._pack('0', 'o', t1, data='data')
+        self._pack('1', 'o2', t1, '.ts')
+        locations = list(diskfile.volume_location_generator(
+            self.devices, 'objects', mount_check=False))
+        path = os.path.join(df.datadir, t1 + '.data')
+        self.assertEquals(locations, [(path, 'sda', '0')])
+        self.assertEquals(diskfile.read_location_metadata(path)['name'],
+                          '/a/c/o')
+        self.assertRaises(DiskFileNotExist, diskfile.read_location_metadata,
+                          os.path.join(df.datadir, 'missing.data'))
+        df = self._put_file('2', 'o3', t1, data='data')
+        self.assertEquals(diskfile.read_location_metadata(
+            os.path.join(df.datadir, t1 + '.data'))['name'], '/a/c/o3')
+
+    def test_device_location_generator(self):
+        t1 = normalize_timestamp(time())
+        dfs = [self._put_file('10', 'o1', t1, data='data'),
+               self._pack('10', 'o2', t1, data='data'),
+               self._put_file('2', 'o3', t1, data='data'),
+               self._put_file('2', 'o4', t1, '.ts')]
+        locations = list(diskfile.device_location_generator(
+            self.devices, 'sda', 'objects'))
+        expected = sorted(
+            [(os.path.join(df.datadir, t1 + '.data'), 'sda', partition,
+              (partition,) + tuple(df.datadir.rsplit('/', 2)[1:]))
+             for df, partition in zip(dfs[:3], ('10', '10', '2'))],
+            key=lambda location: (int(location[2]), location[3]))
+        # in order of partition, suffix and hash, packed objects included
+        self.assertEquals(locations, expected)
+        for index, location in enumerate(expected):
+            self.assertEquals(list(diskfile.device_location_generator(
+                self.devices, 'sda', 'objects', location[3])),
+                expected[index + 1:])
+        # a cursor at an object gone since resumes after its place
+        self.assertEquals(list(diskfile.device_location_generator(
+            self.devices, 'sda', 'objects', ('2', 'fff', 'f' * 32))),
+            expected[1:])
+        self.assertEquals(list(diskfile.device_location_generator(
+            self.devices, 'sda', 'objects', ('3', '000', '0' * 32))),
+            expected[1:])
+        self.assertEquals(list(diskfile.device_location_generator(
+            self.devices, 'sdx', 'objects')), [])
+        # an object's position is only given with its last location
+        older = os.path.join(dfs[2].datadir, normalize_timestamp(1) + '.data')
+        with open(older, 'wb'):
+            pass
+        locations = list(diskfile.device_location_generator(
+            self.devices, 'sda', 'objects'))
+        self.assertEquals(locations[:2], [
+            expected[0][:3] + (None,), (older, 'sda', '2', expected[0][3])])
+        self.assertEquals(locations[2:], expected[1:])
+        self.assertEquals(list(diskfile.device_location_generator(
+            self.devices, 'sda', 'objects', locations[0][3])), locations)
+
+    def test_list_and_missing_object_files(self):
+        t1, t2, t3 = [normalize_timestamp(time() - t) for t in (30, 20, 10)]
+        df1 = self._put_file('0', 'o1', t1, data='one')
+        self._put_file('0', 'o1', t2, '.meta')
+        df2 = self._pack('0', 'o2', t1, data='two')
+        self._pack('0', 'o2', t3, '.ts')
+        suffixes = [os.path.basename(os.path.dirname(df.datadir))
+                    for df in (df1, df2)]
+        offered = diskfile.list_object_files(self.parts['0'], suffixes,
+                                             reclaim_age=60)
+        hsh1 = os.path.basename(df1.datadir)
+        hsh2 = os.path.basename(df2.datadir)
+        self.assertEquals(offered, {hsh1: [t1 + '.data', t2 + '.meta'],
+                                    hsh2: [t3 + '.ts']})
+        # old enough tombstones are not offered
+        self.assertEquals(
+            diskfile.list_object_files(self.parts['0'], suffixes, 0),
+            {hsh1: [t1 + '.data', t2 + '.meta']})
+        self.assertEquals(
+            diskfile.missing_object_files(self.parts['1'], offered, 60),
+            offered)
+        # newer files here make older ones obsolete
+        self._put_file('1', 'o1', t3, '.ts')
+        self._put_file('1', 'o2', t2, data='newer')
+        self.assertEquals(
+            diskfile.missing_object_files(self.parts['1'], offered, 60),
+            {hsh2: [t3 + '.ts']})
+        self.assertEquals(
+            diskfile.missing_object_files(self.parts['0'], offered, 60),
+            {})
+
+    def test_open_and_write_object_files(self):
+        t1, t2 = [normalize_timestamp(time() - t) for t in (20, 10)]
+        df1 = self._put_file('0', 'o1', t1, data='one')
+        df2 = self._pack('0', 'o2', t1, data='two')
+        self._put_file('1', 'o2', t2, '.ts')
+        hsh1 = os.path.basename(df1.datadir)
+        hsh2 = os.path.basename(df2.datadir)
+        files = []
+        for hsh in (hsh1, hsh2):
+            metadata, fp, length = diskfile.open_object_file(
+                self.parts['0'], hsh, t1 + '.data')
+            self.assertEquals(length, 3)
+            self.assertEquals(metadata['X-Timestamp'], t1)
+            files.append((hsh, t1 + '.data', metadata, length, fp.read))
+        self.assertRaises(DiskFileNotExist, diskfile.open_object_file,
+                          self.parts['0'], hsh1, t2 + '.data')
+        diskfile.get_hashes(self.parts['1'])
+        written = diskfile.write_object_files(self.parts['1'], files,
+                                              chunk_size=2)
+        self.assertEquals(
+            written,
+            [os.path.join(self.parts['1'], hsh1[-3:], hsh1, t1 + '.data'),
+             os.path.join(self.parts['1'], hsh2[-3:], hsh2, t1 + '.data')])
+        # the older .data is removed again by the newer tombstone
+        self.assertEquals(os.listdir(os.path.dirname(written[1])),
+                          [t2 + '.ts'])
+        with open(written[0]) as fp:
+            self.assertEquals(fp.read(), 'one')
+            self.assertEquals(diskfile.read_metadata(fp)['name'], '/a/c/o1')
+        # the suffix hashes were invalidated
+        self.assertEquals(
+            diskfile.get_hashes(self.parts['1'])[1][hsh1[-3:]],
+            diskfile.get_hashes(self.parts['0'])[1][hsh1[-3:]])
+        self.assertRaises(
+            diskfile.DiskFileError, diskfile.write_object_files,
+            self.parts['2'], [(hsh1, t2 + '.data', {}, 10, lambda s: '')])
+        self.assertEquals(os.listdir(os.path.join(self.devices, 'sda',
+                                                  'tmp')), [])
+
+    def test_write_object_files_in_threadpool(self):
+        calls = []
+
+        class FakeThreadPool(object):
+
+            def run_in_thread(self, func, *args):
+                calls.append(('run', func.__name__))
+                return func(*args)
+
+            def force_run_in_thread(self, func, *args):
+                calls.append(('force', func.__name__))
+                return func(*args)
+
+        def read(size):
+            calls.append(('read', size))
+            return 'x' * size
+
+        hsh = hash_path('a', 'c', 'o')
+        t1 = normalize_timestamp(1)
+        written = diskfile.write_object_files(
+            self.parts['0'], [(hsh, t1 + '.data', {'X-Timestamp': t1}, 3,
+                               read)],
+            chunk_size=2, threadpool=FakeThreadPool())
+        self.assertEquals(len(written), 1)
+        # data is read in the calling thread, disk work done in the pool
+        self.assertEquals(calls, [('force', '_create_tmp_file'),
+                                  ('read', 2), ('run', '_write_all'),
+                                  ('read', 1), ('run', '_write_all'),
+                                  ('force', '_commit_tmp_file'),
+                                  ('force', '_discard_tmp_file'),
+                                  ('force', 'hash_cleanup_listdir'),
+                                  ('force', '_invalidate_suffixes')])
+
+    def test_device_hash_tree(self):
+        t1 = normalize_timestamp(time())
+        df = self._put_file('0', 'o1', t1, data='one')
+        self._put_file('1', 'o1', t1, data='one')
+        device_path = os.path.join(self.devices, 'sda')
+        tree = diskfile.DeviceHashTree(device_path)
+        hashes = tree.get(['0', '1', '2', '4'])
+        self.assertEquals(hashes['0'], hashes['1'])
+        self.assertEquals(len(hashes['0']), 32)
+        self.assertEquals(hashes['2'], None)
+        self.assertEquals(hashes['4'], None)
+        self.assert_(os.path.exists(tree.tree_file))
+        # unchanged partitions are not read again, even after a restart
+        with mock.patch('swift.obj.diskfile.get_hashes') as get_hashes:
+            self.assertEquals(tree.get(['0', '1', '2']),
+                              {'0': hashes['0'], '1': hashes['1'],
+                               '2': None})
+            tree = diskfile.DeviceHashTree(device_path)
+            self.assertEquals(tree.get(['0', '1']),
+                              {'0': hashes['0'], '1': hashes['1']})
+        self.assertFalse(get_hashes.called)
+        # a changed object invalidates its suffix, and so the partition
+        df.put_metadata({'X-Timestamp': normalize_timestamp(time() + 1)})
+        changed = tree.get(['0', '1'])
+        self.assertNotEquals(changed['0'], hashes['0'])
+        self.assertEquals(changed['1'], hashes['1'])
+        self.assertEquals(diskfile.DeviceHashTree(device_path).get(['0']),
+                          {'0': changed['0']})
+        rmtree(self.parts['0'])
+        self.assertEquals(tree.get(['0']), {'0': None})
+        # past the deadline only what needs no rehashing is answered for
+        df = self._put_file('0', 'o1', t1, data='one')
+        df.put_metadata({'X-Timestamp': normalize_timestamp(time() + 2)})
+        self.assertEquals(tree.get(['0', '1', '2'], deadline=time() - 1),
+                          {'0': diskfile.UNKNOWN_HASH, '1': hashes['1'],
+                           '2': None})
+        self.assertEquals(len(tree.get(['0'], deadline=time() + 60)['0']),
+                          32)
+
+    def test_write_read_metadata_compact(self):
+        metadata = {'name': '/a/c/o', 'X-Timestamp': '1234567890.12345',
+                    'Content-Length': '0', 'X-Object-Meta-Empty': '',
+                    'X-Object-Meta-Utf8': '\xe2\x98\x83'}
+        with tempfile.NamedTemporaryFile() as fp:
+            diskfile.write_metadata(fp.fileno(), metadata, compact=True)
+            with mock.patch('swift.obj.diskfile.getxattr',
+                            side_effect=diskfile.getxattr) as getxattr:
+                self.assertEquals(diskfile.read_metadata(fp.fileno()),
+                                  metadata)
+            # one syscall, no probing for further chunks
+            self.assertEquals(getxattr.call_count, 1)
+            raw = diskfile.getxattr(fp.fileno(), diskfile.METADATA_KEY)
+            self.assert_(raw.startswith(diskfile.COMPACT_METADATA_MAGIC))
+
+    def test_write_read_metadata_compact_chunked_fallback(self):
+        metadata = {'name': '/a/c/o', 'X-Object-Meta-Big': 'x' * 1000}
+        orig_setxattr = diskfile.setxattr
+
+        def limited_setxattr(fd, key, value):
+            if len(value) > 254:
+                raise IOError(errno.E2BIG, 'Argument list too long')
+            return orig_setxattr(fd, key, value)
+
+        with tempfile.NamedTemporaryFile() as fp:
+            with mock.patch('swift.obj.diskfile.setxattr', limited_setxattr):
+                diskfile.write_metadata(fp.fileno(), metadata, compact=True)
+            raw = diskfile.getxattr(fp.fileno(), diskfile.METADATA_KEY + '1')
+            self.assert_(raw)
+            self.assertEquals(diskfile.read_metadata(fp.fileno()), metadata)
+
+    def test_write_metadata_compact_non_str_pickles(self):
+        metadata = {'X-Timestamp': 1234567890.12345, 'name': u'/a/c/o'}
+        with tempfile.NamedTemporaryFile() as fp:
+            diskfile.write_metadata(fp.fileno(), metadata, compact=True)
+            raw = diskfile.getxattr(fp.fileno(), diskfile.METADATA_KEY)
+            self.assertEquals(pickle.loads(raw), metadata)
+            self.assertEquals(diskfile.read_metadata(fp.fileno()), metadata)
+
+    def test_read_metadata_legacy_pickle(self):
+        metadata = {'name': '/a/c/o', 'X-Object-Meta-Big': 'x' * 1000}
+        with tempfile.NamedTemporaryFile() as fp:
+            diskfile.write_metadata(fp.fileno(), metadata)
+            raw = diskfile.getxattr(fp.fileno(), diskfile.METADATA_KEY)
+            self.assertEquals(len(raw), 254)
+            self.assertFalse(raw.startswith(diskfile.COMPACT_METADATA_MAGIC))
+            self.assertEquals(diskfile.read_metadata(fp.fileno()), metadata)
+
+    def test_read_metadata_compact_bad_version(self):
+        metastr = diskfile._pack_metadata({'name': '/a/c/o'})
+        metastr = metastr[:3] + chr(99) + metastr[4:]
+        self.assertRaises(ValueError, diskfile._unpack_metadata, metastr)
+        self.assertRaises(ValueError, diskfile._unpack_metadata,
+                          diskfile._pack_metadata({'name': '/a/c/o'})[:-1])
+
+    def test_read_metadata_compact_corrupt_lengths(self):
+        metastr = diskfile._pack_metadata({'name': '/a/c/o', 'Etag': 'x'})
+        header = diskfile._COMPACT_HEADER
+        self.assertRaises(ValueError, diskfile._unpack_metadata,
+                          metastr[:header.size - 1])
+        # more items than the string has room for
+        corrupt = metastr[:header.size - 2] + struct.pack('!H', 1000) + \
+            metastr[header.size:]
+        self.assertRaises(ValueError, diskfile._unpack_metadata, corrupt)
+        # a key longer than the rest of the string
+        corrupt = metastr[:header.size] + struct.pack('!H', 1000) + \
+            metastr[header.size + 2:]
+        self.assertRaises(ValueError, diskfile._unpack_metadata, corrupt)
+
     def test_invalidate_hash(self):
 
         def assertFileData(file_path, data):
@@ -202,6 +616,8 @@ class TestDiskFileModuleMethods(unittest.TestCase):
         whole_path_from = os.path.join(self.objects, '0', data_dir)
         hashes_file = os.path.join(self.objects, '0',
                                    diskfile.HASH_FILE)
+        invalidations_file = os.path.join(self.objects, '0',
+                                          diskfile.HASH_INVALIDATIONS_FILE)
         # test that non existent file except caught
         self.assertEquals(diskfile.invalidate_hash(whole_path_from),
                           None)
@@ -212,7 +628,143 @@ class TestDiskFileModuleMethods(unittest.TestCase):
             with open(hashes_file, 'wb') as fp:
                 pickle.dump(data_hash, fp, diskfile.PICKLE_PROTOCOL)
             diskfile.invalidate_hash(whole_path_from)
+            # the invalidation is only journaled...
+            assertFileData(hashes_file, pickle.dumps(
+                data_hash, diskfile.PICKLE_PROTOCOL))
+            with open(invalidations_file, 'rb') as fp:
+                self.assertEquals(fp.read().split(), [data_dir, data_dir])
+            # ...until it is folded into the hashes file
+            diskfile.consolidate_hashes(os.path.join(self.objects, '0'))
             assertFileData(hashes_file, check_pickle_data)
+            self.assertEquals(os.path.getsize(invalidations_file), 0)
+            diskfile.invalidate_hash(whole_path_from)
+
+    def test_invalidate_hash_does_not_rewrite_hashes_file(self):
+        part = os.path.join(self.objects, '0')
+        hashes_file = os.path.join(part, diskfile.HASH_FILE)
+        with open(hashes_file, 'wb') as fp:
+            pickle.dump({'abc': 'fake'}, fp, diskfile.PICKLE_PROTOCOL)
+        with mock.patch('swift.obj.diskfile.write_pickle') as write_pickle:
+            for _junk in xrange(3):
+                diskfile.invalidate_hash(os.path.join(part, 'abc'))
+        self.assertFalse(write_pickle.called)
+        with open(os.path.join(part, diskfile.HASH_INVALIDATIONS_FILE)) as fp:
+            self.assertEquals(fp.read(), 'abc\nabc\nabc\n')
+
+    def test_consolidate_hashes_new_suffix(self):
+        part = os.path.join(self.objects, '0')
+        hashes_file = os.path.join(part, diskfile.HASH_FILE)
+        with open(hashes_file, 'wb') as fp:
+            pickle.dump({'abc': 'fake'}, fp, diskfile.PICKLE_PROTOCOL)
+        diskfile.invalidate_hash(os.path.join(part, 'def'))
+        diskfile.consolidate_hashes(part)
+        with open(hashes_file, 'rb') as fp:
+            self.assertEquals(pickle.load(fp), {'abc': 'fake', 'def': None})
+
+    def test_consolidate_hashes_no_hashes_file(self):
+        part = os.path.join(self.objects, '0')
+        diskfile.invalidate_hash(os.path.join(part, 'abc'))
+        with mock.patch('swift.obj.diskfile.write_pickle') as write_pickle:
+            diskfile.consolidate_hashes(part)
+        self.assertFalse(write_pickle.called)
+        self.assertFalse(os.path.exists(os.path.join(part,
+                                                     diskfile.HASH_FILE)))
+        self.assertEquals(os.path.getsize(
+            os.path.join(part, diskfile.HASH_INVALIDATIONS_FILE)), 0)
+
+    def test_get_hashes_invalidated_while_hashing(self):
+        df = self._put_file('0', 'o', normalize_timestamp(1), data='x')
+        suffix_dir = os.path.dirname(df.datadir)
+        suffix = os.path.basename(suffix_dir)
+        diskfile.get_hashes(self.parts['0'])
+        diskfile.invalidate_hash(suffix_dir)
+        real_hash_suffix = diskfile.hash_suffix
+        calls = []
+
+        def racing_hash_suffix(path, reclaim_age):
+            calls.append(path)
+            if len(calls) == 1:
+                # a PUT lands while the suffix is being hashed
+                self._put_file('0', 'o', normalize_timestamp(2), data='x')
+                return 'stale'
+            return real_hash_suffix(path, reclaim_age)
+
+        with mock.patch('swift.obj.diskfile.hash_suffix',
+                        racing_hash_suffix):
+            hashed, hashes = diskfile.get_hashes(self.parts['0'])
+        self.assertEquals(calls, [suffix_dir, suffix_dir])
+        self.assertEquals(hashes[suffix],
+                          real_hash_suffix(suffix_dir, diskfile.ONE_WEEK))
+        with open(os.path.join(self.parts['0'], diskfile.HASH_FILE)) as fp:
+            self.assertEquals(pickle.load(fp), hashes)
+        self.assertEquals(os.path.getsize(os.path.join(
+            self.parts['0'], diskfile.HASH_INVALIDATIONS_FILE)), 0)
+
+    def test_get_hashes_invalidated_while_hashing_gives_up(self):
+        df = self._put_file('0', 'o', normalize_timestamp(1), data='x')
+        suffix_dir = os.path.dirname(df.datadir)
+        suffix = os.path.basename(suffix_dir)
+        calls = []
+
+        def racing_hash_suffix(path, reclaim_age):
+            calls.append(path)
+            diskfile.invalidate_hash(path)
+            return 'stale'
+
+        with mock.patch('swift.obj.diskfile.hash_suffix',
+                        racing_hash_suffix):
+            hashed, hashes = diskfile.get_hashes(self.parts['0'])
+        self.assertEquals(calls,
+                          [suffix_dir] * diskfile.GET_HASHES_ATTEMPTS)
+        self.assertEquals(hashed, diskfile.GET_HASHES_ATTEMPTS)
+        self.assertEquals(hashes, {suffix: None})
+        with open(os.path.join(self.parts['0'], diskfile.HASH_FILE)) as fp:
+            self.assertEquals(pickle.load(fp), hashes)
+
+    def test_get_hashes_invalidated_while_hashing_another(self):
+        df = self._put_file('0', 'o', normalize_timestamp(1), data='x')
+        suffix_dir = os.path.dirname(df.datadir)
+        suffix = os.path.basename(suffix_dir)
+        other = 'fff'
+        other_dir = os.path.join(self.parts['0'], other)
+        diskfile.get_hashes(self.parts['0'])
+        calls = []
+
+        def racing_hash_suffix(path, reclaim_age):
+            calls.append(path)
+            # a suffix not being hashed is changed
+            diskfile.invalidate_hash(other_dir)
+            return 'fresh'
+
+        with mock.patch('swift.obj.diskfile.hash_suffix',
+                        racing_hash_suffix):
+            hashed, hashes = diskfile.get_hashes(self.parts['0'],
+                                                 recalculate=[suffix])
+        # what was computed is still good, so it is not hashed again
+        self.assertEquals(calls, [suffix_dir])
+        self.assertEquals(hashes, {suffix: 'fresh', other: None})
+        with open(os.path.join(self.parts['0'], diskfile.HASH_FILE)) as fp:
+            self.assertEquals(pickle.load(fp), hashes)
+        self.assertEquals(os.path.getsize(os.path.join(
+            self.parts['0'], diskfile.HASH_INVALIDATIONS_FILE)), 0)
+
+    def test_get_hashes_folds_invalidations(self):
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        mkdirs(df.datadir)
+        with open(os.path.join(df.datadir,
+                               normalize_timestamp(time()) + '.ts'),
+                  'wb') as f:
+            f.write('1234567890')
+        part = os.path.join(self.objects, '0')
+        hashed, hashes = diskfile.get_hashes(part)
+        self.assertEquals(hashed, 1)
+        hashed, hashes = diskfile.get_hashes(part)
+        self.assertEquals(hashed, 0)
+        diskfile.invalidate_hash(os.path.dirname(df.datadir))
+        hashed, hashes = diskfile.get_hashes(part)
+        self.assertEquals(hashed, 1)
+        self.assert_('a83' in hashes)
 
     def test_get_hashes(self):
         df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
@@ -234,6 +786,81 @@ class TestDiskFileModuleMethods(unittest.TestCase):
         self.assertEquals(hashed, 1)
         self.assert_('a83' in hashes)
 
+    def test_get_hashes_concurrently(self):
+        part = os.path.join(self.objects, '0')
+        for obj in ('o1', 'o2', 'o3', 'o4', 'o5'):
+            df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', obj,
+                                   FakeLogger())
+            mkdirs(df.datadir)
+            with open(os.path.join(df.datadir,
+                                   normalize_timestamp(time()) + '.ts'),
+                      'wb') as f:
+                f.write('1234567890')
+        serial_hashed, serial_hashes = diskfile.get_hashes(
+            part, do_listdir=True)
+        os.unlink(os.path.join(part, diskfile.HASH_FILE))
+        hashed, hashes = diskfile.get_hashes(part, concurrency=3)
+        self.assertEquals(hashed, serial_hashed)
+        self.assertEquals(hashes, serial_hashes)
+        self.assert_(all(hashes.values()))
+        # suffixes that disappeared are dropped
+        hashed, hashes = diskfile.get_hashes(part, recalculate=['fff'],
+                                             concurrency=3)
+        self.assertEquals(hashed, 0)
+        self.assertEquals(hashes, serial_hashes)
+
+    def test_hash_suffixes_concurrently_limits_device(self):
+        part = os.path.join(self.objects, '0')
+        running = []
+        peak = []
+        orig_hash_suffix = diskfile.hash_suffix
+
+        def slow_hash_suffix(path, reclaim_age):
+            running.append(path)
+            peak.append(len(running))
+            sleep(0.01)
+            running.remove(path)
+            return orig_hash_suffix(path, reclaim_age)
+
+        results = []
+
+        def hash_suffixes(suffixes):
+            results.append(diskfile.hash_suffixes_concurrently(
+                part, suffixes, 101, 2))
+
+        with mock.patch.dict(diskfile._suffix_hash_pools, clear=True):
+            with mock.patch('swift.obj.diskfile.hash_suffix',
+                            slow_hash_suffix):
+                # concurrent callers share the threads of the device
+                callers = [threading.Thread(
+                    target=hash_suffixes,
+                    args=(['%03x' % i for i in xrange(n, n + 4)],))
+                    for n in (0, 4)]
+                for caller in callers:
+                    caller.start()
+                for caller in callers:
+                    caller.join()
+                self.assertEquals(len(diskfile._suffix_hash_pools), 1)
+                # and later calls reuse them
+                nthreads = threading.active_count()
+                hash_suffixes(['%03x' % i for i in xrange(8)])
+                self.assertEquals(threading.active_count(), nthreads)
+        self.assertEquals(sorted(len(r) for r in results), [4, 4, 8])
+        self.assertEquals(results[-1], dict(('%03x' % i, None)
+                                            for i in xrange(8)))
+        self.assert_(max(peak) <= 2)
+
+    def test_hash_suffixes_concurrently_reraises(self):
+        part = os.path.join(self.objects, '0')
+
+        def bad_hash_suffix(path, reclaim_age):
+            raise ValueError('boom')
+
+        with mock.patch('swift.obj.diskfile.hash_suffix', bad_hash_suffix):
+            self.assertRaises(ValueError,
+                              diskfile.hash_suffixes_concurrently,
+                              part, ['abc', 'def'], 101, 2)
+
     def test_get_hashes_bad_dir(self):
         df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
                                FakeLogger())
@@ -437,6 +1064,333 @@ class TestDiskFile(unittest.TestCase):
         self.assert_('3456789' in value)
         self.assert_('01' in value)
 
+    def test_hash_dir_listing_cache(self):
+        logger = FakeLogger()
+        cache = diskfile.HashDirListingCache(10, logger=logger)
+        df = self._create_test_file('1234567890')
+        datadir = df.datadir
+        files = sorted(os.listdir(datadir), reverse=True)
+        self.assertEquals(list(cache.listdir(datadir)), files)
+        with mock.patch('os.listdir') as listdir:
+            self.assertEquals(list(cache.listdir(datadir)), files)
+        self.assertFalse(listdir.called)
+        self.assertEquals(logger.get_increment_counts(),
+                          {'hash_dir_cache.hits': 1,
+                           'hash_dir_cache.misses': 1})
+        # a change by someone else moves the directory's mtime
+        open(os.path.join(datadir, '99.meta'), 'w').close()
+        st = os.stat(datadir)
+        os.utime(datadir, (st.st_atime, st.st_mtime + 1))
+        self.assertEquals(cache.listdir(datadir)[0], '99.meta')
+        self.assertEquals(logger.get_increment_counts(),
+                          {'hash_dir_cache.hits': 1,
+                           'hash_dir_cache.misses': 2})
+        # explicit invalidation
+        cache.invalidate(datadir)
+        cache.listdir(datadir)
+        self.assertEquals(logger.get_increment_counts(),
+                          {'hash_dir_cache.hits': 1,
+                           'hash_dir_cache.misses': 3})
+        cache.invalidate('/not/cached')
+        rmtree(datadir)
+        self.assertRaises(OSError, cache.listdir, datadir)
+        self.assertEquals(len(cache._listings), 0)
+
+    def test_disk_file_uses_listing_cache(self):
+        cache = diskfile.HashDirListingCache(10)
+        self._create_test_file('1234567890')
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger(), listing_cache=cache)
+        data_file = df.data_file
+        self.assert_(data_file)
+        with mock.patch('os.listdir') as listdir:
+            df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                   FakeLogger(), listing_cache=cache)
+        self.assertFalse(listdir.called)
+        self.assertEquals(df.data_file, data_file)
+        # no hash dir
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o2',
+                               FakeLogger(), listing_cache=cache)
+        self.assertEquals(df.data_file, None)
+
+    def test_metadata_cache(self):
+        logger = FakeLogger()
+        cache = diskfile.MetadataCache(10, logger=logger)
+        df = self._create_test_file('1234567890')
+        data_file = df.data_file
+        version, metadata = cache.get(data_file, None)
+        self.assertEquals(metadata, None)
+        cache.set(data_file, version, df.metadata)
+        version2, metadata = cache.get(data_file, None)
+        self.assertEquals(version2, version)
+        self.assertEquals(metadata, df.metadata)
+        metadata['X-Changed'] = 'yes'
+        self.assert_('X-Changed' not in cache.get(data_file, None)[1])
+        self.assertEquals(logger.get_increment_counts(),
+                          {'metadata_cache.hits': 2,
+                           'metadata_cache.misses': 1})
+        # a different .meta file
+        self.assertEquals(cache.get(data_file, '/meta')[1], None)
+        # a change to the data file moves its mtime
+        st = os.stat(data_file)
+        os.utime(data_file, (st.st_atime, st.st_mtime + 1))
+        self.assertEquals(cache.get(data_file, None)[1], None)
+        cache.set(data_file, cache.get(data_file, None)[0], df.metadata)
+        cache.invalidate(data_file)
+        self.assertEquals(cache.get(data_file, None)[1], None)
+        cache.invalidate('/not/cached')
+        os.unlink(data_file)
+        self.assertRaises(OSError, cache.get, data_file, None)
+        self.assertEquals(len(cache._metadata), 0)
+
+    def test_page_cache_tracker(self):
+        logger = FakeLogger()
+        tracker = diskfile.PageCacheTracker(100, min_hits=2, sketch_size=1000,
+                                            logger=logger)
+        self.assertEquals(len(tracker._rows[0]), 1024)
+        # not kept until read twice
+        self.assertFalse(tracker.keep('a', 60))
+        self.assertTrue(tracker.keep('a', 60))
+        self.assertTrue(tracker.keep('a', 60))
+        self.assertEquals(tracker.estimate('a'), 3)
+        self.assertEquals(tracker.kept_bytes, 60)
+        # never larger than the budget
+        for _junk in xrange(5):
+            self.assertFalse(tracker.keep('huge', 101))
+        # b is not read as often as a, so does not displace it
+        self.assertFalse(tracker.keep('b', 50))
+        self.assertFalse(tracker.keep('b', 50))
+        self.assertFalse(tracker.keep('b', 50))
+        # until it is read more often
+        self.assertTrue(tracker.keep('b', 50))
+        self.assertEquals(tracker.kept_bytes, 50)
+        self.assertTrue(tracker.keep('c', 10) or tracker.keep('c', 10))
+        self.assertEquals(tracker.kept_bytes, 60)
+        self.assertEquals(logger.get_increment_counts(),
+                          {'page_cache.hits': 1,
+                           'page_cache.misses': 13,
+                           'page_cache.evictions': 1})
+
+    def test_page_cache_tracker_ages(self):
+        tracker = diskfile.PageCacheTracker(100, sketch_size=16)
+        for _junk in xrange(20):
+            tracker.keep('a', 10)
+        self.assertEquals(tracker.estimate('a'), 20)
+        for i in xrange(140):
+            tracker.keep(str(i), 1000)
+        self.assert_(tracker.estimate('a') < 20)
+        self.assert_(tracker._reads < 160)
+
+    def test_disk_file_uses_metadata_cache(self):
+        cache = diskfile.MetadataCache(10)
+        self._create_test_file('1234567890')
+
+        def disk_file(**kwargs):
+            return diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                                     FakeLogger(), metadata_cache=cache,
+                                     **kwargs)
+
+        df = disk_file()
+        metadata = df.metadata
+        self.assert_(df.data_file)
+        with mock.patch('swift.obj.diskfile.read_metadata') as read:
+            df = disk_file()
+            self.assertEquals(df.metadata, metadata)
+            self.assertEquals(df.fp, None)
+            self.assertFalse(df.open_deferred)
+            df = disk_file(keep_data_fp=True)
+            self.assertEquals(df.fp, None)
+            self.assert_(df.open_deferred)
+        self.assertFalse(read.called)
+        self.assertEquals(''.join(df), '1234567890')
+        self.assertFalse(df.quarantined_dir)
+        df = disk_file(keep_data_fp=True)
+        self.assertEquals(''.join(df.app_iter_range(2, 5)), '345')
+        # a deferred open is never done if the data is not read
+        df = disk_file(keep_data_fp=True)
+        df.close()
+        self.assertFalse(df.open_deferred)
+        self.assertEquals(df.fp, None)
+        # or may be done up front
+        df = disk_file(keep_data_fp=True)
+        df.open_data_file()
+        self.assertFalse(df.open_deferred)
+        self.assert_(df.fp)
+        self.assertEquals(''.join(df), '1234567890')
+        # by when the data file may have gone
+        df = disk_file(keep_data_fp=True)
+        self.assert_(df.open_deferred)
+        os.rename(df.data_file, df.data_file + '.moved')
+        self.assertRaises(DiskFileNotExist, df.open_data_file)
+        self.assertEquals(len(cache._metadata), 0)
+        os.rename(df.data_file + '.moved', df.data_file)
+
+        # a POST is picked up
+        df.put_metadata({'X-Timestamp': normalize_timestamp(time() + 1),
+                         'X-Object-Meta-Test': 'yes'})
+        self.assertEquals(len(cache._metadata), 0)
+        df = disk_file()
+        self.assertEquals(df.metadata['X-Object-Meta-Test'], 'yes')
+        df = disk_file()
+        self.assertEquals(df.metadata['X-Object-Meta-Test'], 'yes')
+        # as is a DELETE
+        df.delete(normalize_timestamp(time() + 2))
+        self.assert_(disk_file().is_deleted())
+
+    def _packed_disk_file(self, obj='o', **kwargs):
+        return diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', obj,
+                                 FakeLogger(), packed_volumes=True,
+                                 pack_max_size=10, **kwargs)
+
+    def _put_packed(self, data, timestamp, obj='o'):
+        df = self._packed_disk_file(obj)
+        with df.create() as writer:
+            writer.write(data)
+            writer.put({'X-Timestamp': timestamp,
+                        'ETag': md5(data).hexdigest(),
+                        'Content-Length': str(len(data))})
+        return df
+
+    def test_packed_put_and_get(self):
+        ts = normalize_timestamp(time())
+        df = self._put_packed('1234567890', ts)
+        self.assertFalse(os.path.exists(df.datadir))
+        self.assertFalse(os.listdir(os.path.join(self.testdir, 'sda1',
+                                                 'tmp')))
+        df = self._packed_disk_file(keep_data_fp=True)
+        self.assertFalse(df.is_deleted())
+        self.assertEquals(df.data_file, os.path.join(df.datadir,
+                                                     ts + '.data'))
+        self.assertEquals(df.metadata['name'], '/a/c/o')
+        self.assertEquals(df.get_data_file_size(), 10)
+        self.assertEquals(''.join(df), '1234567890')
+        self.assertFalse(df.quarantined_dir)
+        df = self._packed_disk_file(keep_data_fp=True)
+        self.assertEquals(''.join(df.app_iter_range(2, 5)), '345')
+        # not visible without packed_volumes
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        self.assert_(df.is_deleted())
+
+    def test_packed_large_object_is_a_file(self):
+        ts = normalize_timestamp(time())
+        df = self._put_packed('12345678901', ts)
+        self.assertEquals(os.listdir(df.datadir), [ts + '.data'])
+        df = self._packed_disk_file()
+        self.assertEquals(df.volume_entry, None)
+        self.assertEquals(df.get_data_file_size(), 11)
+
+    def test_packed_post_and_delete(self):
+        t1, t2, t3 = [normalize_timestamp(t) for t in (1, 2, 3)]
+        self._put_packed('abc', t1)
+        df = self._packed_disk_file()
+        df.put_metadata({'X-Timestamp': t2, 'X-Object-Meta-Test': 'yes'})
+        self.assertFalse(os.path.exists(df.datadir))
+        df = self._packed_disk_file()
+        self.assertEquals(df.metadata['X-Object-Meta-Test'], 'yes')
+        self.assertEquals(df.metadata['Content-Length'], '3')
+        df.delete(t3)
+        self.assertFalse(os.path.exists(df.datadir))
+        df = self._packed_disk_file()
+        self.assert_(df.is_deleted())
+        self.assertEquals(df.metadata['X-Timestamp'], t3)
+
+    def test_packed_put_removes_older_files(self):
+        t1, t2, t3 = [normalize_timestamp(t) for t in (1, 2, 3)]
+        df = self._put_packed('12345678901', t1)
+        self.assertEquals(os.listdir(df.datadir), [t1 + '.data'])
+        df = self._packed_disk_file()
+        df.put_metadata({'X-Timestamp': t2})
+        self.assertEquals(sorted(os.listdir(df.datadir)),
+                          [t1 + '.data', t2 + '.meta'])
+        df = self._put_packed('small', t3)
+        self.assertFalse(os.path.exists(df.datadir))
+        df = self._packed_disk_file(keep_data_fp=True)
+        self.assertEquals(''.join(df), 'small')
+
+    def test_packed_newer_file_wins(self):
+        t1, t2 = normalize_timestamp(1), normalize_timestamp(2)
+        self._put_packed('small', t1)
+        df = self._put_packed('12345678901', t2)
+        df = self._packed_disk_file(keep_data_fp=True)
+        self.assertEquals(df.volume_entry, None)
+        self.assertEquals(''.join(df), '12345678901')
+
+    def test_packed_quarantine(self):
+        ts = normalize_timestamp(time())
+        df = self._packed_disk_file()
+        with df.create() as writer:
+            writer.write('abc')
+            writer.put({'X-Timestamp': ts, 'ETag': 'bad',
+                        'Content-Length': '3'})
+        df = self._packed_disk_file(keep_data_fp=True)
+        self.assertEquals(''.join(df), 'abc')
+        self.assert_(df.quarantined_dir)
+        with open(os.path.join(df.quarantined_dir, ts + '.data')) as fp:
+            self.assertEquals(fp.read(), 'abc')
+            self.assertEquals(diskfile.read_metadata(fp)['ETag'], 'bad')
+        df = self._packed_disk_file()
+        self.assert_(df.is_deleted())
+        partition_dir = os.path.dirname(os.path.dirname(df.datadir))
+        with open(os.path.join(partition_dir,
+                               diskfile.HASH_INVALIDATIONS_FILE)) as fp:
+            self.assert_(os.path.basename(os.path.dirname(df.datadir)) in
+                         fp.read().split())
+
+    def _sendfile_disk_file(self, data):
+        sent = []
+
+        def fake_sendfile(fd, offset, length, run_in_thread):
+            os.lseek(fd, offset, os.SEEK_SET)
+            sent.append(os.read(fd, length))
+            return len(sent[-1])
+
+        df = self._create_test_file(data)
+        df.sendfile = fake_sendfile
+        return df, sent
+
+    def test_disk_file_iter_sendfile(self):
+        df, sent = self._sendfile_disk_file('1234567890')
+        self.assertEquals(list(df), [''])
+        self.assertEquals(sent, ['1234567890'])
+        self.assertEquals(df.fp, None)
+
+    def test_disk_file_iter_sendfile_skips_md5(self):
+        df = self._get_disk_file(invalid_type='ETag')
+        df.sendfile = lambda fd, offset, length, run_in_thread: length
+        list(df)
+        self.assertFalse(df.quarantined_dir)
+
+    def test_disk_file_iter_sendfile_truncated(self):
+        df, sent = self._sendfile_disk_file('1234567890')
+        df.metadata['Content-Length'] = '10'
+        with open(df.data_file, 'r+b') as fp:
+            fp.truncate(4)
+        it = iter(df)
+        self.assertEquals(it.next(), '')
+        self.assertRaises(diskfile.DiskFileError, it.next)
+        self.assertEquals(sent, ['1234'])
+        self.assert_(df.quarantined_dir)
+        self.assertFalse(os.path.exists(df.data_file))
+        self.assertEquals(df.fp, None)
+
+    def test_disk_file_app_iter_range_sendfile(self):
+        df, sent = self._sendfile_disk_file('1234567890')
+        self.assertEquals(list(df.app_iter_range(2, 5)), [''])
+        self.assertEquals(sent, ['345'])
+        self.assertEquals(df.fp, None)
+
+        df, sent = self._sendfile_disk_file('1234567890')
+        self.assertEquals(list(df.app_iter_range(5, None)), [''])
+        self.assertEquals(sent, ['67890'])
+
+    def test_disk_file_app_iter_ranges_no_sendfile(self):
+        df, sent = self._sendfile_disk_file('012345678911234567892123456789')
+        value = ''.join(df.app_iter_ranges([(3, 10), (0, 2)], 'plain/text',
+                                           '\r\n--someheader\r\n', 30))
+        self.assert_('3456789' in value)
+        self.assertEquals(sent, [])
+
     def test_disk_file_large_app_iter_ranges(self):
         """
         This test case is to make sure that the disk file app_iter_ranges
@@ -682,6 +1636,67 @@ class TestDiskFile(unittest.TestCase):
         self.assertEquals(len(dl), 1)
         self.assertTrue(exp_name in set(dl))
 
+    def test_put_compact_metadata(self):
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger(), compact_metadata=True)
+        timestamp = normalize_timestamp(time())
+        with df.create() as writer:
+            writer.write('abc')
+            writer.put({'X-Timestamp': timestamp, 'Content-Length': '3',
+                        'ETag': md5('abc').hexdigest()})
+        data_file = os.path.join(df.datadir, timestamp + '.data')
+        raw = diskfile.getxattr(data_file, diskfile.METADATA_KEY)
+        self.assert_(raw.startswith(diskfile.COMPACT_METADATA_MAGIC))
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        self.assertEquals(df.metadata['name'], '/a/c/o')
+        self.assertEquals(df.metadata['X-Timestamp'], timestamp)
+
+    def test_put_uses_fsync_batcher(self):
+        synced = []
+
+        class FakeBatcher(object):
+            def sync(self, fd):
+                synced.append(fd)
+
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger(), fsync_batcher=FakeBatcher())
+        with mock.patch('swift.obj.diskfile.fsync') as fsync:
+            with df.create() as writer:
+                writer.write('abc')
+                writer.put({'X-Timestamp': normalize_timestamp(time())})
+                fd = writer.fd
+        self.assertEquals(synced, [fd])
+        self.assertFalse(fsync.called)
+
+    def test_write_batch(self):
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        df.bytes_per_sync = 4
+        etag = md5()
+        with mock.patch('swift.obj.diskfile.fdatasync') as fdatasync:
+            with df.create() as writer:
+                writer.write_batch(['abc', 'def'], etag)
+                # the next batch waits for the one being written
+                writer.write_batch(['ghi'], etag)
+                self.assert_(writer._writing is not None)
+                writer.put({'X-Timestamp': normalize_timestamp(time()),
+                            'ETag': etag.hexdigest()})
+                self.assert_(writer._writing is None)
+                self.assertEquals(writer.upload_size, 9)
+        self.assertEquals(etag.hexdigest(), md5('abcdefghi').hexdigest())
+        self.assertEquals(fdatasync.call_count, 1)
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o',
+                               FakeLogger(), keep_data_fp=True)
+        self.assertEquals(''.join(df), 'abcdefghi')
+
+        # errors of the batch are raised by the next call
+        df = diskfile.DiskFile(self.testdir, 'sda1', '0', 'a', 'c', 'o2',
+                               FakeLogger())
+        with df.create() as writer:
+            writer.write_batch([42])
+            self.assertRaises(TypeError, writer.wait)
+
     def test_close_error(self):
 
         def err():
@@ -815,3 +1830,113 @@ class TestDiskFile(unittest.TestCase):
         df.close()
         log_lines = df.logger.get_lines_for_level('error')
         self.assert_('a very special error' in log_lines[-1])
+
+
+class TestDiskFileManager(unittest.TestCase):
+    """Test swift.obj.diskfile.DiskFileManager"""
+
+    def setUp(self):
+        self.testdir = os.path.join(mkdtemp(), 'tmp_test_obj_DiskFileManager')
+        mkdirs(os.path.join(self.testdir, 'sda1', 'tmp'))
+        self.conf = {'devices': self.testdir, 'mount_check': 'false'}
+
+    def tearDown(self):
+        rmtree(os.path.dirname(self.testdir))
+
+    def test_get_diskfile(self):
+        self.conf.update({'mb_per_sync': '2', 'disk_chunk_size': '1024',
+                          'compact_metadata': 'yes',
+                          'hash_dir_cache_size': '10',
+                          'metadata_cache_size': '10',
+                          'pack_max_size': '100'})
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        df = mgr.get_diskfile('sda1', '0', 'a', 'c', 'o', keep_data_fp=True)
+        self.assert_(isinstance(df, diskfile.DiskFile))
+        self.assertEquals(df.datadir, os.path.join(
+            self.testdir, 'sda1', utils.storage_directory(
+                diskfile.DATADIR, '0', hash_path('a', 'c', 'o'))))
+        self.assertEquals(df.bytes_per_sync, 2 * 1024 * 1024)
+        self.assertEquals(df.disk_chunk_size, 1024)
+        self.assert_(df.compact_metadata)
+        self.assert_(df.threadpool is mgr.threadpools['sda1'])
+        self.assertEquals(df.fsync_batcher, None)
+        self.assert_(df.listing_cache is mgr.hash_dir_cache)
+        self.assert_(df.metadata_cache is mgr.metadata_cache)
+        self.assert_(df.volume)
+        self.assertEquals(df.pack_max_size, 100)
+
+        self.conf['mount_check'] = 'true'
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        self.assertRaises(DiskFileDeviceUnavailable, mgr.get_diskfile,
+                          'sda1', '0', 'a', 'c', 'o')
+
+    def test_get_hashes(self):
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        df = mgr.get_diskfile('sda1', '0', 'a', 'c', 'o')
+        with df.create() as writer:
+            writer.put({'X-Timestamp': normalize_timestamp(1)})
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        hashed, hashes = mgr.get_hashes('sda1', '0', [])
+        self.assertEquals(hashed, 1)
+        self.assertEquals(hashes.keys(), [suffix])
+        hashed, hashes = mgr.get_hashes('sda1', '1', [])
+        self.assertEquals((hashed, hashes), (0, {}))
+        self.assert_(os.path.isdir(os.path.join(
+            self.testdir, 'sda1', diskfile.DATADIR, '1')))
+
+        self.conf['mount_check'] = 'true'
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        self.assertRaises(DiskFileDeviceUnavailable, mgr.get_hashes,
+                          'sda1', '0', [])
+
+    def test_get_partition_hashes(self):
+        self.conf['reclaim_age'] = '3600'
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        df = mgr.get_diskfile('sda1', '0', 'a', 'c', 'o')
+        with df.create() as writer:
+            writer.put({'X-Timestamp': normalize_timestamp(1)})
+        hashes = mgr.get_partition_hashes('sda1', ['0', '1'])
+        self.assertEquals(len(hashes['0']), 32)
+        self.assertEquals(hashes['1'], None)
+        self.assertEquals(mgr.hash_trees['sda1'].reclaim_age, 3600)
+        df.put_metadata({'X-Timestamp': normalize_timestamp(2)})
+        self.assertEquals(
+            mgr.get_partition_hashes('sda1', ['0'], deadline=time() - 1),
+            {'0': diskfile.UNKNOWN_HASH})
+
+        self.conf['mount_check'] = 'true'
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        self.assertRaises(DiskFileDeviceUnavailable,
+                          mgr.get_partition_hashes, 'sda1', ['0'])
+
+    def test_pickle_async_update(self):
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        mgr.pickle_async_update('sda1', 'a', 'c', 'o', {'op': 'PUT'}, '1')
+        ohash = hash_path('a', 'c', 'o')
+        path = os.path.join(self.testdir, 'sda1', diskfile.ASYNCDIR,
+                            ohash[-3:], ohash + '-' + normalize_timestamp(1))
+        self.assertEquals(pickle.load(open(path)), {'op': 'PUT'})
+
+    def test_pickle_async_update_journal(self):
+        self.conf['async_pending_journal'] = 'yes'
+        mgr = diskfile.DiskFileManager(self.conf, FakeLogger())
+        mgr.pickle_async_update('sda1', 'a', 'c', 'o', {'op': 'PUT'}, '1')
+        mgr.pickle_async_update('sda1', 'a', 'c', 'o', {'op': 'DELETE'}, '2')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.testdir, 'sda1', diskfile.ASYNCDIR)))
+        segments = AsyncPendingJournal(
+            os.path.join(self.testdir, 'sda1')).segments()
+        self.assertEquals(len(segments), 1)
+        self.assertEquals(read_segment(segments[0])[0],
+                          [{'op': 'PUT'}, {'op': 'DELETE'}])
+        # async_pending is still there to fall back to
+        with mock.patch('swift.obj.journal.lock_path',
+                        side_effect=LockTimeout(None, 'lock')):
+            mgr.pickle_async_update('sda1', 'a', 'c', 'o', {'op': 'PUT'},
+                                    '3')
+        self.assertEquals(mgr.logger.get_increment_counts(),
+                          {'async_journal.lock_timeouts': 1})
+        ohash = hash_path('a', 'c', 'o')
+        path = os.path.join(self.testdir, 'sda1', diskfile.ASYNCDIR,
+                            ohash[-3:], ohash + '-' + normalize_timestamp(3))
+        self.assertEquals(pickle.load(open(path)), {'op': 'PUT'})
@@ -0,0 +1,39 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.obj.hashbatch"""
+
+import unittest
+
+from swift.common.utils import json
+from swift.obj import hashbatch
+
+
+class TestHashBatch(unittest.TestCase):
+
+    def test_parse_request(self):
+        partitions = hashbatch.parse_request(
+            json.dumps({'1': ['abc', '0f1'], '20': []}))
+        self.assertEquals(partitions, {'1': ['abc', '0f1'], '20': []})
+        self.assertEquals(hashbatch.parse_request('{}'), {})
+        for body in ('', '[]', '"1"', json.dumps({'1': 'abc'}),
+                     json.dumps({'x': []}), json.dumps({'-1': []}),
+                     json.dumps({'1': [1]}), json.dumps({'1': ['abcd']}),
+                     json.dumps({'1': ['ABC']}), json.dumps({'1': ['..']})):
+            self.assertRaises(ValueError, hashbatch.parse_request, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.obj.hashtree"""
+
+import unittest
+
+from swift.common.utils import json
+from swift.obj import hashtree
+
+
+class TestHashTree(unittest.TestCase):
+
+    def test_partition_hash(self):
+        self.assertEquals(hashtree.partition_hash({}), None)
+        hsh = hashtree.partition_hash({'abc': 'x', 'def': 'y'})
+        self.assertEquals(len(hsh), 32)
+        self.assertEquals(hsh, hashtree.partition_hash(
+            dict([('def', 'y'), ('abc', 'x')])))
+        self.assertNotEquals(hsh, hashtree.partition_hash(
+            {'abc': 'x', 'def': 'z'}))
+        self.assertNotEquals(hsh, hashtree.partition_hash({'abc': 'x'}))
+
+    def test_bucket_hashes(self):
+        partitions = ['1', '2', '10', '11', '12']
+        hashes = dict((partition, 'h' + partition)
+                      for partition in partitions)
+        buckets = hashtree.bucket_hashes(hashes, partitions, 2)
+        self.assertEquals(len(buckets), 3)
+        self.assertEquals(hashtree.bucket_hashes(hashes, partitions, 5),
+                          hashtree.bucket_hashes(hashes, partitions, 10))
+        hashes['10'] = None
+        changed = hashtree.bucket_hashes(hashes, partitions, 2)
+        self.assertEquals(changed[0], buckets[0])
+        self.assertNotEquals(changed[1], buckets[1])
+        self.assertEquals(changed[2], buckets[2])
+        # missing partitions hash as empty ones
+        del hashes['10']
+        self.assertEquals(hashtree.bucket_hashes(hashes, partitions, 2),
+                          changed)
+        self.assertEquals(hashtree.bucket_hashes(hashes, [], 2), [])
+
+    def test_parse_request(self):
+        self.assertEquals(
+            hashtree.parse_request(json.dumps(
+                {'partitions': ['1', '20'], 'bucket_size': 2})),
+            (['1', '20'], 2))
+        self.assertEquals(
+            hashtree.parse_request(json.dumps({'partitions': []})),
+            ([], None))
+        for body in ('', '[]', '{}', json.dumps({'partitions': '1'}),
+                     json.dumps({'partitions': [1]}),
+                     json.dumps({'partitions': ['..']}),
+                     json.dumps({'partitions': ['1'], 'bucket_size': 0}),
+                     json.dumps({'partitions': ['1'], 'bucket_size': '2'})):
+            self.assertRaises(ValueError, hashtree.parse_request, body)
+
+
+if __name__ == '__main__':
+    unittest.main()
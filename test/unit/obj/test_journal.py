@@ -0,0 +1,96 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.obj.journal"""
+
+from __future__ import with_statement
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.obj import journal
+
+
+class TestAsyncPendingJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.journal = journal.AsyncPendingJournal(self.testdir)
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def test_append_and_read(self):
+        self.assertEquals(self.journal.segments(), [])
+        self.journal.append({'op': 'PUT', 'obj': 'o1'})
+        self.journal.append({'op': 'DELETE', 'obj': 'o2'})
+        segments = self.journal.segments()
+        self.assertEquals([os.path.basename(s) for s in segments],
+                          ['0000000000000001.journal'])
+        updates, length = journal.read_segment(segments[0])
+        self.assertEquals(updates, [{'op': 'PUT', 'obj': 'o1'},
+                                    {'op': 'DELETE', 'obj': 'o2'}])
+        self.assertEquals(length, os.path.getsize(segments[0]))
+
+    def test_segment_rotation(self):
+        self.journal.segment_size = 1
+        self.journal.append({'obj': 'o1'})
+        self.journal.append({'obj': 'o2'})
+        segments = self.journal.segments()
+        self.assertEquals(len(segments), 2)
+        self.assertEquals(journal.read_segment(segments[1])[0],
+                          [{'obj': 'o2'}])
+
+    def test_new_segment_per_process(self):
+        self.journal.append({'obj': 'o1'})
+        self.journal.append({'obj': 'o2'})
+        other = journal.AsyncPendingJournal(self.testdir)
+        other.append({'obj': 'o3'})
+        self.journal.append({'obj': 'o4'})
+        segments = self.journal.segments()
+        self.assertEquals(len(segments), 2)
+        self.assertEquals(journal.read_segment(segments[1])[0],
+                          [{'obj': 'o3'}, {'obj': 'o4'}])
+
+    def test_rotate(self):
+        self.assertEquals(self.journal.rotate(), [])
+        self.journal.append({'obj': 'o1'})
+        sealed = self.journal.rotate()
+        self.assertEquals(sealed, self.journal.segments()[:1])
+        # nothing new to seal
+        self.assertEquals(self.journal.rotate(), sealed)
+        self.journal.append({'obj': 'o2'})
+        self.assertEquals(journal.read_segment(sealed[0])[0], [{'obj': 'o1'}])
+        self.assertEquals(len(self.journal.rotate()), 2)
+
+    def test_torn_record(self):
+        self.journal.append({'obj': 'o1'})
+        segment = self.journal.segments()[0]
+        good = os.path.getsize(segment)
+        self.journal.append({'obj': 'o2'})
+        with open(segment, 'r+b') as fp:
+            fp.truncate(os.path.getsize(segment) - 1)
+        self.assertEquals(journal.read_segment(segment),
+                          ([{'obj': 'o1'}], good))
+        with open(segment, 'r+b') as fp:
+            fp.seek(good + journal._RECORD_HEADER.size)
+            fp.write('X')
+        self.assertEquals(journal.read_segment(segment),
+                          ([{'obj': 'o1'}], good))
+
+
+if __name__ == '__main__':
+    unittest.main()
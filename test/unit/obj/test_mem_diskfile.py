@@ -0,0 +1,111 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.obj.mem_diskfile"""
+
+from __future__ import with_statement
+import unittest
+from time import time
+
+from test.unit import FakeLogger
+from swift.common.exceptions import DiskFileNotExist
+from swift.common.utils import normalize_timestamp
+from swift.obj import mem_diskfile
+
+
+class TestDiskFile(unittest.TestCase):
+
+    def setUp(self):
+        self.mgr = mem_diskfile.DiskFileManager({}, FakeLogger())
+
+    def _diskfile(self, **kwargs):
+        return self.mgr.get_diskfile('sda1', '0', 'a', 'c', 'o', **kwargs)
+
+    def _put(self, data, timestamp, **metadata):
+        df = self._diskfile()
+        with df.create(size=len(data)) as writer:
+            for chunk in data:
+                writer.write(chunk)
+            metadata.update({'X-Timestamp': timestamp,
+                             'Content-Length': str(writer.upload_size),
+                             'Content-Type': 'text/plain',
+                             'ETag': 'etag'})
+            writer.put(metadata)
+        return df
+
+    def test_missing(self):
+        df = self._diskfile()
+        self.assert_(df.is_deleted())
+        self.assertFalse(df.is_expired())
+        self.assertEquals(df.metadata, {})
+        self.assertRaises(DiskFileNotExist, df.get_data_file_size)
+        self.assertEquals(list(df), [])
+
+    def test_put_and_get(self):
+        ts = normalize_timestamp(1)
+        df = self._put('abcdef', ts)
+        self.assertEquals(df.metadata['name'], '/a/c/o')
+        df = self._diskfile(disk_chunk_size=4, keep_data_fp=True,
+                            threadpool=None)
+        self.assertFalse(df.is_deleted())
+        self.assertEquals(df.get_data_file_size(), 6)
+        self.assertEquals(df.metadata['X-Timestamp'], ts)
+        self.assertEquals(list(df), ['abcd', 'ef'])
+        self.assertEquals(list(df.app_iter_range(1, 5)), ['bcde'])
+        self.assertEquals(list(df.app_iter_range(4, None)), ['ef'])
+        self.assertEquals(list(df.app_iter_ranges([], 'text/plain', 'b', 6)),
+                          [''])
+        self.assertEquals(df.quarantine(), None)
+        # Other managers have their own objects.
+        other = mem_diskfile.DiskFileManager({}, FakeLogger())
+        self.assert_(other.get_diskfile('sda1', '0', 'a', 'c', 'o')
+                     .is_deleted())
+
+    def test_put_metadata_and_delete(self):
+        self._put('abc', normalize_timestamp(1), **{'X-Object-Meta-A': 'a'})
+        df = self._diskfile()
+        df.put_metadata({'X-Timestamp': normalize_timestamp(2),
+                         'X-Object-Meta-B': 'b'})
+        df = self._diskfile()
+        self.assertEquals(df.metadata['X-Timestamp'], normalize_timestamp(2))
+        self.assertEquals(df.metadata['X-Object-Meta-B'], 'b')
+        self.assert_('X-Object-Meta-A' not in df.metadata)
+        self.assertEquals(df.metadata['Content-Length'], '3')
+        self.assertEquals(''.join(df), 'abc')
+        df.delete(normalize_timestamp(3))
+        df = self._diskfile()
+        self.assert_(df.is_deleted())
+        self.assertEquals(df.metadata['X-Timestamp'], normalize_timestamp(3))
+        self.assert_(df.metadata['deleted'])
+        # metadata alone does not bring an object back
+        df.put_metadata({'X-Timestamp': normalize_timestamp(4)})
+        self.assert_(self._diskfile().is_deleted())
+
+    def test_is_expired(self):
+        self._put('abc', normalize_timestamp(1),
+                  **{'X-Delete-At': str(int(time()) - 1)})
+        self.assert_(self._diskfile().is_expired())
+
+    def test_manager(self):
+        self.assertEquals(self.mgr.get_hashes('sda1', '0', ['abc']), (0, {}))
+        self.mgr.pickle_async_update('sda1', 'a', 'c', 'o', {'op': 'PUT'},
+                                     '1')
+        self.assertEquals(
+            self.mgr.async_updates,
+            {('sda1', 'a', 'c', 'o', normalize_timestamp(1)): {'op': 'PUT'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
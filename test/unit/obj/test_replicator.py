@@ -25,14 +25,18 @@ import time
 import tempfile
 from contextlib import contextmanager, closing
 
+import eventlet
 from eventlet.green import subprocess
-from eventlet import Timeout, tpool
+from eventlet import Timeout, tpool, listen, spawn, wsgi
 
 from test.unit import FakeLogger
 from swift.common import utils
-from swift.common.utils import hash_path, mkdirs, normalize_timestamp
+from swift.common.exceptions import ChunkWriteTimeout
+from swift.common.utils import hash_path, mkdirs, normalize_timestamp, \
+    NullLogger
 from swift.common import ring
-from swift.obj import diskfile, replicator as object_replicator
+from swift.obj import diskfile, replicator as object_replicator, \
+    server as object_server
 
 
 def _ips():
@@ -195,6 +199,564 @@ class TestObjectReplicator(unittest.TestCase):
 
         object_replicator.http_connect = was_connector
 
+    def test_rsync_unpacks_packed_objects(self):
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                               FakeLogger(), packed_volumes=True,
+                               pack_max_size=10)
+        timestamp = normalize_timestamp(time.time())
+        with df.create() as writer:
+            writer.write('1234567890')
+            writer.put({'X-Timestamp': timestamp, 'Content-Length': '10'})
+        self.assertFalse(os.path.exists(df.datadir))
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        data_file = os.path.join(df.datadir, timestamp + '.data')
+        seen = []
+
+        def fake_rsync(args):
+            seen.append(args)
+            with open(data_file) as fp:
+                self.assertEquals(fp.read(), '1234567890')
+                self.assertEquals(diskfile.read_metadata(fp)['X-Timestamp'],
+                                  timestamp)
+            return 0
+
+        self.replicator._rsync = fake_rsync
+        node = {'replication_ip': '127.0.0.2', 'replication_port': 6000,
+                'device': 'sdb'}
+        job = {'path': self.parts['0'], 'partition': '0'}
+        self.assertTrue(self.replicator.rsync(node, job, [suffix]))
+        self.assertEquals(len(seen), 1)
+        self.assert_(os.path.join(self.parts['0'], suffix) in seen[0])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.parts['0'], suffix)))
+        self.assertFalse(diskfile.DiskFile(
+            self.devices, 'sda', '0', 'a', 'c', 'o', FakeLogger(),
+            packed_volumes=True).is_deleted())
+
+    def test_http_sync(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sdb'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        listener = listen(('localhost', 0))
+        server = spawn(wsgi.server, listener, controller, NullLogger())
+        t1, t2 = [normalize_timestamp(time.time() - t) for t in (20, 10)]
+        for devices, device, obj, timestamp, data in (
+                (self.devices, 'sda', 'o1', t1, 'one'),
+                (self.devices, 'sda', 'o2', t1, 'two'),
+                (remote, 'sdb', 'o1', t1, 'one'),
+                (remote, 'sdb', 'o3', t2, 'new')):
+            df = diskfile.DiskFile(devices, device, '0', 'a', 'c', obj,
+                                   FakeLogger(), packed_volumes=True,
+                                   pack_max_size=10)
+            with df.create() as writer:
+                writer.write(data)
+                writer.put({'X-Timestamp': timestamp,
+                            'Content-Length': str(len(data))})
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o3',
+                               FakeLogger())
+        df.put_metadata({'X-Timestamp': t1}, tombstone=True)
+        suffixes = [hash_path('a', 'c', obj)[-3:] for obj in ('o1', 'o2')]
+        node = {'replication_ip': '127.0.0.1',
+                'replication_port': listener.getsockname()[1],
+                'device': 'sdb'}
+        job = {'path': self.parts['0'], 'partition': '0', 'device': 'sda'}
+        self.replicator.sync_method = 'http'
+        try:
+            with mock.patch('swift.obj.replicator.http_connect',
+                            side_effect=object_replicator.http_connect) \
+                    as connect:
+                self.assertTrue(self.replicator.sync(
+                    node, job,
+                    suffixes + [hash_path('a', 'c', 'o3')[-3:], 'fff']))
+        finally:
+            server.kill()
+        # one connection for both steps
+        self.assertEquals(connect.call_count, 1)
+        self.assertEquals(
+            self.replicator.logger.log_dict['update_stats'],
+            [(('sync.files', 1), {})])
+        df = diskfile.DiskFile(remote, 'sdb', '0', 'a', 'c', 'o2',
+                               FakeLogger(), keep_data_fp=True)
+        self.assertEquals(''.join(df), 'two')
+        self.assertEquals(df.metadata['X-Timestamp'], t1)
+        # the older tombstone is not wanted
+        self.assertFalse(diskfile.DiskFile(
+            remote, 'sdb', '0', 'a', 'c', 'o3', FakeLogger(),
+            packed_volumes=True).is_deleted())
+        # the remote node invalidated the suffixes itself
+        local_hashes = diskfile.get_hashes(self.parts['0'])[1]
+        remote_hashes = diskfile.get_hashes(
+            os.path.join(remote, 'sdb', 'objects', '0'))[1]
+        for suffix in suffixes:
+            self.assertEquals(local_hashes[suffix], remote_hashes[suffix])
+
+    def test_http_sync_longer_than_http_timeout(self):
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        with df.create() as writer:
+            writer.write('x' * 10)
+            writer.put({'X-Timestamp': normalize_timestamp(time.time()),
+                        'Content-Length': '10'})
+        node = {'replication_ip': '127.0.0.2', 'replication_port': 6000,
+                'device': 'sdb'}
+        job = {'path': self.parts['0'], 'partition': '0', 'device': 'sda'}
+        self.replicator.sync_method = 'http'
+        self.replicator.sync_chunk_size = 1
+        self.replicator.http_timeout = 0.05
+        self.replicator.rsync_io_timeout = '0.05'
+        resps = [mock.MagicMock(status=200), mock.MagicMock(status=201)]
+        resps[0].read.return_value = utils.json.dumps(
+            {hash_path('a', 'c', 'o'): [os.listdir(df.datadir)[0]]})
+        resps[1].read.return_value = ''
+        chunks = []
+
+        def slow_send(data):
+            # each chunk is quick, but all of them take well over the
+            # http_timeout
+            eventlet.sleep(0.01)
+            chunks.append(data)
+
+        with mock.patch('swift.obj.replicator.http_connect') as connect:
+            connect.return_value.getresponse.side_effect = resps
+            connect.return_value.send.side_effect = slow_send
+            self.assertTrue(self.replicator.sync(
+                node, job, [hash_path('a', 'c', 'o')[-3:]]))
+        self.assertEquals(chunks[-1], '0\r\n\r\n')
+        self.assertEquals(len(chunks), 1 + 1 + 10 + 1)
+
+        # but a stalled chunk fails the push, here the first one after the
+        # missing request
+        def stalled_send(data):
+            if chunks:
+                eventlet.sleep(1)
+            chunks.append(data)
+
+        del chunks[:]
+        resps = [mock.MagicMock(status=200)]
+        resps[0].read.return_value = utils.json.dumps(
+            {hash_path('a', 'c', 'o'): [os.listdir(df.datadir)[0]]})
+        with mock.patch('swift.obj.replicator.http_connect') as connect:
+            connect.return_value.getresponse.side_effect = resps
+            connect.return_value.send.side_effect = stalled_send
+            self.assertRaises(ChunkWriteTimeout, self.replicator.sync,
+                              node, job, [hash_path('a', 'c', 'o')[-3:]])
+        self.assertEquals(len(chunks), 1)
+
+    def test_http_sync_errors(self):
+        node = {'replication_ip': '127.0.0.2', 'replication_port': 6000,
+                'device': 'sdb'}
+        job = {'path': self.parts['0'], 'partition': '0'}
+        self.replicator.sync_method = 'http'
+        with mock.patch('swift.obj.replicator.http_connect') as connect:
+            # nothing to offer, nothing to send
+            self.assertTrue(self.replicator.sync(node, job, ['abc']))
+            self.assertFalse(connect.called)
+            df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                                   FakeLogger())
+            df.put_metadata({'X-Timestamp': normalize_timestamp(time.time())},
+                            tombstone=True)
+            resp = connect.return_value.getresponse.return_value
+            resp.status = 507
+            self.assertFalse(self.replicator.sync(
+                node, job, [hash_path('a', 'c', 'o')[-3:]]))
+            self.assertTrue(connect.return_value.close.called)
+            self.assertFalse(connect.return_value.putrequest.called)
+            connect.reset_mock()
+            # the remote node rehashes the suffixes without being asked
+            self.replicator._rehash_remote(node, job, ['abc'])
+            self.assertFalse(connect.called)
+        self.assertFalse(self.replicator.http_sync(
+            node, {'path': self.parts['0'] + 'x', 'partition': '0x'},
+            ['abc']))
+        conf = dict(self.conf, sync_method='scp')
+        self.assertRaises(ValueError, object_replicator.ObjectReplicator,
+                          conf)
+
+    def test_compare_partitions(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sdb', 'objects'))
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        listener = listen(('localhost', 0))
+        server = spawn(wsgi.server, listener, controller, NullLogger())
+        timestamp = normalize_timestamp(time.time())
+        for devices, device, part, obj in (
+                (self.devices, 'sda', '0', 'o'),
+                (self.devices, 'sda', '1', 'o'),
+                (self.devices, 'sda', '2', 'o'),
+                (self.devices, 'sda', '2', 'o2'),
+                (remote, 'sdb', '0', 'o'),
+                (remote, 'sdb', '1', 'o'),
+                (remote, 'sdb', '2', 'o')):
+            df = diskfile.DiskFile(devices, device, part, 'a', 'c', obj,
+                                   FakeLogger())
+            with df.create() as writer:
+                writer.write('x')
+                writer.put({'X-Timestamp': timestamp, 'Content-Length': '1'})
+        node = {'id': 1, 'replication_ip': '127.0.0.1',
+                'replication_port': listener.getsockname()[1],
+                'device': 'sdb'}
+        jobs = [dict(device='sda', partition=part, nodes=[node],
+                     delete=False, path=self.parts[part])
+                for part in ('3', '2', '1', '0')]
+        jobs.append(dict(device='sda', partition='4', nodes=[node],
+                         delete=True, path=self.parts['0'] + '4'))
+        self.replicator.hash_tree_bucket_size = 2
+        try:
+            with mock.patch('swift.obj.replicator.http_connect',
+                            side_effect=object_replicator.http_connect) \
+                    as connect:
+                self.replicator.compare_partitions(jobs)
+        finally:
+            server.kill()
+        self.assertEquals(connect.call_count, 2)
+        self.assertEquals([job['partition'] for job in jobs
+                           if job.get('synced') == set([1])],
+                          ['3', '1', '0'])
+        self.assertEquals(jobs[1]['synced'], set())
+        self.assertFalse('synced' in jobs[4])
+        self.assertEquals(self.replicator.logger.log_dict['update_stats'],
+                          [(('hash_tree.synced', 3), {}),
+                           (('hash_tree.differing', 1), {})])
+        # nodes in sync are not asked for their suffix hashes
+        self.replicator.replication_count = 0
+        with mock.patch('swift.obj.replicator.http_connect') as connect:
+            self.replicator.update(jobs[2])
+        self.assertFalse(connect.called)
+
+    def test_compare_partitions_error(self):
+        node = {'id': 1, 'replication_ip': '127.0.0.1',
+                'replication_port': 6000, 'device': 'sdb'}
+        jobs = [dict(device='sda', partition='0', nodes=[node],
+                     delete=False, path=self.parts['0'])]
+        with mock.patch('swift.obj.replicator.http_connect') as connect:
+            resp = connect.return_value.getresponse.return_value
+            resp.status = 507
+            self.replicator.compare_partitions(jobs)
+        self.assertEquals(jobs[0]['synced'], set())
+        self.assertEquals(len(self.replicator.logger.log_dict['exception']),
+                          1)
+
+    def test_replication_queue(self):
+        queue = object_replicator.ReplicationQueue()
+        self.assertEquals(queue.pop(), None)
+        jobs = {}
+        for device, partition, priority in (
+                ('sda', '1', object_replicator.ROUTINE),
+                ('sda', '2', object_replicator.ROUTINE),
+                ('sdb', '3', object_replicator.ROUTINE),
+                ('sda', '4', object_replicator.OUT_OF_DATE),
+                ('sdb', '5', object_replicator.HANDOFF),
+                ('sdb', '6', object_replicator.HANDOFF),
+                ('sdc', '7', object_replicator.HANDOFF)):
+            jobs[partition] = {'device': device, 'partition': partition}
+            queue.push(jobs[partition], priority)
+        self.assertEquals(len(queue), 7)
+        self.assertEquals(queue.depths(), {
+            'sda': {'handoff': 0, 'out_of_date': 1, 'routine': 2},
+            'sdb': {'handoff': 2, 'out_of_date': 0, 'routine': 1},
+            'sdc': {'handoff': 1, 'out_of_date': 0, 'routine': 0}})
+        order = []
+        while queue:
+            order.append(queue.pop()['partition'])
+        # most urgent first, taking devices in turn
+        self.assertEquals(order, ['5', '7', '6', '4', '3', '1', '2'])
+        self.assertEquals(queue.pop(), None)
+
+    def test_replication_queue_pop_batch(self):
+        queue = object_replicator.ReplicationQueue()
+        self.assertEquals(queue.pop_batch(2), [])
+        for device, partition, priority in (
+                ('sda', '1', object_replicator.ROUTINE),
+                ('sda', '2', object_replicator.ROUTINE),
+                ('sda', '3', object_replicator.ROUTINE),
+                ('sda', '4', object_replicator.HANDOFF),
+                ('sdb', '5', object_replicator.ROUTINE)):
+            queue.push({'device': device, 'partition': partition}, priority)
+        batches = []
+        while queue:
+            batches.append([job['partition'] for job in queue.pop_batch(
+                2, available=lambda device: device != 'sdb' or
+                len(queue) == 1)])
+        # one device and priority per batch
+        self.assertEquals(batches, [['4'], ['1', '2'], ['3'], ['5']])
+
+    def test_job_priority(self):
+        job = {'device': 'sda', 'partition': '1', 'delete': True}
+        self.assertEquals(self.replicator.job_priority(job),
+                          object_replicator.HANDOFF)
+        job['delete'] = False
+        self.assertEquals(self.replicator.job_priority(job),
+                          object_replicator.ROUTINE)
+        job['differing'] = set([1])
+        self.assertEquals(self.replicator.job_priority(job),
+                          object_replicator.OUT_OF_DATE)
+        job['differing'] = set()
+        self.replicator.out_of_date.add(('sda', '1'))
+        self.assertEquals(self.replicator.job_priority(job),
+                          object_replicator.OUT_OF_DATE)
+
+    def test_batch_request(self):
+        remote = os.path.join(self.testdir, 'remote')
+        mkdirs(os.path.join(remote, 'sdb'))
+        df = diskfile.DiskFile(remote, 'sdb', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        with df.create() as writer:
+            writer.write('data')
+            writer.put({'X-Timestamp': normalize_timestamp(time.time()),
+                        'Content-Length': '4'})
+        controller = object_server.ObjectController(
+            {'devices': remote, 'mount_check': 'false'})
+        listener = listen(('localhost', 0))
+        server = spawn(wsgi.server, listener, controller, NullLogger())
+        node = {'replication_ip': '127.0.0.1',
+                'replication_port': listener.getsockname()[1],
+                'device': 'sdb'}
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        try:
+            with mock.patch(
+                    'swift.obj.replicator.BufferedHTTPConnection',
+                    side_effect=object_replicator.BufferedHTTPConnection) \
+                    as connection:
+                hashes = self.replicator._batch_request(
+                    node, {'0': [], '1': []})
+                self.assertEquals(
+                    self.replicator._batch_request(node, {'0': [suffix]}),
+                    {'0': hashes['0']})
+                # the connection is kept alive between requests
+                self.assertEquals(connection.call_count, 1)
+                idle = self.replicator.peer_conns[('127.0.0.1',
+                                                   node['replication_port'])]
+                self.assertEquals(len(idle), 1)
+                # a connection the node closed is replaced
+                stale = mock.MagicMock()
+                stale.putrequest.side_effect = IOError('closed')
+                idle[:] = [stale]
+                self.assertEquals(
+                    self.replicator._batch_request(node, {'0': []}),
+                    {'0': hashes['0']})
+                self.assertEquals(connection.call_count, 2)
+                self.assertTrue(stale.close.called)
+                self.assertRaises(Exception, self.replicator._batch_request,
+                                  node, {'0': ['xyz']})
+                self.assertEquals(len(idle), 1)
+                self.replicator.close_peer_connections()
+                self.assertEquals(dict(self.replicator.peer_conns), {})
+        finally:
+            server.kill()
+        self.assertEquals(hashes, {
+            '0': diskfile.get_hashes(
+                os.path.join(remote, 'sdb', 'objects', '0'))[1],
+            '1': {}})
+
+    def test_run_jobs_batch(self):
+        self.replicator.suffix_hash = self.replicator.suffix_count = 0
+        self.replicator.suffix_sync = self.replicator.replication_count = 0
+        self.replicator.partition_times = []
+        df = diskfile.DiskFile(self.devices, 'sda', '0', 'a', 'c', 'o',
+                               FakeLogger())
+        df.put_metadata({'X-Timestamp': normalize_timestamp(time.time())},
+                        tombstone=True)
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        nodes = [{'id': node_id, 'replication_ip': '127.0.0.%d' % node_id,
+                  'replication_port': 6000, 'device': 'sdb'}
+                 for node_id in (1, 2)]
+        jobs = [{'device': 'sda', 'partition': part, 'path': self.parts[part],
+                 'nodes': nodes, 'delete': False} for part in '012']
+        requests = []
+
+        def fake_batch_request(node, partitions):
+            requests.append((node['id'], partitions))
+            if node['id'] == 2 and len(requests) <= 2:
+                raise Exception('no batch requests here')
+            return dict((partition, {}) for partition in partitions)
+
+        self.replicator.device_jobs['sda'] = 1
+        with mock.patch.object(self.replicator, '_batch_request',
+                               side_effect=fake_batch_request), \
+                mock.patch.object(self.replicator, 'sync',
+                                  return_value=True) as sync, \
+                mock.patch('swift.obj.replicator.http_connect',
+                           side_effect=mock_http_connect(200)) as connect:
+            self.replicator.run_jobs(jobs)
+        self.assertEquals(sorted(requests[:2]), [
+            (1, {'0': [], '1': [], '2': []}),
+            (2, {'0': [], '1': [], '2': []})])
+        # node 2 is asked partition by partition instead
+        self.assertEquals(connect.call_count, 3)
+        self.assertEquals(
+            [(args[0]['id'], args[1]['partition'], args[2])
+             for args, kwargs in sync.call_args_list],
+            [(1, '0', [suffix]), (2, '0', [suffix])])
+        # and both rehash the synced suffixes once the batch is done
+        self.assertEquals(sorted(requests[2:]), [
+            (1, {'0': [suffix]}), (2, {'0': [suffix]})])
+        for job in jobs:
+            self.assertFalse('rehash' in job or 'remote_hashes' in job)
+        self.assertEquals(self.replicator.device_jobs['sda'], 0)
+        self.assertEquals(self.replicator.finished_jobs.get(), 'sda')
+
+    def test_fetch_node_hashes_partial_answers(self):
+        node = {'id': 1, 'replication_ip': '127.0.0.1',
+                'replication_port': 6000, 'device': 'sdb'}
+        jobs = [{'partition': part, 'remote_hashes': {}} for part in '012']
+        requests = []
+
+        def fake_batch_request(node, partitions):
+            requests.append(sorted(partitions))
+            if len(requests) == 3:
+                return {}
+            return {min(partitions): {'abc': 'x' * 32}}
+
+        with mock.patch.object(self.replicator, '_batch_request',
+                               side_effect=fake_batch_request):
+            self.replicator._fetch_node_hashes(node, jobs)
+        self.assertEquals(requests, [['0', '1', '2'], ['1', '2'], ['2']])
+        # the partitions answered for before the node gave up are kept
+        self.assertEquals([job['remote_hashes'] for job in jobs],
+                          [{1: {'abc': 'x' * 32}}, {1: {'abc': 'x' * 32}},
+                           {}])
+        self.assertEquals(len(self.replicator.logger.log_dict['exception']),
+                          1)
+
+    def test_update_records_out_of_date(self):
+        self.replicator.suffix_hash = self.replicator.suffix_count = 0
+        self.replicator.replication_count = 0
+        self.replicator.partition_times = []
+        node = {'id': 1, 'replication_ip': '127.0.0.1',
+                'replication_port': 6000, 'device': 'sdb'}
+        job = {'device': 'sda', 'partition': '0', 'path': self.parts['0'],
+               'nodes': [node], 'delete': False}
+        with mock.patch('swift.obj.replicator.http_connect',
+                        mock_http_connect(500)):
+            self.replicator.update(job)
+        self.assertEquals(self.replicator.out_of_date, set([('sda', '0')]))
+        with mock.patch('swift.obj.replicator.http_connect',
+                        mock_http_connect(200)):
+            self.replicator.update(job)
+        self.assertEquals(self.replicator.out_of_date, set())
+
+    def test_replicate_handoffs_first(self):
+        self.replicator.rcache = os.path.join(self.testdir, 'object.recon')
+        self.replicator.mount_check = False
+        self.replicator.concurrency = 1
+        self.replicator.out_of_date.add(('sda', '2'))
+        jobs = [dict(device='sda', partition=str(part), nodes=[],
+                     path=self.parts[str(part)], delete=(part == 3))
+                for part in xrange(4)]
+        done = []
+        reports = []
+
+        def fake_update(job):
+            done.append(job['partition'])
+            if not reports:
+                with open(self.replicator.rcache) as fp:
+                    reports.append(utils.json.load(fp))
+
+        self.replicator.update = self.replicator.update_deleted = fake_update
+        with mock.patch.object(self.replicator, 'collect_jobs',
+                               return_value=jobs):
+            self.replicator.replicate()
+        self.assertEquals(done[:2], ['3', '2'])
+        self.assertEquals(sorted(done[2:]), ['0', '1'])
+        self.assertEquals(reports[0]['object_replication_queue'], {
+            'sda': {'handoff': 1, 'out_of_date': 1, 'routine': 2}})
+        # the queue is reported empty once the pass is over
+        with open(self.replicator.rcache) as fp:
+            self.assertEquals(
+                utils.json.load(fp)['object_replication_queue'], {})
+
+    def test_device_concurrency(self):
+        self.replicator.rcache = os.path.join(self.testdir, 'object.recon')
+        self.replicator.mount_check = False
+        self.replicator.concurrency = 4
+        self.replicator.device_concurrency = 1
+        jobs = [dict(device=device, partition=str(part), nodes=[],
+                     path=self.parts[str(part)], delete=False)
+                for device in ('sda', 'sdb') for part in xrange(3)]
+        running = []
+        most = []
+
+        def fake_update(job):
+            running.append(job['device'])
+            most.append(len(running))
+            self.assertEquals(running.count(job['device']), 1)
+            eventlet.sleep(0.01)
+            running.remove(job['device'])
+
+        self.replicator.update = fake_update
+        with mock.patch.object(self.replicator, 'collect_jobs',
+                               return_value=jobs):
+            self.replicator.replicate()
+        self.assertEquals(len(most), 6)
+        # both devices ran at once, but never two jobs of one device
+        self.assertEquals(max(most), 2)
+        self.assertEquals(self.replicator.device_jobs,
+                          {'sda': 0, 'sdb': 0})
+
+    def test_charge(self):
+        self.replicator.device_bytes_per_sec = 1000
+        self.replicator.device_iops = 10
+        with mock.patch('swift.obj.replicator.ratelimit_sleep',
+                        side_effect=lambda running_time, max_rate, incr_by:
+                        running_time + incr_by) as ratelimit_sleep:
+            self.replicator.charge('sda', 100, 2)
+            self.replicator.charge('sda', ops=1)
+            self.replicator.charge('sdb', 10)
+        self.assertEquals(ratelimit_sleep.call_args_list, [
+            mock.call(0, 1000, incr_by=100), mock.call(0, 10, incr_by=2),
+            mock.call(100, 1000, incr_by=0), mock.call(2, 10, incr_by=1),
+            mock.call(0, 1000, incr_by=10), mock.call(0, 10, incr_by=0)])
+        self.assertEquals(self.replicator.device_budgets,
+                          {'sda': [100, 3], 'sdb': [10, 0]})
+
+    def test_rsync_bwlimit(self):
+        self.assertEquals(self.replicator._rsync_bwlimit(), 0)
+        self.replicator.device_bytes_per_sec = 4 * 1024 * 1024
+        self.assertEquals(self.replicator._rsync_bwlimit(), 4096)
+        self.replicator.device_concurrency = 4
+        self.assertEquals(self.replicator._rsync_bwlimit(), 1024)
+        self.replicator.rsync_bwlimit = '512'
+        self.assertEquals(self.replicator._rsync_bwlimit(), 512)
+        self.replicator.rsync_bwlimit = '2048'
+        self.assertEquals(self.replicator._rsync_bwlimit(), 1024)
+
+    def test_reload_limits(self):
+        conf_file = os.path.join(self.testdir, 'object-server.conf')
+        with open(conf_file, 'w') as fp:
+            fp.write('[object-replicator]\ndevice_concurrency = 1\n')
+        replicator = object_replicator.ObjectReplicator(
+            dict(self.conf, device_concurrency='1', __file__=conf_file,
+                 recon_cache_path=self.testdir))
+        replicator.logger = FakeLogger()
+        self.assertEquals(replicator.device_concurrency, 1)
+        with open(conf_file, 'w') as fp:
+            fp.write('[object-replicator]\ndevice_concurrency = 2\n'
+                     'device_bytes_per_sec = 1048576\ndevice_iops = 50\n')
+        os.utime(conf_file, (time.time() + 1, time.time() + 1))
+        # not before reload_interval
+        replicator.reload_limits()
+        self.assertEquals(replicator.device_concurrency, 1)
+        replicator.next_reload = 0
+        replicator.reload_limits()
+        self.assertEquals((replicator.device_concurrency,
+                           replicator.device_bytes_per_sec,
+                           replicator.device_iops), (2, 1048576, 50))
+        with open(os.path.join(self.testdir, 'object.recon')) as fp:
+            limits = utils.json.load(fp)['object_replication_limits']
+        self.assertEquals(limits['device_concurrency'], 2)
+        self.assertEquals(limits['device_bytes_per_sec'], 1048576)
+        self.assertEquals(limits['device_iops'], 50)
+        # a broken file leaves the limits as they were
+        with open(conf_file, 'w') as fp:
+            fp.write('[other]\n')
+        os.utime(conf_file, (time.time() + 2, time.time() + 2))
+        replicator.next_reload = 0
+        replicator.reload_limits()
+        self.assertEquals(replicator.device_concurrency, 2)
+        self.assertEquals(len(replicator.logger.log_dict['exception']), 1)
+
     def test_check_ring(self):
         self.assertTrue(self.replicator.check_ring())
         orig_check = self.replicator.next_check
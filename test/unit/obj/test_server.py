@@ -27,14 +27,14 @@ from time import gmtime, strftime, time
 from tempfile import mkdtemp
 from hashlib import md5
 
-from eventlet import sleep, spawn, wsgi, listen, Timeout
+from eventlet import GreenPool, sleep, spawn, wsgi, listen, Timeout
 from test.unit import FakeLogger
 from test.unit import connect_tcp, readuntil2crlfs
 from swift.obj import server as object_server
-from swift.obj import diskfile
+from swift.obj import diskfile, hashtree, sync
 from swift.common import utils
 from swift.common.utils import hash_path, mkdirs, normalize_timestamp, \
-    NullLogger, storage_directory, public, replication
+    NullLogger, storage_directory, public, replication, json
 from swift.common import constraints
 from eventlet import tpool
 from swift.common.swob import Request, HeaderKeyDict
@@ -52,7 +52,7 @@ class TestObjectController(unittest.TestCase):
         mkdirs(os.path.join(self.testdir, 'sda1', 'tmp'))
         conf = {'devices': self.testdir, 'mount_check': 'false'}
         self.object_controller = object_server.ObjectController(conf)
-        self.object_controller.bytes_per_sync = 1
+        self.object_controller._diskfile_mgr.bytes_per_sync = 1
         self._orig_tpool_exc = tpool.execute
         tpool.execute = lambda f, *args, **kwargs: f(*args, **kwargs)
 
@@ -457,6 +457,61 @@ class TestObjectController(unittest.TestCase):
                            'Content-Type': 'application/octet-stream',
                            'name': '/a/c/o'})
 
+    def test_PUT_put_batch_size(self):
+        self.assertEquals(self.object_controller.put_batch_size, 0)
+        body = ''.join(chr(i % 256) for i in xrange(100000))
+        for batch_size in ('0', '1', '16384', '100000'):
+            controller = object_server.ObjectController(
+                {'devices': self.testdir, 'mount_check': 'false',
+                 'network_chunk_size': '4096',
+                 'put_batch_size': batch_size})
+            self.assertEquals(controller.put_batch_size, int(batch_size))
+            timestamp = normalize_timestamp(time())
+            req = Request.blank(
+                '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                headers={'X-Timestamp': timestamp,
+                         'Content-Length': str(len(body)),
+                         'Content-Type': 'application/octet-stream',
+                         'ETag': md5(body).hexdigest()},
+                body=body)
+            with mock.patch.object(diskfile.DiskWriter, 'write_batch',
+                                   autospec=True,
+                                   side_effect=diskfile.DiskWriter.write_batch
+                                   ) as write_batch:
+                resp = req.get_response(controller)
+            self.assertEquals(resp.status_int, 201)
+            self.assertEquals(resp.etag, md5(body).hexdigest())
+            if batch_size == '0':
+                self.assertFalse(write_batch.called)
+            else:
+                self.assertEquals(write_batch.call_count, -(
+                    -len(body) // max(int(batch_size), 4096)))
+            objfile = os.path.join(
+                self.testdir, 'sda1',
+                storage_directory(object_server.DATADIR, 'p',
+                                  hash_path('a', 'c', 'o')),
+                timestamp + '.data')
+            self.assertEquals(open(objfile).read(), body)
+
+    def test_PUT_fsync_batch_window(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'fsync_batch_window': '0.001'})
+        timestamp = normalize_timestamp(time())
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': timestamp,
+                     'Content-Length': '6',
+                     'Content-Type': 'application/octet-stream'})
+        req.body = 'VERIFY'
+        with mock.patch('swift.common.utils.syncfs') as syncfs:
+            resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(syncfs.call_count, 1)
+        batcher = self.object_controller._diskfile_mgr.fsync_batchers['sda1']
+        self.assertEquals(batcher.window, 0.001)
+        self.assertEquals(batcher.synced, 1)
+
     def test_PUT_overwrite(self):
         req = Request.blank(
             '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
@@ -828,6 +883,297 @@ class TestObjectController(unittest.TestCase):
         resp = req.get_response(self.object_controller)
         self.assertEquals(resp.status_int, 404)
 
+    def test_GET_use_sendfile(self):
+        timestamp = normalize_timestamp(time())
+        req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': timestamp,
+                                     'Content-Type': 'application/x-test'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+
+        sent = []
+
+        def fake_sendfile(fd, offset, length, run_in_thread):
+            sent.append((offset, length))
+            return length
+
+        # not enabled
+        req = Request.blank('/sda1/p/a/c/o', environ={
+            'REQUEST_METHOD': 'GET', 'swift.sendfile': fake_sendfile})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.body, 'VERIFY')
+        self.assertEquals(sent, [])
+
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'use_sendfile': 'true'})
+        req = Request.blank('/sda1/p/a/c/o', environ={
+            'REQUEST_METHOD': 'GET', 'swift.sendfile': fake_sendfile})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, '')
+        self.assertEquals(resp.headers['content-length'], '6')
+        self.assertEquals(sent, [(0, 6)])
+        self.assertEquals(
+            req.environ['eventlet.minimum_write_chunk_size'], 0)
+
+        req = Request.blank('/sda1/p/a/c/o', environ={
+            'REQUEST_METHOD': 'GET', 'swift.sendfile': fake_sendfile})
+        req.range = 'bytes=1-3'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, '')
+        self.assertEquals(resp.headers['content-length'], '3')
+        self.assertEquals(sent, [(0, 6), (1, 3)])
+
+        # no sendfile from the WSGI server (e.g. SSL)
+        req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'GET'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.body, 'VERIFY')
+        self.assertEquals(sent, [(0, 6), (1, 3)])
+
+    def test_hash_dir_cache(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'hash_dir_cache_size': '10'})
+        cache = self.object_controller._diskfile_mgr.hash_dir_cache
+        cache.logger = FakeLogger()
+
+        def do(method, headers=None, body=None):
+            req = Request.blank('/sda1/p/a/c/o',
+                                environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            if body is not None:
+                req.body = body
+            return req.get_response(self.object_controller)
+
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(time()),
+                          'Content-Type': 'application/x-test'}, 'VERIFY')
+        self.assertEquals(resp.status_int, 201)
+        datadir = os.path.join(
+            self.testdir, 'sda1',
+            storage_directory(object_server.DATADIR, 'p',
+                              hash_path('a', 'c', 'o')))
+        self.assert_(datadir not in cache._listings)
+        self.assertEquals(do('GET').body, 'VERIFY')
+        self.assertEquals(do('HEAD').status_int, 200)
+        self.assertEquals(cache.logger.get_increment_counts(),
+                          {'hash_dir_cache.hits': 1,
+                           'hash_dir_cache.misses': 1})
+
+        sleep(.00001)
+        resp = do('POST', {'X-Timestamp': normalize_timestamp(time()),
+                           'X-Object-Meta-Test': 'Yes'})
+        self.assertEquals(resp.status_int, 202)
+        self.assert_(datadir not in cache._listings)
+        self.assertEquals(do('HEAD').headers['X-Object-Meta-Test'], 'Yes')
+
+        sleep(.00001)
+        resp = do('DELETE', {'X-Timestamp': normalize_timestamp(time())})
+        self.assertEquals(resp.status_int, 204)
+        self.assert_(datadir not in cache._listings)
+        self.assertEquals(do('GET').status_int, 404)
+
+        # disabled by default
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false'})
+        self.assertEquals(
+            self.object_controller._diskfile_mgr.hash_dir_cache, None)
+
+    def test_metadata_cache(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'metadata_cache_size': '10'})
+        cache = self.object_controller._diskfile_mgr.metadata_cache
+        cache.logger = FakeLogger()
+
+        def do(method, headers=None, body=None):
+            req = Request.blank('/sda1/p/a/c/o',
+                                environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            if body is not None:
+                req.body = body
+            return req.get_response(self.object_controller)
+
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(time()),
+                          'Content-Type': 'application/x-test'}, 'VERIFY')
+        self.assertEquals(resp.status_int, 201)
+        etag = resp.etag
+        self.assertEquals(do('HEAD').etag, etag)
+        with mock.patch('swift.obj.diskfile.read_metadata') as read:
+            self.assertEquals(do('HEAD').etag, etag)
+            resp = do('GET', {'If-None-Match': etag})
+            self.assertEquals(resp.status_int, 304)
+        self.assertFalse(read.called)
+        self.assertEquals(do('GET').body, 'VERIFY')
+        self.assertEquals(cache.logger.get_increment_counts(),
+                          {'metadata_cache.hits': 3,
+                           'metadata_cache.misses': 1})
+
+        sleep(.00001)
+        resp = do('POST', {'X-Timestamp': normalize_timestamp(time()),
+                           'X-Object-Meta-Test': 'Yes'})
+        self.assertEquals(resp.status_int, 202)
+        self.assertEquals(do('HEAD').headers['X-Object-Meta-Test'], 'Yes')
+
+        sleep(.00001)
+        resp = do('DELETE', {'X-Timestamp': normalize_timestamp(time())})
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(do('HEAD').status_int, 404)
+        self.assertEquals(len(cache._metadata), 0)
+
+        # the data file is opened before a GET commits to sending it
+        sleep(.00001)
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(time()),
+                          'Content-Type': 'application/x-test'}, 'VERIFY')
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(do('HEAD').status_int, 200)
+        get_data_file_size = diskfile.DiskFile.get_data_file_size
+
+        def size_then_unlink(disk_file):
+            size = get_data_file_size(disk_file)
+            os.unlink(disk_file.data_file)
+            return size
+
+        with mock.patch.object(diskfile.DiskFile, 'get_data_file_size',
+                               size_then_unlink):
+            self.assertEquals(do('GET').status_int, 404)
+        self.assertEquals(len(cache._metadata), 0)
+
+        # disabled by default
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false'})
+        self.assertEquals(
+            self.object_controller._diskfile_mgr.metadata_cache, None)
+
+    def test_diskfile_manager(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'diskfile_manager': 'swift.obj.mem_diskfile.DiskFileManager'})
+
+        def do(method, headers=None, body=None):
+            req = Request.blank('/sda1/p/a/c/o',
+                                environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            if body is not None:
+                req.body = body
+            return req.get_response(self.object_controller)
+
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(1),
+                          'Content-Type': 'application/x-test',
+                          'X-Object-Meta-1': 'One'}, 'VERIFY')
+        self.assertEquals(resp.status_int, 201)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.testdir, 'sda1', object_server.DATADIR)))
+        resp = do('GET')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.body, 'VERIFY')
+        self.assertEquals(resp.headers['Content-Type'], 'application/x-test')
+        self.assertEquals(resp.headers['X-Object-Meta-1'], 'One')
+        self.assertEquals(resp.etag, md5('VERIFY').hexdigest())
+        resp = do('GET', {'Range': 'bytes=1-3'})
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, 'ERI')
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(1),
+                          'Content-Type': 'application/x-test'}, 'OLD')
+        self.assertEquals(resp.status_int, 409)
+        resp = do('POST', {'X-Timestamp': normalize_timestamp(2),
+                           'X-Object-Meta-2': 'Two'})
+        self.assertEquals(resp.status_int, 202)
+        resp = do('HEAD')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(resp.content_length, 6)
+        self.assertEquals(resp.headers['X-Object-Meta-2'], 'Two')
+        self.assert_('X-Object-Meta-1' not in resp.headers)
+        resp = do('DELETE', {'X-Timestamp': normalize_timestamp(3)})
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(do('GET').status_int, 404)
+        self.assertEquals(do('HEAD').status_int, 404)
+        resp = do('REPLICATE')
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(pickle.loads(resp.body), {})
+
+    def test_pack_max_size(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'pack_max_size': '10'})
+
+        def do(method, headers=None, body=None, obj='o'):
+            req = Request.blank('/sda1/p/a/c/' + obj,
+                                environ={'REQUEST_METHOD': method},
+                                headers=headers or {})
+            if body is not None:
+                req.body = body
+            return req.get_response(self.object_controller)
+
+        def datadir(obj='o'):
+            return os.path.join(
+                self.testdir, 'sda1',
+                storage_directory(object_server.DATADIR, 'p',
+                                  hash_path('a', 'c', obj)))
+
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(time()),
+                          'Content-Type': 'application/x-test'}, 'VERIFY')
+        self.assertEquals(resp.status_int, 201)
+        self.assertFalse(os.path.exists(datadir()))
+        resp = do('GET')
+        self.assertEquals(resp.body, 'VERIFY')
+        self.assertEquals(resp.headers['Content-Type'], 'application/x-test')
+        req = Request.blank('/sda1/p/a/c/o', headers={'Range': 'bytes=1-3'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 206)
+        self.assertEquals(resp.body, 'ERI')
+        self.assertEquals(do('HEAD').content_length, 6)
+
+        sleep(.00001)
+        resp = do('POST', {'X-Timestamp': normalize_timestamp(time()),
+                           'X-Object-Meta-Test': 'Yes'})
+        self.assertEquals(resp.status_int, 202)
+        self.assertFalse(os.path.exists(datadir()))
+        self.assertEquals(do('HEAD').headers['X-Object-Meta-Test'], 'Yes')
+
+        sleep(.00001)
+        resp = do('DELETE', {'X-Timestamp': normalize_timestamp(time())})
+        self.assertEquals(resp.status_int, 204)
+        self.assertFalse(os.path.exists(datadir()))
+        self.assertEquals(do('GET').status_int, 404)
+
+        resp = do('PUT', {'X-Timestamp': normalize_timestamp(time()),
+                          'Content-Type': 'application/x-test'},
+                  'VERIFY' * 2, obj='big')
+        self.assertEquals(resp.status_int, 201)
+        self.assertEquals(len(os.listdir(datadir('big'))), 1)
+        self.assertEquals(do('GET', obj='big').body, 'VERIFY' * 2)
+
+    def test_GET_page_cache(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'page_cache_budget': '10', 'page_cache_min_hits': '2'})
+        tracker = self.object_controller.page_cache
+        tracker.logger = FakeLogger()
+        req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+                            headers={'X-Timestamp': normalize_timestamp(1),
+                                     'Content-Type': 'application/x-test'})
+        req.body = 'VERIFY'
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+
+        def dropped(headers=None):
+            req = Request.blank('/sda1/p/a/c/o', headers=headers)
+            with mock.patch('swift.obj.diskfile.drop_buffer_cache') as drop:
+                resp = req.get_response(self.object_controller)
+                self.assertEquals(resp.body, 'VERIFY')
+            return drop.called
+
+        self.assertTrue(dropped())
+        # authenticated requests never count
+        self.assertTrue(dropped({'X-Auth-Token': 'a'}))
+        self.assertFalse(dropped())
+        self.assertFalse(dropped())
+        self.assertEquals(tracker.logger.get_increment_counts(),
+                          {'page_cache.hits': 1, 'page_cache.misses': 2})
+
     def test_GET_if_match(self):
         req = Request.blank('/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
                             headers={
@@ -1991,6 +2337,115 @@ class TestObjectController(unittest.TestCase):
         finally:
             object_server.http_connect = orig_http_connect
 
+    def test_async_update_batched(self):
+        conf = {'devices': self.testdir, 'mount_check': 'false',
+                'update_batch_window': '0.01'}
+        controller = object_server.ObjectController(conf)
+        self.assertEquals(controller.container_update_batcher.window, 0.01)
+        self.assertEquals(
+            controller.container_update_batcher.max_batch_size, 1000)
+        controller.logger = controller.container_update_batcher.logger = \
+            FakeLogger()
+        requests = []
+        statuses = []
+
+        class FakeConn(object):
+
+            def __init__(self, method, path):
+                self.method = method
+                self.path = path
+
+            def send(self, data):
+                requests.append((self.method, self.path, json.loads(data)))
+
+            def getresponse(self):
+                if self.method != 'MERGE':
+                    requests.append((self.method, self.path, None))
+                self.status = statuses.pop(0)
+                return self
+
+            def read(self):
+                return ''
+
+        def fake_http_connect(ip, port, device, partition, method, path,
+                              headers):
+            return FakeConn(method, path)
+
+        def update(obj, timestamp):
+            controller.async_update(
+                'PUT', 'a', 'c', obj, '127.0.0.1:1234', 1, 'sdc1',
+                {'x-timestamp': normalize_timestamp(timestamp),
+                 'x-size': '0', 'x-content-type': 'text/plain',
+                 'x-etag': 'x', 'x-trans-id': 'tx%d' % timestamp}, 'sda1')
+
+        pickled = []
+
+        def fake_pickle(device, account, container, obj, data, timestamp):
+            pickled.append(obj)
+
+        controller._diskfile_mgr.pickle_async_update = fake_pickle
+        with mock.patch.object(object_server, 'http_connect',
+                               fake_http_connect):
+            # concurrent updates of a container are merged in one request
+            statuses[:] = [204]
+            pool = GreenPool()
+            for i in xrange(3):
+                pool.spawn(update, 'o%d' % i, i + 1)
+            pool.waitall()
+            self.assertEquals(len(requests), 1)
+            method, path, rows = requests.pop()
+            self.assertEquals((method, path), ('MERGE', '/a/c'))
+            self.assertEquals(sorted(row['name'] for row in rows),
+                              ['o0', 'o1', 'o2'])
+            self.assertEquals(pickled, [])
+            self.assertEquals(controller.logger.get_increment_counts(),
+                              {'container_update_batches': 1})
+            # the merged transactions are logged
+            debug = controller.logger.get_lines_for_level('debug')
+            self.assertEquals(len(debug), 1)
+            for trans_id in ('tx1', 'tx2', 'tx3'):
+                self.assert_(trans_id in debug[0], debug)
+
+            # a full batch is sent without waiting out the window
+            controller.container_update_batcher.window = 10
+            controller.container_update_batcher.max_batch_size = 2
+            statuses[:] = [204]
+            start = time()
+            for i in xrange(2):
+                pool.spawn(update, 'o%d' % i, i + 1)
+            pool.waitall()
+            self.assert_(time() - start < 1)
+            self.assertEquals(len(requests), 1)
+            del requests[:]
+            controller.container_update_batcher.window = 0.01
+            controller.container_update_batcher.max_batch_size = 1000
+
+            # a failed batch leaves every update as an async pending
+            statuses[:] = [503]
+            for i in xrange(2):
+                pool.spawn(update, 'o%d' % i, i + 1)
+            pool.waitall()
+            self.assertEquals(len(requests), 1)
+            self.assertEquals(sorted(pickled), ['o0', 'o1'])
+            del requests[:]
+            del pickled[:]
+
+            # a lone update, or one to a container server without MERGE,
+            # is sent on its own
+            statuses[:] = [201]
+            update('o3', 4)
+            self.assertEquals(requests, [('PUT', '/a/c/o3', None)])
+            del requests[:]
+            statuses[:] = [405, 201, 201]
+            for i in xrange(2):
+                pool.spawn(update, 'o%d' % i, i + 1)
+            pool.waitall()
+            self.assertEquals(len(requests), 3)
+            self.assertEquals(requests[0][0], 'MERGE')
+            self.assertEquals(sorted(path for _m, path, _r in requests[1:]),
+                              ['/a/c/o0', '/a/c/o1'])
+            self.assertEquals(pickled, [])
+
     def test_container_update_no_async_update(self):
         given_args = []
 
@@ -2041,6 +2496,78 @@ class TestObjectController(unittest.TestCase):
                     'referer': 'PUT http://localhost/v1/a/c/o'},
                 'sda1'])
 
+    def test_container_update_wait(self):
+        self.assertEquals(self.object_controller.container_update_wait, 3)
+        conf = {'devices': self.testdir, 'mount_check': 'false',
+                'node_timeout': '5'}
+        controller = object_server.ObjectController(conf)
+        self.assertEquals(controller.container_update_wait, 5)
+        conf = {'devices': self.testdir, 'mount_check': 'false',
+                'container_update_wait': '0.01'}
+        controller = object_server.ObjectController(conf)
+        self.assertEquals(controller.container_update_wait, 0.01)
+        controller.logger = FakeLogger()
+        finished = []
+
+        def slow_async_update(*args):
+            if args[4] == 'chost2':
+                sleep(0.05)
+            finished.append(args[4])
+
+        controller.async_update = slow_async_update
+        req = Request.blank(
+            '/v1/a/c/o',
+            environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': 1,
+                     'X-Trans-Id': '123',
+                     'X-Container-Host': 'chost1,chost2',
+                     'X-Container-Partition': 'cpartition',
+                     'X-Container-Device': 'cdevice1,cdevice2'})
+        controller.container_update(
+            'PUT', 'a', 'c', 'o', req, {
+                'x-size': '0', 'x-etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                'x-content-type': 'text/plain', 'x-timestamp': '1'},
+            'sda1')
+        # the slow update is left to finish in the background
+        self.assertEquals(finished, ['chost1'])
+        self.assertEquals(controller.logger.get_increment_counts(),
+                          {'container_update_timeouts': 1})
+        sleep(0.1)
+        self.assertEquals(finished, ['chost1', 'chost2'])
+
+    def test_container_update_wait_other_timeout(self):
+        conf = {'devices': self.testdir, 'mount_check': 'false',
+                'container_update_wait': '10'}
+        controller = object_server.ObjectController(conf)
+        controller.logger = FakeLogger()
+
+        def slow_async_update(*args):
+            sleep(0.05)
+
+        controller.async_update = slow_async_update
+        req = Request.blank(
+            '/v1/a/c/o',
+            environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': 1,
+                     'X-Trans-Id': '123',
+                     'X-Container-Host': 'chost',
+                     'X-Container-Partition': 'cpartition',
+                     'X-Container-Device': 'cdevice'})
+        # a caller's timeout is not taken for the container update wait
+        try:
+            with Timeout(0.01) as timer:
+                controller.container_update(
+                    'PUT', 'a', 'c', 'o', req, {
+                        'x-size': '0', 'x-timestamp': '1',
+                        'x-etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                        'x-content-type': 'text/plain'},
+                    'sda1')
+        except Timeout as t:
+            self.assert_(t is timer)
+        else:
+            self.fail('Timeout not raised')
+        self.assertEquals(controller.logger.get_increment_counts(), {})
+
     def test_delete_at_update_on_put(self):
         # Test how delete_at_update works when issued a delete for old
         # expiration info after a new put with no new expiration info.
@@ -2703,8 +3230,8 @@ class TestObjectController(unittest.TestCase):
         def my_tpool_execute(func, *args, **kwargs):
             return func(*args, **kwargs)
 
-        was_get_hashes = object_server.get_hashes
-        object_server.get_hashes = fake_get_hashes
+        was_get_hashes = diskfile.get_hashes
+        diskfile.get_hashes = fake_get_hashes
         was_tpool_exe = tpool.execute
         tpool.execute = my_tpool_execute
         try:
@@ -2718,7 +3245,36 @@ class TestObjectController(unittest.TestCase):
             self.assertEquals(p_data, {1: 2})
         finally:
             tpool.execute = was_tpool_exe
-            object_server.get_hashes = was_get_hashes
+            diskfile.get_hashes = was_get_hashes
+
+    def test_REPLICATE_suffix_hash_concurrency(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'suffix_hash_concurrency': '4'})
+        calls = []
+
+        def fake_get_hashes(*args, **kwargs):
+            calls.append((args, kwargs))
+            return 0, {1: 2}
+
+        with mock.patch('swift.obj.diskfile.get_hashes', fake_get_hashes):
+            req = Request.blank(
+                '/sda1/p/suff',
+                environ={'REQUEST_METHOD': 'REPLICATE'},
+                headers={})
+            resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(calls[0][1]['concurrency'], 4)
+        self.assertEquals(calls[0][1]['recalculate'], ['suff'])
+
+    def test_REPLICATE_insufficient_storage(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'true'})
+        req = Request.blank('/sda1/p/suff',
+                            environ={'REQUEST_METHOD': 'REPLICATE'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 507)
 
     def test_REPLICATE_timeout(self):
 
@@ -2728,8 +3284,8 @@ class TestObjectController(unittest.TestCase):
         def my_tpool_execute(func, *args, **kwargs):
             return func(*args, **kwargs)
 
-        was_get_hashes = object_server.get_hashes
-        object_server.get_hashes = fake_get_hashes
+        was_get_hashes = diskfile.get_hashes
+        diskfile.get_hashes = fake_get_hashes
         was_tpool_exe = tpool.execute
         tpool.execute = my_tpool_execute
         try:
@@ -2740,7 +3296,215 @@ class TestObjectController(unittest.TestCase):
             self.assertRaises(Timeout, self.object_controller.REPLICATE, req)
         finally:
             tpool.execute = was_tpool_exe
-            object_server.get_hashes = was_get_hashes
+            diskfile.get_hashes = was_get_hashes
+
+    def test_REPLICATE_sync(self):
+        timestamp = normalize_timestamp(time())
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': timestamp,
+                     'Content-Type': 'application/octet-stream'},
+            body='VERIFY')
+        self.assertEquals(req.get_response(self.object_controller).status_int,
+                          201)
+        hsh = hash_path('a', 'c', 'o')
+        newer = normalize_timestamp(float(timestamp) + 1)
+        offer = {hsh: [timestamp + '.data', newer + '.meta'],
+                 hash_path('a', 'c', 'o2'): []}
+        req = Request.blank(
+            '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Sync': 'missing'},
+            body=json.dumps(offer))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(json.loads(resp.body), {hsh: [newer + '.meta']})
+
+        metadata = {'X-Timestamp': newer, 'X-Object-Meta-Test': 'synced',
+                    'name': '/a/c/o'}
+        req = Request.blank(
+            '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Sync': 'put'},
+            body=sync.file_header(hsh, newer + '.meta', metadata, 0))
+        self.object_controller.logger = FakeLogger()
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 204)
+        self.assertEquals(
+            self.object_controller.logger.log_dict['update_stats'],
+            [(('REPLICATE.sync.files', 1), {})])
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.headers['X-Object-Meta-Test'], 'synced')
+        self.assertEquals(resp.headers['Content-Length'], '6')
+
+    def test_REPLICATE_sync_binary_metadata(self):
+        hsh = hash_path('a', 'c', 'o')
+        timestamp = normalize_timestamp(time())
+        metadata = {'X-Timestamp': timestamp, 'name': '/a/c/o',
+                    'ETag': md5('data').hexdigest(), 'Content-Length': '4',
+                    'X-Object-Meta-Bytes': '\xff\xfe not utf-8'}
+        header = sync.file_header(hsh, timestamp + '.data', metadata, 4)
+        self.assertFalse('\xff' in header)
+        req = Request.blank(
+            '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Sync': 'put'}, body=header + 'data')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 204)
+        path = os.path.join(self.testdir, 'sda1', 'objects', 'p', hsh[-3:],
+                            hsh, timestamp + '.data')
+        self.assertEquals(diskfile.read_metadata(path), metadata)
+        # metadata the compact format cannot hold goes as JSON
+        header = json.loads(sync.file_header(
+            hsh, timestamp + '.data', {'X-Timestamp': 1}, 0))
+        self.assertEquals(header['metadata'], {'X-Timestamp': 1})
+
+    def test_REPLICATE_sync_bad_requests(self):
+        for step, body in (('missing', 'not json'),
+                           ('missing', '[]'),
+                           ('missing', json.dumps({'abc': ['x.data']})),
+                           ('put', '{"name": "abc/def/1.data"}\n'),
+                           ('put', '{"metadata": {}, "length": 0}\n'),
+                           ('put', json.dumps(
+                               {'name': 'abc/%sabc/1.00000.data' % ('0' * 29),
+                                'length': 0, 'packed_metadata': 'AFNN'})),
+                           ('fetch', '')):
+            req = Request.blank(
+                '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+                headers={'X-Replication-Sync': step}, body=body)
+            resp = req.get_response(self.object_controller)
+            self.assertEquals(resp.status_int, 400, (step, body))
+        hsh = hash_path('a', 'c', 'o')
+        header = sync.file_header(hsh, normalize_timestamp(1) + '.data',
+                                  {}, 10)
+        req = Request.blank(
+            '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Sync': 'put'}, body=header + 'short')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 400)
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'true'})
+        req = Request.blank(
+            '/sda1/p', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Sync': 'missing'}, body='{}')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 507)
+
+    def test_REPLICATE_tree(self):
+        req = Request.blank(
+            '/sda1/1/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Type': 'application/octet-stream'},
+            body='VERIFY')
+        self.assertEquals(req.get_response(self.object_controller).status_int,
+                          201)
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Tree': 'partitions'},
+            body=json.dumps({'partitions': ['1', '2']}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        hashes = json.loads(resp.body)
+        self.assertEquals(sorted(hashes), ['1', '2'])
+        self.assertEquals(len(hashes['1']), 32)
+        self.assertEquals(hashes['2'], None)
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Tree': 'buckets'},
+            body=json.dumps({'partitions': ['1', '2', '3'],
+                             'bucket_size': 2}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(json.loads(resp.body), hashtree.bucket_hashes(
+            hashes, ['1', '2', '3'], 2))
+        for step, body in (('buckets', json.dumps({'partitions': ['1']})),
+                           ('leaves', json.dumps({'partitions': ['1']})),
+                           ('partitions', json.dumps({'partitions': 'p'}))):
+            req = Request.blank(
+                '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+                headers={'X-Replication-Tree': step}, body=body)
+            resp = req.get_response(self.object_controller)
+            self.assertEquals(resp.status_int, 400, (step, body))
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'true'})
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Tree': 'partitions'},
+            body=json.dumps({'partitions': ['1']}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 507)
+
+    def test_REPLICATE_tree_time_limit(self):
+        req = Request.blank(
+            '/sda1/1/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Type': 'application/octet-stream'},
+            body='VERIFY')
+        self.assertEquals(req.get_response(self.object_controller).status_int,
+                          201)
+        self.object_controller.replicate_batch_time = 0
+        body = json.dumps({'partitions': ['1', '2'], 'bucket_size': 2})
+        for step in ('partitions', 'buckets'):
+            req = Request.blank(
+                '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+                headers={'X-Replication-Tree': step}, body=body)
+            resp = req.get_response(self.object_controller)
+            self.assertEquals(resp.status_int, 200)
+            hashes = json.loads(resp.body)
+            if step == 'partitions':
+                # not rehashed in time, so never matches
+                self.assertEquals(hashes, {'1': hashtree.UNKNOWN_HASH,
+                                           '2': None})
+            else:
+                self.assertEquals(hashes, hashtree.bucket_hashes(
+                    {'1': hashtree.UNKNOWN_HASH, '2': None}, ['1', '2'],
+                    2))
+
+    def test_REPLICATE_batch(self):
+        req = Request.blank(
+            '/sda1/1/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Type': 'application/octet-stream'},
+            body='VERIFY')
+        self.assertEquals(req.get_response(self.object_controller).status_int,
+                          201)
+        suffix = hash_path('a', 'c', 'o')[-3:]
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Batch': 'hashes'},
+            body=json.dumps({'1': [suffix], '2': []}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        hashes = json.loads(resp.body)
+        self.assertEquals(sorted(hashes), ['1', '2'])
+        self.assertEquals(hashes['1'].keys(), [suffix])
+        self.assertEquals(len(hashes['1'][suffix]), 32)
+        self.assertEquals(hashes['2'], {})
+        # out of time after the first partition, the rest are left out
+        self.object_controller.replicate_batch_time = 0
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Batch': 'hashes'},
+            body=json.dumps({'1': [], '2': []}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 200)
+        self.assertEquals(len(json.loads(resp.body)), 1)
+        for step, body in (('suffixes', json.dumps({'1': []})),
+                           ('hashes', json.dumps(['1'])),
+                           ('hashes', json.dumps({'..': []})),
+                           ('hashes', json.dumps({'1': ['../x']}))):
+            req = Request.blank(
+                '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+                headers={'X-Replication-Batch': step}, body=body)
+            resp = req.get_response(self.object_controller)
+            self.assertEquals(resp.status_int, 400, (step, body))
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'true'})
+        req = Request.blank(
+            '/sda1/*', environ={'REQUEST_METHOD': 'REPLICATE'},
+            headers={'X-Replication-Batch': 'hashes'},
+            body=json.dumps({'1': []}))
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 507)
 
     def test_PUT_with_full_drive(self):
 
@@ -2879,6 +3643,131 @@ class TestObjectController(unittest.TestCase):
             response = self.object_controller.__call__(env, start_response)
             self.assertEqual(response, answer)
 
+    def test_device_load(self):
+        load = object_server.DeviceLoad(max_concurrency=2, max_latency=1,
+                                        decay=0.5)
+        self.assertEquals(load.admit('sda1'), None)
+        self.assertEquals(load.admit('sda1'), None)
+        self.assertEquals(load.admit('sda1'), 503)
+        self.assertEquals(load.admit('sdb1'), None)
+        load.done('sda1', 3)
+        self.assertEquals(load.stats('sda1')['latency'], 3)
+        # too slow, but nothing else in flight
+        load.done('sda1', 3)
+        self.assertEquals(load.admit('sda1'), None)
+        self.assertEquals(load.admit('sda1'), 507)
+        load.done('sda1', 0)
+        self.assertEquals(load.stats('sda1'), {
+            'in_flight': 0, 'latency': 1.5, 'requests': 3, 'rejected': 2})
+        load.done('sdb1', 0.5)
+        self.assertEquals(load.admit('sdb1'), None)
+        self.assertEquals(load.admit('sdb1'), None)
+
+    def test_call_device_load(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'device_max_concurrency': '2', 'device_max_latency': '1',
+             'recon_cache_path': self.testdir})
+        self.object_controller.logger = FakeLogger()
+        load = self.object_controller.device_load
+
+        def do_request(method='HEAD', path='/sda1/p/a/c/o'):
+            resp = Request.blank(path, environ={'REQUEST_METHOD': method}
+                                 ).get_response(self.object_controller)
+            # the request is finished once its body is
+            resp.body
+            return resp
+
+        self.assertEquals(do_request().status_int, 404)
+        self.assertEquals(load.stats('sda1')['requests'], 1)
+        self.assertEquals(load.stats('sda1')['in_flight'], 0)
+        load.admit('sda1')
+        load.admit('sda1')
+        self.assertEquals(do_request().status_int, 503)
+        load.done('sda1', 10)
+        self.assertEquals(do_request().status_int, 507)
+        # other devices, replication and bad paths are not affected
+        self.assertEquals(do_request(path='/sdb1/p/a/c/o').status_int, 404)
+        self.assertEquals(do_request('REPLICATE', '/sda1/p').status_int, 200)
+        self.assertEquals(do_request(path='/').status_int, 400)
+        self.assertEquals(
+            self.object_controller.logger.get_increment_counts(),
+            {'device_load_rejections': 2})
+        load.done('sda1', 0)
+        self.assertEquals(do_request().status_int, 404)
+        self.assertEquals(load.stats('sda1')['rejected'], 2)
+
+        # the load is reported to recon in the background
+        reporter = self.object_controller._device_load_reporter
+        self.assert_(reporter is not None)
+        reporter.kill()
+        rcache = os.path.join(self.testdir, 'object.recon')
+        self.assertFalse(os.path.exists(rcache))
+        # entries of workers that have exited are dropped
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(rcache, 'w') as fp:
+            json.dump({'object_server_device_load': {str(pid): {}},
+                       'async_pending': 1}, fp)
+        self.object_controller._report_device_load()
+        with open(rcache) as fp:
+            cached = json.load(fp)
+        workers = cached['object_server_device_load']
+        self.assertEquals(workers.keys(), [str(os.getpid())])
+        self.assertEquals(workers[str(os.getpid())]['devices']['sda1'],
+                          load.stats('sda1'))
+        self.assertEquals(cached['async_pending'], 1)
+
+    def test_call_device_load_counts_body(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'device_max_concurrency': '1'})
+        load = self.object_controller.device_load
+        req = Request.blank(
+            '/sda1/p/a/c/o', environ={'REQUEST_METHOD': 'PUT'},
+            headers={'X-Timestamp': normalize_timestamp(time()),
+                     'Content-Type': 'application/octet-stream'},
+            body='VERIFY')
+        resp = req.get_response(self.object_controller)
+        self.assertEquals(resp.status_int, 201)
+        resp.body
+        req = Request.blank('/sda1/p/a/c/o')
+        statuses = []
+        body = self.object_controller(
+            req.environ, lambda status, headers: statuses.append(status))
+        self.assertEquals(statuses, ['200 OK'])
+        # a slow GET body is still in flight on the device
+        sleep(0.05)
+        self.assertEquals(load.stats('sda1')['in_flight'], 1)
+        head = Request.blank('/sda1/p/a/c/o',
+                             environ={'REQUEST_METHOD': 'HEAD'})
+        self.assertEquals(
+            head.get_response(self.object_controller).status_int, 503)
+        self.assertEquals(''.join(body), 'VERIFY')
+        self.assertEquals(load.stats('sda1')['in_flight'], 0)
+        self.assertEquals(load.stats('sda1')['requests'], 2)
+        # as is one abandoned before it is read
+        body = self.object_controller(
+            req.environ, lambda status, headers: None)
+        self.assertEquals(load.stats('sda1')['in_flight'], 1)
+        body.close()
+        body.close()
+        self.assertEquals(load.stats('sda1')['in_flight'], 0)
+
+    def test_call_device_load_not_reported_without_limits(self):
+        self.object_controller = object_server.ObjectController(
+            {'devices': self.testdir, 'mount_check': 'false',
+             'recon_cache_path': self.testdir, 'device_load_interval': '0'})
+        req = Request.blank('/sda1/p/a/c/o',
+                            environ={'REQUEST_METHOD': 'HEAD'})
+        self.assertEquals(req.get_response(self.object_controller).status_int,
+                          404)
+        self.assertEquals(self.object_controller._device_load_reporter, None)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.testdir, 'object.recon')))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import cPickle as pickle
+import errno
 import os
 import unittest
 from contextlib import closing
@@ -22,11 +23,16 @@ from shutil import rmtree
 from time import time
 from distutils.dir_util import mkpath
 
-from eventlet import spawn, Timeout, listen
+import mock
+import simplejson
+from eventlet import sleep, spawn, Timeout, listen
 
 from swift.obj import updater as object_updater, server as object_server
 from swift.obj.server import ASYNCDIR
+from swift.obj.journal import AsyncPendingJournal, JOURNAL_DIR, read_segment
+from swift.common.exceptions import LockTimeout
 from swift.common.ring import RingData
+from swift.common.swob import HeaderKeyDict
 from swift.common import utils
 from swift.common.utils import hash_path, normalize_timestamp, mkdirs, \
     write_pickle
@@ -94,14 +100,16 @@ class TestObjectUpdater(unittest.TestCase):
                                       normalize_timestamp(t))
                 if t == timestamps[0]:
                     expected.add(o_path)
-                write_pickle({}, o_path)
+                write_pickle({'account': 'account', 'container': 'container',
+                              'obj': o}, o_path)
 
         seen = set()
 
         class MockObjectUpdater(object_updater.ObjectUpdater):
-            def process_object_update(self, update_path, device):
-                seen.add(update_path)
-                os.unlink(update_path)
+            def process_object_updates(self, updates, device):
+                for update, update_path in updates:
+                    seen.add(update_path)
+                    os.unlink(update_path)
 
         cu = MockObjectUpdater({
             'devices': self.devices_dir,
@@ -114,6 +122,268 @@ class TestObjectUpdater(unittest.TestCase):
         self.assert_(not os.path.exists(prefix_dir))
         self.assertEqual(expected, seen)
 
+    def test_object_sweep_concurrency(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'slowdown': '0',
+            'update_concurrency': '3',
+            'update_window': '4'})
+        self.assertEquals(cu.update_concurrency, 3)
+        self.assertEquals(cu.update_window, 4)
+        prefix_dir = os.path.join(self.sda1, ASYNCDIR, 'abc')
+        mkdirs(prefix_dir)
+        for i in xrange(10):
+            container = 'c%d' % (i % 3)
+            o_path = os.path.join(prefix_dir, '%s-%s' % (
+                hash_path('a', container, 'o%d' % i), normalize_timestamp(i)))
+            write_pickle({'op': 'PUT', 'account': 'a', 'container': container,
+                          'obj': 'o%d' % i, 'headers': {}}, o_path)
+        running = set()
+        max_running = [0]
+        sent = []
+
+        def fake_send(updates):
+            container = updates[0][0]['container']
+            # updates of one container are never sent at once
+            self.assert_(container not in running)
+            running.add(container)
+            max_running[0] = max(max_running[0], len(running))
+            sleep(0.01)
+            running.remove(container)
+            for update, update_path in updates:
+                self.assertEquals(update['container'], container)
+                sent.append(update['obj'])
+            return [(True, False)] * len(updates)
+
+        cu.send_object_updates = fake_send
+        cu.object_sweep(self.sda1)
+        self.assertEquals(sorted(sent), sorted('o%d' % i for i in xrange(10)))
+        self.assertEquals(max_running[0], 3)
+        self.assertFalse(os.path.exists(prefix_dir))
+
+    def test_rate_limit(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'slowdown': '0.5'})
+        slept = []
+        with mock.patch.object(object_updater, 'sleep', slept.append):
+            with mock.patch('time.time', return_value=100.0):
+                for i in xrange(3):
+                    cu._rate_limit()
+        # updates are spread out however many wait for a slot at once
+        self.assertEquals(slept, [0.5, 1.0])
+
+    def test_journal_sweep(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'interval': '1',
+            'concurrency': '1',
+            'node_timeout': '5'})
+        cu.logger = FakeLogger()
+        # nothing journaled yet
+        cu.journal_sweep(self.sda1)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sda1, JOURNAL_DIR)))
+
+        def update(obj, timestamp):
+            return {'op': 'PUT', 'account': 'a', 'container': 'c',
+                    'obj': obj,
+                    'headers': {'x-timestamp': normalize_timestamp(timestamp)}}
+
+        journal = AsyncPendingJournal(self.sda1)
+        for u in (update('o1', 1), update('o1', 3), update('o1', 2),
+                  update('o2', 1)):
+            journal.append(u)
+        sent = []
+
+        def fake_send(updates):
+            results = []
+            for update, segment in updates:
+                sent.append(update)
+                if update['obj'] == 'o2':
+                    update['successes'] = [0]
+                    results.append((False, True))
+                else:
+                    results.append((True, False))
+            return results
+
+        cu.send_object_updates = fake_send
+        cu.journal_sweep(self.sda1)
+        self.assertEquals(sorted((u['obj'], u['headers']['x-timestamp'])
+                                 for u in sent),
+                          [('o1', normalize_timestamp(3)),
+                           ('o2', normalize_timestamp(1))])
+        self.assertEquals(cu.logger.get_increment_counts(), {'unlinks': 2})
+        # the failed update is left in a new segment
+        segments = journal.segments()
+        self.assertEquals(len(segments), 1)
+        self.assertEquals(read_segment(segments[0])[0],
+                          [dict(update('o2', 1), successes=[0])])
+
+        # a corrupt segment is quarantined
+        with open(segments[0], 'ab') as fp:
+            fp.write('torn')
+        del sent[:]
+        cu.logger = FakeLogger()
+        cu.journal_sweep(self.sda1)
+        self.assertEquals(len(sent), 1)
+        self.assertEquals(cu.logger.get_increment_counts(),
+                          {'quarantines': 1})
+        self.assert_(os.path.exists(os.path.join(
+            self.sda1, 'quarantined', 'objects',
+            os.path.basename(segments[0]))))
+        self.assertEquals(len(journal.segments()), 1)
+
+    def test_journal_sweep_requeue_failures(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir})
+        cu.logger = FakeLogger()
+        update = {'op': 'PUT', 'account': 'a', 'container': 'c', 'obj': 'o',
+                  'headers': {'x-timestamp': normalize_timestamp(1)}}
+        journal = AsyncPendingJournal(self.sda1)
+        journal.append(update)
+        segment = journal.segments()[0]
+
+        # an update that cannot be journaled again goes to async_pending
+        cu.send_object_updates = lambda updates: [(False, False)]
+        with mock.patch.object(AsyncPendingJournal, 'append',
+                               side_effect=LockTimeout(None, 'lock')):
+            cu.journal_sweep(self.sda1)
+        self.assertFalse(os.path.exists(segment))
+        ohash = hash_path('a', 'c', 'o')
+        async_path = os.path.join(
+            self.sda1, ASYNCDIR, ohash[-3:],
+            ohash + '-' + normalize_timestamp(1))
+        self.assertEquals(pickle.load(open(async_path, 'rb')), update)
+        os.unlink(async_path)
+
+        # and if it cannot be saved anywhere the segment is kept
+        journal.append(update)
+        segments = journal.segments()
+        with mock.patch.object(AsyncPendingJournal, 'append',
+                               side_effect=OSError(errno.ENOSPC, 'full')):
+            with mock.patch.object(object_updater, 'write_pickle',
+                                   side_effect=OSError(errno.ENOSPC,
+                                                       'full')):
+                cu.journal_sweep(self.sda1)
+        self.assertEquals(journal.segments()[:len(segments)], segments)
+        self.assertEquals(cu.logger.get_increment_counts(),
+                          {'journal_segments_kept': 1})
+
+        # as it is when sending the updates fails
+        def broken_send(updates):
+            raise Exception('boom')
+
+        cu.send_object_updates = broken_send
+        cu.journal_sweep(self.sda1)
+        self.assertEquals(journal.segments()[:len(segments)], segments)
+        self.assertEquals(read_segment(segments[0])[0], [update])
+
+    def test_send_object_updates(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir,
+            'slowdown': '0'})
+        cu.logger = FakeLogger()
+
+        def update(obj, successes=None):
+            update = {'op': 'PUT', 'account': 'a', 'container': 'c',
+                      'obj': obj, 'headers': {}}
+            if successes is not None:
+                update['successes'] = successes
+            return update, obj
+
+        merged = []
+        sent = []
+        merge_statuses = {0: 204, 1: 500}
+
+        def fake_merge(node, part, account, container, updates):
+            merged.append((node['id'], [u['obj'] for u in updates]))
+            return merge_statuses[node['id']]
+
+        def fake_update(node, part, op, obj, headers):
+            sent.append((node['id'], obj))
+            return 201
+
+        cu.object_merge = fake_merge
+        cu.object_update = fake_update
+        updates = [update('o1'), update('o2', [1]), update('o3', [0])]
+        self.assertEquals(cu.send_object_updates(updates),
+                          [(False, True), (True, True), (False, False)])
+        # each replica missing several updates gets them all at once
+        self.assertEquals(merged, [(0, ['o1', 'o2']), (1, ['o1', 'o3'])])
+        self.assertEquals(sent, [])
+        self.assertEquals(updates[0][0]['successes'], [0])
+        self.assertEquals(cu.logger.get_increment_counts(),
+                          {'successes': 1, 'failures': 2})
+
+        # replicas that don't support MERGE get the updates one by one
+        del merged[:]
+        merge_statuses = {0: 405, 1: 405}
+        self.assertEquals(cu.send_object_updates(updates[:1]),
+                          [(True, True)])
+        self.assertEquals(merged, [])
+        self.assertEquals(sent, [(1, '/a/c/o1')])
+        del sent[:]
+        updates = [update('o4'), update('o5')]
+        self.assertEquals(cu.send_object_updates(updates),
+                          [(True, True), (True, True)])
+        self.assertEquals(merged, [(0, ['o4', 'o5']), (1, ['o4', 'o5'])])
+        self.assertEquals(sent, [(0, '/a/c/o4'), (0, '/a/c/o5'),
+                                 (1, '/a/c/o4'), (1, '/a/c/o5')])
+
+    def test_object_merge(self):
+        cu = object_updater.ObjectUpdater({
+            'devices': self.devices_dir,
+            'mount_check': 'false',
+            'swift_dir': self.testdir})
+        bindsock = listen(('127.0.0.1', 0))
+
+        def accept():
+            with Timeout(3):
+                sock, addr = bindsock.accept()
+                inc = sock.makefile('rb')
+                out = sock.makefile('wb')
+                request_line = inc.readline()
+                headers = {}
+                line = inc.readline()
+                while line and line != '\r\n':
+                    headers[line.split(':')[0].lower()] = \
+                        line.split(':')[1].strip()
+                    line = inc.readline()
+                body = inc.read(int(headers['content-length']))
+                out.write('HTTP/1.1 204 No Content\r\n'
+                          'Content-Length: 0\r\n\r\n')
+                out.flush()
+                return request_line, headers, body
+
+        event = spawn(accept)
+        node = {'ip': '127.0.0.1', 'port': bindsock.getsockname()[1],
+                'device': 'sda1'}
+        updates = [
+            {'op': 'PUT', 'account': 'a', 'container': 'c', 'obj': 'o1',
+             'headers': HeaderKeyDict({
+                 'x-timestamp': normalize_timestamp(1), 'x-size': '3',
+                 'x-content-type': 'text/plain', 'x-etag': 'etag'})},
+            {'op': 'DELETE', 'account': 'a', 'container': 'c', 'obj': 'o2',
+             'headers': {'x-timestamp': normalize_timestamp(2)}}]
+        self.assertEquals(cu.object_merge(node, 0, 'a', 'c', updates), 204)
+        request_line, headers, body = event.wait()
+        self.assertEquals(request_line, 'MERGE /sda1/0/a/c HTTP/1.1\r\n')
+        self.assertEquals(headers['x-timestamp'], normalize_timestamp(2))
+        self.assertEquals(simplejson.loads(body), [
+            {'name': 'o1', 'created_at': normalize_timestamp(1),
+             'size': '3', 'content_type': 'text/plain', 'etag': 'etag'},
+            {'name': 'o2', 'created_at': normalize_timestamp(2),
+             'deleted': 1}])
+
     def test_run_once(self):
         cu = object_updater.ObjectUpdater({
             'devices': self.devices_dir,
@@ -0,0 +1,254 @@
+# Copyright (c) 2010-2013 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for swift.obj.volume"""
+
+from __future__ import with_statement
+import mock
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from swift.common.utils import normalize_timestamp
+from swift.obj import volume
+
+
+HASH1 = 'f' * 29 + 'abc'
+HASH2 = 'e' * 29 + 'abc'
+HASH3 = 'd' * 29 + '123'
+
+
+class TestPartitionVolume(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = mkdtemp()
+        self.partition_dir = os.path.join(self.testdir, 'objects', '0')
+        os.makedirs(self.partition_dir)
+        self.volume = volume.PartitionVolume(self.partition_dir)
+
+    def tearDown(self):
+        rmtree(self.testdir, ignore_errors=1)
+
+    def test_empty(self):
+        self.assertEquals(self.volume.lookup(HASH1), {})
+        self.assertEquals(self.volume.suffixes(), [])
+        self.assertEquals(self.volume.suffix_hashes('abc'), set())
+        self.assertFalse(os.path.exists(self.volume.volume_dir))
+
+    def test_append_and_open(self):
+        ts = normalize_timestamp(1)
+        self.volume.append(HASH1, ts, '.data', {'X-Timestamp': ts}, 'hello')
+        entries = self.volume.lookup(HASH1)
+        self.assertEquals(entries.keys(), ['.data'])
+        entry = entries['.data']
+        self.assertEquals(entry.filename, ts + '.data')
+        self.assertEquals(entry.data_length, 5)
+        self.assertEquals(self.volume.read_metadata(entry),
+                          {'X-Timestamp': ts})
+        metadata, fp = self.volume.open(entry)
+        self.assertEquals(metadata, {'X-Timestamp': ts})
+        self.assertEquals(fp.read(2), 'he')
+        self.assertEquals(fp.tell(), 2)
+        self.assertEquals(fp.read(), 'llo')
+        self.assertEquals(fp.read(), '')
+        fp.seek(1)
+        self.assertEquals(fp.read(10), 'ello')
+        fp.close()
+
+    def test_newest_record_wins(self):
+        ts1, ts2, ts3 = [normalize_timestamp(t) for t in (1, 2, 3)]
+        self.volume.append(HASH1, ts2, '.data', {'X-Timestamp': ts2}, 'two')
+        self.volume.append(HASH1, ts1, '.data', {'X-Timestamp': ts1}, 'one')
+        self.volume.append(HASH1, ts3, '.meta', {'X-Timestamp': ts3})
+        self.volume.append(HASH2, ts1, '.ts', {'X-Timestamp': ts1})
+        self.volume.append(HASH3, ts1, '.data', {'X-Timestamp': ts1}, '')
+        entries = self.volume.lookup(HASH1)
+        self.assertEquals(entries['.data'].timestamp, ts2)
+        self.assertEquals(entries['.meta'].timestamp, ts3)
+        self.assertEquals(self.volume.lookup(HASH2).keys(), ['.ts'])
+        self.assertEquals(sorted(self.volume.suffixes()), ['123', 'abc'])
+        self.assertEquals(self.volume.suffix_hashes('abc'),
+                          set([HASH1, HASH2]))
+
+    def test_other_instances_see_appends(self):
+        ts = normalize_timestamp(1)
+        other = volume.PartitionVolume(self.partition_dir)
+        self.assertEquals(other.lookup(HASH1), {})
+        self.volume.append(HASH1, ts, '.data', {'X-Timestamp': ts}, 'x')
+        self.assertEquals(other.lookup(HASH1).keys(), ['.data'])
+        self.volume.append(HASH2, ts, '.data', {'X-Timestamp': ts}, 'y')
+        self.assertEquals(other.lookup(HASH2).keys(), ['.data'])
+
+    def test_recreated_volume_is_reloaded(self):
+        ts = normalize_timestamp(1)
+        self.volume.append(HASH1, ts, '.data', {'X-Timestamp': ts}, 'x')
+        self.assertEquals(self.volume.lookup(HASH1).keys(), ['.data'])
+        other = volume.PartitionVolume(self.partition_dir)
+        rmtree(self.volume.volume_dir)
+        self.assertEquals(self.volume.lookup(HASH1), {})
+        other.append(HASH2, ts, '.data', {'X-Timestamp': ts}, 'y')
+        other.append(HASH3, ts, '.data', {'X-Timestamp': ts}, 'z')
+        self.assertEquals(self.volume.lookup(HASH1), {})
+        self.assertEquals(self.volume.lookup(HASH2).keys(), ['.data'])
+
+    def test_torn_index_entry(self):
+        ts = normalize_timestamp(1)
+        self.volume.append(HASH1, ts, '.data', {'X-Timestamp': ts}, 'x')
+        with open(self.volume.index_path, 'ab') as fp:
+            fp.write('torn')
+        other = volume.PartitionVolume(self.partition_dir)
+        self.assertEquals(other.lookup(HASH1).keys(), ['.data'])
+        self.volume.append(HASH2, ts, '.data', {'X-Timestamp': ts}, 'y')
+        self.assertEquals(
+            os.path.getsize(self.volume.index_path) %
+            volume._INDEX_ENTRY.size, 0)
+        self.assertEquals(other.lookup(HASH2).keys(), ['.data'])
+        metadata, fp = other.open(other.lookup(HASH2)['.data'])
+        self.assertEquals(fp.read(), 'y')
+        fp.close()
+
+    def test_quarantine(self):
+        ts1, ts2 = normalize_timestamp(1), normalize_timestamp(2)
+        self.volume.append(HASH1, ts1, '.data', {'X-Timestamp': ts1}, 'x')
+        self.volume.append(HASH2, ts1, '.data', {'X-Timestamp': ts1}, 'y')
+        self.volume.quarantine(HASH1)
+        self.assertEquals(self.volume.lookup(HASH1), {})
+        self.assertEquals(self.volume.suffix_hashes('abc'), set([HASH2]))
+        self.volume.append(HASH1, ts2, '.data', {'X-Timestamp': ts2}, 'z')
+        self.assertEquals(self.volume.lookup(HASH1)['.data'].timestamp, ts2)
+        other = volume.PartitionVolume(self.partition_dir)
+        self.assertEquals(other.lookup(HASH1)['.data'].timestamp, ts2)
+
+    def test_compact(self):
+        ts1, ts2 = normalize_timestamp(1), normalize_timestamp(2)
+        self.volume.append(HASH1, ts1, '.data', {'X-Timestamp': ts1}, 'old')
+        self.volume.append(HASH1, ts2, '.data', {'X-Timestamp': ts2}, 'new')
+        self.volume.append(HASH2, ts1, '.data', {'X-Timestamp': ts1}, 'two')
+        self.volume.append(HASH2, ts2, '.ts', {'X-Timestamp': ts2})
+        stale = self.volume.lookup(HASH1)['.data']
+        size = os.path.getsize(self.volume.data_path)
+
+        def live(hsh, entries):
+            return [entries['.data']] if hsh == HASH1 else []
+
+        # not enough to reclaim yet
+        self.assertEquals(self.volume.compact(live, min_dead_ratio=0.9), 0)
+        self.assertEquals(os.path.getsize(self.volume.data_path), size)
+        reclaimed = self.volume.compact(live)
+        self.assertEquals(
+            reclaimed, size - os.path.getsize(self.volume.data_path))
+        self.assert_(reclaimed > 0)
+        self.assertEquals(self.volume.lookup(HASH2), {})
+        self.assertEquals(self.volume.suffix_hashes('abc'), set([HASH1]))
+        # entries from before the compaction are looked up again
+        for vol in (self.volume, volume.PartitionVolume(self.partition_dir)):
+            metadata, fp = vol.open(stale)
+            self.assertEquals(fp.read(), 'new')
+            fp.close()
+        self.assertEquals(self.volume.read_metadata(stale),
+                          {'X-Timestamp': ts2})
+        # and appends go on after the kept records
+        self.volume.append(HASH3, ts1, '.data', {'X-Timestamp': ts1}, 'x')
+        other = volume.PartitionVolume(self.partition_dir)
+        metadata, fp = other.open(other.lookup(HASH3)['.data'])
+        self.assertEquals(fp.read(), 'x')
+        fp.close()
+        self.assertEquals(other.lookup(HASH1)['.data'].timestamp, ts2)
+
+    def test_compact_interrupted_before_switch(self):
+        ts1, ts2 = normalize_timestamp(1), normalize_timestamp(2)
+        self.volume.append(HASH1, ts1, '.data', {'X-Timestamp': ts1}, 'old')
+        self.volume.append(HASH1, ts2, '.data', {'X-Timestamp': ts2}, 'new')
+        data_path = self.volume.data_path
+
+        def live(hsh, entries):
+            return [entries['.data']]
+
+        with mock.patch.object(volume.os, 'rename',
+                               side_effect=OSError('crash')):
+            self.assertRaises(OSError, self.volume.compact, live)
+        # the old generation is still the current one, and whole
+        self.assertEquals(self.volume.data_path, data_path)
+        other = volume.PartitionVolume(self.partition_dir)
+        metadata, fp = other.open(other.lookup(HASH1)['.data'])
+        self.assertEquals(fp.read(), 'new')
+        fp.close()
+        # the next compaction gets rid of whatever was left behind
+        self.assert_(self.volume.compact(live) > 0)
+        self.assertEquals(sorted(os.listdir(self.volume.volume_dir)),
+                          ['.lock', 'volume.1.dat', 'volume.1.idx',
+                           'volume.gen'])
+
+    def test_compact_interrupted_after_switch(self):
+        ts1, ts2 = normalize_timestamp(1), normalize_timestamp(2)
+        self.volume.append(HASH1, ts1, '.data', {'X-Timestamp': ts1}, 'old')
+        self.volume.append(HASH1, ts2, '.data', {'X-Timestamp': ts2}, 'new')
+
+        def live(hsh, entries):
+            return [entries['.data']]
+
+        synced = []
+        with mock.patch.object(volume, 'fsync_dir', synced.append):
+            with mock.patch.object(volume.os, 'unlink',
+                                   side_effect=OSError('crash')):
+                self.assertRaises(OSError, self.volume.compact, live)
+        # the switch was made durable before anything was removed
+        self.assertEquals(synced, [self.volume.volume_dir])
+        other = volume.PartitionVolume(self.partition_dir)
+        self.assertEquals(other.data_path,
+                          os.path.join(self.volume.volume_dir,
+                                       'volume.1.dat'))
+        metadata, fp = other.open(other.lookup(HASH1)['.data'])
+        self.assertEquals(fp.read(), 'new')
+        fp.close()
+        other.append(HASH2, ts1, '.data', {'X-Timestamp': ts1}, 'two')
+        self.assertEquals(self.volume.lookup(HASH2).keys(), ['.data'])
+        # the old generation is left over until the next compaction
+        old_data_path = os.path.join(self.volume.volume_dir, 'volume.0.dat')
+        self.assert_(os.path.exists(old_data_path))
+        self.assertEquals(self.volume.compact(live), 0)
+        self.assertFalse(os.path.exists(old_data_path))
+
+    def test_compact_nothing_live(self):
+        ts = normalize_timestamp(1)
+        self.volume.append(HASH1, ts, '.ts', {'X-Timestamp': ts})
+        entry = self.volume.lookup(HASH1)['.ts']
+        self.assert_(self.volume.compact(lambda hsh, entries: []) > 0)
+        self.assertFalse(os.path.exists(self.volume.data_path))
+        self.assertFalse(os.path.exists(self.volume.index_path))
+        self.assertEquals(self.volume.suffixes(), [])
+        self.assertRaises(IOError, self.volume.open, entry)
+        self.assertEquals(self.volume.compact(lambda hsh, entries: []), 0)
+
+    def test_get_volume(self):
+        vol = volume.get_volume(self.partition_dir)
+        self.assert_(vol is volume.get_volume(self.partition_dir))
+        self.assertEquals(vol.partition_dir, self.partition_dir)
+
+    def test_find_volume(self):
+        other_dir = os.path.join(self.testdir, 'objects', '1')
+        self.assertEquals(volume.find_volume(other_dir), None)
+        self.assertFalse(other_dir in volume._volumes)
+        ts = normalize_timestamp(1)
+        volume.PartitionVolume(other_dir).append(
+            HASH1, ts, '.data', {'X-Timestamp': ts}, 'x')
+        vol = volume.find_volume(other_dir)
+        self.assert_(vol is volume.get_volume(other_dir))
+        self.assertEquals(vol.suffixes(), ['abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()